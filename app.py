@@ -5,6 +5,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
+from utils.database import RoutingSession
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -12,32 +13,69 @@ logging.basicConfig(level=logging.DEBUG)
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 login_manager = LoginManager()
 
 # Create the app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET") or os.urandom(32).hex()
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+# Client addresses (rate limits, audit logs) come from X-Forwarded-For only when
+# TRUSTED_PROXY_COUNT proxies in front of the app set it; otherwise it is spoofable
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get("TRUSTED_PROXY_COUNT", "0")), x_proto=1, x_host=1)
 
 # Initialize Flask-Login
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+# Configure the database (psycopg 3 when psycopg2 is not installed)
+from utils.concurrency import database_url, get_pool_settings
+app.config["SQLALCHEMY_DATABASE_URI"] = database_url(os.environ.get("DATABASE_URL"))
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+# Pool sizing (DB_POOL_SIZE etc.); gevent workers run many requests per process
+app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(get_pool_settings())
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+# Optional read replica for reports and dashboards
+if os.environ.get("REPLICA_DATABASE_URL"):
+    app.config["SQLALCHEMY_BINDS"] = {"replica": database_url(os.environ["REPLICA_DATABASE_URL"])}
 app.config["WTF_CSRF_ENABLED"] = True
 app.config["WTF_CSRF_TIME_LIMIT"] = None
 
 # Initialize the app with the extension
 db.init_app(app)
 
+# Server-side sessions (SESSION_BACKEND)
+from utils.sessions import init_sessions
+init_sessions(app)
+
+# Hashed, precompressed static bundles
+from utils.assets import init_assets
+init_assets(app)
+
+# gzip/brotli compression of dynamic responses (COMPRESS_*)
+from utils.compression import init_compression
+init_compression(app)
+
+# orjson-backed JSON responses (falls back to the stdlib provider)
+from utils.serializers import init_json_provider
+init_json_provider(app)
+
+# Jinja bytecode cache, cached public pages and dashboard fragments
+from utils.page_cache import init_page_cache, cached_page
+init_page_cache(app)
+
+# Token-bucket rate limits (RATELIMIT_*), checked before any other hook
+from utils.ratelimit import init_rate_limits
+init_rate_limits(app)
+
+# Idempotency-Key replay for retried sale and payment POSTs
+from utils.idempotency import init_idempotency
+init_idempotency()
+
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
@@ -46,6 +84,8 @@ def load_user(user_id):
 with app.app_context():
     # Import models and routes
     import models  # noqa: F401
+    from utils.inventory import init_inventory_counters
+    init_inventory_counters()
     from routes import auth, super_admin, shop_admin, cashier, mpesa
     
     # Register blueprints
@@ -70,32 +110,70 @@ with app.app_context():
     
     # Static pages routes
     @app.route('/home')
+    @cached_page()
     def homepage():
         from flask import render_template
         return render_template('homepage.html')
     
     @app.route('/about')
+    @cached_page()
     def about():
         from flask import render_template
         return render_template('about.html')
     
     @app.route('/privacy')
+    @cached_page()
     def privacy():
         from flask import render_template
         return render_template('privacy.html')
     
     @app.route('/terms')
+    @cached_page()
     def terms():
         from flask import render_template
         return render_template('terms.html')
     
     @app.route('/screenshots')
+    @cached_page()
     def screenshots():
         from flask import render_template
         return render_template('screenshots.html')
     
-    # Create all tables
-    db.create_all()
+    # Service worker for the offline till; served from the root so it can
+    # control /cashier/, and never cached so new asset builds are picked up
+    @app.route('/sw.js')
+    def service_worker():
+        import hashlib
+        from flask import render_template, url_for
+        asset_urls = app.jinja_env.globals['asset_urls']
+        shell = [url_for('cashier.pos')]
+        for bundle in ('css/app.css', 'js/base.js', 'js/pos.js'):
+            shell.extend(asset_urls(bundle))
+        version = hashlib.sha256('\n'.join(shell).encode('utf-8')).hexdigest()[:12]
+        response = app.response_class(render_template('sw.js', shell=shell, version=version),
+                                      mimetype='application/javascript')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    # Create all tables and add any new model columns
+    db.create_all(bind_key=None)
+    from utils.database import upgrade_schema
+    upgrade_schema()
+    
+    # Make sure this month's (and upcoming) partitions exist
+    from utils.partitioning import ensure_future_partitions
+    try:
+        ensure_future_partitions()
+    except Exception as e:
+        logging.error(f"Failed to create partitions: {e}")
+    
+    # Register management commands
+    from commands import register_commands
+    register_commands(app)
+    
+    # Sweep license expiries in the background of each worker process
+    from utils.licenses import ensure_license_sweeper
+    app.before_request(lambda: ensure_license_sweeper(app))
     
     # Create default super admin if none exists
     from models import User, Shop, Product, Category
@@ -0,0 +1,42 @@
+"""
+Benchmarks
+Standalone scripts timing the hot paths the performance work targets. Run
+them from the repository root, e.g. `python -m benchmarks.pricing`. Each one
+uses a scratch SQLite database unless BENCH_DATABASE_URL is set, and checks
+that the optimised path returns the same result as the one it replaced.
+"""
+
+import logging
+import os
+import tempfile
+import time
+
+
+def setup_app():
+    """Import the app against the benchmark database; returns (app, db)"""
+    # Never the configured DATABASE_URL: benchmarks write thousands of rows
+    os.environ['DATABASE_URL'] = (os.environ.get('BENCH_DATABASE_URL')
+                                  or f"sqlite:///{tempfile.mkdtemp(prefix='comolor-bench-')}/bench.db")
+    os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+    logging.disable(logging.INFO)
+
+    from app import app, db
+    return app, db
+
+
+def best_of(fn, repeat=5):
+    """Fastest of `repeat` runs of fn, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(label, seconds, count=None, unit='item'):
+    """Print a timing, with the per-item cost when count is given"""
+    line = f"{label:<48} {seconds * 1000:10.2f} ms"
+    if count:
+        line += f"  ({seconds / count * 1e6:,.1f} µs/{unit})"
+    print(line)
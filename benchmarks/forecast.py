@@ -0,0 +1,131 @@
+"""
+Demand forecast: every SKU of a shop over two years of daily sales.
+
+Times forecast_inventory end to end (aggregate query plus NumPy) and the
+vectorised computation alone, against a per-product Python loop computing
+the same exponentially smoothed demand over the same query result.
+
+    python -m benchmarks.forecast [--skus 50000] [--days 730] [--density 0.02]
+
+density is the share of (product, day) pairs with a sale line, so the
+defaults write about 730k sale lines.
+"""
+
+import argparse
+import math
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+
+from benchmarks import best_of, report, setup_app
+
+SALES_PER_DAY = 200
+CHUNK = 50000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--skus', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--density', type=float, default=0.02)
+    return parser.parse_args()
+
+
+def loop_forecast(product_ids, daily, days, smoothing):
+    """Per-product EMA demand, one Python loop per product over its daily series"""
+    demand = {}
+    for product_id in product_ids:
+        series = daily.get(product_id, {})
+        level = weight = 0.0
+        factor = 1.0
+        for offset in range(days - 1, -1, -1):
+            level += series.get(offset, 0) * factor
+            weight += factor
+            factor *= 1 - smoothing
+        demand[product_id] = level / weight
+    return demand
+
+
+def main():
+    args = parse_args()
+    app, db = setup_app()
+    from sqlalchemy import insert, select
+    from models import Product, Sale, SaleItem, Shop, User
+    from utils import forecasting
+
+    rng = np.random.default_rng(7)
+    today = datetime.utcnow().date()
+    end = datetime(today.year, today.month, today.day)
+    start = end - timedelta(days=args.days)
+
+    with app.app_context():
+        shop = Shop(name='Forecast Benchmark', owner_name='Bench', email='bench@example.com',
+                    phone='+254700000000', till_number='BENCH002', is_active=True)
+        db.session.add(shop)
+        db.session.flush()
+        shop_id = shop.id
+        cashier_id = db.session.execute(select(User.id).where(User.role == 'cashier')).scalar()
+
+        created = start - timedelta(days=1)
+        for first in range(0, args.skus, CHUNK):
+            db.session.execute(insert(Product), [{
+                'shop_id': shop_id, 'name': f'SKU {i}', 'sku': f'SKU{i:06d}', 'price': 100, 'cost_price': 70,
+                'stock_quantity': int(rng.integers(0, 200)), 'is_active': True, 'created_at': created,
+            } for i in range(first, min(first + CHUNK, args.skus))])
+        product_ids = np.array(db.session.execute(
+            select(Product.id).where(Product.shop_id == shop_id).order_by(Product.id)
+        ).scalars().all())
+
+        sale_ids = []
+        for first in range(0, args.days * SALES_PER_DAY, CHUNK):
+            sale_ids.extend(db.session.execute(insert(Sale).returning(Sale.id), [{
+                'receipt_number': f'FB{shop_id}-{n}', 'shop_id': shop_id, 'cashier_id': cashier_id,
+                'subtotal': 0, 'total_amount': 0, 'payment_method': 'cash', 'status': 'completed',
+                'created_at': start + timedelta(days=n // SALES_PER_DAY, minutes=n % SALES_PER_DAY * 5),
+            } for n in range(first, min(first + CHUNK, args.days * SALES_PER_DAY))]).scalars())
+        sale_ids = np.array(sorted(sale_ids))
+
+        lines = int(args.skus * args.days * args.density)
+        line_products = rng.integers(0, args.skus, lines)
+        line_days = rng.integers(0, args.days, lines)
+        line_sales = line_days * SALES_PER_DAY + rng.integers(0, SALES_PER_DAY, lines)
+        quantities = rng.integers(1, 6, lines)
+        for first in range(0, lines, CHUNK):
+            db.session.execute(insert(SaleItem), [{
+                'sale_id': int(sale_ids[s]), 'product_id': int(product_ids[p]), 'quantity': int(q),
+                'unit_price': 100, 'line_total': int(q) * 100,
+                'created_at': start + timedelta(days=int(d)),
+            } for p, d, s, q in zip(line_products[first:first + CHUNK], line_days[first:first + CHUNK],
+                                    line_sales[first:first + CHUNK], quantities[first:first + CHUNK])])
+        db.session.commit()
+        print(f'{args.skus:,} SKUs, {args.days} days, {lines:,} sale lines')
+
+        def run():
+            return forecasting.forecast_inventory(shop_id, method='ema', history_days=args.days, today=today)
+
+        result = run()
+        report('forecast_inventory, end to end', best_of(run, 3), args.skus, 'SKU')
+
+        sold = forecasting.load_daily_demand(shop_id, start, end)
+        report('  aggregate query (load_daily_demand)',
+               best_of(lambda: forecasting.load_daily_demand(shop_id, start, end), 3))
+        with mock.patch.object(forecasting, 'load_daily_demand', lambda *a: sold):
+            report('  products query and NumPy', best_of(run, 3), args.skus, 'SKU')
+
+        daily = {}
+        for product_id, offset, quantity in zip(*sold):
+            daily.setdefault(int(product_id), {})[int(offset)] = float(quantity)
+        smoothing = forecasting.get_forecast_settings()['smoothing']
+        all_ids = product_ids.tolist()
+        looped = {}
+        report('per-product Python loop (demand only)',
+               best_of(lambda: looped.update(loop_forecast(all_ids, daily, args.days, smoothing)), 1),
+               args.skus, 'SKU')
+
+        vectorised = {p['product_id']: p['daily_demand'] for p in result['products']}
+        assert all(math.isclose(vectorised[pid], looped[pid], abs_tol=0.006) for pid in all_ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Basket pricing: 100-line baskets against 1,000 active promotions.
+
+Compares the compiled PromotionIndex (rules looked up by product and
+category) with scanning every promotion for every line, and times the
+per-request index check in get_promotion_index.
+"""
+
+import random
+from types import SimpleNamespace
+
+from benchmarks import best_of, report, setup_app
+
+PRODUCTS = 5000
+CATEGORIES = 50
+PROMOTIONS = 1000
+BASKETS = 200
+LINES = 100
+KINDS = ('multi_buy', 'category_percent', 'bundle', 'time_of_day')
+
+
+def make_promotions(rng):
+    promotions = []
+    for i in range(PROMOTIONS):
+        kind = KINDS[i % len(KINDS)]
+        promotion = SimpleNamespace(id=i + 1, name=f'Promo {i}', promo_type=kind, starts_at=None, ends_at=None,
+                                    product_id=None, category_id=None, rules={})
+        if kind == 'multi_buy':
+            promotion.product_id = rng.randint(1, PRODUCTS)
+            promotion.rules = {'quantity': 3, 'pay_quantity': 2}
+        elif kind == 'category_percent':
+            promotion.category_id = rng.randint(1, CATEGORIES)
+            promotion.rules = {'percent': str(rng.randint(1, 30))}
+        elif kind == 'bundle':
+            promotion.rules = {'product_ids': rng.sample(range(1, PRODUCTS + 1), 2),
+                               'price_cents': rng.randint(100, 5000)}
+        else:
+            promotion.category_id = rng.randint(1, CATEGORIES)
+            promotion.rules = {'percent': '5', 'start': '00:00', 'end': '24:00'}
+        promotions.append(promotion)
+    return promotions
+
+
+def main():
+    app, db = setup_app()
+    from sqlalchemy import insert, select
+    from models import Category, Product, Promotion, Shop
+    from utils.pricing import CompiledRule, PromotionIndex, get_promotion_index, price_basket
+
+    class ScanIndex(PromotionIndex):
+        """Every promotion checked against every line, as an unindexed engine would"""
+
+        def __init__(self, promotions):
+            super().__init__(promotions)
+            self.entries = [(CompiledRule(p), p.product_id, p.category_id)
+                            for p in promotions if p.promo_type != 'bundle']
+
+        def line_rules(self, product_id, category_id):
+            return [rule for rule, rule_product, rule_category in self.entries
+                    if rule_product == product_id
+                    or (not rule_product and rule_category == category_id)
+                    or (not rule_product and not rule_category and rule.kind == 'time_of_day')]
+
+    rng = random.Random(1)
+    products = {pid: SimpleNamespace(price=f'{rng.randint(10, 5000)}.{rng.randint(0, 99):02d}',
+                                     category_id=rng.randint(1, CATEGORIES)) for pid in range(1, PRODUCTS + 1)}
+    promotions = make_promotions(rng)
+    shop = SimpleNamespace(id=0, settings={'tax_rate': 16, 'enable_discounts': True})
+    baskets = [[(pid, rng.randint(1, 6)) for pid in rng.sample(range(1, PRODUCTS + 1), LINES)]
+               for _ in range(BASKETS)]
+
+    report(f'compile {PROMOTIONS} promotions', best_of(lambda: PromotionIndex(promotions)))
+    index = PromotionIndex(promotions)
+    scan = ScanIndex(promotions)
+
+    indexed = [price_basket(shop, basket, products, index=index) for basket in baskets]
+    scanned = [price_basket(shop, basket, products, index=scan) for basket in baskets]
+    assert [b['total_cents'] for b in indexed] == [b['total_cents'] for b in scanned]
+    discounted = sum(1 for basket in indexed for line in basket['lines'] if line['discount_cents'])
+
+    def price_all(idx):
+        return lambda: [price_basket(shop, basket, products, index=idx) for basket in baskets]
+
+    print(f'{BASKETS} baskets of {LINES} lines, {discounted} discounted lines')
+    report('price baskets, indexed rules', best_of(price_all(index)), BASKETS, 'basket')
+    report('price baskets, scanning every promotion', best_of(price_all(scan), repeat=2), BASKETS, 'basket')
+
+    with app.app_context():
+        # The same promotions stored for a shop with real products and categories
+        shop_row = Shop(name='Pricing Benchmark', owner_name='Bench', email='bench@example.com',
+                        phone='+254700000000', till_number='BENCH001', is_active=True)
+        db.session.add(shop_row)
+        db.session.flush()
+        db.session.execute(insert(Category), [{'name': f'Category {c}', 'shop_id': shop_row.id}
+                                              for c in range(1, CATEGORIES + 1)])
+        db.session.execute(insert(Product), [{'name': f'Product {pid}', 'price': product.price, 'shop_id': shop_row.id,
+                                              'stock_quantity': 100, 'is_active': True}
+                                             for pid, product in products.items()])
+        category_ids = db.session.execute(select(Category.id).where(Category.shop_id == shop_row.id)
+                                          .order_by(Category.id)).scalars().all()
+        product_ids = db.session.execute(select(Product.id).where(Product.shop_id == shop_row.id)
+                                         .order_by(Product.id)).scalars().all()
+        db.session.add_all([Promotion(shop_id=shop_row.id, name=p.name, promo_type=p.promo_type,
+                                      product_id=p.product_id and product_ids[p.product_id - 1],
+                                      category_id=p.category_id and category_ids[p.category_id - 1],
+                                      rules=p.rules, is_active=True) for p in promotions])
+        db.session.commit()
+        report('load and compile from the database (cold)', best_of(lambda: get_promotion_index(shop_row.id), 1))
+        report('unchanged-index check per request (warm)', best_of(lambda: get_promotion_index(shop_row.id), 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+JSON serialization: a 10,000-product catalogue payload.
+
+Compares loading ORM entities, building dicts by hand and encoding with
+Flask's stdlib provider (as the product views used to) with the compiled
+PRODUCT_LOOKUP schema over a column-only SELECT, encoded by the orjson
+provider. Also times the till's catalogue endpoint end to end, and its
+ETag revalidation.
+
+    python -m benchmarks.serialization [--products 10000]
+"""
+
+import argparse
+import json
+
+from benchmarks import best_of, report, setup_app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=10000)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    app, db = setup_app()
+    from datetime import datetime, timedelta
+    from flask.json.provider import DefaultJSONProvider
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from models import Product, Shop, User
+    from schemas import PRODUCT_LOOKUP
+
+    with app.app_context():
+        shop = Shop(name='Serialization Benchmark', owner_name='Bench', email='bench@example.com',
+                    phone='+254700000000', till_number='BENCH004', is_active=True,
+                    license_expires=datetime.utcnow() + timedelta(days=30))
+        db.session.add(shop)
+        db.session.flush()
+        shop_id = shop.id
+        db.session.add(User(username=f'bench{shop_id}', email=f'bench{shop_id}@example.com', role='cashier',
+                            password_hash=generate_password_hash('bench123'), shop_id=shop_id, user_active=True))
+        db.session.execute(insert(Product), [{
+            'shop_id': shop_id, 'name': f'Product {i:05d}', 'price': f'{10 + i % 500}.{i % 100:02d}',
+            'barcode': f'6{i:012d}', 'sku': f'SKU{i:06d}', 'stock_quantity': i % 40, 'is_active': True,
+        } for i in range(args.products)])
+        db.session.commit()
+
+        stdlib = DefaultJSONProvider(app)
+        query = PRODUCT_LOOKUP.select().where(Product.shop_id == shop_id)
+
+        def as_dicts(products):
+            return [{'id': p.id, 'name': p.name, 'price': float(p.price), 'barcode': p.barcode,
+                     'stock_quantity': p.stock_quantity} for p in products]
+
+        def entities():
+            db.session.expunge_all()
+            return Product.query.filter_by(shop_id=shop_id).all()
+
+        def before():
+            return stdlib.dumps(as_dicts(entities()))
+
+        def after():
+            return app.json.dumps(PRODUCT_LOOKUP.dump_all(db.session.execute(query)))
+
+        assert json.loads(before()) == json.loads(after())
+        print(f'{args.products:,} products, {len(after().encode()) / 1024:,.0f} KiB of JSON '
+              f'({type(app.json).__name__})')
+
+        report('ORM entities, dicts, stdlib json', best_of(before), args.products, 'product')
+        report('schema SELECT, compiled dump, orjson', best_of(after), args.products, 'product')
+
+        products = entities()
+        rows = db.session.execute(query).all()
+        report('  encode only: dicts, stdlib json', best_of(lambda: stdlib.dumps(as_dicts(products))),
+               args.products, 'product')
+        report('  encode only: compiled dump, orjson', best_of(lambda: app.json.dumps(PRODUCT_LOOKUP.dump_all(rows))),
+               args.products, 'product')
+
+    client = app.test_client()
+    client.post('/auth/login', data={'username': f'bench{shop_id}', 'password': 'bench123'})
+    response = client.get('/cashier/api/products/catalogue')
+    assert response.status_code == 200 and len(response.get_json()) == args.products
+    etag = response.headers['ETag']
+
+    report('GET /cashier/api/products/catalogue',
+           best_of(lambda: client.get('/cashier/api/products/catalogue')), args.products, 'product')
+    report('  revalidated with If-None-Match (304)',
+           best_of(lambda: client.get('/cashier/api/products/catalogue', headers={'If-None-Match': etag})))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Payment streams: concurrent open connections per gunicorn worker.
+
+Starts one gunicorn worker per worker class, opens --streams server-sent
+event streams of a pending M-Pesa sale against it, and counts how many are
+being served after --wait seconds, then times product searches made while
+those streams are still open.
+
+    python -m benchmarks.streams [--streams 200] [--wait 8] [--classes sync gevent]
+
+Needs gunicorn, and gevent for the cooperative worker.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import threading
+import time
+
+import requests
+
+from benchmarks import report, setup_app
+
+PORT = 8765
+BASE = f'http://127.0.0.1:{PORT}'
+SEARCHES = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--wait', type=float, default=8)
+    parser.add_argument('--classes', nargs='+', default=['sync', 'gevent'])
+    return parser.parse_args()
+
+
+def seed(app, db):
+    """A shop with a cashier, a product and a pending M-Pesa sale; returns (username, sale_id)"""
+    from datetime import datetime, timedelta
+    from werkzeug.security import generate_password_hash
+    from models import Product, Sale, Shop, User
+
+    with app.app_context():
+        shop = Shop(name='Streams Benchmark', owner_name='Bench', email='bench@example.com',
+                    phone='+254700000000', till_number='BENCH003', is_active=True,
+                    license_expires=datetime.utcnow() + timedelta(days=30))
+        db.session.add(shop)
+        db.session.flush()
+        cashier = User(username=f'bench{shop.id}', email=f'bench{shop.id}@example.com', role='cashier',
+                       password_hash=generate_password_hash('bench123'), shop_id=shop.id, user_active=True)
+        db.session.add(cashier)
+        db.session.add(Product(shop_id=shop.id, name='Milk 500ml', price=60, stock_quantity=100, is_active=True))
+        db.session.flush()
+        sale = Sale(receipt_number=f'BENCH{shop.id}-1', shop_id=shop.id, cashier_id=cashier.id, subtotal=60,
+                    total_amount=60, payment_method='mpesa', status='pending')
+        db.session.add(sale)
+        db.session.commit()
+        return cashier.username, sale.id
+
+
+def start_server(worker_class, streams):
+    env = dict(os.environ, PORT=str(PORT), GUNICORN_WORKER_CLASS=worker_class, WEB_CONCURRENCY='1',
+               GUNICORN_WORKER_CONNECTIONS=str(streams + 100), MPESA_STREAM_INTERVAL='2',
+               MPESA_STREAM_TIMEOUT='60')
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'main:app'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get(f'{BASE}/mpesa/health', timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.3)
+    server.terminate()
+    raise RuntimeError(f'gunicorn ({worker_class}) did not start')
+
+
+def open_stream(sale_id, cookie, opened, lock, sockets):
+    """Count the stream once its first status event arrives"""
+    try:
+        conn = socket.create_connection(('127.0.0.1', PORT), timeout=60)
+        sockets.append(conn)
+        conn.sendall(f'GET /mpesa/payment/stream/{sale_id} HTTP/1.1\r\nHost: bench\r\n'
+                     f'Cookie: {cookie}\r\n\r\n'.encode())
+        data = b''
+        while b'event: status' not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return
+            data += chunk
+        with lock:
+            opened.append(time.monotonic())
+    except OSError:
+        pass
+
+
+def run(worker_class, args, username, sale_id):
+    server = start_server(worker_class, args.streams)
+    sockets = []
+    try:
+        client = requests.Session()
+        client.post(f'{BASE}/auth/login', data={'username': username, 'password': 'bench123'},
+                    allow_redirects=False)
+        cookie = '; '.join(f'{name}={value}' for name, value in client.cookies.items())
+
+        opened = []
+        lock = threading.Lock()
+        for _ in range(args.streams):
+            threading.Thread(target=open_stream, args=(sale_id, cookie, opened, lock, sockets),
+                             daemon=True).start()
+        time.sleep(args.wait)
+
+        latencies = []
+        for _ in range(SEARCHES):
+            start = time.perf_counter()
+            try:
+                client.get(f'{BASE}/cashier/api/products/search?q=mi', timeout=5).raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except requests.RequestException:
+                pass
+
+        print(f'{worker_class}: {len(opened)}/{args.streams} streams open after {args.wait:g} s')
+        if latencies:
+            report(f'  product search with the streams open ({len(latencies)}/{SEARCHES})',
+                   statistics.median(latencies))
+        else:
+            print(f'  product search with the streams open: all {SEARCHES} timed out')
+    finally:
+        for conn in sockets:
+            conn.close()
+        server.terminate()
+        server.wait()
+
+
+def main():
+    args = parse_args()
+    app, db = setup_app()
+    username, sale_id = seed(app, db)
+    for worker_class in args.classes:
+        run(worker_class, args, username, sale_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Management Commands
+Flask CLI commands for scheduled maintenance jobs (run from cron or a worker)
+"""
+
+import click
+from flask.cli import AppGroup
+
+partitions_cli = AppGroup('partitions', help='Manage monthly table partitions.')
+assets_cli = AppGroup('assets', help='Build static asset bundles.')
+rollups_cli = AppGroup('rollups', help='Maintain daily sales rollups.')
+stock_cli = AppGroup('stock', help='Stock snapshots and ledger checks.')
+analytics_cli = AppGroup('analytics', help='Platform-wide sales analytics.')
+licenses_cli = AppGroup('licenses', help='Shop license expiry.')
+idempotency_cli = AppGroup('idempotency', help='Idempotency keys of retried till requests.')
+shifts_cli = AppGroup('shifts', help='Cashier shifts and their running totals.')
+mpesa_cli = AppGroup('mpesa', help='M-Pesa statement reconciliation.')
+customers_cli = AppGroup('customers', help='Customer directory and loyalty points.')
+
+
+@partitions_cli.command('convert')
+@click.argument('tables', nargs=-1)
+def convert_partitions(tables):
+    """Convert tables to monthly partitions (one-off, needs a maintenance window)"""
+    from utils.partitioning import PARTITIONED_TABLES, convert_to_partitioned
+
+    for table in tables or PARTITIONED_TABLES:
+        if table not in PARTITIONED_TABLES:
+            raise click.BadParameter(f"{table} is not a partitioned table")
+        converted = convert_to_partitioned(table)
+        click.echo(f"{table}: {'converted' if converted else 'skipped'}")
+
+
+@partitions_cli.command('maintain')
+def maintain_partitions_command():
+    """Create upcoming partitions and archive partitions past retention"""
+    from utils.partitioning import maintain_partitions
+
+    created, archived = maintain_partitions()
+    click.echo(f"Created {len(created)} partitions, archived {len(archived)}")
+    for path in archived:
+        click.echo(f"  {path}")
+
+
+@assets_cli.command('build')
+def build_assets_command():
+    """Bundle, minify, hash and precompress static assets"""
+    from flask import current_app
+    from utils.assets import build_assets
+
+    manifest = build_assets(current_app.static_folder)
+    for bundle, hashed_name in sorted(manifest.items()):
+        click.echo(f"{bundle} -> {hashed_name}")
+
+
+@rollups_cli.command('rebuild')
+@click.option('--shop-id', type=int, default=None, help='Only rebuild this shop.')
+def rebuild_rollups_command(shop_id):
+    """Recompute daily sales rollups from sales and refunds"""
+    from utils.sales import rebuild_daily_sales
+
+    count = rebuild_daily_sales(shop_id)
+    click.echo(f"Rebuilt {count} daily rollups")
+
+
+@stock_cli.command('snapshot')
+@click.option('--date', 'day', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Day to snapshot (default: yesterday).')
+@click.option('--shop-id', type=int, default=None, help='Only snapshot this shop.')
+def snapshot_stock_command(day, shop_id):
+    """Record end-of-day stock checkpoints"""
+    from utils.stock_history import take_daily_snapshots
+
+    count = take_daily_snapshots(day.date() if day else None, shop_id)
+    click.echo(f"Recorded {count} stock snapshots")
+
+
+@stock_cli.command('check-drift')
+@click.option('--shop-id', type=int, default=None, help='Only check this shop.')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+@click.option('--fix', is_flag=True, help='Write adjustment movements for any drift found.')
+def check_drift_command(shop_id, batch_size, fix):
+    """Verify the stock movement ledger against product stock levels"""
+    from utils.stock_history import check_stock_drift
+
+    drifted = check_stock_drift(shop_id, batch_size, fix)
+    for item in drifted:
+        click.echo(f"  {item['product_id']} {item['name']}: stock {item['stock_quantity']}, "
+                   f"ledger {item['ledger_quantity']} ({item['difference']:+d})")
+    click.echo(f"{len(drifted)} products drifted{' (corrected)' if fix and drifted else ''}")
+
+
+@stock_cli.command('counters')
+@click.option('--shop-id', type=int, default=None, help='Only reconcile this shop.')
+def reconcile_counters_command(shop_id):
+    """Recount per-shop inventory counters and repair any drift"""
+    from utils.inventory import reconcile_inventory_counters
+
+    drifted = reconcile_inventory_counters(shop_id)
+    for current_id, old, new in drifted:
+        changed = ', '.join(f"{name} {old[name]} -> {new[name]}" for name in new if old[name] != new[name])
+        click.echo(f"  shop {current_id}: {changed}")
+    click.echo(f"{len(drifted)} shops drifted (corrected)")
+
+
+@analytics_cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def export_analytics_command(path):
+    """Write per-shop daily aggregates to a Parquet file (requires pyarrow)"""
+    from utils.analytics import export_parquet
+
+    try:
+        with open(path, 'wb') as output:
+            rows = export_parquet(output)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Exported {rows} shop-days to {path}")
+
+
+@licenses_cli.command('sweep')
+def sweep_licenses_command():
+    """Expire lapsed licenses and refresh the expiring-soon list"""
+    from utils.licenses import get_expiring_licenses, sweep_licenses
+
+    expired = sweep_licenses()
+    click.echo(f"Expired {len(expired)} licenses, {len(get_expiring_licenses())} expiring soon")
+
+
+@idempotency_cli.command('purge')
+def purge_idempotency_keys_command():
+    """Delete expired idempotency keys"""
+    from utils.idempotency import purge_expired_keys
+
+    click.echo(f"Purged {purge_expired_keys()} expired idempotency keys")
+
+
+@shifts_cli.command('rebuild')
+@click.option('--shift-id', type=int, default=None, help='Only rebuild this shift.')
+def rebuild_shifts_command(shift_id):
+    """Recompute shift totals from their sales and refunds"""
+    from utils.shifts import rebuild_shift_totals
+
+    count = rebuild_shift_totals(shift_id)
+    click.echo(f"Rebuilt totals for {count} shifts")
+
+
+@mpesa_cli.command('reconcile')
+@click.argument('statements', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--till', default=None, help='Till number for statements without a till column.')
+@click.option('--window-minutes', type=int, default=None, help='Time window for matching payments to sales.')
+@click.option('--report', type=click.File('w'), default=None, help='Write the exceptions report (CSV) here.')
+@click.option('--dry-run', is_flag=True, help='Match and report without writing anything.')
+def reconcile_mpesa_command(statements, till, window_minutes, report, dry_run):
+    """Reconcile Safaricom statement exports (CSV) against recorded payments and unpaid M-Pesa sales"""
+    from utils.reconciliation import Reconciliation
+
+    reconciliation = Reconciliation(window_minutes=window_minutes, dry_run=dry_run)
+    try:
+        for path in statements:
+            reconciliation.load(path, till_number=till)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    summary = reconciliation.run()
+    if report is not None:
+        reconciliation.write_exceptions(report)
+
+    click.echo(f"{summary['credits']} credits in {summary['statement_lines']} statement lines: "
+               f"{summary['matched']} matched by receipt, {summary['recorded']} missing callbacks "
+               f"{'found' if dry_run else 'recorded'}, {summary['settled']} sales "
+               f"{'to settle' if dry_run else 'settled'}")
+    for kind, count in sorted(summary['exceptions'].items()):
+        click.echo(f"  {kind}: {count}")
+
+
+@customers_cli.command('backfill')
+@click.option('--award-points', is_flag=True, help='Also earn points on the past sales linked.')
+def backfill_customers_command(award_points):
+    """Build the customer directory from recorded M-Pesa payers and past sales"""
+    from utils.customers import backfill_customers
+
+    payments, linked = backfill_customers(award_points=award_points)
+    click.echo(f"Read {payments} payments, linked {linked} sales to customers")
+
+
+@customers_cli.command('rebuild')
+@click.option('--shop-id', type=int, default=None, help='Only rebuild this shop\'s customers.')
+def rebuild_customers_command(shop_id):
+    """Recompute customer purchase totals and points balances"""
+    from utils.customers import rebuild_customer_totals
+
+    count = rebuild_customer_totals(shop_id)
+    click.echo(f"Rebuilt totals for {count} customers")
+
+
+def register_commands(app):
+    """Register management commands on the Flask app"""
+    app.cli.add_command(partitions_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(stock_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(licenses_cli)
+    app.cli.add_command(idempotency_cli)
+    app.cli.add_command(shifts_cli)
+    app.cli.add_command(mpesa_cli)
+    app.cli.add_command(customers_cli)
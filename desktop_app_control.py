@@ -36,7 +36,7 @@ class DesktopManager:
         if not shop.is_active:
             return False, "Shop is inactive"
             
-        if not shop.is_license_active():
+        if not shop.is_license_active:
             return False, "License expired - please renew"
             
         # Verify installation key
@@ -194,7 +194,7 @@ def desktop_heartbeat():
         commands = get_pending_commands(shop_id)
         
         # Check license status
-        license_status = 'active' if shop.is_license_active() else 'expired'
+        license_status = 'active' if shop.is_license_active else 'expired'
         
         return jsonify({
             'status': 'success',
@@ -249,7 +249,7 @@ def check_desktop_license(shop_id):
     try:
         shop = Shop.query.get_or_404(shop_id)
         
-        license_active = shop.is_license_active()
+        license_active = shop.is_license_active
         days_remaining = 0
         
         if shop.license_expires:
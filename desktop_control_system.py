@@ -26,7 +26,7 @@ class DesktopControlAPI:
         if not shop or not shop.is_active:
             return False, "Shop not active"
             
-        if not shop.is_license_active():
+        if not shop.is_license_active:
             return False, "License expired"
             
         # Verify installation key
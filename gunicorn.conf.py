@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration
+GUNICORN_WORKER_CLASS=gevent runs cooperative workers that keep many slow
+connections (payment streams, M-Pesa calls, large exports) open per process
+"""
+
+import os
+from utils.concurrency import get_worker_settings
+
+settings = get_worker_settings()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = settings['worker_class']
+workers = settings['workers']
+worker_connections = settings['worker_connections']
+timeout = settings['timeout']
+max_requests = settings['max_requests']
+max_requests_jitter = max_requests // 10
+
+# Cooperative workers monkey-patch the stdlib after forking, so the app must be
+# imported in the worker: locks and sockets created at import time would
+# otherwise block the whole worker
+preload_app = not settings['cooperative']
+
+
+def post_fork(server, worker):
+    if settings['cooperative']:
+        from utils.concurrency import patch_psycopg
+        patch_psycopg()
@@ -15,6 +15,7 @@ class User(db.Model, UserMixin):
     user_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    settings = db.Column(db.JSON, default={})  # Cashier preferences
     
     # Relationships
     shop = db.relationship('Shop', backref='users')
@@ -23,6 +24,7 @@ class User(db.Model, UserMixin):
 
 class Shop(db.Model):
     __tablename__ = 'shops'
+    __table_args__ = (db.Index('ix_shops_license_status_expires', 'license_status', 'license_expires'),)
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -32,6 +34,7 @@ class Shop(db.Model):
     address = db.Column(db.Text)
     till_number = db.Column(db.String(20), unique=True)
     license_expires = db.Column(db.DateTime)
+    license_status = db.Column(db.String(20), default='active')  # active, expired (set by the license sweep)
     is_active = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     settings = db.Column(db.JSON, default={})
@@ -42,8 +45,9 @@ class Shop(db.Model):
     categories = db.relationship('Category', backref='shop', cascade='all, delete-orphan')
     license_payments = db.relationship('LicensePayment', backref='shop')
     
+    @property
     def is_license_active(self):
-        return self.license_expires and self.license_expires > datetime.utcnow()
+        return bool(self.license_expires and self.license_expires > datetime.utcnow())
 
 class Category(db.Model):
     __tablename__ = 'categories'
@@ -82,8 +86,32 @@ class Product(db.Model):
     def is_low_stock(self):
         return self.stock_quantity <= self.low_stock_threshold
 
+# Pricing rules compiled by utils.pricing; `rules` holds the type-specific parameters
+class Promotion(db.Model):
+    __tablename__ = 'promotions'
+    __table_args__ = (db.Index('ix_promotions_shop_id_updated_at', 'shop_id', 'updated_at'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    promo_type = db.Column(db.String(20), nullable=False)  # multi_buy, category_percent, bundle, time_of_day
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
+    rules = db.Column(db.JSON, default={})
+    starts_at = db.Column(db.DateTime)
+    ends_at = db.Column(db.DateTime)
+    is_active = db.Column(db.Boolean, default=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationships
+    product = db.relationship('Product')
+    category = db.relationship('Category')
+
 class Sale(db.Model):
     __tablename__ = 'sales'
+    __table_args__ = (db.Index('ix_sales_customer_id_created_at', 'customer_id', 'created_at'),)
     
     id = db.Column(db.Integer, primary_key=True)
     receipt_number = db.Column(db.String(50), unique=True, nullable=False)
@@ -97,8 +125,11 @@ class Sale(db.Model):
     mpesa_receipt = db.Column(db.String(100))
     customer_phone = db.Column(db.String(15))
     customer_name = db.Column(db.String(100))
-    status = db.Column(db.String(20), default='completed')  # completed, refunded, void
+    status = db.Column(db.String(20), default='completed')  # completed, partially_refunded, refunded, void
     refund_reason = db.Column(db.Text)
+    client_uuid = db.Column(db.String(36), index=True)  # set by tills for sales recorded offline
+    shift_id = db.Column(db.Integer, index=True)  # cashier's shift the sale was added to, if one was open
+    customer_id = db.Column(db.Integer)  # payer's customer record, once the M-Pesa payment is matched
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -113,13 +144,64 @@ class SaleItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     unit_price = db.Column(db.Numeric(10, 2), nullable=False)
     line_total = db.Column(db.Numeric(10, 2), nullable=False)
+    discount_amount = db.Column(db.Numeric(10, 2), default=0)  # promotion discount within line_total
+    refunded_quantity = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)  # copy of sale.created_at, used as partition key
+
+# Next unallocated receipt number per shop; numbers are handed out in leased blocks
+class ReceiptSequence(db.Model):
+    __tablename__ = 'receipt_sequences'
+    
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), primary_key=True)
+    next_value = db.Column(db.BigInteger, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ReceiptBlock(db.Model):
+    __tablename__ = 'receipt_blocks'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False, index=True)
+    holder = db.Column(db.String(100), nullable=False)  # worker:<host>:<pid> or till:<till id>
+    start_value = db.Column(db.BigInteger, nullable=False)
+    end_value = db.Column(db.BigInteger, nullable=False)  # inclusive
+    leased_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# sales and sale_items may be partitioned, so refunds reference them without foreign keys
+class Refund(db.Model):
+    __tablename__ = 'refunds'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    sale_id = db.Column(db.Integer, nullable=False, index=True)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    reason = db.Column(db.Text, nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    shift_id = db.Column(db.Integer, index=True)  # shift whose drawer paid the refund, if one was open
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    sale = db.relationship('Sale', primaryjoin='foreign(Refund.sale_id) == Sale.id', backref='refunds')
+    items = db.relationship('RefundItem', backref='refund', cascade='all, delete-orphan')
+    created_by_user = db.relationship('User', foreign_keys=[created_by])
+
+class RefundItem(db.Model):
+    __tablename__ = 'refund_items'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    refund_id = db.Column(db.Integer, db.ForeignKey('refunds.id'), nullable=False, index=True)
+    sale_item_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
 
 class StockMovement(db.Model):
     __tablename__ = 'stock_movements'
+    __table_args__ = (db.Index('ix_stock_movements_product_id_created_at', 'product_id', 'created_at'),)
     
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
-    movement_type = db.Column(db.String(20), nullable=False)  # in, out, adjustment
+    movement_type = db.Column(db.String(20), nullable=False)  # in, out, adjustment (signed quantity)
     quantity = db.Column(db.Integer, nullable=False)
     reference = db.Column(db.String(100))  # sale_id, purchase_order, etc.
     notes = db.Column(db.Text)
@@ -129,6 +211,126 @@ class StockMovement(db.Model):
     # Relationships
     created_by_user = db.relationship('User', foreign_keys=[created_by])
 
+# End-of-day stock checkpoints over the stock movement ledger
+class StockSnapshot(db.Model):
+    __tablename__ = 'stock_snapshots'
+    __table_args__ = (db.UniqueConstraint('shop_id', 'date', 'product_id', name='uq_stock_snapshots_shop_date_product'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)  # stock at the end of this (UTC) day
+    quantity = db.Column(db.Integer, nullable=False)
+    cost_price = db.Column(db.Numeric(10, 2), default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Per-shop daily totals, updated in the same transaction as each sale and refund
+class ShopDailySales(db.Model):
+    __tablename__ = 'shop_daily_sales'
+    __table_args__ = (db.UniqueConstraint('shop_id', 'date', name='uq_shop_daily_sales_shop_date'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    items_sold = db.Column(db.Integer, nullable=False, default=0)
+    gross_sales = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    tax_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    refunds_count = db.Column(db.Integer, nullable=False, default=0)
+    refund_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    cash_sales = db.Column(db.Numeric(12, 2), default=0)
+    mpesa_sales = db.Column(db.Numeric(12, 2), default=0)
+    mpesa_count = db.Column(db.Integer, default=0)
+    active_tills = db.Column(db.Integer, default=0)  # distinct cashiers with a sale that day
+    
+    @property
+    def net_sales(self):
+        return (self.gross_sales or 0) - (self.refund_amount or 0)
+
+# Cashiers who made a sale on a day; a new row bumps ShopDailySales.active_tills
+class ShopDailyTill(db.Model):
+    __tablename__ = 'shop_daily_tills'
+    
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    cashier_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+
+# Per-shop inventory counters, updated in the same transaction as every product change
+class ShopInventory(db.Model):
+    __tablename__ = 'shop_inventory'
+
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), primary_key=True)
+    total_products = db.Column(db.Integer, nullable=False, default=0)
+    active_products = db.Column(db.Integer, nullable=False, default=0)
+    low_stock = db.Column(db.Integer, nullable=False, default=0)  # active, at or below threshold
+    out_of_stock = db.Column(db.Integer, nullable=False, default=0)  # active, at or below zero
+    cost_value = db.Column(db.Numeric(14, 2), nullable=False, default=0)  # active stock at cost
+    retail_value = db.Column(db.Numeric(14, 2), nullable=False, default=0)  # active stock at price
+    reconciled_at = db.Column(db.DateTime)
+
+# A cashier's till session; sale and refund totals are added as they happen,
+# so closing a shift and its Z-report read this row alone
+class Shift(db.Model):
+    __tablename__ = 'shifts'
+    __table_args__ = (
+        # At most one open shift per cashier and shop
+        db.Index('uq_shifts_open_cashier', 'shop_id', 'cashier_id', unique=True,
+                 postgresql_where=db.text('closed_at IS NULL'), sqlite_where=db.text('closed_at IS NULL')),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    cashier_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    opened_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    closed_at = db.Column(db.DateTime)
+    closed_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    opening_float = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    counted_cash = db.Column(db.Numeric(12, 2))  # cash in the drawer at close
+    notes = db.Column(db.Text)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    items_sold = db.Column(db.Integer, nullable=False, default=0)
+    gross_sales = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    discount_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    tax_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    cash_sales = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    mpesa_sales = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    mpesa_count = db.Column(db.Integer, nullable=False, default=0)
+    refunds_count = db.Column(db.Integer, nullable=False, default=0)
+    cash_refunds = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    mpesa_refunds = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    cashier = db.relationship('User', foreign_keys=[cashier_id])
+
+    @property
+    def expected_cash(self):
+        return (self.opening_float or 0) + (self.cash_sales or 0) - (self.cash_refunds or 0)
+
+    @property
+    def cash_variance(self):
+        if self.counted_cash is None:
+            return None
+        return self.counted_cash - self.expected_cash
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    shop_id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)  # client's Idempotency-Key header
+    fingerprint = db.Column(db.String(32), nullable=False)  # method, path and body digest
+    status_code = db.Column(db.Integer)  # NULL while the first request is in flight
+    content_type = db.Column(db.String(100))
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class KeyValueEntry(db.Model):
+    __tablename__ = 'kv_entries'
+
+    namespace = db.Column(db.String(50), primary_key=True)  # e.g. session
+    key = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, index=True)  # NULL never expires
+
 class MpesaTransaction(db.Model):
     __tablename__ = 'mpesa_transactions'
     
@@ -137,11 +339,11 @@ class MpesaTransaction(db.Model):
     transaction_id = db.Column(db.String(100), unique=True, nullable=False)
     bill_ref_number = db.Column(db.String(100))
     amount = db.Column(db.Numeric(10, 2), nullable=False)
-    msisdn = db.Column(db.String(15), nullable=False)
+    msisdn = db.Column(db.String(15), nullable=False, index=True)
     first_name = db.Column(db.String(100))
     middle_name = db.Column(db.String(100))
     last_name = db.Column(db.String(100))
-    transaction_time = db.Column(db.DateTime, nullable=False)
+    transaction_time = db.Column(db.DateTime, nullable=False, index=True)
     shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'))
     sale_id = db.Column(db.Integer, db.ForeignKey('sales.id'))
     is_processed = db.Column(db.Boolean, default=False)
@@ -150,6 +352,42 @@ class MpesaTransaction(db.Model):
     # Relationships
     sale = db.relationship('Sale', backref='mpesa_transaction')
 
+class Customer(db.Model):
+    __tablename__ = 'customers'
+    __table_args__ = (db.UniqueConstraint('shop_id', 'msisdn', name='uq_customers_shop_msisdn'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    msisdn = db.Column(db.String(15), nullable=False)  # normalised, 2547XXXXXXXX
+    name = db.Column(db.String(100))
+    first_seen_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_seen_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    purchases_count = db.Column(db.Integer, nullable=False, default=0)
+    total_spent = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # net of refunds
+    last_purchase_at = db.Column(db.DateTime)
+    points_balance = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LoyaltyEntry(db.Model):
+    __tablename__ = 'loyalty_ledger'
+    __table_args__ = (
+        db.Index('ix_loyalty_ledger_customer_id_id', 'customer_id', 'id'),
+        # Points are earned once per sale
+        db.Index('uq_loyalty_ledger_earn_sale', 'sale_id', unique=True,
+                 postgresql_where=db.text("entry_type = 'earn'"), sqlite_where=db.text("entry_type = 'earn'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    entry_type = db.Column(db.String(20), nullable=False)  # earn, reverse, redeem, adjust
+    points = db.Column(db.Integer, nullable=False)  # signed
+    balance_after = db.Column(db.Integer, nullable=False)  # customer's running balance after this entry
+    sale_id = db.Column(db.Integer, index=True)
+    note = db.Column(db.String(200))
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class LicensePayment(db.Model):
     __tablename__ = 'license_payments'
     
@@ -2,12 +2,14 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from werkzeug.security import check_password_hash, generate_password_hash
 from models import User, Shop, AuditLog
 from app import db
-from utils.auth import log_audit
+from utils.auth import log_audit, is_shop_active, get_current_user
+from utils.ratelimit import rate_limit
 import uuid
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 @bp.route('/login', methods=['GET', 'POST'])
+@rate_limit('auth')
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -22,11 +24,13 @@ def login():
             
             # Check shop license if not super admin
             if user.role != 'super_admin' and user.shop:
-                if not user.shop.is_active or not user.shop.is_license_active:
+                if not is_shop_active(user.shop_id, refresh=True):
                     flash('Shop license has expired. Please renew your license.', 'error')
                     return render_template('auth/login.html')
             
-            # Login successful
+            # Login successful; issue a fresh session ID
+            if hasattr(session, 'regenerate'):
+                session.regenerate()
             session['user_id'] = user.id
             session['username'] = user.username
             session['role'] = user.role
@@ -54,6 +58,7 @@ def login():
     return render_template('auth/login.html')
 
 @bp.route('/register', methods=['GET', 'POST'])
+@rate_limit('auth')
 def register():
     if request.method == 'POST':
         # Shop details
@@ -115,6 +120,7 @@ def register():
     return render_template('auth/register.html')
 
 @bp.route('/forgot-password', methods=['GET', 'POST'])
+@rate_limit('auth')
 def forgot_password():
     if request.method == 'POST':
         email = request.form['email']
@@ -148,7 +154,7 @@ def change_password():
         new_password = request.form['new_password']
         confirm_password = request.form['confirm_password']
         
-        user = User.query.get(session['user_id'])
+        user = get_current_user()
         if not user:
             flash('User not found', 'error')
             return redirect(url_for('auth.login'))
@@ -1,12 +1,32 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
-from models import Product, Sale, SaleItem, StockMovement, MpesaTransaction, Shop
+from flask import Blueprint, Response, abort, render_template, request, redirect, url_for, flash, session, jsonify
+from models import Customer, LoyaltyEntry, Product, Sale, SaleItem, Shift, StockMovement, MpesaTransaction
 from app import db
 from utils.auth import require_role, require_shop_access, log_audit
-from datetime import datetime, timedelta
+from utils.user_settings import save_cashier_settings
+from utils.receipts import get_receipt_layout, get_sale_snapshot, send_to_printer
+from utils.sales import record_sale
+from utils.customers import normalize_msisdn, post_points, record_customer_sales
+from utils.shifts import close_shift, get_open_shift, open_shift, record_shift_sale, z_report, z_report_json
+from utils.pricing import from_cents, price_basket, priced_basket_json
+from utils.receipt_numbers import next_receipt_number, parse_receipt_number, till_leased_values
+from utils.concurrency import is_cooperative
+from utils.ratelimit import rate_limit
+from utils.tenant import get_tenant
+from utils.idempotency import claim_key, get_idempotency_settings, idempotent
+from utils.page_cache import etag_for
+from schemas import CUSTOMER, CUSTOMER_PURCHASE, LOYALTY_ENTRY, MPESA_PAYMENT, PRODUCT_LOOKUP, SALE_PAYMENT
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+import hashlib
+import logging
 import uuid
 
 bp = Blueprint('cashier', __name__, url_prefix='/cashier')
 
+MAX_OFFLINE_BATCH = 100  # sales per upload from an offline till
+
 @bp.before_request
 def check_auth():
     if 'user_id' not in session or session.get('role') not in ['cashier', 'shop_admin', 'super_admin']:
@@ -14,9 +34,7 @@ def check_auth():
     
     # Check shop license for cashiers and shop admins (not super admin when impersonating)
     if session.get('role') in ['cashier', 'shop_admin'] and not session.get('impersonating'):
-        from models import User
-        user = User.query.get(session['user_id'])
-        if user and user.shop and (not user.shop.is_active or not user.shop.is_license_active()):
+        if session.get('shop_id') and not get_tenant().license_active:
             flash('Shop license has expired. Please contact your administrator.', 'error')
             return redirect(url_for('auth.logout'))
 
@@ -30,14 +48,15 @@ def pos():
     ).order_by(Product.name).all()
     
     # Get shop settings
-    shop = Shop.query.get(session['shop_id'])
-    settings = {}
-    if shop and shop.settings:
-        settings = shop.settings
+    tenant = get_tenant()
+    shop = tenant.shop
+    settings = tenant.settings
     
-    return render_template('cashier/pos.html', products=products, shop=shop, settings=settings)
+    return render_template('cashier/pos.html', products=products, shop=shop, settings=settings,
+                           payment_streaming=is_cooperative())
 
 @bp.route('/api/products/search')
+@rate_limit('lookup')
 @require_shop_access
 def search_products():
     query = request.args.get('q', '')
@@ -45,44 +64,152 @@ def search_products():
     if len(query) < 2:
         return jsonify([])
     
-    products = Product.query.filter(
+    rows = db.session.execute(PRODUCT_LOOKUP.select().where(
         Product.shop_id == session['shop_id'],
         Product.is_active == True,
         (Product.name.ilike(f'%{query}%') | 
          Product.barcode.ilike(f'%{query}%') |
          Product.sku.ilike(f'%{query}%'))
-    ).limit(10).all()
+    ).limit(10))
     
-    return jsonify([{
-        'id': p.id,
-        'name': p.name,
-        'price': float(p.price),
-        'barcode': p.barcode,
-        'stock_quantity': p.stock_quantity
-    } for p in products])
+    return jsonify(PRODUCT_LOOKUP.dump_all(rows))
 
 @bp.route('/api/products/<barcode>')
+@rate_limit('lookup')
 @require_shop_access
 def get_product_by_barcode(barcode):
-    product = Product.query.filter_by(
-        shop_id=session['shop_id'],
-        barcode=barcode,
-        is_active=True
-    ).first()
+    product = db.session.execute(PRODUCT_LOOKUP.select().where(
+        Product.shop_id == session['shop_id'],
+        Product.barcode == barcode,
+        Product.is_active == True
+    )).first()
     
     if not product:
         return jsonify({'error': 'Product not found'}), 404
     
-    return jsonify({
-        'id': product.id,
-        'name': product.name,
-        'price': float(product.price),
-        'barcode': product.barcode,
-        'stock_quantity': product.stock_quantity
-    })
+    return jsonify(PRODUCT_LOOKUP.dump_row(product))
+
+@bp.route('/api/products/catalogue')
+@rate_limit('lookup')
+@require_shop_access
+def product_catalogue():
+    """Every active product, so the till can look up scans locally (revalidated by ETag)"""
+    rows = db.session.execute(PRODUCT_LOOKUP.select().where(
+        Product.shop_id == session['shop_id'],
+        Product.is_active == True
+    ).order_by(Product.name))
+    
+    response = jsonify(PRODUCT_LOOKUP.dump_all(rows))
+    response.set_etag(etag_for(response.get_data()))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def load_basket(items):
+    """Parse cart items into (product_id, quantity) lines and load their products in one query.
+
+    Prices come from the catalogue, never from the client. Raises ValueError
+    for unknown products or invalid quantities.
+    """
+    lines = []
+    for item_data in items:
+        product_id = item_data.get('productId') or item_data.get('product_id')
+        try:
+            product_id, quantity = int(product_id), int(item_data['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Invalid product or quantity: {product_id}")
+        if quantity < 1 or quantity != item_data['quantity']:
+            raise ValueError(f"Invalid quantity for product {product_id}")
+        lines.append((product_id, quantity))
+    
+    products = {product.id: product for product in Product.query.filter(
+        Product.shop_id == session['shop_id'],
+        Product.id.in_([product_id for product_id, _ in lines])
+    )}
+    for product_id, _ in lines:
+        if product_id not in products:
+            raise ValueError(f"Invalid product: {product_id}")
+    return lines, products
+
+@bp.route('/cart/price', methods=['POST'])
+@require_shop_access
+def price_cart():
+    """Price the current cart with the shop's promotions and tax"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('items'):
+        return jsonify({'error': 'No items provided'}), 400
+    
+    try:
+        lines, products = load_basket(data['items'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    basket = price_basket(get_tenant().shop, lines, products)
+    return jsonify(priced_basket_json(basket))
+
+def save_sale(shop, basket, products, payment_method, receipt_number, created_at=None,
+              allow_short_stock=False):
+    """Add a priced basket to the session as a sale with its items and stock movements.
+
+    Raises ValueError when a line needs more stock than is left, unless
+    allow_short_stock (offline sales, whose goods have already left the shop).
+    """
+    sale = Sale()
+    sale.receipt_number = receipt_number
+    sale.shop_id = shop.id
+    sale.cashier_id = session['user_id']
+    sale.subtotal = from_cents(basket['subtotal_cents'])
+    sale.discount_amount = from_cents(basket['discount_cents'])
+    sale.tax_amount = from_cents(basket['tax_cents'])
+    sale.total_amount = from_cents(basket['total_cents'])
+    sale.payment_method = payment_method
+    if created_at is not None:
+        sale.created_at = created_at
+    items_sold = sum(line['quantity'] for line in basket['lines'])
+    sale.shift_id = record_shift_sale(sale, items_sold, created_at)
+    
+    db.session.add(sale)
+    db.session.flush()  # Get sale ID
+    
+    # Create sale items and update stock
+    for line in basket['lines']:
+        product = products[line['product_id']]
+        quantity = line['quantity']
+        if product.stock_quantity < quantity and not allow_short_stock:
+            raise ValueError(f"Insufficient stock for {product.name}")
+        
+        # Create sale item
+        sale_item = SaleItem()
+        sale_item.sale_id = sale.id
+        sale_item.product_id = product.id
+        sale_item.quantity = quantity
+        sale_item.unit_price = from_cents(line['unit_cents'])
+        sale_item.line_total = from_cents(line['gross_cents'])
+        sale_item.discount_amount = from_cents(line['discount_cents'])
+        sale_item.created_at = sale.created_at
+        db.session.add(sale_item)
+        
+        # Update stock
+        product.stock_quantity -= quantity
+        
+        # Create stock movement
+        movement = StockMovement()
+        movement.product_id = product.id
+        movement.movement_type = 'out'
+        movement.quantity = quantity
+        movement.reference = receipt_number
+        movement.notes = f'Sale: {receipt_number}'
+        movement.created_by = session['user_id']
+        if created_at is not None:
+            movement.created_at = created_at
+        db.session.add(movement)
+    
+    db.session.flush()
+    record_sale(sale, items_sold)
+    return sale
 
 @bp.route('/sale/create', methods=['POST'])
 @require_shop_access
+@idempotent
 def create_sale():
     data = request.get_json()
     
@@ -90,80 +217,25 @@ def create_sale():
         return jsonify({'error': 'No items provided'}), 400
     
     try:
-        # Generate receipt number
-        receipt_number = f"RCP{datetime.now().strftime('%Y%m%d')}{str(uuid.uuid4())[:6].upper()}"
-        
-        # Calculate totals from cart items
-        subtotal = 0
-        for item in data['items']:
-            if 'lineTotal' in item:
-                subtotal += item['lineTotal']
-            else:
-                subtotal += item['quantity'] * item['unitPrice']
-        
-        shop = Shop.query.get(session['shop_id'])
-        settings = shop.settings if shop and shop.settings else {}
-        tax_rate = settings.get('tax_rate', 16) / 100
-        tax_amount = subtotal * tax_rate
-        total_amount = subtotal + tax_amount
-        
-        # Create sale
-        sale = Sale()
-        sale.receipt_number = receipt_number
-        sale.shop_id = session['shop_id']
-        sale.cashier_id = session['user_id']
-        sale.subtotal = subtotal
-        sale.tax_amount = tax_amount
-        sale.total_amount = total_amount
-        sale.payment_method = data['payment_method']
-        
-        db.session.add(sale)
-        db.session.flush()  # Get sale ID
-        
-        # Create sale items and update stock
-        for item_data in data['items']:
-            product_id = item_data.get('productId') or item_data.get('product_id')
-            product = Product.query.get(product_id)
-            if not product or product.shop_id != session['shop_id']:
-                raise ValueError(f"Invalid product: {product_id}")
-            
-            quantity = item_data['quantity']
-            if product.stock_quantity < quantity:
-                raise ValueError(f"Insufficient stock for {product.name}")
-            
-            # Create sale item
-            sale_item = SaleItem()
-            sale_item.sale_id = sale.id
-            sale_item.product_id = product.id
-            sale_item.quantity = quantity
-            sale_item.unit_price = item_data.get('unitPrice', product.price)
-            sale_item.line_total = item_data.get('lineTotal', quantity * sale_item.unit_price)
-            db.session.add(sale_item)
-            
-            # Update stock
-            product.stock_quantity -= quantity
-            
-            # Create stock movement
-            movement = StockMovement()
-            movement.product_id = product.id
-            movement.movement_type = 'out'
-            movement.quantity = quantity
-            movement.reference = receipt_number
-            movement.notes = f'Sale: {receipt_number}'
-            movement.created_by = session['user_id']
-            db.session.add(movement)
-        
+        shop = get_tenant().shop
+        lines, products = load_basket(data['items'])
+        basket = price_basket(shop, lines, products)
+        receipt_number = next_receipt_number(session['shop_id'])
+        sale = save_sale(shop, basket, products, data['payment_method'], receipt_number)
         db.session.commit()
         
         log_audit(session['user_id'], 'create_sale', 'sale', sale.id,
                   request.remote_addr, request.user_agent.string,
-                  new_values={'receipt_number': receipt_number, 'total_amount': float(total_amount)})
+                  new_values={'receipt_number': receipt_number, 'total_amount': float(sale.total_amount)})
         
         return jsonify({
             'success': True,
             'sale_id': sale.id,
             'receipt_number': receipt_number,
-            'total_amount': float(total_amount)
+            'subtotal': float(sale.subtotal),
+            'discount_amount': float(sale.discount_amount),
+            'tax_amount': float(sale.tax_amount),
+            'total_amount': float(sale.total_amount)
         })
         
     except ValueError as e:
@@ -173,7 +245,187 @@ def create_sale():
         db.session.rollback()
         return jsonify({'message': 'Failed to create sale'}), 500
 
+def save_offline_sale(shop, entry, leased_values, fallback_number=None):
+    """Record one queued sale in the current savepoint; None if it was already recorded.
+
+    The sale is priced with the promotions in force when it was made. Raises
+    ValueError for sales that can't be recorded as sent.
+    """
+    try:
+        client_uuid = str(uuid.UUID(str(entry.get('client_uuid'))))
+    except ValueError:
+        raise ValueError("Invalid client_uuid")
+    
+    payment_method = entry.get('payment_method')
+    if payment_method not in ('cash', 'mpesa'):
+        raise ValueError(f"Invalid payment method: {payment_method}")
+    
+    now = datetime.utcnow()
+    try:
+        created_at = datetime.fromisoformat(str(entry['created_at']).replace('Z', '+00:00'))
+    except (KeyError, ValueError):
+        raise ValueError("Invalid created_at")
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    created_at = min(created_at, now)  # till clocks run fast too
+    
+    receipt_number = entry.get('receipt_number')
+    if receipt_number is not None:
+        parsed = parse_receipt_number(receipt_number)
+        if parsed is None or parsed[0] != shop.id or parsed[1] not in leased_values:
+            raise ValueError(f"Receipt number {receipt_number} was not leased to this shop's tills")
+    
+    # Claimed with the sale, so a concurrent upload of the same queue waits
+    # for this one and then skips the sale
+    fingerprint = hashlib.blake2b(client_uuid.encode('utf-8'), digest_size=16).hexdigest()
+    if not claim_key(db.session, shop.id, f'sale:{client_uuid}', fingerprint,
+                     get_idempotency_settings()['ttl_seconds']):
+        return None
+    
+    lines, products = load_basket(entry.get('items') or [])
+    if not lines:
+        raise ValueError("No items provided")
+    basket = price_basket(shop, lines, products, now=created_at)
+    sale = save_sale(shop, basket, products, payment_method, receipt_number or fallback_number,
+                     created_at, allow_short_stock=True)
+    sale.client_uuid = client_uuid
+    if payment_method == 'mpesa' and entry.get('mpesa_receipt'):
+        link_offline_payment(sale, str(entry['mpesa_receipt']).strip().upper()[:100])
+    return sale
+
+def link_offline_payment(sale, mpesa_code):
+    """Settle an offline M-Pesa sale with the code the cashier typed, if it checks out.
+
+    The code must name an unprocessed payment to this shop for the sale's
+    total, which is claimed in the same statement so no other sale can take
+    it. Anything else leaves the sale unpaid for reconciliation to settle.
+    """
+    payment = db.session.execute(
+        update(MpesaTransaction).where(
+            MpesaTransaction.transaction_id == mpesa_code,
+            MpesaTransaction.shop_id == sale.shop_id,
+            MpesaTransaction.amount == sale.total_amount,
+            MpesaTransaction.is_processed == False
+        ).values(is_processed=True, sale_id=sale.id)
+        .returning(MpesaTransaction.msisdn, MpesaTransaction.first_name,
+                   MpesaTransaction.middle_name, MpesaTransaction.last_name),
+        execution_options={'synchronize_session': False}
+    ).first()
+    if payment is None:
+        logging.warning(f"Offline sale {sale.receipt_number}: M-Pesa code {mpesa_code} does not match "
+                        f"an unprocessed payment of {sale.total_amount}; left for reconciliation")
+        return False
+    
+    sale.mpesa_receipt = mpesa_code
+    sale.customer_phone = payment.msisdn
+    sale.customer_name = ' '.join(filter(None, (payment.first_name, payment.middle_name, payment.last_name)))
+    record_customer_sales([(sale.id, sale.shop_id, sale.customer_phone, sale.customer_name,
+                            sale.total_amount, sale.created_at)])
+    return True
+
+@bp.route('/sales/batch', methods=['POST'])
+@require_shop_access
+def upload_offline_sales():
+    """Record the sales a till queued while offline, in one request.
+
+    Sales are keyed by the till's client_uuid and recorded once, however often
+    the queue is uploaded. Each sale is saved in its own savepoint, so one
+    that is rejected doesn't hold back the rest of the batch.
+    """
+    data = request.get_json(silent=True) or {}
+    entries = data.get('sales')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': 'No sales provided'}), 400
+    if len(entries) > MAX_OFFLINE_BATCH:
+        return jsonify({'error': f'At most {MAX_OFFLINE_BATCH} sales per batch'}), 400
+    entries = [entry if isinstance(entry, dict) else {} for entry in entries]
+    
+    shop = get_tenant().shop
+    recorded = {row.client_uuid: row for row in db.session.execute(
+        select(Sale.client_uuid, Sale.id, Sale.receipt_number).where(
+            Sale.shop_id == shop.id,
+            Sale.client_uuid.in_({str(entry.get('client_uuid')) for entry in entries}))
+    )}
+    parsed = [parse_receipt_number(entry.get('receipt_number')) for entry in entries]
+    leased_values = till_leased_values(shop.id, [value for shop_id, value in filter(None, parsed)
+                                                 if shop_id == shop.id])
+    # Numbered before any writes: allocation may lease a block on its own connection
+    fallback_numbers = {i: next_receipt_number(shop.id) for i, entry in enumerate(entries)
+                        if not entry.get('receipt_number') and str(entry.get('client_uuid')) not in recorded}
+    
+    results = []
+    for i, entry in enumerate(entries):
+        result = {'client_uuid': entry.get('client_uuid')}
+        results.append(result)
+        previous = recorded.get(str(entry.get('client_uuid')))
+        if previous is not None:
+            result.update(status='duplicate', sale_id=previous.id, receipt_number=previous.receipt_number)
+            continue
+        try:
+            with db.session.begin_nested():
+                sale = save_offline_sale(shop, entry, leased_values, fallback_numbers.get(i))
+        except ValueError as e:
+            result.update(status='rejected', error=str(e))
+            continue
+        except IntegrityError:
+            result.update(status='rejected', error='Receipt number already used')
+            continue
+        if sale is None:
+            result.update(status='duplicate')
+        else:
+            result.update(status='created', sale_id=sale.id, receipt_number=sale.receipt_number)
+    
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Offline sales upload failed for shop {shop.id}: {e}")
+        return jsonify({'message': 'Failed to record sales'}), 500
+    
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('created', 'duplicate', 'rejected')}
+    log_audit(session['user_id'], 'upload_offline_sales', 'shop', shop.id,
+              request.remote_addr, request.user_agent.string, new_values=counts)
+    
+    return jsonify({'results': results, **counts})
+
+@bp.route('/receipts/lease', methods=['POST'])
+@require_shop_access
+def lease_receipt_numbers():
+    """Lease a block of receipt numbers to a till for offline sales"""
+    from utils.receipt_numbers import (MAX_TILL_BLOCK_SIZE, format_receipt_number,
+                                       get_receipt_settings, lease_block)
+    
+    data = request.get_json(silent=True) or {}
+    till_id = str(data.get('till_id', '')).strip()[:50]
+    if not till_id:
+        return jsonify({'error': 'till_id is required'}), 400
+    
+    try:
+        size = int(data.get('size') or get_receipt_settings()['till_block_size'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be a number'}), 400
+    if not 1 <= size <= MAX_TILL_BLOCK_SIZE:
+        return jsonify({'error': f'size must be between 1 and {MAX_TILL_BLOCK_SIZE}'}), 400
+    
+    shop_id = session['shop_id']
+    start, end = lease_block(shop_id, size, f'till:{till_id}', session['user_id'])
+    
+    log_audit(session['user_id'], 'lease_receipt_numbers', 'shop', shop_id,
+              request.remote_addr, request.user_agent.string,
+              new_values={'till_id': till_id, 'start': start, 'end': end})
+    
+    return jsonify({
+        'shop_id': shop_id,
+        'till_id': till_id,
+        'start': start,
+        'end': end,
+        'first_receipt_number': format_receipt_number(shop_id, start),
+        'last_receipt_number': format_receipt_number(shop_id, end)
+    })
+
 @bp.route('/mpesa/check/<int:sale_id>')
+@rate_limit('polling')
 @require_shop_access
 def check_mpesa_payment(sale_id):
     """Check if MPesa payment has been received for a sale"""
@@ -185,41 +437,29 @@ def check_mpesa_payment(sale_id):
     if sale.mpesa_receipt:
         return jsonify({
             'payment_received': True,
-            'payment_data': {
-                'amount': float(sale.total_amount),
-                'phone': sale.customer_phone or 'Unknown',
-                'mpesa_code': sale.mpesa_receipt,
-                'customer_name': sale.customer_name or 'Customer',
-                'transaction_time': sale.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            }
+            'payment_data': SALE_PAYMENT.dump_object(sale)
         })
     
     # Look for recent MPesa transactions
-    shop = Shop.query.get(session['shop_id'])
     recent_time = datetime.now() - timedelta(minutes=10)
     
-    transaction = MpesaTransaction.query.filter(
+    transaction = db.session.execute(MPESA_PAYMENT.select().where(
         MpesaTransaction.amount == sale.total_amount,
         MpesaTransaction.transaction_time >= recent_time,
         MpesaTransaction.is_processed == False
-    ).order_by(MpesaTransaction.transaction_time.desc()).first()
+    ).order_by(MpesaTransaction.transaction_time.desc()).limit(1)).first()
     
     if transaction:
         return jsonify({
             'payment_received': True,
-            'payment_data': {
-                'amount': float(transaction.amount),
-                'phone': transaction.msisdn,
-                'mpesa_code': transaction.transaction_id,
-                'customer_name': f"{transaction.first_name or ''} {transaction.middle_name or ''} {transaction.last_name or ''}".strip() or 'Customer',
-                'transaction_time': transaction.transaction_time.strftime('%Y-%m-%d %H:%M:%S')
-            }
+            'payment_data': MPESA_PAYMENT.dump_row(transaction)
         })
     
     return jsonify({'payment_received': False})
 
 @bp.route('/mpesa/confirm/<int:sale_id>', methods=['POST'])
 @require_shop_access
+@idempotent
 def confirm_mpesa_payment(sale_id):
     """Confirm MPesa payment for a sale"""
     sale = Sale.query.get_or_404(sale_id)
@@ -246,6 +486,8 @@ def confirm_mpesa_payment(sale_id):
         # Mark transaction as processed
         transaction.is_processed = True
         transaction.sale_id = sale.id
+        record_customer_sales([(sale.id, sale.shop_id, sale.customer_phone, sale.customer_name,
+                                sale.total_amount, sale.created_at)])
         
         db.session.commit()
         
@@ -269,17 +511,195 @@ def confirm_mpesa_payment(sale_id):
 @require_shop_access
 def view_receipt(sale_id):
     sale = Sale.query.filter_by(id=sale_id, shop_id=session['shop_id']).first_or_404()
-    shop = Shop.query.get(session['shop_id'])
+    shop = get_tenant().shop
     
     return render_template('cashier/receipt.html', sale=sale, shop=shop)
 
 @bp.route('/receipt/<int:sale_id>/print')
 @require_shop_access
 def print_receipt(sale_id):
-    sale = Sale.query.filter_by(id=sale_id, shop_id=session['shop_id']).first_or_404()
-    shop = Shop.query.get(session['shop_id'])
+    snapshot = get_sale_snapshot(sale_id, session['shop_id'])
+    if snapshot is None:
+        abort(404)
     
-    return render_template('cashier/print_receipt.html', sale=sale, shop=shop)
+    return receipt_layout().render_html(snapshot)
+
+@bp.route('/receipt/<int:sale_id>/escpos')
+@require_shop_access
+def receipt_escpos(sale_id):
+    """Receipt as a raw ESC/POS byte stream for thermal printers"""
+    snapshot = get_sale_snapshot(sale_id, session['shop_id'])
+    if snapshot is None:
+        abort(404)
+    
+    data = receipt_layout().render_escpos(snapshot)
+    return Response(data, mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'inline; filename={snapshot["receipt_number"]}.bin'
+    })
+
+def parse_amount(value, name):
+    """Parse a KES amount from a JSON body; raises ValueError"""
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'{name} must be a number')
+    if not amount.is_finite():
+        raise ValueError(f'{name} must be a number')
+    return amount
+
+def load_shift(shift_id):
+    """A shift of the current shop; cashiers only see their own"""
+    shift = Shift.query.filter_by(id=shift_id, shop_id=session['shop_id']).first_or_404()
+    if session.get('role') == 'cashier' and shift.cashier_id != session['user_id']:
+        abort(404)
+    return shift
+
+@bp.route('/shift')
+@require_shop_access
+def current_shift():
+    """The cashier's open shift with its running totals"""
+    shift = get_open_shift(session['shop_id'], session['user_id'])
+    return jsonify({'shift': z_report_json(z_report(shift)) if shift else None})
+
+@bp.route('/shift/open', methods=['POST'])
+@require_shop_access
+def start_shift():
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        opening_float = parse_amount(data.get('opening_float', 0), 'opening_float')
+        shift = open_shift(session['shop_id'], session['user_id'], opening_float)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except IntegrityError:
+        # Lost a race with another open on the same cashier
+        db.session.rollback()
+        return jsonify({'error': 'You already have an open shift'}), 400
+    
+    log_audit(session['user_id'], 'open_shift', 'shift', shift.id,
+              request.remote_addr, request.user_agent.string,
+              new_values={'opening_float': float(shift.opening_float)})
+    
+    return jsonify({'success': True, 'shift': z_report_json(z_report(shift))})
+
+@bp.route('/shift/close', methods=['POST'])
+@require_shop_access
+def end_shift():
+    """Close the cashier's shift with the counted cash and return its Z-report"""
+    data = request.get_json(silent=True) or {}
+    if data.get('counted_cash') is None:
+        return jsonify({'error': 'counted_cash is required'}), 400
+    
+    shift = get_open_shift(session['shop_id'], session['user_id'])
+    if shift is None:
+        return jsonify({'error': 'No open shift'}), 400
+    
+    try:
+        counted_cash = parse_amount(data['counted_cash'], 'counted_cash')
+        close_shift(shift, counted_cash, session['user_id'], str(data.get('notes') or '')[:500])
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    
+    report = z_report(shift)
+    log_audit(session['user_id'], 'close_shift', 'shift', shift.id,
+              request.remote_addr, request.user_agent.string,
+              new_values={'expected_cash': float(report['expected_cash']),
+                          'counted_cash': float(report['counted_cash']),
+                          'cash_variance': float(report['cash_variance'])})
+    
+    return jsonify({
+        'success': True,
+        'z_report': z_report_json(report),
+        'print_url': url_for('cashier.print_z_report', shift_id=shift.id)
+    })
+
+@bp.route('/shift/<int:shift_id>/z-report')
+@require_shop_access
+def print_z_report(shift_id):
+    """Printable Z-report (an X-report while the shift is still open)"""
+    return receipt_layout().render_z_report_html(z_report(load_shift(shift_id)))
+
+@bp.route('/shift/<int:shift_id>/z-report/escpos')
+@require_shop_access
+def z_report_escpos(shift_id):
+    """Z-report as a raw ESC/POS byte stream for thermal printers"""
+    data = receipt_layout().render_z_report_escpos(z_report(load_shift(shift_id)))
+    return Response(data, mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'inline; filename=z-report-{shift_id}.bin'
+    })
+
+@bp.route('/customers/lookup')
+@require_shop_access
+def lookup_customer():
+    """Returning customer and points balance by phone number (one indexed read)"""
+    msisdn = normalize_msisdn(request.args.get('phone'))
+    if msisdn is None:
+        return jsonify({'error': 'Enter a valid phone number'}), 400
+    
+    row = db.session.execute(CUSTOMER.select().where(
+        Customer.shop_id == session['shop_id'], Customer.msisdn == msisdn
+    )).first()
+    return jsonify({'customer': CUSTOMER.dump_row(row) if row else None})
+
+@bp.route('/customers/<int:customer_id>')
+@require_shop_access
+def customer_history(customer_id):
+    """A customer's latest purchases and points ledger entries"""
+    row = db.session.execute(CUSTOMER.select().where(
+        Customer.id == customer_id, Customer.shop_id == session['shop_id']
+    )).first()
+    if row is None:
+        return jsonify({'error': 'Customer not found'}), 404
+    
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    purchases = db.session.execute(CUSTOMER_PURCHASE.select().where(Sale.customer_id == customer_id)
+                                   .order_by(Sale.created_at.desc()).limit(limit)).all()
+    ledger = db.session.execute(LOYALTY_ENTRY.select().where(LoyaltyEntry.customer_id == customer_id)
+                                .order_by(LoyaltyEntry.id.desc()).limit(limit)).all()
+    return jsonify({
+        'customer': CUSTOMER.dump_row(row),
+        'purchases': CUSTOMER_PURCHASE.dump_all(purchases),
+        'ledger': LOYALTY_ENTRY.dump_all(ledger),
+    })
+
+@bp.route('/customers/<int:customer_id>/redeem', methods=['POST'])
+@require_shop_access
+@idempotent
+def redeem_points(customer_id):
+    """Take points off a customer's balance"""
+    customer = Customer.query.filter_by(id=customer_id, shop_id=session['shop_id']).first()
+    if customer is None:
+        return jsonify({'error': 'Customer not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    points = data.get('points')
+    if not isinstance(points, int) or isinstance(points, bool) or points <= 0:
+        return jsonify({'error': 'points must be a positive whole number'}), 400
+    
+    try:
+        sale_id = data.get('sale_id') if isinstance(data.get('sale_id'), int) else None
+        balance = post_points(customer.id, customer.shop_id, -points, 'redeem', sale_id=sale_id,
+                              user_id=session['user_id'], note=str(data.get('note') or '')[:200] or None)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    
+    log_audit(session['user_id'], 'redeem_points', 'customer', customer.id,
+              request.remote_addr, request.user_agent.string,
+              new_values={'points': -points, 'points_balance': balance})
+    
+    return jsonify({'success': True, 'points_balance': balance})
+
+def receipt_layout():
+    """Compiled receipt layout for the current shop and cashier's paper width"""
+    tenant = get_tenant()
+    width = tenant.cashier_settings.get('receipt_width', '80mm')
+    return get_receipt_layout(tenant.shop, width)
 
 @bp.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -287,11 +707,8 @@ def settings():
         return redirect(url_for('auth.login'))
     
     if request.method == 'POST':
-        # Save cashier settings to database or session
-        from models import User
-        user = User.query.get(session['user_id'])
+        user = get_tenant().user
         
-        # Update user settings (you can extend User model to include settings JSON field)
         settings_data = {
             'theme': request.form.get('theme', 'light'),
             'language': request.form.get('language', 'en'),
@@ -319,11 +736,9 @@ def settings():
             'scanner_suffix': request.form.get('scanner_suffix', '')
         }
         
-        # Store in session for now (could be extended to database)
-        session['cashier_settings'] = settings_data
-        
         # Log audit trail
         if user:
+            save_cashier_settings(user, settings_data)
             log_audit(
                 user_id=session['user_id'],
                 action='update_cashier_settings',
@@ -337,35 +752,51 @@ def settings():
         flash('Settings updated successfully', 'success')
         return redirect(url_for('cashier.settings'))
     
-    return render_template('cashier/settings.html')
+    return render_template('cashier/settings.html',
+                           cashier_settings=get_tenant().cashier_settings)
 
 @bp.route('/test-printer', methods=['POST'])
 @require_shop_access
 def test_printer():
     """Test the receipt printer with a sample receipt"""
     try:
-        from utils.reports import generate_sales_report_pdf
-        from datetime import datetime
+        from decimal import Decimal
         
         # Generate a test receipt
-        test_data = {
+        snapshot = {
             'receipt_number': 'TEST-' + datetime.now().strftime('%Y%m%d%H%M%S'),
-            'shop_name': session.get('shop_name', 'Demo Shop'),
-            'items': [
-                {'name': 'Test Item', 'quantity': 1, 'price': 100.00, 'total': 100.00}
-            ],
-            'total': 100.00,
+            'created_at': datetime.now(),
+            'subtotal': Decimal('100.00'),
+            'tax_amount': Decimal('0.00'),
+            'discount_amount': Decimal('0.00'),
+            'total_amount': Decimal('100.00'),
             'payment_method': 'TEST',
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'mpesa_receipt': None,
+            'customer_name': None,
+            'cashier': session.get('username', ''),
+            'items': [('Test Item', 1, Decimal('100.00'), Decimal('100.00'))]
         }
+        data = receipt_layout().render_escpos(snapshot)
+        
+        send_to_printer(data)
         
-        # In a real implementation, this would send to the actual printer
-        # For now, we'll just return success
         return jsonify({
             'success': True,
-            'message': 'Test receipt generated successfully'
+            'message': 'Test receipt sent to printer',
+            'bytes': len(data)
         })
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except OSError as e:
+        logging.warning(f"Receipt printer unreachable: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Printer unreachable'
+        }), 502
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1,14 +1,22 @@
-from flask import Blueprint, request, jsonify, render_template
+from flask import Blueprint, Response, request, jsonify, render_template, session, stream_with_context
 from models import MpesaTransaction, Shop, Sale, LicensePayment
 from app import db
 from datetime import datetime, timedelta
+import json
 import logging
+import os
+import time
+from utils.auth import require_shop_access
+from utils.ratelimit import rate_limit
+from schemas import PAYMENT_COMPLETED
 from utils.mpesa import mpesa_api
+from utils.customers import normalize_msisdn, record_customer_sales, record_payers
 from utils.license_payments import process_license_payment, is_license_payment, get_license_payment_instructions
 
 bp = Blueprint('mpesa', __name__, url_prefix='/mpesa')
 
 @bp.route('/c2b/confirmation', methods=['POST'])
+@rate_limit('callback')
 def c2b_confirmation():
     """Handle MPesa C2B confirmation callback with webhook validation"""
     try:
@@ -52,7 +60,7 @@ def c2b_confirmation():
             transaction_id=payment_result['transaction_id'],
             bill_ref_number=payment_result['reference'],
             amount=payment_result['amount'],
-            msisdn=payment_result['phone'],
+            msisdn=normalize_msisdn(payment_result['phone']) or payment_result['phone'],
             first_name=payment_result['customer_name'].split()[0] if payment_result['customer_name'] else '',
             middle_name=' '.join(payment_result['customer_name'].split()[1:-1]) if len(payment_result['customer_name'].split()) > 2 else '',
             last_name=payment_result['customer_name'].split()[-1] if len(payment_result['customer_name'].split()) > 1 else '',
@@ -88,12 +96,16 @@ def c2b_confirmation():
                 if pending_sale and abs(float(pending_sale.total_amount) - payment_result['amount']) < 0.01:
                     # Match found - update sale with MPesa receipt
                     pending_sale.mpesa_receipt = payment_result['transaction_id']
-                    pending_sale.customer_phone = payment_result['phone']
+                    pending_sale.customer_phone = transaction.msisdn
                     pending_sale.customer_name = payment_result['customer_name']
                     transaction.sale_id = pending_sale.id
                     transaction.is_processed = True
+                    record_customer_sales([(pending_sale.id, shop.id, transaction.msisdn, payment_result['customer_name'],
+                                            pending_sale.total_amount, pending_sale.created_at)])
                     
                     logging.info(f"Matched MPesa payment {payment_result['transaction_id']} to sale {pending_sale.id}")
+                else:
+                    record_payers([(shop.id, transaction.msisdn, payment_result['customer_name'], transaction_time)])
         
         db.session.add(transaction)
         db.session.commit()
@@ -108,6 +120,7 @@ def c2b_confirmation():
         return jsonify({"ResultCode": 1, "ResultDesc": "Internal server error"}), 500
 
 @bp.route('/c2b/validation', methods=['POST'])
+@rate_limit('callback')
 def c2b_validation():
     """Handle MPesa C2B validation callback"""
     try:
@@ -138,6 +151,7 @@ def c2b_validation():
         return jsonify({"ResultCode": 1, "ResultDesc": "Validation failed"}), 500
 
 @bp.route('/c2b/timeout', methods=['POST'])
+@rate_limit('callback')
 def c2b_timeout():
     """Handle MPesa C2B timeout callback"""
     try:
@@ -150,59 +164,97 @@ def c2b_timeout():
         logging.error(f"Error handling MPesa timeout: {str(e)}")
         return jsonify({"ResultCode": 1, "ResultDesc": "Error handling timeout"}), 500
 
+def payment_status(sale):
+    """Payment status of a sale, matching it to an unprocessed M-Pesa transaction if one has arrived"""
+    if sale.mpesa_receipt:
+        return {'status': 'completed', **PAYMENT_COMPLETED.dump_object(sale)}
+    
+    # Check for recent transactions matching this sale
+    transaction = MpesaTransaction.query.filter(
+        MpesaTransaction.shop_id == sale.shop_id,
+        MpesaTransaction.transaction_time >= sale.created_at - timedelta(minutes=5),
+        MpesaTransaction.amount == sale.total_amount,
+        MpesaTransaction.is_processed == False
+    ).order_by(MpesaTransaction.transaction_time.desc()).first()
+    
+    if transaction:
+        # Match transaction to sale
+        sale.mpesa_receipt = transaction.transaction_id
+        sale.customer_phone = transaction.msisdn
+        sale.customer_name = f"{transaction.first_name} {transaction.middle_name} {transaction.last_name}".strip()
+        transaction.sale_id = sale.id
+        transaction.is_processed = True
+        record_customer_sales([(sale.id, sale.shop_id, sale.customer_phone, sale.customer_name,
+                                sale.total_amount, sale.created_at)])
+        
+        db.session.commit()
+        
+        return {'status': 'completed', **PAYMENT_COMPLETED.dump_object(sale)}
+    
+    # No payment found yet
+    return {
+        'status': 'pending',
+        'amount': float(sale.total_amount),
+        'till_number': sale.shop.till_number if sale.shop else None
+    }
+
 @bp.route('/payment/status/<int:sale_id>')
+@rate_limit('polling')
 def get_payment_status(sale_id):
     """Get real-time payment status for a sale"""
     try:
         sale = Sale.query.get_or_404(sale_id)
-        
-        # Check if payment already received
-        if sale.mpesa_receipt:
-            return jsonify({
-                'status': 'completed',
-                'mpesa_receipt': sale.mpesa_receipt,
-                'customer_phone': sale.customer_phone,
-                'customer_name': sale.customer_name,
-                'amount': float(sale.total_amount)
-            })
-        
-        # Check for recent transactions matching this sale
-        recent_transactions = MpesaTransaction.query.filter(
-            MpesaTransaction.shop_id == sale.shop_id,
-            MpesaTransaction.transaction_time >= sale.created_at - timedelta(minutes=5),
-            MpesaTransaction.amount == sale.total_amount,
-            MpesaTransaction.is_processed == False
-        ).order_by(MpesaTransaction.transaction_time.desc()).all()
-        
-        for transaction in recent_transactions:
-            # Match transaction to sale
-            sale.mpesa_receipt = transaction.transaction_id
-            sale.customer_phone = transaction.msisdn
-            sale.customer_name = f"{transaction.first_name} {transaction.middle_name} {transaction.last_name}".strip()
-            transaction.sale_id = sale.id
-            transaction.is_processed = True
-            
-            db.session.commit()
-            
-            return jsonify({
-                'status': 'completed',
-                'mpesa_receipt': sale.mpesa_receipt,
-                'customer_phone': sale.customer_phone,
-                'customer_name': sale.customer_name,
-                'amount': float(sale.total_amount)
-            })
-        
-        # No payment found yet
-        return jsonify({
-            'status': 'pending',
-            'amount': float(sale.total_amount),
-            'till_number': sale.shop.till_number if sale.shop else None
-        })
+        return jsonify(payment_status(sale))
         
     except Exception as e:
         logging.error(f"Error checking payment status: {e}")
         return jsonify({'error': 'Failed to check payment status'}), 500
 
+@bp.route('/payment/stream/<int:sale_id>')
+@rate_limit('polling')
+@require_shop_access
+def stream_payment_status(sale_id):
+    """Server-sent events stream of a sale's payment status until it completes.
+    
+    Each connection stays open for up to MPESA_STREAM_TIMEOUT seconds, so this is
+    only offered to browsers under cooperative (gevent) workers.
+    """
+    sale = Sale.query.get_or_404(sale_id)
+    if session.get('role') != 'super_admin' and sale.shop_id != session.get('shop_id'):
+        return jsonify({'message': 'Unauthorized'}), 403
+    
+    interval = float(os.environ.get('MPESA_STREAM_INTERVAL', '2'))
+    deadline = time.monotonic() + float(os.environ.get('MPESA_STREAM_TIMEOUT', '300'))
+    
+    def events():
+        status = None
+        while True:
+            try:
+                current = payment_status(db.session.get(Sale, sale_id))
+            except Exception as e:
+                logging.error(f"Error checking payment status: {e}")
+                db.session.rollback()
+                current = {'status': 'error', 'error': 'Failed to check payment status'}
+            finally:
+                # Hand the connection back to the pool while waiting
+                db.session.remove()
+            
+            if current != status:
+                status = current
+                yield f"event: status\ndata: {json.dumps(status)}\n\n"
+            if status['status'] == 'completed':
+                return
+            if time.monotonic() >= deadline:
+                yield "event: timeout\ndata: {}\n\n"
+                return
+            # Comment line as a keep-alive for proxies
+            yield ": waiting\n\n"
+            time.sleep(interval)
+    
+    db.session.remove()
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @bp.route('/payment/simulate', methods=['POST'])
 def simulate_payment():
     """Simulate MPesa payment for testing"""
@@ -1,10 +1,17 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
 from werkzeug.security import generate_password_hash
-from models import User, Shop, Product, Category, Sale, SaleItem, StockMovement, MpesaTransaction
+from models import User, Product, Category, Promotion, Sale, SaleItem, StockMovement, MpesaTransaction
 from app import db
 from utils.auth import require_role, require_shop_access, log_audit
+from utils.database import read_replica
+from utils.ratelimit import rate_limit
+from utils.tenant import get_tenant
+from utils.inventory import get_inventory_counters, track_inventory
+from utils.page_cache import cached_fragment, conditional_response
+from utils.sales import REVENUE_STATUSES, net_item_quantity, net_item_revenue, net_sale_amount
 from datetime import datetime, timedelta
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, select
+from sqlalchemy.orm import selectinload
 import csv
 import io
 
@@ -17,8 +24,7 @@ def check_auth():
     
     # Check if shop admin has access to their shop
     if session.get('role') == 'shop_admin' and not session.get('impersonating'):
-        user = User.query.get(session['user_id'])
-        if not user.shop or not user.shop.is_active or not user.shop.is_license_active:
+        if not get_tenant().license_active:
             flash('Your shop license has expired. Please renew to continue.', 'error')
             return redirect(url_for('auth.logout'))
 
@@ -26,40 +32,56 @@ def check_auth():
 @require_shop_access
 def dashboard():
     shop_id = session['shop_id']
+    widgets = cached_fragment('shop_dashboard', lambda: render_dashboard_widgets(shop_id))
+    return conditional_response(render_template('shop_admin/dashboard.html', widgets=widgets))
+
+def render_dashboard_widgets(shop_id):
+    """Dashboard statistics and tables (cached until the shop's data changes)"""
+    # Date ranges (range predicates on created_at let PostgreSQL prune partitions)
+    today = datetime.now().date()
+    today_start = datetime.combine(today, datetime.min.time())
+    tomorrow_start = today_start + timedelta(days=1)
+    current_month = today_start.replace(day=1)
+    
+    # Revenue counts completed and partially refunded sales, net of refunds
+    net_amount = net_sale_amount()
     
     # Today's sales
-    today = datetime.now().date()
-    today_sales = db.session.query(func.sum(Sale.total_amount)).filter(
+    today_sales = db.session.query(func.sum(net_amount)).filter(
         Sale.shop_id == shop_id,
-        func.date(Sale.created_at) == today,
-        Sale.status == 'completed'
+        Sale.created_at >= today_start,
+        Sale.created_at < tomorrow_start,
+        Sale.status.in_(REVENUE_STATUSES)
     ).scalar() or 0
     
     # This month's sales
-    current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_sales = db.session.query(func.sum(Sale.total_amount)).filter(
+    monthly_sales = db.session.query(func.sum(net_amount)).filter(
         Sale.shop_id == shop_id,
         Sale.created_at >= current_month,
-        Sale.status == 'completed'
+        Sale.status.in_(REVENUE_STATUSES)
     ).scalar() or 0
     
     # Top selling products this month
     top_products = db.session.query(
         Product.name,
-        func.sum(SaleItem.quantity).label('total_quantity'),
-        func.sum(SaleItem.line_total).label('total_revenue')
+        func.sum(net_item_quantity()).label('total_quantity'),
+        func.sum(net_item_revenue()).label('total_revenue')
     ).join(SaleItem).join(Sale).filter(
         Product.shop_id == shop_id,
+        SaleItem.created_at >= current_month,
         Sale.created_at >= current_month,
-        Sale.status == 'completed'
+        Sale.status.in_(REVENUE_STATUSES)
     ).group_by(Product.id, Product.name).order_by(desc('total_revenue')).limit(5).all()
     
-    # Low stock products
-    low_stock_products = Product.query.filter(
-        Product.shop_id == shop_id,
-        Product.stock_quantity <= Product.low_stock_threshold,
-        Product.is_active == True
-    ).limit(10).all()
+    # Low stock products (the count comes from the inventory counters)
+    inventory = get_inventory_counters(shop_id)
+    low_stock_products = []
+    if inventory['low_stock']:
+        low_stock_products = Product.query.filter(
+            Product.shop_id == shop_id,
+            Product.stock_quantity <= Product.low_stock_threshold,
+            Product.is_active == True
+        ).limit(10).all()
     
     # Recent sales
     recent_sales = Sale.query.filter_by(shop_id=shop_id).order_by(desc(Sale.created_at)).limit(10).all()
@@ -68,35 +90,44 @@ def dashboard():
     cashier_performance = db.session.query(
         User.username,
         func.count(Sale.id).label('sale_count'),
-        func.sum(Sale.total_amount).label('total_amount')
+        func.sum(net_amount).label('total_amount')
     ).join(Sale, User.id == Sale.cashier_id).filter(
         Sale.shop_id == shop_id,
-        func.date(Sale.created_at) == today,
-        Sale.status == 'completed'
+        Sale.created_at >= today_start,
+        Sale.created_at < tomorrow_start,
+        Sale.status.in_(REVENUE_STATUSES)
     ).group_by(User.id, User.username).all()
     
-    # Sales trend data for the past 7 days
+    # Sales trend data for the past 7 days (one grouped query)
+    trend_start = today_start - timedelta(days=6)
+    daily_totals = db.session.query(
+        func.date(Sale.created_at).label('date'),
+        func.sum(net_amount).label('total')
+    ).filter(
+        Sale.shop_id == shop_id,
+        Sale.created_at >= trend_start,
+        Sale.created_at < tomorrow_start,
+        Sale.status.in_(REVENUE_STATUSES)
+    ).group_by(func.date(Sale.created_at)).all()
+    totals_by_date = {str(row.date): float(row.total or 0) for row in daily_totals}
+    
     sales_trend = []
     for i in range(6, -1, -1):
-        date = today - timedelta(days=i)
-        daily_sales = db.session.query(func.sum(Sale.total_amount)).filter(
-            Sale.shop_id == shop_id,
-            func.date(Sale.created_at) == date,
-            Sale.status == 'completed'
-        ).scalar() or 0
+        date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
         sales_trend.append({
-            'date': date.strftime('%Y-%m-%d'),
-            'sales': float(daily_sales)
+            'date': date,
+            'sales': totals_by_date.get(date, 0.0)
         })
     
-    return render_template('shop_admin/dashboard.html',
-                         today_sales=today_sales,
-                         monthly_sales=monthly_sales,
-                         top_products=top_products,
-                         low_stock_products=low_stock_products,
-                         recent_sales=recent_sales,
-                         cashier_performance=cashier_performance,
-                         sales_trend=sales_trend)
+    return render_template('shop_admin/dashboard_widgets.html',
+                           today_sales=today_sales,
+                           monthly_sales=monthly_sales,
+                           top_products=top_products,
+                           low_stock_products=low_stock_products,
+                           low_stock_count=inventory['low_stock'],
+                           recent_sales=recent_sales,
+                           cashier_performance=cashier_performance,
+                           sales_trend=sales_trend)
 
 @bp.route('/products')
 @require_shop_access
@@ -171,6 +202,56 @@ def add_product():
     categories = Category.query.filter_by(shop_id=session['shop_id']).all()
     return render_template('shop_admin/add_product.html', categories=categories)
 
+@bp.route('/products/import', methods=['GET', 'POST'])
+@require_shop_access
+def import_products():
+    from flask import current_app
+    from utils.product_import import COLUMNS, ProductImport, run_import_file
+    import os
+    import tempfile
+    import threading
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV or XLSX file to import', 'error')
+            return redirect(url_for('shop_admin.import_products'))
+        
+        extension = os.path.splitext(upload.filename)[1].lower()
+        if extension not in ('.csv', '.xlsx'):
+            flash('Unsupported file type; upload a .csv or .xlsx file', 'error')
+            return redirect(url_for('shop_admin.import_products'))
+        
+        fd, path = tempfile.mkstemp(suffix=extension)
+        with os.fdopen(fd, 'wb') as f:
+            upload.save(f)
+        
+        job = ProductImport(session['shop_id'], session['user_id'])
+        job.save_progress(filename=upload.filename)
+        threading.Thread(
+            target=run_import_file,
+            args=(current_app._get_current_object(), job, path, upload.filename,
+                  request.remote_addr, request.user_agent.string),
+            daemon=True
+        ).start()
+        
+        return redirect(url_for('shop_admin.import_products', job=job.job_id))
+    
+    return render_template('shop_admin/import_products.html', columns=COLUMNS,
+                           job_id=request.args.get('job'))
+
+@bp.route('/products/import/<job_id>/status')
+@rate_limit('polling')
+@require_shop_access
+def import_products_status(job_id):
+    from utils.product_import import get_import_progress
+    
+    progress = get_import_progress(job_id)
+    if progress is None or progress.get('shop_id') != session['shop_id']:
+        return jsonify({'error': 'Import not found'}), 404
+    
+    return jsonify(progress)
+
 @bp.route('/products/<int:product_id>/edit', methods=['GET', 'POST'])
 @require_shop_access
 def edit_product(product_id):
@@ -355,6 +436,150 @@ def delete_category(category_id):
     flash('Category deleted successfully', 'success')
     return redirect(url_for('shop_admin.categories'))
 
+def promotion_from_form(form):
+    """Build promotion fields from the admin form; raises ValueError on invalid input"""
+    from utils.pricing import PROMOTION_TYPES, parse_minutes, to_cents
+    
+    promo_type = form.get('promo_type')
+    if promo_type not in PROMOTION_TYPES:
+        raise ValueError('Choose a promotion type')
+    name = form.get('name', '').strip()
+    if not name:
+        raise ValueError('Promotion name is required')
+    
+    def shop_ids(model, values):
+        ids = {int(value) for value in values if value}
+        found = {row.id for row in model.query.filter(model.shop_id == session['shop_id'], model.id.in_(ids))}
+        if found != ids:
+            raise ValueError('Unknown product or category')
+        return [int(value) for value in values if value]
+    
+    product_id = (shop_ids(Product, [form.get('product_id')]) or [None])[0]
+    category_id = (shop_ids(Category, [form.get('category_id')]) or [None])[0]
+    
+    def percent():
+        value = float(form.get('percent') or 0)
+        if not 0 < value <= 100:
+            raise ValueError('Percentage must be between 0 and 100')
+        return form.get('percent')
+    
+    rules = {}
+    if promo_type == 'multi_buy':
+        if not product_id:
+            raise ValueError('Multi-buy promotions need a product')
+        rules['quantity'] = int(form.get('quantity') or 0)
+        if rules['quantity'] < 2:
+            raise ValueError('Multi-buy quantity must be at least 2')
+        if form.get('price'):
+            rules['price_cents'] = to_cents(form['price'])
+        else:
+            rules['pay_quantity'] = int(form.get('pay_quantity') or 0)
+            if not 0 < rules['pay_quantity'] < rules['quantity']:
+                raise ValueError('Give a multi-buy price or a pay quantity below the buy quantity')
+    elif promo_type == 'category_percent':
+        if not category_id:
+            raise ValueError('Category promotions need a category')
+        product_id = None
+        rules['percent'] = percent()
+    elif promo_type == 'bundle':
+        rules['product_ids'] = shop_ids(Product, form.getlist('bundle_product_ids'))
+        if len(set(rules['product_ids'])) < 2:
+            raise ValueError('Bundles need at least two products')
+        if not form.get('price'):
+            raise ValueError('Bundle price is required')
+        rules['price_cents'] = to_cents(form['price'])
+        product_id = category_id = None
+    else:
+        rules['percent'] = percent()
+        rules['start'] = form.get('start_time') or '00:00'
+        rules['end'] = form.get('end_time') or '24:00'
+        parse_minutes(rules['start'])
+        parse_minutes(rules['end'])
+        days = [int(day) for day in form.getlist('days') if day.isdigit() and int(day) < 7]
+        if days:
+            rules['days'] = days
+    
+    def date_value(field):
+        return datetime.strptime(form[field], '%Y-%m-%d') if form.get(field) else None
+    
+    return {
+        'name': name[:100],
+        'promo_type': promo_type,
+        'product_id': product_id,
+        'category_id': category_id,
+        'rules': rules,
+        'starts_at': date_value('starts_at'),
+        'ends_at': date_value('ends_at'),
+    }
+
+@bp.route('/promotions')
+@require_shop_access
+def promotions():
+    from utils.pricing import PROMOTION_TYPES
+    
+    shop = get_tenant().shop
+    promotions = Promotion.query.filter_by(shop_id=session['shop_id']).order_by(Promotion.created_at.desc()).all()
+    products = Product.query.filter_by(shop_id=session['shop_id'], is_active=True).order_by(Product.name).all()
+    categories = Category.query.filter_by(shop_id=session['shop_id']).order_by(Category.name).all()
+    product_names = {product.id: product.name for product in products}
+    
+    return render_template('shop_admin/promotions.html', promotions=promotions, products=products,
+                           categories=categories, product_names=product_names,
+                           promotion_types=PROMOTION_TYPES,
+                           discounts_enabled=(shop.settings or {}).get('enable_discounts', True))
+
+@bp.route('/promotions/add', methods=['POST'])
+@require_shop_access
+def add_promotion():
+    try:
+        fields = promotion_from_form(request.form)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('shop_admin.promotions'))
+    
+    promotion = Promotion(shop_id=session['shop_id'], created_by=session['user_id'], **fields)
+    db.session.add(promotion)
+    db.session.commit()
+    
+    log_audit(session['user_id'], 'add_promotion', 'promotion', promotion.id,
+              request.remote_addr, request.user_agent.string,
+              new_values={'name': promotion.name, 'promo_type': promotion.promo_type, 'rules': promotion.rules})
+    
+    flash('Promotion added successfully', 'success')
+    return redirect(url_for('shop_admin.promotions'))
+
+@bp.route('/promotions/<int:promotion_id>/toggle', methods=['POST'])
+@require_shop_access
+def toggle_promotion(promotion_id):
+    promotion = Promotion.query.filter_by(id=promotion_id, shop_id=session['shop_id']).first_or_404()
+    
+    promotion.is_active = not promotion.is_active
+    db.session.commit()
+    
+    log_audit(session['user_id'], 'toggle_promotion', 'promotion', promotion_id,
+              request.remote_addr, request.user_agent.string,
+              new_values={'is_active': promotion.is_active})
+    
+    status_text = 'activated' if promotion.is_active else 'deactivated'
+    flash(f'Promotion {status_text} successfully', 'success')
+    return redirect(url_for('shop_admin.promotions'))
+
+@bp.route('/promotions/<int:promotion_id>/delete', methods=['POST'])
+@require_shop_access
+def delete_promotion(promotion_id):
+    promotion = Promotion.query.filter_by(id=promotion_id, shop_id=session['shop_id']).first_or_404()
+    
+    promotion_name = promotion.name
+    db.session.delete(promotion)
+    db.session.commit()
+    
+    log_audit(session['user_id'], 'delete_promotion', 'promotion', promotion_id,
+              request.remote_addr, request.user_agent.string,
+              old_values={'name': promotion_name})
+    
+    flash('Promotion deleted successfully', 'success')
+    return redirect(url_for('shop_admin.promotions'))
+
 @bp.route('/sales')
 @require_shop_access
 def sales():
@@ -386,41 +611,58 @@ def sales():
 @bp.route('/sales/<int:sale_id>/refund', methods=['POST'])
 @require_shop_access
 def refund_sale(sale_id):
-    sale = Sale.query.filter_by(id=sale_id, shop_id=session['shop_id']).first_or_404()
-    
-    if sale.status != 'completed':
-        flash('Can only refund completed sales', 'error')
-        return redirect(url_for('shop_admin.sales'))
+    from utils.sales import refund_sale_items
     
+    sale = Sale.query.filter_by(id=sale_id, shop_id=session['shop_id']).first_or_404()
     reason = request.form['reason']
     
-    # Restore stock quantities
-    for item in sale.items:
-        product = item.product
-        product.stock_quantity += item.quantity
-        
-        # Create stock movement
-        movement = StockMovement(
-            product_id=product.id,
-            movement_type='in',
-            quantity=item.quantity,
-            reference=f'refund_{sale.receipt_number}',
-            notes=f'Refund: {reason}',
-            created_by=session['user_id']
-        )
-        db.session.add(movement)
-    
-    sale.status = 'refunded'
-    sale.refund_reason = reason
-    db.session.commit()
+    # Line-level refunds post quantity_<sale item id> fields; otherwise refund everything
+    quantities = None
+    line_fields = [key for key in request.form if key.startswith('quantity_')]
+    if line_fields:
+        try:
+            quantities = {int(key[len('quantity_'):]): int(request.form[key] or 0) for key in line_fields}
+        except ValueError:
+            flash('Invalid refund quantity', 'error')
+            return redirect(url_for('shop_admin.sales'))
+        quantities = {item_id: quantity for item_id, quantity in quantities.items() if quantity}
+    
+    try:
+        refund = refund_sale_items(sale, reason, session['user_id'], quantities)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+        return redirect(url_for('shop_admin.sales'))
     
     log_audit(session['user_id'], 'refund_sale', 'sale', sale_id,
               request.remote_addr, request.user_agent.string,
-              new_values={'status': 'refunded', 'reason': reason})
+              new_values={'status': sale.status, 'reason': reason, 'refund_id': refund.id,
+                          'amount': float(refund.amount)})
     
-    flash('Sale refunded successfully', 'success')
+    flash(f'Refunded KES {refund.amount:,.2f}', 'success')
     return redirect(url_for('shop_admin.sales'))
 
+@bp.route('/sales/<int:sale_id>/refundable')
+@require_shop_access
+def refundable_items(sale_id):
+    sale = Sale.query.filter_by(id=sale_id, shop_id=session['shop_id']).first_or_404()
+    
+    rows = db.session.query(
+        SaleItem.id, Product.name, SaleItem.quantity,
+        func.coalesce(SaleItem.refunded_quantity, 0), SaleItem.unit_price
+    ).join(Product, Product.id == SaleItem.product_id
+    ).filter(SaleItem.sale_id == sale.id).order_by(SaleItem.id).all()
+    
+    return jsonify([{
+        'id': item_id,
+        'name': name,
+        'quantity': quantity,
+        'refunded_quantity': refunded,
+        'remaining': quantity - refunded,
+        'unit_price': float(unit_price)
+    } for item_id, name, quantity, refunded, unit_price in rows])
+
 @bp.route('/cashiers')
 @require_shop_access
 def cashiers():
@@ -560,7 +802,7 @@ def delete_cashier(cashier_id):
 @bp.route('/settings', methods=['GET', 'POST'])
 @require_shop_access
 def settings():
-    shop = Shop.query.get(session['shop_id'])
+    shop = get_tenant().shop
     
     if request.method == 'POST':
         old_values = {
@@ -617,6 +859,7 @@ def reports():
 
 @bp.route('/reports/sales')
 @require_shop_access
+@read_replica
 def sales_report():
     start_date = request.args.get('start_date', '')
     end_date = request.args.get('end_date', '')
@@ -631,33 +874,34 @@ def sales_report():
     start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
     end_datetime = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
     
-    # Base query for sales in date range
+    # Base query for sales in date range; revenue is net of refunds
+    net_amount = net_sale_amount()
     base_query = Sale.query.filter(
         Sale.shop_id == session['shop_id'],
         Sale.created_at >= start_datetime,
         Sale.created_at < end_datetime,
-        Sale.status == 'completed'
+        Sale.status.in_(REVENUE_STATUSES)
     )
     
     # Summary data
     total_sales = base_query.count()
-    total_revenue = db.session.query(func.sum(Sale.total_amount)).filter(
+    total_revenue = db.session.query(func.sum(net_amount)).filter(
         Sale.shop_id == session['shop_id'],
         Sale.created_at >= start_datetime,
         Sale.created_at < end_datetime,
-        Sale.status == 'completed'
+        Sale.status.in_(REVENUE_STATUSES)
     ).scalar() or 0
     
     # Payment method breakdown
     payment_breakdown = db.session.query(
         Sale.payment_method,
         func.count(Sale.id).label('count'),
-        func.sum(Sale.total_amount).label('total')
+        func.sum(net_amount).label('total')
     ).filter(
         Sale.shop_id == session['shop_id'],
         Sale.created_at >= start_datetime,
         Sale.created_at < end_datetime,
-        Sale.status == 'completed'
+        Sale.status.in_(REVENUE_STATUSES)
     ).group_by(Sale.payment_method).all()
     
     # Daily sales if detailed report
@@ -666,12 +910,12 @@ def sales_report():
         daily_sales = db.session.query(
             func.date(Sale.created_at).label('date'),
             func.count(Sale.id).label('transaction_count'),
-            func.sum(Sale.total_amount).label('total_amount')
+            func.sum(net_amount).label('total_amount')
         ).filter(
             Sale.shop_id == session['shop_id'],
             Sale.created_at >= start_datetime,
             Sale.created_at < end_datetime,
-            Sale.status == 'completed'
+            Sale.status.in_(REVENUE_STATUSES)
         ).group_by(func.date(Sale.created_at)).order_by(func.date(Sale.created_at)).all()
     
     return render_template('shop_admin/sales_report.html',
@@ -685,6 +929,7 @@ def sales_report():
 
 @bp.route('/reports/inventory')
 @require_shop_access
+@read_replica
 def inventory_report():
     category_filter = request.args.get('category', '', type=int)
     status_filter = request.args.get('status', 'all')
@@ -706,24 +951,8 @@ def inventory_report():
     
     products = query.order_by(Product.name).all()
     
-    # Inventory summary
-    total_products = Product.query.filter_by(shop_id=session['shop_id']).count()
-    active_products = Product.query.filter_by(shop_id=session['shop_id'], is_active=True).count()
-    low_stock_count = Product.query.filter(
-        Product.shop_id == session['shop_id'],
-        Product.stock_quantity <= Product.low_stock_threshold,
-        Product.is_active == True
-    ).count()
-    out_of_stock_count = Product.query.filter(
-        Product.shop_id == session['shop_id'],
-        Product.stock_quantity <= 0,
-        Product.is_active == True
-    ).count()
-    
-    # Total inventory value
-    inventory_value = db.session.query(
-        func.sum(Product.cost_price * Product.stock_quantity)
-    ).filter_by(shop_id=session['shop_id'], is_active=True).scalar() or 0
+    # Inventory summary (maintained counters, one row)
+    inventory = get_inventory_counters(session['shop_id'])
     
     categories = Category.query.filter_by(shop_id=session['shop_id']).all()
     
@@ -732,14 +961,157 @@ def inventory_report():
                          categories=categories,
                          selected_category=category_filter,
                          status_filter=status_filter,
-                         total_products=total_products,
-                         active_products=active_products,
-                         low_stock_count=low_stock_count,
-                         out_of_stock_count=out_of_stock_count,
-                         inventory_value=inventory_value)
+                         total_products=inventory['total_products'],
+                         active_products=inventory['active_products'],
+                         low_stock_count=inventory['low_stock'],
+                         out_of_stock_count=inventory['out_of_stock'],
+                         inventory_value=inventory['cost_value'],
+                         retail_value=inventory['retail_value'])
+
+@bp.route('/reports/inventory/history')
+@require_shop_access
+@read_replica
+def inventory_history():
+    """Stock levels at the end of a past day"""
+    from utils.stock_history import parse_date, stock_levels_at
+    
+    try:
+        day = parse_date(request.args.get('date'), datetime.utcnow().date())
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    
+    product_id = request.args.get('product_id', type=int)
+    levels = stock_levels_at(session['shop_id'], day, [product_id] if product_id else None)
+    
+    return jsonify({
+        'date': day.isoformat(),
+        'products': [{'product_id': pid, 'quantity': quantity, 'cost_price': float(cost or 0)}
+                     for pid, (quantity, cost) in sorted(levels.items())]
+    })
+
+@bp.route('/reports/inventory/valuation')
+@require_shop_access
+@read_replica
+def inventory_valuation():
+    """Stock valuation at the end of a day (month-end by default)"""
+    from utils.stock_history import parse_date, stock_valuation
+    
+    today = datetime.utcnow().date()
+    try:
+        day = parse_date(request.args.get('date'), today.replace(day=1) - timedelta(days=1))
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    
+    valuation = stock_valuation(session['shop_id'], day)
+    return jsonify({
+        'date': day.isoformat(),
+        'products': valuation['products'],
+        'total_quantity': valuation['total_quantity'],
+        'total_value': float(valuation['total_value']),
+        'by_category': {name: {'quantity': c['quantity'], 'value': float(c['value'])}
+                        for name, c in valuation['by_category'].items()}
+    })
+
+@bp.route('/reports/inventory/shrinkage')
+@require_shop_access
+@read_replica
+def inventory_shrinkage():
+    """Stock written down between two dates"""
+    from utils.stock_history import parse_date, shrinkage
+    
+    today = datetime.utcnow().date()
+    try:
+        start = parse_date(request.args.get('start_date'), today.replace(day=1))
+        end = parse_date(request.args.get('end_date'), today)
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    
+    result = shrinkage(session['shop_id'], start, end)
+    return jsonify({
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'total_quantity': result['total_quantity'],
+        'total_value': float(result['total_value']),
+        'products': [dict(p, value=float(p['value'])) for p in result['products']]
+    })
+
+def forecast_from_args(args):
+    """Run the inventory forecast with parameters from the query string or form"""
+    from utils.forecasting import forecast_inventory
+    
+    return forecast_inventory(
+        session['shop_id'],
+        method=args.get('method') or None,
+        history_days=args.get('history_days', type=int),
+        lead_time_days=args.get('lead_time_days', type=int),
+        review_days=args.get('review_days', type=int),
+    )
+
+@bp.route('/reports/inventory/forecast')
+@require_shop_access
+@read_replica
+def inventory_forecast():
+    """Demand forecast, days of cover and suggested reorders"""
+    try:
+        forecast = forecast_from_args(request.args)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('shop_admin.inventory_forecast'))
+    
+    show_all = request.args.get('show') == 'all'
+    reorders = [p for p in forecast['products'] if p['needs_reorder']]
+    return render_template('shop_admin/inventory_forecast.html',
+                           forecast=forecast,
+                           products=forecast['products'][:500] if show_all else reorders,
+                           show_all=show_all,
+                           reorder_count=len(reorders),
+                           reorder_units=sum(p['suggested_order'] for p in reorders),
+                           reorder_cost=sum(p['suggested_order_cost'] for p in reorders))
+
+@bp.route('/api/inventory/forecast')
+@require_shop_access
+@read_replica
+def inventory_forecast_api():
+    """Inventory forecast for every active product as JSON"""
+    try:
+        forecast = forecast_from_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if request.args.get('reorder_only') == '1':
+        forecast['products'] = [p for p in forecast['products'] if p['needs_reorder']]
+    return jsonify(forecast)
+
+@bp.route('/reports/inventory/forecast/apply', methods=['POST'])
+@require_shop_access
+def apply_forecast_thresholds():
+    """Replace static low-stock thresholds with forecast reorder points"""
+    from utils.forecasting import apply_reorder_points
+    
+    try:
+        forecast = forecast_from_args(request.form)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('shop_admin.inventory_forecast'))
+    
+    updated = apply_reorder_points(session['shop_id'], forecast)
+    db.session.commit()
+    
+    log_audit(session['user_id'], 'apply_forecast_thresholds', 'shop', session['shop_id'],
+              request.remote_addr, request.user_agent.string,
+              new_values={'products_updated': updated, 'method': forecast['method'],
+                          'history_days': forecast['history_days'],
+                          'lead_time_days': forecast['lead_time_days']})
+    
+    flash(f'Low-stock thresholds updated for {updated} products', 'success')
+    return redirect(url_for('shop_admin.inventory_forecast', method=forecast['method'],
+                            history_days=forecast['history_days'],
+                            lead_time_days=forecast['lead_time_days'],
+                            review_days=forecast['review_days']))
 
 @bp.route('/reports/cashier-performance')
 @require_shop_access
+@read_replica
 def cashier_performance_report():
     start_date = request.args.get('start_date', '')
     end_date = request.args.get('end_date', '')
@@ -753,27 +1125,79 @@ def cashier_performance_report():
     start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
     end_datetime = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
     
-    # Cashier performance data
+    # Cashier performance data (revenue net of refunds)
+    net_amount = net_sale_amount()
     cashier_stats = db.session.query(
         User.username,
         User.email,
         func.count(Sale.id).label('total_sales'),
-        func.sum(Sale.total_amount).label('total_revenue'),
-        func.avg(Sale.total_amount).label('avg_sale'),
+        func.sum(net_amount).label('total_revenue'),
+        func.avg(net_amount).label('avg_sale'),
         func.min(Sale.created_at).label('first_sale'),
         func.max(Sale.created_at).label('last_sale')
     ).join(Sale, User.id == Sale.cashier_id).filter(
         Sale.shop_id == session['shop_id'],
         Sale.created_at >= start_datetime,
         Sale.created_at < end_datetime,
-        Sale.status == 'completed'
-    ).group_by(User.id, User.username, User.email).order_by(func.sum(Sale.total_amount).desc()).all()
+        Sale.status.in_(REVENUE_STATUSES)
+    ).group_by(User.id, User.username, User.email).order_by(desc('total_revenue')).all()
     
     return render_template('shop_admin/cashier_performance_report.html',
                          start_date=start_date,
                          end_date=end_date,
                          cashier_stats=cashier_stats)
 
+@bp.route('/reports/sales/export')
+@require_shop_access
+@read_replica
+def export_sales_report():
+    from flask import Response, stream_with_context
+    from utils.reports import iter_sales_csv, generate_sales_report_pdf
+    
+    start_date = request.args.get('start_date', '')
+    end_date = request.args.get('end_date', '')
+    export_format = request.args.get('format', 'csv')
+    
+    # Default to current month if no dates provided
+    if not start_date:
+        start_date = datetime.now().replace(day=1).strftime('%Y-%m-%d')
+    if not end_date:
+        end_date = datetime.now().strftime('%Y-%m-%d')
+    
+    start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+    end_datetime = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+    
+    filename = f"sales_{start_date}_{end_date}"
+    
+    if export_format == 'pdf':
+        sales_data = Sale.query.options(
+            selectinload(Sale.cashier_user),
+            selectinload(Sale.items)
+        ).filter(
+            Sale.shop_id == session['shop_id'],
+            Sale.created_at >= start_datetime,
+            Sale.created_at < end_datetime
+        ).order_by(Sale.created_at).all()
+        shop = get_tenant().shop
+        pdf = generate_sales_report_pdf(sales_data, shop.name, 'Sales Report', f"{start_date} to {end_date}")
+        return Response(pdf.getvalue(), mimetype='application/pdf',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.pdf'})
+    
+    # CSV is streamed in batches straight from the cursor (and compressed on the fly)
+    rows = db.session.execute(
+        select(Sale.receipt_number, Sale.created_at, User.username, Sale.customer_phone,
+               Sale.customer_name, Sale.subtotal, Sale.tax_amount, Sale.total_amount,
+               Sale.payment_method, Sale.mpesa_receipt, Sale.status)
+        .outerjoin(User, User.id == Sale.cashier_id)
+        .where(Sale.shop_id == session['shop_id'],
+               Sale.created_at >= start_datetime,
+               Sale.created_at < end_datetime)
+        .order_by(Sale.created_at)
+        .execution_options(yield_per=2000)
+    )
+    return Response(stream_with_context(iter_sales_csv(rows)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+
 @bp.route('/bulk-actions', methods=['POST'])
 @require_shop_access
 def bulk_actions():
@@ -785,18 +1209,16 @@ def bulk_actions():
         return redirect(request.referrer or url_for('shop_admin.products'))
     
     if action == 'activate_products':
-        Product.query.filter(
-            Product.id.in_(selected_items),
-            Product.shop_id == session['shop_id']
-        ).update({'is_active': True}, synchronize_session=False)
+        selected = (Product.id.in_(selected_items), Product.shop_id == session['shop_id'])
+        with track_inventory(*selected):
+            Product.query.filter(*selected).update({'is_active': True}, synchronize_session=False)
         db.session.commit()
         flash(f'{len(selected_items)} products activated', 'success')
         
     elif action == 'deactivate_products':
-        Product.query.filter(
-            Product.id.in_(selected_items),
-            Product.shop_id == session['shop_id']
-        ).update({'is_active': False}, synchronize_session=False)
+        selected = (Product.id.in_(selected_items), Product.shop_id == session['shop_id'])
+        with track_inventory(*selected):
+            Product.query.filter(*selected).update({'is_active': False}, synchronize_session=False)
         db.session.commit()
         flash(f'{len(selected_items)} products deactivated', 'success')
         
@@ -3,6 +3,8 @@ from werkzeug.security import generate_password_hash
 from models import User, Shop, LicensePayment, MpesaTransaction, AuditLog, SystemSettings, Sale, Product
 from app import db
 from utils.auth import require_role, log_audit
+from utils.licenses import get_expiring_licenses, invalidate_license
+from utils.database import read_replica
 from datetime import datetime, timedelta
 from sqlalchemy import func, desc
 
@@ -15,6 +17,7 @@ def check_auth():
 
 @bp.route('/dashboard')
 @require_role('super_admin')
+@read_replica
 def dashboard():
     # Statistics
     total_shops = Shop.query.count()
@@ -31,11 +34,8 @@ def dashboard():
     # Recent MPesa transactions
     recent_transactions = MpesaTransaction.query.filter_by(transaction_type='license').order_by(desc(MpesaTransaction.created_at)).limit(10).all()
     
-    # Shops with expiring licenses (next 30 days)
-    expiring_soon = datetime.now() + timedelta(days=30)
-    expiring_licenses = Shop.query.filter(
-        Shop.license_expires.between(datetime.now(), expiring_soon)
-    ).all()
+    # Shops with expiring licenses (precomputed by the license sweep)
+    expiring_licenses = get_expiring_licenses()
     
     # Recent audit logs
     recent_logs = AuditLog.query.order_by(desc(AuditLog.created_at)).limit(20).all()
@@ -75,6 +75,7 @@ def toggle_shop_status(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     shop.is_active = not shop.is_active
     db.session.commit()
+    invalidate_license(shop_id)
     
     log_audit(session['user_id'], 'toggle_shop_status', 'shop', shop_id, 
               request.remote_addr, request.user_agent.string,
@@ -219,6 +220,72 @@ def toggle_user_status(user_id):
     flash(f'User {user.username} has been {status}', 'success')
     return redirect(url_for('super_admin.users'))
 
+ANALYTICS_PERIODS = (7, 30, 90)
+
+def analytics_args():
+    """Validated period and metric for the analytics views"""
+    from utils.analytics import METRICS
+    
+    days = request.args.get('days', 30, type=int)
+    metric = request.args.get('metric', 'gmv')
+    return (days if days in ANALYTICS_PERIODS else 30), (metric if metric in METRICS else 'gmv')
+
+@bp.route('/analytics')
+@require_role('super_admin')
+@read_replica
+def analytics():
+    from utils.analytics import METRICS, churn_risk, daily_series, platform_summary, shop_growth, top_shops
+    
+    days, metric = analytics_args()
+    return render_template('super_admin/analytics.html',
+                           days=days, metric=metric, periods=ANALYTICS_PERIODS, metrics=METRICS,
+                           summary=platform_summary(days),
+                           top_shops=top_shops(metric, days),
+                           growth=shop_growth(days),
+                           churn=churn_risk(),
+                           series=daily_series(days))
+
+@bp.route('/api/analytics')
+@require_role('super_admin')
+@read_replica
+def analytics_api():
+    """Platform analytics as JSON"""
+    from utils.analytics import churn_risk, daily_series, platform_summary, shop_growth, top_shops
+    
+    days, metric = analytics_args()
+    limit = min(request.args.get('limit', 20, type=int), 500)
+    return jsonify({
+        'summary': platform_summary(days),
+        'top_shops': top_shops(metric, days, limit),
+        'growth': shop_growth(days, limit),
+        'churn_risk': churn_risk(request.args.get('expiring_within', 30, type=int)),
+        'daily': daily_series(days),
+    })
+
+@bp.route('/analytics/export')
+@require_role('super_admin')
+@read_replica
+def export_analytics():
+    """Download the per-shop daily aggregates as Parquet"""
+    import io
+    from flask import Response
+    from utils.analytics import export_parquet
+    
+    output = io.BytesIO()
+    try:
+        rows = export_parquet(output)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('super_admin.analytics'))
+    
+    log_audit(session['user_id'], 'export_analytics', 'platform', None,
+              request.remote_addr, request.user_agent.string,
+              new_values={'rows': rows})
+    
+    filename = f"shop_daily_sales_{datetime.utcnow():%Y%m%d}.parquet"
+    return Response(output.getvalue(), mimetype='application/vnd.apache.parquet',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @bp.route('/licenses')
 @require_role('super_admin')
 def licenses():
@@ -273,6 +340,7 @@ def approve_mpesa_license(transaction_id):
     
     # Update shop
     shop.license_expires = license_end
+    shop.license_status = 'active'
     shop.is_active = True
     
     # Mark transaction as processed
@@ -281,6 +349,7 @@ def approve_mpesa_license(transaction_id):
     
     db.session.add(payment)
     db.session.commit()
+    invalidate_license(shop.id)
     
     log_audit(session['user_id'], 'approve_license', 'license_payment', payment.id,
               request.remote_addr, request.user_agent.string,
@@ -0,0 +1,75 @@
+"""
+Response Schemas
+Shapes of the JSON API responses, compiled once at import (see utils.serializers)
+"""
+
+from sqlalchemy import func
+from models import Customer, LoyaltyEntry, MpesaTransaction, Product, Sale
+from utils.serializers import Schema, as_float, as_timestamp, default_to
+
+# Product search and barcode lookup on the till
+PRODUCT_LOOKUP = Schema('product_lookup', [
+    ('id', Product.id),
+    ('name', Product.name),
+    ('price', Product.price, as_float),
+    ('barcode', Product.barcode),
+    ('stock_quantity', Product.stock_quantity),
+])
+
+# A sale's confirmed M-Pesa payment, as shown on the till
+SALE_PAYMENT = Schema('sale_payment', [
+    ('amount', Sale.total_amount, as_float),
+    ('phone', Sale.customer_phone, default_to('Unknown')),
+    ('mpesa_code', Sale.mpesa_receipt),
+    ('customer_name', Sale.customer_name, default_to('Customer')),
+    ('transaction_time', Sale.created_at, as_timestamp),
+])
+
+# An unmatched M-Pesa transaction that may pay for a sale
+MPESA_PAYMENT = Schema('mpesa_payment', [
+    ('amount', MpesaTransaction.amount, as_float),
+    ('phone', MpesaTransaction.msisdn),
+    ('mpesa_code', MpesaTransaction.transaction_id),
+    ('customer_name', func.trim(func.coalesce(MpesaTransaction.first_name, '') + ' '
+                                + func.coalesce(MpesaTransaction.middle_name, '') + ' '
+                                + func.coalesce(MpesaTransaction.last_name, '')), default_to('Customer')),
+    ('transaction_time', MpesaTransaction.transaction_time, as_timestamp),
+])
+
+# Payment status of a completed sale (M-Pesa payment stream and polling)
+PAYMENT_COMPLETED = Schema('payment_completed', [
+    ('mpesa_receipt', Sale.mpesa_receipt),
+    ('customer_phone', Sale.customer_phone),
+    ('customer_name', Sale.customer_name),
+    ('amount', Sale.total_amount, as_float),
+])
+
+# A returning customer looked up at the till
+CUSTOMER = Schema('customer', [
+    ('id', Customer.id),
+    ('phone', Customer.msisdn),
+    ('name', Customer.name, default_to('Customer')),
+    ('points_balance', Customer.points_balance),
+    ('purchases_count', Customer.purchases_count),
+    ('total_spent', Customer.total_spent, as_float),
+    ('last_purchase_at', Customer.last_purchase_at, as_timestamp),
+])
+
+# A sale in a customer's purchase history
+CUSTOMER_PURCHASE = Schema('customer_purchase', [
+    ('sale_id', Sale.id),
+    ('receipt_number', Sale.receipt_number),
+    ('total_amount', Sale.total_amount, as_float),
+    ('status', Sale.status),
+    ('created_at', Sale.created_at, as_timestamp),
+])
+
+# A points ledger entry with the balance it left
+LOYALTY_ENTRY = Schema('loyalty_entry', [
+    ('entry_type', LoyaltyEntry.entry_type),
+    ('points', LoyaltyEntry.points),
+    ('balance_after', LoyaltyEntry.balance_after),
+    ('sale_id', LoyaltyEntry.sale_id),
+    ('note', LoyaltyEntry.note),
+    ('created_at', LoyaltyEntry.created_at, as_timestamp),
+])
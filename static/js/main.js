@@ -371,6 +371,13 @@ const ComolorPOS = {
     },
     
     // AJAX helpers
+    newIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    },
+    
     async makeRequest(url, options = {}) {
         const defaultOptions = {
             headers: {
@@ -379,6 +386,15 @@ const ComolorPOS = {
             ...options
         };
         
+        // One key per request, kept when it is queued offline, so a
+        // retried sale or payment is replayed by the server, not repeated
+        if (['POST', 'PUT', 'PATCH'].includes(defaultOptions.method?.toUpperCase())) {
+            defaultOptions.headers = {
+                'Idempotency-Key': this.newIdempotencyKey(),
+                ...defaultOptions.headers
+            };
+        }
+        
         try {
             const response = await fetch(url, defaultOptions);
             
@@ -449,10 +465,10 @@ document.addEventListener('DOMContentLoaded', function() {
 // Export for global use
 window.ComolorPOS = ComolorPOS;
 
-// Service Worker registration for offline support
+// Service Worker registration for the offline till
 if ('serviceWorker' in navigator) {
     window.addEventListener('load', function() {
-        navigator.serviceWorker.register('/static/sw.js')
+        navigator.serviceWorker.register('/sw.js', { scope: '/cashier/' })
             .then(function(registration) {
                 console.log('ServiceWorker registration successful');
             })
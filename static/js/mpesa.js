@@ -3,6 +3,7 @@
 class MpesaIntegration {
     constructor() {
         this.pollingInterval = null;
+        this.eventSource = null;
         this.maxPollingAttempts = 60; // 5 minutes
         this.pollingAttempts = 0;
         this.isPolling = false;
@@ -41,6 +42,12 @@ class MpesaIntegration {
         
         window.alert(`MPesa payment request initiated!\n\nPhone: ${phoneNumber}\nAmount: ${amount}\n\nCustomer should check their phone for MPesa prompt.\nPayment will be verified automatically.`);
         
+        // Cooperative servers push status changes over one open connection
+        if (typeof PAYMENT_STREAMING !== 'undefined' && PAYMENT_STREAMING && window.EventSource) {
+            this.startPaymentStream(saleId);
+            return;
+        }
+        
         console.log('Starting payment polling for sale:', saleId);
         
         this.pollingInterval = setInterval(() => {
@@ -51,6 +58,33 @@ class MpesaIntegration {
         this.checkPaymentStatus();
     }
     
+    startPaymentStream(saleId) {
+        console.log('Streaming payment status for sale:', saleId);
+        
+        this.eventSource = new EventSource(`/mpesa/payment/stream/${saleId}`);
+        this.eventSource.addEventListener('status', (event) => {
+            const result = JSON.parse(event.data);
+            if (result.status === 'completed') {
+                this.handlePaymentReceived(result);
+            } else if (result.status === 'pending' && result.till_number) {
+                const tillInfo = document.getElementById('till-info');
+                if (tillInfo) {
+                    tillInfo.innerHTML = `<strong>Till Number: ${result.till_number}</strong><br>Customer should send KES ${result.amount} to this till number`;
+                }
+            }
+        });
+        this.eventSource.addEventListener('timeout', () => this.handlePollingTimeout());
+        this.eventSource.onerror = () => {
+            // Fall back to polling if the stream cannot be kept open
+            if (this.eventSource && this.eventSource.readyState === EventSource.CLOSED) {
+                this.eventSource = null;
+                this.pollingInterval = setInterval(() => {
+                    this.checkPaymentStatus();
+                }, 3000);
+            }
+        };
+    }
+    
     async checkPaymentStatus() {
         this.pollingAttempts++;
         
@@ -158,15 +192,12 @@ Transaction completed successfully!`;
         }
         
         try {
-            const response = await fetch('/cashier/api/mpesa/confirm-payment', {
+            const response = await fetch(`/cashier/mpesa/confirm/${this.saleId}`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    mpesa_id: this.pendingPaymentData.mpesa_id,
-                    sale_id: this.saleId
-                })
+                    'Idempotency-Key': newClientUuid()
+                }
             });
             
             if (response.ok) {
@@ -250,6 +281,10 @@ Would you like to try the payment again?`;
     }
     
     stopPolling() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
         if (this.pollingInterval) {
             clearInterval(this.pollingInterval);
             this.pollingInterval = null;
@@ -0,0 +1,142 @@
+/**
+ * Comolor POS - Offline Sales Queue
+ * Sales made on the till are kept in IndexedDB until the server has recorded
+ * them, and uploaded in batches to /cashier/sales/batch. Loaded by the POS
+ * page and by the service worker, so the queue also drains in the background.
+ */
+
+const OFFLINE_DB_NAME = 'comolor-pos';
+const OFFLINE_DB_VERSION = 1;
+const QUEUED_SALES = 'queued_sales';
+const REJECTED_SALES = 'rejected_sales';
+const UPLOAD_BATCH_SIZE = 100; // MAX_OFFLINE_BATCH on the server
+const SALES_BATCH_URL = '/cashier/sales/batch';
+
+class SaleQueue {
+    constructor() {
+        this.db = null;
+        this.uploading = null;
+    }
+
+    open() {
+        if (!this.db) {
+            this.db = new Promise((resolve, reject) => {
+                const request = indexedDB.open(OFFLINE_DB_NAME, OFFLINE_DB_VERSION);
+                request.onupgradeneeded = () => {
+                    const db = request.result;
+                    if (!db.objectStoreNames.contains(QUEUED_SALES)) {
+                        const store = db.createObjectStore(QUEUED_SALES, { keyPath: 'client_uuid' });
+                        store.createIndex('created_at', 'created_at');
+                    }
+                    if (!db.objectStoreNames.contains(REJECTED_SALES)) {
+                        db.createObjectStore(REJECTED_SALES, { keyPath: 'client_uuid' });
+                    }
+                };
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => reject(request.error);
+            });
+        }
+        return this.db;
+    }
+
+    // Run work(tx) in one transaction; resolves with its return value once committed
+    async transaction(stores, mode, work) {
+        const db = await this.open();
+        return new Promise((resolve, reject) => {
+            const tx = db.transaction(stores, mode);
+            const pending = work(tx);
+            tx.oncomplete = () => resolve(pending && pending.result !== undefined ? pending.result : pending);
+            tx.onerror = () => reject(tx.error);
+            tx.onabort = () => reject(tx.error);
+        });
+    }
+
+    add(sale) {
+        return this.transaction([QUEUED_SALES], 'readwrite', tx => {
+            tx.objectStore(QUEUED_SALES).put(sale);
+        });
+    }
+
+    // Oldest queued sales first
+    list(limit = UPLOAD_BATCH_SIZE) {
+        return this.transaction([QUEUED_SALES], 'readonly', tx =>
+            tx.objectStore(QUEUED_SALES).index('created_at').getAll(null, limit)
+        );
+    }
+
+    count() {
+        return this.transaction([QUEUED_SALES], 'readonly', tx => tx.objectStore(QUEUED_SALES).count());
+    }
+
+    rejected() {
+        return this.transaction([REJECTED_SALES], 'readonly', tx => tx.objectStore(REJECTED_SALES).getAll());
+    }
+
+    // Drop sales the server recorded; park the ones it rejected for a supervisor
+    settle(sales, results) {
+        const byUuid = new Map(sales.map(sale => [sale.client_uuid, sale]));
+        return this.transaction([QUEUED_SALES, REJECTED_SALES], 'readwrite', tx => {
+            const queued = tx.objectStore(QUEUED_SALES);
+            const rejected = tx.objectStore(REJECTED_SALES);
+            results.forEach(result => {
+                const sale = byUuid.get(result.client_uuid);
+                if (!sale) return;
+                queued.delete(sale.client_uuid);
+                if (result.status === 'rejected') {
+                    rejected.put({ ...sale, error: result.error, rejected_at: new Date().toISOString() });
+                }
+            });
+        });
+    }
+
+    // Upload every queued sale; one upload at a time per page or worker
+    upload() {
+        if (!this.uploading) {
+            this.uploading = this.uploadBatches().finally(() => {
+                this.uploading = null;
+            });
+        }
+        return this.uploading;
+    }
+
+    async uploadBatches() {
+        const totals = { created: 0, duplicate: 0, rejected: 0 };
+        for (;;) {
+            const sales = await this.list();
+            if (sales.length === 0) break;
+
+            const response = await fetch(SALES_BATCH_URL, {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ sales })
+            });
+            // Signed out (redirected to the login page) or the server failed: try again later
+            if (!response.ok || response.redirected) {
+                throw new Error(`Sales upload failed: ${response.status}`);
+            }
+
+            const result = await response.json();
+            await this.settle(sales, result.results);
+            totals.created += result.created;
+            totals.duplicate += result.duplicate;
+            totals.rejected += result.rejected;
+            if (sales.length < UPLOAD_BATCH_SIZE) break;
+        }
+        return totals;
+    }
+}
+
+function newClientUuid() {
+    if (self.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    // RFC 4122 version 4 from Math.random where randomUUID is unavailable
+    return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, c => {
+        const r = Math.random() * 16 | 0;
+        return (c === 'x' ? r : (r & 0x3 | 0x8)).toString(16);
+    });
+}
+
+self.SaleQueue = SaleQueue;
+self.newClientUuid = newClientUuid;
@@ -1,469 +1,565 @@
 /**
  * Comolor POS System - Point of Sale Interface
- * Real-world ready POS functionality with comprehensive features
+ * The till keeps working without a connection: products come from a cached
+ * catalogue, receipt numbers from a block leased to this till, and completed
+ * sales are queued in IndexedDB (offline.js) and uploaded when the network
+ * is back.
  */
 
-class POS {
+const RECEIPT_PREFIX = 'RCP';
+const RECEIPT_REFILL_AT = 20; // lease another block when fewer numbers are left
+const SYNC_INTERVAL = 30000; // 30 seconds
+const PRICE_DEBOUNCE = 300;
+
+class POSSystem {
     constructor() {
         this.cart = [];
-        this.products = [];
-        this.currentSale = null;
+        this.products = new Map();
+        this.barcodes = new Map();
+        this.serverTotals = null;
+        this.currentSaleId = null;
         this.isProcessingPayment = false;
+        this.shift = null;
+        this.queue = new SaleQueue();
+        this.tillId = this.getTillId();
         this.init();
     }
 
     init() {
         this.setupEventListeners();
-        this.loadProducts();
         this.restoreCart();
+        this.loadCatalogue();
+        this.ensureReceiptNumbers();
+        this.setupSync();
+        this.loadShift();
         console.log('POS System initialized');
     }
 
     setupEventListeners() {
-        // Product search
-        const searchInput = document.getElementById('product-search');
+        const searchInput = document.getElementById('productSearch');
         if (searchInput) {
             searchInput.addEventListener('input', this.debounce((e) => {
                 this.searchProducts(e.target.value);
             }, 300));
-        }
-
-        // Barcode input
-        const barcodeInput = document.getElementById('barcode-input');
-        if (barcodeInput) {
-            barcodeInput.addEventListener('keypress', (e) => {
-                if (e.key === 'Enter') {
-                    this.searchByBarcode(e.target.value);
+            searchInput.addEventListener('keypress', (e) => {
+                if (e.key === 'Enter' && e.target.value.trim()) {
+                    this.searchByBarcode(e.target.value.trim());
                     e.target.value = '';
+                    this.searchProducts('');
                 }
             });
         }
 
-        // Payment method selection
-        document.addEventListener('click', (e) => {
-            if (e.target.matches('[data-payment-method]')) {
-                this.selectPaymentMethod(e.target.dataset.paymentMethod);
-            }
-        });
+        const amountReceived = document.getElementById('amountReceived');
+        if (amountReceived) {
+            amountReceived.addEventListener('input', () => this.updateChange());
+        }
 
-        // Cart operations
-        document.addEventListener('click', (e) => {
-            if (e.target.matches('[data-cart-action]')) {
-                const action = e.target.dataset.cartAction;
-                const productId = e.target.dataset.productId;
-                this.handleCartAction(action, productId);
-            }
+        // Quantity and remove buttons in the cart
+        const cartItems = document.getElementById('cartItems');
+        if (cartItems) {
+            cartItems.addEventListener('click', (e) => {
+                const button = e.target.closest('[data-item-action]');
+                if (!button) return;
+                const productId = button.closest('.cart-item').dataset.productId;
+                const action = button.dataset.itemAction;
+                if (action === 'increase') this.changeQuantity(productId, 1);
+                if (action === 'decrease') this.changeQuantity(productId, -1);
+                if (action === 'remove') this.removeFromCart(productId);
+            });
+        }
+
+        // M-Pesa payment confirmed on the server: the sale is complete
+        document.addEventListener('paymentConfirmed', () => {
+            this.finishSale();
+            this.notify('M-Pesa payment confirmed', 'success');
         });
     }
 
-    async loadProducts() {
+    // Catalogue
+
+    async loadCatalogue() {
         try {
-            // In real implementation, this would fetch from server
-            window.alert('Loading products from inventory...\n\nIn a real application, this would fetch current product data from the database.');
-            
-            // Simulate product loading
-            this.products = [
-                { id: 1, name: 'Coca Cola 500ml', price: 60.00, barcode: '1234567890123', stock: 50 },
-                { id: 2, name: 'White Bread', price: 45.00, barcode: '2345678901234', stock: 25 },
-                { id: 3, name: 'Milk 1L', price: 55.00, barcode: '3456789012345', stock: 30 }
-            ];
-            
-            this.renderProducts(this.products);
+            // Served network-first by the service worker, so this also works offline
+            const response = await fetch('/cashier/api/products/catalogue', { credentials: 'same-origin' });
+            if (!response.ok || response.redirected) return;
+            const products = await response.json();
+            this.products.clear();
+            this.barcodes.clear();
+            products.forEach(product => {
+                this.products.set(String(product.id), product);
+                if (product.barcode) {
+                    this.barcodes.set(product.barcode, product);
+                }
+            });
         } catch (error) {
-            window.alert('Error loading products from inventory.\nPlease check your connection and try again.');
+            console.warn('Product catalogue unavailable:', error);
         }
     }
 
-    renderProducts(products) {
-        const container = document.getElementById('products-grid');
-        if (!container) return;
-
-        container.innerHTML = products.map(product => `
-            <div class="col-md-4 mb-3">
-                <div class="card product-card" data-product-id="${product.id}">
-                    <div class="card-body">
-                        <h6 class="card-title">${product.name}</h6>
-                        <p class="card-text">
-                            <strong>KES ${product.price.toFixed(2)}</strong><br>
-                            <small class="text-muted">Stock: ${product.stock}</small>
-                        </p>
-                        <button class="btn btn-primary btn-sm" onclick="pos.addToCart(${product.id})">
-                            Add to Cart
-                        </button>
-                    </div>
-                </div>
-            </div>
-        `).join('');
-    }
-
     searchProducts(query) {
-        if (!query.trim()) {
-            this.renderProducts(this.products);
-            return;
-        }
-
-        const filtered = this.products.filter(product =>
-            product.name.toLowerCase().includes(query.toLowerCase()) ||
-            product.barcode.includes(query)
-        );
-
-        if (filtered.length === 0) {
-            window.alert(`No products found for: "${query}"\n\nTry adjusting your search terms or scan the barcode directly.`);
-        }
-
-        this.renderProducts(filtered);
+        const term = query.trim().toLowerCase();
+        document.querySelectorAll('#productContainer .product-card').forEach(card => {
+            const product = this.products.get(card.dataset.productId);
+            const matches = !term
+                || card.dataset.productName.toLowerCase().includes(term)
+                || (product && product.barcode && product.barcode.includes(term));
+            card.parentElement.style.display = matches ? '' : 'none';
+        });
     }
 
     searchByBarcode(barcode) {
-        if (!barcode.trim()) return;
-
-        const product = this.products.find(p => p.barcode === barcode);
-        
+        const product = this.barcodes.get(barcode);
         if (product) {
-            window.alert(`Product found!\n\nName: ${product.name}\nPrice: KES ${product.price.toFixed(2)}\nStock: ${product.stock}\n\nAdding to cart...`);
-            this.addToCart(product.id);
+            this.addToCart(product.id, product.name, product.price);
+            const sound = document.getElementById('scanSuccessSound');
+            if (sound) sound.play().catch(() => {});
         } else {
-            window.alert(`Product not found for barcode: ${barcode}\n\nPlease verify the barcode or add the product to inventory first.`);
+            this.notify(`No product with barcode ${barcode}`, 'warning');
         }
     }
 
-    addToCart(productId) {
-        const product = this.products.find(p => p.id === productId);
-        if (!product) {
-            window.alert('Product not found. Please refresh and try again.');
-            return;
+    // Cart
+
+    addToCart(productId, name, price) {
+        productId = String(productId);
+        const item = this.cart.find(line => line.productId === productId);
+        if (item) {
+            item.quantity += 1;
+        } else {
+            this.cart.push({ productId, name, price: Number(price), quantity: 1 });
         }
+        this.cartChanged();
+    }
 
-        if (product.stock <= 0) {
-            window.alert(`${product.name} is out of stock!\n\nPlease restock before selling.`);
+    changeQuantity(productId, delta) {
+        const item = this.cart.find(line => line.productId === String(productId));
+        if (!item) return;
+        item.quantity += delta;
+        if (item.quantity < 1) {
+            this.removeFromCart(productId);
             return;
         }
+        this.cartChanged();
+    }
 
-        const existingItem = this.cart.find(item => item.productId === productId);
-        
-        if (existingItem) {
-            if (existingItem.quantity >= product.stock) {
-                window.alert(`Cannot add more ${product.name}.\n\nOnly ${product.stock} items available in stock.`);
-                return;
-            }
-            existingItem.quantity++;
-        } else {
-            this.cart.push({
-                productId,
-                name: product.name,
-                price: product.price,
-                quantity: 1,
-                lineTotal: product.price
-            });
-        }
+    removeFromCart(productId) {
+        this.cart = this.cart.filter(line => line.productId !== String(productId));
+        this.cartChanged();
+    }
+
+    clearCart() {
+        this.cart = [];
+        this.cartChanged();
+    }
 
-        this.updateCart();
+    cartChanged() {
+        this.serverTotals = null;
         this.saveCart();
-        
-        window.alert(`${product.name} added to cart!\n\nQuantity: ${existingItem ? existingItem.quantity : 1}\nPrice: KES ${product.price.toFixed(2)}`);
+        this.renderCart();
+        this.refreshTotals();
     }
 
-    updateCart() {
-        this.cart.forEach(item => {
-            item.lineTotal = item.price * item.quantity;
-        });
+    saveCart() {
+        localStorage.setItem('pos_cart', JSON.stringify(this.cart));
+    }
 
+    restoreCart() {
+        try {
+            this.cart = JSON.parse(localStorage.getItem('pos_cart')) || [];
+        } catch (error) {
+            this.cart = [];
+        }
         this.renderCart();
-        this.updateTotals();
     }
 
     renderCart() {
-        const container = document.getElementById('cart-items');
+        const container = document.getElementById('cartItems');
+        const emptyCart = document.getElementById('emptyCart');
+        const totalsSection = document.getElementById('totalsSection');
         if (!container) return;
 
-        if (this.cart.length === 0) {
-            container.innerHTML = '<p class="text-muted">Cart is empty</p>';
-            return;
-        }
+        container.querySelectorAll('.cart-item').forEach(element => element.remove());
+        if (emptyCart) emptyCart.style.display = this.cart.length ? 'none' : '';
+        if (totalsSection) totalsSection.style.display = this.cart.length ? '' : 'none';
 
-        container.innerHTML = this.cart.map(item => `
-            <div class="cart-item border-bottom py-2">
-                <div class="d-flex justify-content-between align-items-center">
-                    <div>
-                        <h6 class="mb-1">${item.name}</h6>
-                        <small class="text-muted">KES ${item.price.toFixed(2)} each</small>
-                    </div>
-                    <div class="d-flex align-items-center">
-                        <button class="btn btn-sm btn-outline-secondary" data-cart-action="decrease" data-product-id="${item.productId}">-</button>
-                        <span class="mx-2">${item.quantity}</span>
-                        <button class="btn btn-sm btn-outline-secondary" data-cart-action="increase" data-product-id="${item.productId}">+</button>
-                        <button class="btn btn-sm btn-outline-danger ms-2" data-cart-action="remove" data-product-id="${item.productId}">×</button>
+        this.cart.forEach(item => {
+            const element = document.createElement('div');
+            element.className = 'cart-item';
+            element.dataset.productId = item.productId;
+            element.innerHTML = `
+                <div class="cart-item-name"></div>
+                <div class="cart-item-details">
+                    <div class="quantity-controls">
+                        <button type="button" class="quantity-btn" data-item-action="decrease">-</button>
+                        <span class="quantity-display">${item.quantity}</span>
+                        <button type="button" class="quantity-btn" data-item-action="increase">+</button>
                     </div>
-                </div>
-                <div class="text-end">
-                    <strong>KES ${item.lineTotal.toFixed(2)}</strong>
-                </div>
-            </div>
-        `).join('');
+                    <span class="cart-item-price">${this.formatCurrency(item.price * item.quantity)}</span>
+                    <button type="button" class="remove-item" data-item-action="remove">&times;</button>
+                </div>`;
+            element.querySelector('.cart-item-name').textContent = item.name;
+            container.appendChild(element);
+        });
+
+        this.renderTotals();
     }
 
-    updateTotals() {
-        const subtotal = this.cart.reduce((sum, item) => sum + item.lineTotal, 0);
-        const tax = subtotal * 0.16; // 16% VAT
-        const total = subtotal + tax;
+    // Totals
 
-        document.getElementById('subtotal')?.textContent = `KES ${subtotal.toFixed(2)}`;
-        document.getElementById('tax-amount')?.textContent = `KES ${tax.toFixed(2)}`;
-        document.getElementById('total-amount')?.textContent = `KES ${total.toFixed(2)}`;
+    localTotals() {
+        const subtotal = this.cart.reduce((sum, item) => sum + item.price * item.quantity, 0);
+        const tax = Math.round(subtotal * TAX_RATE * 100) / 100;
+        return { subtotal, discount: 0, tax, total: subtotal + tax };
     }
 
-    handleCartAction(action, productId) {
-        const itemIndex = this.cart.findIndex(item => item.productId == productId);
-        if (itemIndex === -1) return;
+    totals() {
+        return this.serverTotals || this.localTotals();
+    }
 
-        const item = this.cart[itemIndex];
-        const product = this.products.find(p => p.id == productId);
+    renderTotals() {
+        const totals = this.totals();
+        const set = (id, value) => {
+            const element = document.getElementById(id);
+            if (element) element.textContent = this.formatCurrency(value);
+        };
+        set('subtotal', totals.subtotal - totals.discount);
+        set('taxAmount', totals.tax);
+        set('totalAmount', totals.total);
+    }
 
-        switch (action) {
-            case 'increase':
-                if (item.quantity >= product.stock) {
-                    window.alert(`Cannot add more ${item.name}.\n\nOnly ${product.stock} items available in stock.`);
-                    return;
-                }
-                item.quantity++;
-                break;
-            
-            case 'decrease':
-                if (item.quantity > 1) {
-                    item.quantity--;
-                } else {
-                    window.alert(`Removing ${item.name} from cart.`);
-                    this.cart.splice(itemIndex, 1);
-                }
-                break;
-            
-            case 'remove':
-                if (window.confirm(`Remove ${item.name} from cart?`)) {
-                    this.cart.splice(itemIndex, 1);
-                }
-                break;
-        }
+    // Promotions are applied by the server; offline the till shows list prices
+    refreshTotals() {
+        clearTimeout(this.priceTimer);
+        if (!this.cart.length || !navigator.onLine) return;
+        this.priceTimer = setTimeout(async () => {
+            const cart = this.cart;
+            try {
+                const response = await fetch('/cashier/cart/price', {
+                    method: 'POST',
+                    credentials: 'same-origin',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ items: this.saleItems() })
+                });
+                if (!response.ok || response.redirected || cart !== this.cart) return;
+                this.serverTotals = await response.json();
+                this.renderTotals();
+            } catch (error) {
+                // Keep the local totals
+            }
+        }, PRICE_DEBOUNCE);
+    }
 
-        this.updateCart();
-        this.saveCart();
+    saleItems() {
+        return this.cart.map(item => ({ product_id: Number(item.productId), quantity: item.quantity }));
     }
 
-    selectPaymentMethod(method) {
-        if (this.cart.length === 0) {
-            window.alert('Cart is empty. Please add items before selecting payment method.');
-            return;
+    // Receipt numbers leased to this till
+
+    getTillId() {
+        let tillId = localStorage.getItem('pos_till_id');
+        if (!tillId) {
+            tillId = newClientUuid();
+            localStorage.setItem('pos_till_id', tillId);
         }
+        return tillId;
+    }
 
-        const total = this.cart.reduce((sum, item) => sum + (item.lineTotal * 1.16), 0);
-
-        switch (method) {
-            case 'cash':
-                this.processCashPayment(total);
-                break;
-            case 'mpesa':
-                this.processMpesaPayment(total);
-                break;
-            default:
-                window.alert('Invalid payment method selected.');
+    receiptBlocks() {
+        try {
+            return JSON.parse(localStorage.getItem(`pos_receipts_${SHOP_ID}`)) || [];
+        } catch (error) {
+            return [];
         }
     }
 
-    processCashPayment(total) {
-        const received = window.prompt(`Cash Payment
-        
-Total Amount: KES ${total.toFixed(2)}
+    remainingReceiptNumbers() {
+        return this.receiptBlocks().reduce((sum, block) => sum + block.end - block.next + 1, 0);
+    }
 
-Enter amount received from customer:`);
+    async ensureReceiptNumbers() {
+        if (this.leasing || !navigator.onLine || this.remainingReceiptNumbers() >= RECEIPT_REFILL_AT) return;
+        this.leasing = true;
+        try {
+            const response = await fetch('/cashier/receipts/lease', {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ till_id: this.tillId })
+            });
+            if (!response.ok || response.redirected) return;
+            const lease = await response.json();
+            const blocks = this.receiptBlocks();
+            blocks.push({ next: lease.start, end: lease.end });
+            localStorage.setItem(`pos_receipts_${SHOP_ID}`, JSON.stringify(blocks));
+        } catch (error) {
+            console.warn('Could not lease receipt numbers:', error);
+        } finally {
+            this.leasing = false;
+        }
+    }
 
-        if (!received) return;
+    // Next leased number, or null (the server numbers the sale when it is uploaded)
+    takeReceiptNumber() {
+        const blocks = this.receiptBlocks().filter(block => block.next <= block.end);
+        if (!blocks.length) return null;
+        const value = blocks[0].next++;
+        localStorage.setItem(`pos_receipts_${SHOP_ID}`, JSON.stringify(blocks));
+        this.ensureReceiptNumbers();
+        return `${RECEIPT_PREFIX}${String(SHOP_ID).padStart(5, '0')}-${String(value).padStart(9, '0')}`;
+    }
 
-        const amount = parseFloat(received);
-        if (isNaN(amount) || amount < total) {
-            window.alert(`Insufficient amount received.
-            
-Required: KES ${total.toFixed(2)}
-Received: KES ${amount.toFixed(2)}
-Shortage: KES ${(total - amount).toFixed(2)}`);
-            return;
-        }
+    // Sales
 
-        const change = amount - total;
-        
-        const confirmMessage = `Cash Payment Confirmation
-        
-Total: KES ${total.toFixed(2)}
-Received: KES ${amount.toFixed(2)}
-Change: KES ${change.toFixed(2)}
+    async queueSale(paymentMethod, extra = {}) {
+        const sale = {
+            client_uuid: newClientUuid(),
+            receipt_number: this.takeReceiptNumber(),
+            created_at: new Date().toISOString(),
+            payment_method: paymentMethod,
+            items: this.saleItems(),
+            total_amount: this.totals().total,
+            ...extra
+        };
+        await this.queue.add(sale);
+        this.finishSale();
+        this.syncSales();
+        return sale;
+    }
 
-Proceed with sale?`;
+    finishSale() {
+        this.currentSaleId = null;
+        this.isProcessingPayment = false;
+        this.clearCart();
+    }
 
-        if (window.confirm(confirmMessage)) {
-            this.completeSale('cash', { amount_received: amount, change: change });
-        }
+    processCashPayment() {
+        if (!this.cart.length) return;
+        const total = this.totals().total;
+        document.getElementById('cashTotal').textContent = total.toFixed(2);
+        document.getElementById('amountReceived').value = '';
+        this.updateChange();
+        bootstrap.Modal.getOrCreateInstance(document.getElementById('cashPaymentModal')).show();
     }
 
-    processMpesaPayment(total) {
-        const phone = window.prompt(`MPesa Payment
-        
-Total Amount: KES ${total.toFixed(2)}
+    updateChange() {
+        const total = this.totals().total;
+        const received = parseFloat(document.getElementById('amountReceived').value) || 0;
+        const enough = received >= total && total > 0;
+        document.getElementById('changeAmount').value = enough ? (received - total).toFixed(2) : '';
+        document.getElementById('insufficientAlert').style.display = received && !enough ? '' : 'none';
+        document.getElementById('confirmCashBtn').disabled = !enough;
+    }
 
-Enter customer phone number (254XXXXXXXXX):`);
+    async confirmCashPayment() {
+        if (this.isProcessingPayment || !this.cart.length) return;
+        this.isProcessingPayment = true;
+        try {
+            const sale = await this.queueSale('cash');
+            bootstrap.Modal.getOrCreateInstance(document.getElementById('cashPaymentModal')).hide();
+            this.notify(`Sale ${sale.receipt_number || ''} recorded`, 'success');
+        } catch (error) {
+            console.error('Could not record sale:', error);
+            this.notify('Could not record the sale on this till', 'error');
+        } finally {
+            this.isProcessingPayment = false;
+        }
+    }
 
-        if (!phone) return;
+    async showMpesaPayment() {
+        if (this.isProcessingPayment || !this.cart.length) return;
+        const total = this.totals().total;
 
-        if (!phone.match(/^254[0-9]{9}$/)) {
-            window.alert('Invalid phone number format.\nPlease use format: 254XXXXXXXXX');
+        if (!navigator.onLine) {
+            // Payment can't be matched without the server; record the customer's M-Pesa code
+            const code = window.prompt(`Offline: confirm KES ${total.toFixed(2)} was received on the till, then enter the M-Pesa code`);
+            if (code && code.trim()) {
+                await this.queueSale('mpesa', { mpesa_receipt: code.trim().toUpperCase() });
+                this.notify('M-Pesa sale queued for upload', 'success');
+            }
             return;
         }
 
-        const confirmMessage = `MPesa Payment Request
-        
-Amount: KES ${total.toFixed(2)}
-Phone: ${phone}
-
-Send MPesa payment request?`;
-
-        if (window.confirm(confirmMessage)) {
-            this.isProcessingPayment = true;
-            
-            // Show payment processing status
-            window.alert(`MPesa payment request sent to ${phone}
-            
-Customer should check their phone for the payment prompt.
-Payment verification will start automatically.`);
-
-            // Simulate MPesa payment processing
-            setTimeout(() => {
-                if (window.confirm('Did customer complete the MPesa payment?\n\nClick OK if payment was successful, Cancel to retry.')) {
-                    const mpesaCode = window.prompt('Enter MPesa confirmation code:') || 'MP' + Date.now();
-                    this.completeSale('mpesa', { phone, mpesa_code: mpesaCode });
-                } else {
-                    this.isProcessingPayment = false;
-                    window.alert('Payment cancelled. You can try again or switch to cash payment.');
-                }
-            }, 3000);
+        this.isProcessingPayment = true;
+        try {
+            const response = await fetch('/cashier/sale/create', {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': newClientUuid()
+                },
+                body: JSON.stringify({ items: this.saleItems(), payment_method: 'mpesa' })
+            });
+            const result = await response.json();
+            if (!response.ok) {
+                throw new Error(result.error || result.message || 'Failed to create sale');
+            }
+
+            this.currentSaleId = result.sale_id;
+            document.getElementById('mpesaAmount').textContent = result.total_amount.toFixed(2);
+            bootstrap.Modal.getOrCreateInstance(document.getElementById('mpesaPaymentModal')).show();
+            document.dispatchEvent(new CustomEvent('mpesaPaymentStarted', { detail: { saleId: result.sale_id } }));
+        } catch (error) {
+            this.notify(error.message, 'error');
+        } finally {
+            this.isProcessingPayment = false;
         }
     }
 
-    completeSale(paymentMethod, paymentData) {
-        const subtotal = this.cart.reduce((sum, item) => sum + item.lineTotal, 0);
-        const tax = subtotal * 0.16;
-        const total = subtotal + tax;
-
-        const sale = {
-            id: Date.now(),
-            receipt_number: 'RCP' + Date.now(),
-            items: [...this.cart],
-            subtotal,
-            tax,
-            total,
-            payment_method: paymentMethod,
-            payment_data: paymentData,
-            timestamp: new Date(),
-            status: 'completed'
-        };
-
-        // Show sale completion
-        const receiptData = this.generateReceiptText(sale);
-        window.alert(`SALE COMPLETED SUCCESSFULLY!
-
-${receiptData}
+    // Upload queued sales
 
-Receipt will be printed automatically.`);
+    setupSync() {
+        window.addEventListener('online', () => {
+            this.ensureReceiptNumbers();
+            this.syncSales();
+        });
+        setInterval(() => this.syncSales(), SYNC_INTERVAL);
+        this.syncSales();
+    }
 
-        // Update stock (in real implementation, this would update the database)
-        this.updateStock();
+    async syncSales() {
+        if (!navigator.onLine) {
+            this.requestBackgroundSync();
+            return;
+        }
+        try {
+            const result = await this.queue.upload();
+            if (result.rejected) {
+                this.notify(`${result.rejected} queued sale(s) were rejected by the server`, 'warning');
+            }
+            if (result.created) {
+                this.loadCatalogue(); // stock levels changed
+            }
+        } catch (error) {
+            console.warn('Sales upload postponed:', error);
+            this.requestBackgroundSync();
+        }
+    }
 
-        // Clear cart
-        this.clearCart();
+    // Let the service worker upload the queue once the connection returns, even if the page is closed
+    async requestBackgroundSync() {
+        if (!('serviceWorker' in navigator)) return;
+        try {
+            const registration = await navigator.serviceWorker.ready;
+            if (registration.sync) {
+                await registration.sync.register('sync-sales');
+            }
+        } catch (error) {
+            // Background Sync unsupported; the page retries on its own
+        }
+    }
 
-        // Store sale (in real implementation, this would save to database)
-        this.storeSale(sale);
+    // Shifts
 
-        this.isProcessingPayment = false;
+    async loadShift() {
+        try {
+            const response = await fetch('/cashier/shift', { credentials: 'same-origin' });
+            if (!response.ok || response.redirected) return;
+            this.shift = (await response.json()).shift;
+            this.renderShift();
+        } catch (error) {
+            // Offline: keep the last known state
+        }
     }
 
-    generateReceiptText(sale) {
-        return `
-RECEIPT - ${sale.receipt_number}
-Date: ${sale.timestamp.toLocaleString()}
-Payment: ${sale.payment_method.toUpperCase()}
-
-${'='.repeat(30)}
-ITEMS:
-${sale.items.map(item => 
-    `${item.name}\n  ${item.quantity} x KES ${item.price.toFixed(2)} = KES ${item.lineTotal.toFixed(2)}`
-).join('\n')}
+    renderShift() {
+        const button = document.getElementById('shiftButton');
+        if (button) {
+            button.textContent = this.shift ? `Close Shift #${this.shift.shift_id}` : 'Open Shift';
+        }
+    }
 
-${'='.repeat(30)}
-Subtotal: KES ${sale.subtotal.toFixed(2)}
-VAT (16%): KES ${sale.tax.toFixed(2)}
-TOTAL: KES ${sale.total.toFixed(2)}
+    async toggleShift() {
+        if (!navigator.onLine) {
+            this.notify('Shifts are opened and closed online', 'warning');
+            return;
+        }
 
-${sale.payment_method === 'mpesa' ? `MPesa Code: ${sale.payment_data.mpesa_code}` : ''}
-${sale.payment_method === 'cash' ? `Change: KES ${sale.payment_data.change.toFixed(2)}` : ''}
+        if (!this.shift) {
+            const opening = window.prompt('Opening float (cash in the drawer), KES', '0');
+            if (opening === null) return;
+            const result = await this.postJSON('/cashier/shift/open', { opening_float: opening });
+            if (result.ok) {
+                this.shift = result.data.shift;
+                this.renderShift();
+                this.notify(`Shift #${this.shift.shift_id} opened`, 'success');
+            }
+            return;
+        }
 
-Thank you for your business!
-`;
+        // Upload queued sales first so the Z-report includes them
+        await this.syncSales();
+        const counted = window.prompt('Count the cash in the drawer, KES');
+        if (counted === null) return;
+        const notes = window.prompt('Notes (optional)', '') || '';
+        const result = await this.postJSON('/cashier/shift/close', { counted_cash: counted, notes });
+        if (result.ok) {
+            this.shift = null;
+            this.renderShift();
+            window.open(result.data.print_url, '_blank');
+        }
     }
 
-    updateStock() {
-        this.cart.forEach(cartItem => {
-            const product = this.products.find(p => p.id === cartItem.productId);
-            if (product) {
-                product.stock -= cartItem.quantity;
+    async postJSON(url, body) {
+        try {
+            const response = await fetch(url, {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(body)
+            });
+            const data = await response.json();
+            if (!response.ok) {
+                this.notify(data.error || data.message || 'Request failed', 'error');
             }
-        });
-    }
-
-    storeSale(sale) {
-        const sales = JSON.parse(localStorage.getItem('pos_sales') || '[]');
-        sales.unshift(sale);
-        localStorage.setItem('pos_sales', JSON.stringify(sales.slice(0, 100))); // Keep last 100 sales
+            return { ok: response.ok, data };
+        } catch (error) {
+            this.notify('Network error occurred', 'error');
+            return { ok: false, data: null };
+        }
     }
 
-    clearCart() {
-        this.cart = [];
-        this.updateCart();
-        this.saveCart();
-        localStorage.removeItem('pos_cart');
-    }
+    // Helpers
 
-    saveCart() {
-        localStorage.setItem('pos_cart', JSON.stringify(this.cart));
+    notify(message, type = 'info') {
+        if (window.ComolorPOS) {
+            ComolorPOS.showNotification(message, type);
+        } else {
+            console.log(message);
+        }
     }
 
-    restoreCart() {
-        const saved = localStorage.getItem('pos_cart');
-        if (saved) {
-            this.cart = JSON.parse(saved);
-            this.updateCart();
-        }
+    formatCurrency(amount) {
+        return `KES ${Number(amount).toLocaleString('en-KE', { minimumFractionDigits: 2, maximumFractionDigits: 2 })}`;
     }
 
     debounce(func, wait) {
         let timeout;
-        return function executedFunction(...args) {
-            const later = () => {
-                clearTimeout(timeout);
-                func(...args);
-            };
+        return function (...args) {
             clearTimeout(timeout);
-            timeout = setTimeout(later, wait);
+            timeout = setTimeout(() => func.apply(this, args), wait);
         };
     }
 }
 
-// Initialize POS system
-document.addEventListener('DOMContentLoaded', () => {
-    window.pos = new POS();
-});
+// Global functions for the POS template
+function processCashPayment() {
+    if (window.pos) window.pos.processCashPayment();
+}
 
-// Global functions for compatibility
-function confirmMpesaPayment() {
-    window.alert('MPesa payment confirmed!\n\nTransaction completed successfully.');
+function confirmCashPayment() {
+    if (window.pos) window.pos.confirmCashPayment();
 }
 
-function cancelMpesaPayment() {
-    window.alert('MPesa payment cancelled.\n\nYou can try again or switch to cash payment.');
-}
\ No newline at end of file
+function showMpesaPayment() {
+    if (window.pos) window.pos.showMpesaPayment();
+}
+
+function clearCart() {
+    if (window.pos) window.pos.clearCart();
+}
+
+function toggleShift() {
+    if (window.pos) window.pos.toggleShift();
+}
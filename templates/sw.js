@@ -0,0 +1,108 @@
+/**
+ * Comolor POS - Service Worker
+ * Keeps the till's POS page, its assets and the product catalogue cached so
+ * the till opens and sells without a connection, and uploads queued sales
+ * (offline.js) when Background Sync reports the connection is back.
+ */
+
+importScripts('{{ asset_url("js/offline.js") }}');
+
+const CACHE_NAME = 'comolor-pos-{{ version }}';
+const SHELL_URLS = {{ shell|tojson }};
+const POS_URL = SHELL_URLS[0];
+const CATALOGUE_URL = '/cashier/api/products/catalogue';
+const CDN_HOSTS = ['cdn.jsdelivr.net', 'unpkg.com', 'printjs.crabbly.com'];
+
+// Only successful, non-redirected responses are cached (a redirect means the session ended)
+function cacheable(response) {
+    return response && (response.type === 'opaque' || (response.ok && !response.redirected));
+}
+
+async function precache() {
+    const cache = await caches.open(CACHE_NAME);
+    await Promise.all(SHELL_URLS.map(async url => {
+        try {
+            const response = await fetch(url, { credentials: 'same-origin' });
+            if (!cacheable(response)) return;
+            if (url === POS_URL) {
+                // The page's CDN styles and scripts are needed offline too
+                const html = await response.clone().text();
+                const cdnUrls = [...html.matchAll(/(?:src|href)="(https:\/\/[^"]+)"/g)].map(match => match[1]);
+                await Promise.all(cdnUrls.map(cdnUrl =>
+                    fetch(cdnUrl, { mode: 'no-cors' })
+                        .then(cdnResponse => cacheable(cdnResponse) && cache.put(cdnUrl, cdnResponse))
+                        .catch(() => {})
+                ));
+            }
+            await cache.put(url, response);
+        } catch (error) {
+            // Installed anyway; the page is cached on its next successful load
+        }
+    }));
+}
+
+async function networkFirst(request) {
+    const cache = await caches.open(CACHE_NAME);
+    try {
+        const response = await fetch(request);
+        if (cacheable(response)) {
+            await cache.put(request, response.clone());
+        }
+        return response;
+    } catch (error) {
+        const cached = await cache.match(request, { ignoreSearch: request.mode === 'navigate' });
+        if (cached) return cached;
+        throw error;
+    }
+}
+
+async function cacheFirst(request) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+    const response = await fetch(request);
+    if (cacheable(response)) {
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+self.addEventListener('install', event => {
+    event.waitUntil(precache().then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names
+                .filter(name => name.startsWith('comolor-pos-') && name !== CACHE_NAME)
+                .map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    // Sales, payments and leases always go to the server
+    if (request.method !== 'GET') return;
+
+    const url = new URL(request.url);
+    if (url.origin === self.location.origin) {
+        if (url.pathname.startsWith('/assets/')) {
+            // Content-hashed builds never change
+            event.respondWith(cacheFirst(request));
+        } else if (request.mode === 'navigate' && url.pathname === POS_URL) {
+            event.respondWith(networkFirst(request));
+        } else if (url.pathname === CATALOGUE_URL || url.pathname.startsWith('/static/')) {
+            event.respondWith(networkFirst(request));
+        }
+    } else if (CDN_HOSTS.includes(url.hostname)) {
+        event.respondWith(cacheFirst(request));
+    }
+});
+
+self.addEventListener('sync', event => {
+    if (event.tag === 'sync-sales') {
+        event.waitUntil(new SaleQueue().upload());
+    }
+});
@@ -0,0 +1,60 @@
+import logging
+import os
+import tempfile
+
+import pytest
+
+# The app binds its database when it is imported, so point it at a scratch
+# database first. Set TEST_DATABASE_URL to run the suite against PostgreSQL.
+_db_dir = tempfile.mkdtemp(prefix='comolor-tests-')
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL') or f"sqlite:///{_db_dir}/test.db"
+os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+os.environ.setdefault('SESSION_SECRET', 'test-secret')
+
+from app import app as flask_app, db  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['TESTING'] = True
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    with app.test_client() as client:
+        with app.app_context():
+            yield client
+            db.session.remove()
+
+
+@pytest.fixture
+def shop(app):
+    """A fresh shop with a cashier, so tests don't share counters or sequences"""
+    from datetime import datetime, timedelta
+    from werkzeug.security import generate_password_hash
+    from models import Shop, User
+
+    with app.app_context():
+        count = Shop.query.count()
+        shop = Shop(name=f'Test Shop {count}', owner_name='Test Owner', email=f'shop{count}@test.local',
+                    phone='+254700000000', address='Nairobi', till_number=f'T{count:07d}', is_active=True,
+                    license_expires=datetime.utcnow() + timedelta(days=30))
+        db.session.add(shop)
+        db.session.flush()
+        db.session.add(User(username=f'cashier{shop.id}', email=f'cashier{shop.id}@test.local',
+                            password_hash=generate_password_hash('cash123'), role='cashier',
+                            shop_id=shop.id, user_active=True))
+        db.session.commit()
+        shop_id = shop.id
+        db.session.remove()
+    return shop_id
+
+
+@pytest.fixture
+def cashier_client(client, shop):
+    """Test client signed in as the shop fixture's cashier"""
+    client.post('/auth/login', data={'username': f'cashier{shop}', 'password': 'cash123'})
+    return client
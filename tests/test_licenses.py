@@ -0,0 +1,35 @@
+from sqlalchemy import update
+
+from app import db
+from models import Shop
+from utils.kvstore import DatabaseStore, get_store, set_store
+from utils.licenses import invalidate_license, is_license_current
+
+
+def suspend(shop_id):
+    """Deactivate a shop the way another worker would, without touching this worker's cache"""
+    db.session.execute(update(Shop).where(Shop.id == shop_id).values(is_active=False))
+    db.session.commit()
+
+
+def test_suspension_applies_at_once_without_a_shared_store(app, shop):
+    assert not get_store('licenses').shared
+    with app.app_context():
+        assert is_license_current(shop)
+        suspend(shop)
+        assert not is_license_current(shop)
+
+
+def test_shared_store_caches_the_flag_until_invalidated(app, shop):
+    previous = get_store('licenses')
+    set_store('licenses', DatabaseStore('licenses'))
+    try:
+        with app.app_context():
+            assert is_license_current(shop)
+            suspend(shop)
+            # Cached for LICENSE_CACHE_SECONDS, until the worker that suspended it invalidates
+            assert is_license_current(shop)
+            invalidate_license(shop)
+            assert not is_license_current(shop)
+    finally:
+        set_store('licenses', previous)
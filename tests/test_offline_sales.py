@@ -0,0 +1,70 @@
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from app import db
+from models import MpesaTransaction, Product, Sale
+
+TOTAL = Decimal('69.60')  # one 60.00 item plus 16% VAT
+
+
+@pytest.fixture
+def product(app, shop):
+    with app.app_context():
+        product = Product(shop_id=shop, name='Milk 500ml', price=60, stock_quantity=100, is_active=True)
+        db.session.add(product)
+        db.session.commit()
+        product_id = product.id
+        db.session.remove()
+    return product_id
+
+
+def add_payment(shop, code, amount=TOTAL, is_processed=False):
+    db.session.add(MpesaTransaction(transaction_type='sale', transaction_id=code, amount=amount,
+                                    msisdn='254712345678', first_name='Jane', last_name='Wanjiru',
+                                    transaction_time=datetime.utcnow(), shop_id=shop,
+                                    is_processed=is_processed))
+    db.session.commit()
+
+
+def upload(client, product, code):
+    response = client.post('/cashier/sales/batch', json={'sales': [{
+        'client_uuid': str(uuid.uuid4()), 'payment_method': 'mpesa', 'mpesa_receipt': code,
+        'created_at': datetime.utcnow().isoformat() + 'Z', 'items': [{'productId': product, 'quantity': 1}],
+    }]})
+    assert response.status_code == 200
+    result = response.get_json()['results'][0]
+    assert result['status'] == 'created', result
+    return db.session.get(Sale, result['sale_id'])
+
+
+def test_offline_code_of_a_waiting_payment_settles_the_sale(cashier_client, shop, product):
+    code = f'QK{shop:06d}AB'
+    add_payment(shop, code)
+
+    sale = upload(cashier_client, product, code.lower())
+
+    payment = db.session.execute(db.select(MpesaTransaction).filter_by(transaction_id=code)).scalar_one()
+    assert sale.total_amount == TOTAL
+    assert sale.mpesa_receipt == code
+    assert sale.customer_name == 'Jane Wanjiru'
+    assert payment.is_processed and payment.sale_id == sale.id
+
+
+@pytest.mark.parametrize('payment', ['missing', 'wrong_amount', 'processed', 'not_this_shop'])
+def test_offline_code_that_does_not_check_out_leaves_the_sale_unpaid(cashier_client, shop, product, payment):
+    code = f'QX{shop:06d}{payment[:2].upper()}'
+    if payment == 'wrong_amount':
+        add_payment(shop, code, amount=Decimal('70.00'))
+    elif payment == 'processed':
+        add_payment(shop, code, is_processed=True)
+    elif payment == 'not_this_shop':
+        add_payment(None, code)  # a payment to a till no shop is registered with
+
+    sale = upload(cashier_client, product, code)
+
+    assert sale.mpesa_receipt is None
+    transaction = db.session.execute(db.select(MpesaTransaction).filter_by(transaction_id=code)).scalar()
+    assert transaction is None or transaction.sale_id is None
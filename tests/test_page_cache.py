@@ -0,0 +1,27 @@
+from app import db
+from models import Product
+from utils.kvstore import MemoryStore, get_store, set_store
+from utils.page_cache import cached_fragment
+
+
+def test_a_commit_on_another_worker_invalidates_fragments(app, shop):
+    assert not get_store('pages').shared
+    renders = []
+
+    def widget():
+        with app.test_request_context():
+            return cached_fragment('widget', lambda: renders.append(1) or f'<p>{len(renders)}</p>', shop_id=shop)
+
+    with app.app_context():
+        assert widget() == widget() == '<p>1</p>'
+
+        # Another worker, with its own in-process pages store, adds a product
+        this_worker = get_store('pages')
+        set_store('pages', MemoryStore())
+        try:
+            db.session.add(Product(shop_id=shop, name='Bread', price=55, stock_quantity=10, is_active=True))
+            db.session.commit()
+        finally:
+            set_store('pages', this_worker)
+
+        assert widget() == '<p>2</p>'
@@ -0,0 +1,31 @@
+import pytest
+
+from utils import receipts
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Addresses the server tries to connect to; every attempt is refused"""
+    attempts = []
+
+    def refuse(address, timeout=None):
+        attempts.append(address)
+        raise ConnectionRefusedError(111, f'Connection refused by {address[0]}:{address[1]}')
+
+    monkeypatch.setattr(receipts.socket, 'create_connection', refuse)
+    return attempts
+
+
+def test_printer_address_never_comes_from_the_request(cashier_client, connections, monkeypatch):
+    monkeypatch.delenv('RECEIPT_PRINTER_HOST', raising=False)
+    response = cashier_client.post('/cashier/test-printer', json={'host': '10.0.0.5', 'port': 22})
+    assert response.status_code == 400
+    assert connections == []
+
+
+def test_unreachable_printer_error_does_not_leak_details(cashier_client, connections, monkeypatch):
+    monkeypatch.setenv('RECEIPT_PRINTER_HOST', '192.0.2.10')
+    response = cashier_client.post('/cashier/test-printer', json={'host': '10.0.0.5', 'port': 22})
+    assert response.status_code == 502
+    assert response.get_json() == {'success': False, 'message': 'Printer unreachable'}
+    assert connections == [('192.0.2.10', 9100)]
@@ -0,0 +1,87 @@
+import re
+
+import pytest
+from sqlalchemy import event
+
+from app import db
+from models import Product
+
+IDENTITY_TABLES = ('shops', 'users')
+
+
+@pytest.fixture
+def queries(app):
+    """SQL statements the engine runs while the test is recording"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+@pytest.fixture
+def ids(app, shop, cashier_client):
+    """A product in the cashier's shop and a cash sale of it"""
+    with app.app_context():
+        product = Product(shop_id=shop, name='Milk 500ml', barcode=f'600{shop:07d}', price=60,
+                          stock_quantity=100, is_active=True)
+        db.session.add(product)
+        db.session.commit()
+        ids = {'product': product.id, 'barcode': product.barcode}
+        db.session.remove()
+    response = cashier_client.post('/cashier/sale/create', json=sale_payload(ids['product']))
+    assert response.status_code == 200, response.get_data(as_text=True)
+    ids['sale'] = response.get_json()['sale_id']
+    return ids
+
+
+def sale_payload(product_id):
+    return {'items': [{'productId': product_id, 'quantity': 1, 'unitPrice': 60, 'lineTotal': 60}],
+            'payment_method': 'cash'}
+
+
+def identity_loads(statements):
+    """SELECTs whose main table is shops or users, by table"""
+    loads = dict.fromkeys(IDENTITY_TABLES, 0)
+    for statement in statements:
+        match = re.match(r'\s*SELECT\s.*?\sFROM\s+(\w+)', statement, re.S | re.I)
+        if match and match.group(1) in loads:
+            loads[match.group(1)] += 1
+    return loads
+
+
+ENDPOINTS = {
+    'pos': lambda client, ids: client.get('/cashier/pos'),
+    'search': lambda client, ids: client.get('/cashier/api/products/search?q=mil'),
+    'barcode': lambda client, ids: client.get(f"/cashier/api/products/{ids['barcode']}"),
+    'cart_price': lambda client, ids: client.post(
+        '/cashier/cart/price', json={'items': [{'productId': ids['product'], 'quantity': 2}]}),
+    'sale_create': lambda client, ids: client.post('/cashier/sale/create', json=sale_payload(ids['product'])),
+    'receipt': lambda client, ids: client.get(f"/cashier/receipt/{ids['sale']}"),
+    'receipt_print': lambda client, ids: client.get(f"/cashier/receipt/{ids['sale']}/print"),
+    'receipt_escpos': lambda client, ids: client.get(f"/cashier/receipt/{ids['sale']}/escpos"),
+    'mpesa_check': lambda client, ids: client.get(f"/cashier/mpesa/check/{ids['sale']}"),
+    'settings': lambda client, ids: client.get('/cashier/settings'),
+}
+
+
+@pytest.mark.parametrize('endpoint', ENDPOINTS)
+def test_pos_endpoints_load_the_identity_at_most_once(cashier_client, ids, queries, endpoint):
+    queries.clear()
+    response = ENDPOINTS[endpoint](cashier_client, ids)
+    assert response.status_code == 200
+    assert all(count <= 1 for count in identity_loads(queries).values()), queries
+
+
+def test_pos_page_query_count(cashier_client, ids, queries):
+    """check_auth, require_shop_access and the view share one shop load (it used to take two)"""
+    queries.clear()
+    assert cashier_client.get('/cashier/pos').status_code == 200
+    # Session load, the product grid, the shop, the session save
+    assert len(queries) == 4, queries
+    assert identity_loads(queries) == {'shops': 1, 'users': 0}
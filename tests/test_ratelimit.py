@@ -0,0 +1,57 @@
+import pytest
+from flask import request, request_started
+
+from utils import ratelimit
+from utils.ratelimit import MemoryBuckets, check_rate_limit, set_rate_limit_backend
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    """Fresh in-process buckets, with one request a minute for logins and everything else"""
+    monkeypatch.setenv('RATELIMIT_AUTH', '1/60')
+    monkeypatch.setenv('RATELIMIT_DEFAULT', '1/60')
+    ratelimit._limits.clear()
+    backend = MemoryBuckets()
+    set_rate_limit_backend(backend)
+    yield backend
+    set_rate_limit_backend(None)
+    ratelimit._limits.clear()
+
+
+def limited(app, path, **kwargs):
+    """Check the same request twice; returns the second response (None if allowed)"""
+    for _ in range(2):
+        with app.test_request_context(path, **kwargs):
+            response = check_rate_limit(app)
+    return response
+
+
+def test_page_loads_get_an_html_429(app, buckets):
+    response = limited(app, '/auth/login', method='POST', headers={'Accept': 'text/html,*/*;q=0.8'})
+    assert response.status_code == 429
+    assert response.mimetype == 'text/html'
+    assert response.headers['Retry-After'] == '60'
+    assert b'Too Many Requests' in response.get_data()
+
+
+@pytest.mark.parametrize('kwargs', [{'headers': {'Accept': '*/*'}}, {'json': {'username': 'x'}}])
+def test_api_calls_get_a_json_429(app, buckets, kwargs):
+    response = limited(app, '/auth/login', method='POST', **kwargs)
+    assert response.status_code == 429
+    assert response.get_json() == {'error': 'Too many requests', 'retry_after': 60}
+
+
+@pytest.mark.parametrize('path', ['/sw.js', '/assets/js/base.00000000.js', '/static/css/style.css'])
+def test_assets_are_not_rate_limited(app, buckets, path):
+    assert limited(app, path) is None
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(app, client):
+    addresses = []
+
+    def record(sender, **extra):
+        addresses.append(request.remote_addr)
+
+    with request_started.connected_to(record, app):
+        client.get('/sw.js', headers={'X-Forwarded-For': '203.0.113.9'})
+    assert addresses == ['127.0.0.1']
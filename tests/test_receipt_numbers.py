@@ -0,0 +1,98 @@
+import threading
+
+from sqlalchemy import select
+
+from app import db
+from models import ReceiptBlock, ReceiptSequence
+from utils.receipt_numbers import (ReceiptAllocator, format_receipt_number, lease_block,
+                                   parse_receipt_number)
+
+WORKERS = 8
+NUMBERS_PER_WORKER = 150
+BLOCK_SIZE = 7
+
+
+def run_threads(target, count):
+    errors = []
+
+    def guarded(index):
+        try:
+            target(index)
+        except Exception as e:  # surfaced in the main thread below
+            errors.append(e)
+
+    threads = [threading.Thread(target=guarded, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+
+def test_receipt_numbers_round_trip():
+    assert format_receipt_number(12, 4521) == 'RCP00012-000004521'
+    assert parse_receipt_number('RCP00012-000004521') == (12, 4521)
+    assert parse_receipt_number(format_receipt_number(123456, 1234567890)) == (123456, 1234567890)
+    assert parse_receipt_number('RCP0012-000004521') is None
+    assert parse_receipt_number('TEST-20250101') is None
+    assert parse_receipt_number(None) is None
+
+
+def test_concurrent_allocators_hand_out_unique_numbers_without_gaps(app, shop):
+    """Workers leasing blocks at the same time never share a number, and only abandoned lease tails go unused"""
+    allocators = [ReceiptAllocator(block_size=BLOCK_SIZE) for _ in range(WORKERS)]
+    issued = [[] for _ in range(WORKERS)]
+
+    def allocate(index):
+        with app.app_context():
+            for _ in range(NUMBERS_PER_WORKER):
+                issued[index].append(allocators[index].next_value(shop))
+
+    run_threads(allocate, WORKERS)
+
+    numbers = [value for values in issued for value in values]
+    assert len(numbers) == WORKERS * NUMBERS_PER_WORKER
+    assert len(set(numbers)) == len(numbers)
+    for values in issued:
+        assert values == sorted(values)
+
+    with app.app_context():
+        blocks = sorted(db.session.execute(
+            select(ReceiptBlock.start_value, ReceiptBlock.end_value).where(ReceiptBlock.shop_id == shop)
+        ).all())
+        next_value = db.session.get(ReceiptSequence, shop).next_value
+
+    # Leased blocks tile the sequence exactly
+    assert blocks[0][0] == 1
+    assert all(previous[1] + 1 == current[0] for previous, current in zip(blocks, blocks[1:]))
+    assert blocks[-1][1] == next_value - 1
+
+    # The only unused numbers are what each worker still holds in its current block
+    abandoned = set()
+    for allocator in allocators:
+        current, end = allocator._blocks[shop]
+        abandoned.update(range(current, end + 1))
+    assert set(range(1, next_value)) - set(numbers) == abandoned
+    assert len(abandoned) < WORKERS * BLOCK_SIZE
+
+
+def test_concurrent_worker_and_till_leases_do_not_overlap(app, shop):
+    sizes = [1, 5, 50, 500]
+    leases = []
+    lock = threading.Lock()
+
+    def lease(index):
+        with app.app_context():
+            for round_ in range(10):
+                size = sizes[(index + round_) % len(sizes)]
+                holder = f'till:T{index}' if index % 2 else f'worker:test:{index}'
+                block = lease_block(shop, size, holder)
+                with lock:
+                    leases.append((block, size))
+
+    run_threads(lease, WORKERS)
+
+    blocks = sorted(block for block, _ in leases)
+    assert all(end - start + 1 == size for (start, end), size in leases)
+    assert blocks[0][0] == 1
+    assert all(previous[1] + 1 == current[0] for previous, current in zip(blocks, blocks[1:]))
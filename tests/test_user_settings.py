@@ -0,0 +1,36 @@
+from app import db
+from models import User
+from utils.kvstore import DatabaseStore, get_store, set_store
+from utils.user_settings import get_cashier_settings, save_cashier_settings
+
+
+def cashier_of(shop):
+    return db.session.execute(db.select(User).where(User.shop_id == shop)).scalar_one()
+
+
+def save_elsewhere(shop, theme):
+    """Save settings the way another worker would, without touching this worker's cache"""
+    db.session.execute(db.update(User).where(User.shop_id == shop).values(settings={'theme': theme}))
+    db.session.commit()
+
+
+def test_saved_settings_reach_every_worker_without_a_shared_store(app, shop):
+    assert not get_store('user_settings').shared
+    with app.app_context():
+        user_id = cashier_of(shop).id
+        assert get_cashier_settings(user_id)['theme'] == 'light'
+        save_elsewhere(shop, 'dark')
+        assert get_cashier_settings(user_id)['theme'] == 'dark'
+
+
+def test_shared_store_is_invalidated_on_save(app, shop):
+    previous = get_store('user_settings')
+    set_store('user_settings', DatabaseStore('user_settings'))
+    try:
+        with app.app_context():
+            user = cashier_of(shop)
+            assert get_cashier_settings(user.id)['theme'] == 'light'
+            save_cashier_settings(user, {'theme': 'dark'})
+            assert get_cashier_settings(user.id)['theme'] == 'dark'
+    finally:
+        set_store('user_settings', previous)
@@ -0,0 +1,311 @@
+"""
+Platform Analytics
+Cross-shop sales analysis for the super admin from the per-shop daily rollups,
+held in memory as NumPy columns so no request scans the sales table
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import chain
+import numpy as np
+from sqlalchemy import func, select
+from utils.database import day_offset, fetch_driver_rows, is_postgres
+
+COLUMNS = ('gross_sales', 'sales_count', 'items_sold', 'refund_amount',
+           'cash_sales', 'mpesa_sales', 'mpesa_count', 'active_tills')
+METRICS = {
+    'gmv': 'GMV',
+    'transactions': 'Transactions',
+    'avg_basket': 'Average basket',
+    'mpesa_share': 'M-Pesa share',
+}
+
+_frame_cache = {'frame': None}
+_frame_lock = threading.Lock()
+
+
+def get_analytics_settings():
+    """Get platform analytics configuration from the environment"""
+    return {
+        'history_days': int(os.environ.get('ANALYTICS_HISTORY_DAYS', '400')),
+        'cache_seconds': int(os.environ.get('ANALYTICS_CACHE_SECONDS', '300')),
+    }
+
+
+class DailyFrame:
+    """Per-shop daily rollups as parallel NumPy columns, one entry per shop-day"""
+
+    def __init__(self, start, shop_ids, days, values):
+        self.start = start
+        self.days = days
+        self.columns = {name: values[:, i] for i, name in enumerate(COLUMNS)}
+        self.shops, self.shop_index = np.unique(shop_ids, return_inverse=True)
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.days)
+
+    def offset(self, day):
+        return (day - self.start).days
+
+    def date(self, offset):
+        return self.start + timedelta(days=int(offset))
+
+    def by_shop(self, first, last):
+        """Column totals per shop over day offsets [first, last], aligned with self.shops"""
+        mask = (self.days >= first) & (self.days <= last)
+        index = self.shop_index[mask]
+        totals = {name: np.bincount(index, weights=column[mask], minlength=len(self.shops))
+                  for name, column in self.columns.items()}
+        # Tills are counted per day, so a shop's tills over a period is its busiest day
+        tills = np.zeros(len(self.shops))
+        np.maximum.at(tills, index, self.columns['active_tills'][mask])
+        totals['active_tills'] = tills
+        return totals
+
+    def by_day(self, first, last):
+        """Platform column totals per day offset in [first, last]"""
+        mask = (self.days >= first) & (self.days <= last)
+        index = self.days[mask] - first
+        return {name: np.bincount(index, weights=column[mask], minlength=last - first + 1)
+                for name, column in self.columns.items()}
+
+
+def load_daily_frame(start):
+    """Load every shop's daily rollups from `start` (a date) into a DailyFrame"""
+    from app import db
+    from models import ShopDailySales
+
+    query = select(
+        ShopDailySales.shop_id, day_offset(ShopDailySales.date, start),
+        *(func.coalesce(getattr(ShopDailySales, name), 0) for name in COLUMNS)
+    ).where(ShopDailySales.date >= start)
+    rows = fetch_driver_rows(query) if is_postgres() else db.session.execute(query).all()
+
+    width = len(COLUMNS) + 2
+    data = np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=width * len(rows)).reshape(-1, width)
+    return DailyFrame(start, data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2:])
+
+
+def get_daily_frame(refresh=False):
+    """Get the cached DailyFrame, reloaded once it is older than the cache lifetime"""
+    settings = get_analytics_settings()
+    today = datetime.utcnow().date()
+
+    def stale(frame):
+        return (refresh or frame is None
+                or time.monotonic() - frame.loaded_at > settings['cache_seconds']
+                or frame.offset(today) >= settings['history_days'])
+
+    frame = _frame_cache['frame']
+    if stale(frame):
+        with _frame_lock:
+            frame = _frame_cache['frame']
+            if stale(frame):
+                frame = load_daily_frame(today - timedelta(days=settings['history_days'] - 1))
+                _frame_cache['frame'] = frame
+    return frame
+
+
+def ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, 0.0)
+
+
+def shop_metrics(totals):
+    """Derived per-shop metrics from by_shop totals"""
+    return {
+        'gmv': totals['gross_sales'],
+        'transactions': totals['sales_count'],
+        'avg_basket': ratio(totals['gross_sales'], totals['sales_count']),
+        'mpesa_share': ratio(totals['mpesa_sales'], totals['gross_sales']),
+    }
+
+
+def shop_names(shop_ids):
+    from app import db
+    from models import Shop
+
+    if not shop_ids:
+        return {}
+    return dict(db.session.execute(select(Shop.id, Shop.name).where(Shop.id.in_(shop_ids))).all())
+
+
+def period(frame, days, today=None):
+    """Day offsets (first, last) of the `days` days ending today"""
+    last = frame.offset(today or datetime.utcnow().date())
+    return last - days + 1, last
+
+
+def platform_summary(days=30, frame=None):
+    """Platform totals over the last `days` days, with the previous period for comparison"""
+    frame = frame or get_daily_frame()
+    first, last = period(frame, days)
+    current = frame.by_shop(first, last)
+    previous = frame.by_shop(first - days, first - 1)
+
+    gmv = float(current['gross_sales'].sum())
+    transactions = int(current['sales_count'].sum())
+    previous_gmv = float(previous['gross_sales'].sum())
+    return {
+        'days': days,
+        'start_date': frame.date(first).isoformat(),
+        'end_date': frame.date(last).isoformat(),
+        'gmv': round(gmv, 2),
+        'transactions': transactions,
+        'items_sold': int(current['items_sold'].sum()),
+        'refund_amount': round(float(current['refund_amount'].sum()), 2),
+        'avg_basket': round(gmv / transactions, 2) if transactions else 0,
+        'mpesa_share': round(float(current['mpesa_sales'].sum()) / gmv, 4) if gmv else 0,
+        'cash_share': round(float(current['cash_sales'].sum()) / gmv, 4) if gmv else 0,
+        'active_shops': int((current['sales_count'] > 0).sum()),
+        'active_tills': int(current['active_tills'].sum()),
+        'previous_gmv': round(previous_gmv, 2),
+        'gmv_growth': round((gmv - previous_gmv) / previous_gmv, 4) if previous_gmv else None,
+    }
+
+
+def top_shops(metric='gmv', days=30, limit=20, frame=None):
+    """Shops ranked by a metric over the last `days` days"""
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+    frame = frame or get_daily_frame()
+    first, last = period(frame, days)
+    totals = frame.by_shop(first, last)
+    metrics = shop_metrics(totals)
+
+    active = np.flatnonzero(totals['sales_count'] > 0)
+    ranked = active[np.argsort(-metrics[metric][active], kind='stable')[:limit]]
+    names = shop_names([int(frame.shops[i]) for i in ranked])
+    return [{
+        'shop_id': int(frame.shops[i]),
+        'name': names.get(int(frame.shops[i]), ''),
+        'gmv': round(float(metrics['gmv'][i]), 2),
+        'transactions': int(metrics['transactions'][i]),
+        'avg_basket': round(float(metrics['avg_basket'][i]), 2),
+        'mpesa_share': round(float(metrics['mpesa_share'][i]), 4),
+        'active_tills': int(totals['active_tills'][i]),
+    } for i in ranked]
+
+
+def shop_growth(days=30, limit=10, frame=None):
+    """Fastest growing and declining shops: GMV over the last `days` days against the days before"""
+    frame = frame or get_daily_frame()
+    first, last = period(frame, days)
+    current = frame.by_shop(first, last)['gross_sales']
+    previous = frame.by_shop(first - days, first - 1)['gross_sales']
+
+    compared = np.flatnonzero(previous > 0)
+    growth = (current[compared] - previous[compared]) / previous[compared]
+    order = np.argsort(-growth, kind='stable')
+    growing = [i for i in order[:limit] if growth[i] > 0]
+    declining = [i for i in order[::-1][:limit] if growth[i] < 0]
+    names = shop_names([int(frame.shops[compared[i]]) for i in growing + declining])
+
+    def rows(indexes):
+        return [{
+            'shop_id': int(frame.shops[compared[i]]),
+            'name': names.get(int(frame.shops[compared[i]]), ''),
+            'gmv': round(float(current[compared[i]]), 2),
+            'previous_gmv': round(float(previous[compared[i]]), 2),
+            'growth': round(float(growth[i]), 4),
+        } for i in indexes]
+
+    return {'days': days, 'growing': rows(growing), 'declining': rows(declining)}
+
+
+def churn_risk(within_days=30, activity_days=14, frame=None):
+    """Active shops whose license expires within `within_days`, with their recent trading trend.
+
+    Shops that have stopped trading or whose GMV is falling are the likeliest
+    not to renew and are listed first.
+    """
+    from app import db
+    from models import Shop
+
+    now = datetime.utcnow()
+    shops = db.session.execute(
+        select(Shop.id, Shop.name, Shop.license_expires)
+        .where(Shop.is_active == True, Shop.license_expires.isnot(None),
+               Shop.license_expires <= now + timedelta(days=within_days))
+        .order_by(Shop.license_expires)
+    ).all()
+    if not shops:
+        return []
+
+    frame = frame or get_daily_frame()
+    first, last = period(frame, activity_days)
+    current = frame.by_shop(first, last)['gross_sales']
+    previous = frame.by_shop(first - activity_days, first - 1)['gross_sales']
+
+    # Last trading day per shop
+    traded = frame.columns['sales_count'] > 0
+    last_sale = np.full(len(frame.shops), -1)
+    np.maximum.at(last_sale, frame.shop_index[traded], frame.days[traded])
+
+    ids = np.array([shop.id for shop in shops], dtype=np.int64)
+    positions = np.minimum(np.searchsorted(frame.shops, ids), max(len(frame.shops) - 1, 0))
+    known = (frame.shops[positions] == ids) if len(frame.shops) else np.zeros(len(ids), bool)
+
+    result = []
+    for shop, position, has_rollups in zip(shops, positions, known):
+        gmv = float(current[position]) if has_rollups else 0.0
+        previous_gmv = float(previous[position]) if has_rollups else 0.0
+        last_day = int(last_sale[position]) if has_rollups else -1
+        days_idle = last - last_day if last_day >= 0 else None
+        result.append({
+            'shop_id': shop.id,
+            'name': shop.name,
+            'license_expires': shop.license_expires.isoformat(),
+            'days_to_expiry': (shop.license_expires - now).days,
+            'gmv': round(gmv, 2),
+            'previous_gmv': round(previous_gmv, 2),
+            'trend': round((gmv - previous_gmv) / previous_gmv, 4) if previous_gmv else None,
+            'days_since_last_sale': days_idle,
+            'at_risk': gmv == 0 or gmv < previous_gmv,
+        })
+    result.sort(key=lambda row: (not row['at_risk'], row['license_expires']))
+    return result
+
+
+def daily_series(days=30, frame=None):
+    """Platform GMV, transactions and payment split per day"""
+    frame = frame or get_daily_frame()
+    first, last = period(frame, days)
+    totals = frame.by_day(first, last)
+    return [{
+        'date': frame.date(first + i).isoformat(),
+        'gmv': round(float(totals['gross_sales'][i]), 2),
+        'transactions': int(totals['sales_count'][i]),
+        'cash_sales': round(float(totals['cash_sales'][i]), 2),
+        'mpesa_sales': round(float(totals['mpesa_sales'][i]), 2),
+        'active_tills': int(totals['active_tills'][i]),
+    } for i in range(last - first + 1)]
+
+
+def export_parquet(fileobj, frame=None):
+    """Write the per-shop daily aggregates to a Parquet file (requires pyarrow)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('Parquet export requires the pyarrow package')
+
+    frame = frame or get_daily_frame(refresh=True)
+    dates = np.datetime64(frame.start, 'D') + frame.days
+    table = pa.table({
+        'shop_id': frame.shops[frame.shop_index],
+        'date': dates,
+        'gmv': frame.columns['gross_sales'],
+        'transactions': frame.columns['sales_count'].astype(np.int64),
+        'items_sold': frame.columns['items_sold'].astype(np.int64),
+        'refund_amount': frame.columns['refund_amount'],
+        'cash_sales': frame.columns['cash_sales'],
+        'mpesa_sales': frame.columns['mpesa_sales'],
+        'mpesa_count': frame.columns['mpesa_count'].astype(np.int64),
+        'active_tills': frame.columns['active_tills'].astype(np.int64),
+    })
+    pq.write_table(table, fileobj, compression='zstd')
+    return len(frame)
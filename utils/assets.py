@@ -0,0 +1,181 @@
+"""
+Static Asset Pipeline
+Bundles, minifies, content-hashes and precompresses the JS/CSS served to tills.
+Build with `python -m utils.assets` (or `flask assets build`) before deploying.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bundle name -> source files (relative to the static folder), in load order
+BUNDLES = {
+    'css/app.css': ['css/style.css'],
+    'js/base.js': ['js/main.js', 'js/prompt-navigation.js'],
+    'js/pos.js': ['js/offline.js', 'js/pos.js', 'js/barcode.js', 'js/mpesa.js'],
+    'js/offline.js': ['js/offline.js'],
+    'js/pos-prompts.js': ['js/pos-prompts.js'],
+    'js/barcode.js': ['js/barcode.js'],
+    'js/standard-navigation.js': ['js/standard-navigation.js'],
+}
+
+DIST_DIR = 'dist'
+MANIFEST_FILE = 'manifest.json'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_manifest_cache = {}
+
+
+def minify_js(source):
+    """Minify JavaScript (falls back to trimming whitespace without rjsmin)"""
+    if rjsmin:
+        return rjsmin.jsmin(source)
+
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+def minify_css(source):
+    """Minify CSS (falls back to stripping comments and whitespace without rcssmin)"""
+    if rcssmin:
+        return rcssmin.cssmin(source)
+
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    return re.sub(r'\s*([{};,>])\s*', r'\1', source).strip()
+
+
+def build_bundle(static_folder, sources):
+    """Concatenate and minify the source files of a bundle"""
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_folder, source), encoding='utf-8') as f:
+            parts.append(f.read())
+
+    if sources[0].endswith('.css'):
+        return minify_css('\n'.join(parts))
+
+    # Separate scripts with ';' so concatenation never joins two statements
+    return ';\n'.join(minify_js(part) for part in parts)
+
+
+def write_compressed(path, data):
+    """Write gzip (and brotli when available) variants next to path"""
+    with open(f"{path}.gz", 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+    if brotli:
+        with open(f"{path}.br", 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def build_assets(static_folder):
+    """Build every bundle into static/dist and write the manifest"""
+    dist_folder = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+
+    for bundle, sources in BUNDLES.items():
+        data = build_bundle(static_folder, sources).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        root, ext = os.path.splitext(bundle)
+        hashed_name = f"{root}.{digest}{ext}"
+
+        path = os.path.join(dist_folder, hashed_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        write_compressed(path, data)
+
+        manifest[bundle] = hashed_name
+        logging.info(f"Built {bundle} -> {hashed_name} ({len(data)} bytes)")
+
+    # Remove bundles from previous builds
+    current = set(manifest.values())
+    for dirpath, _, filenames in os.walk(dist_folder):
+        for filename in filenames:
+            relative = os.path.relpath(os.path.join(dirpath, filename), dist_folder).replace(os.sep, '/')
+            base = re.sub(r'\.(gz|br)$', '', relative)
+            if filename != MANIFEST_FILE and base not in current:
+                os.remove(os.path.join(dirpath, filename))
+
+    with open(os.path.join(dist_folder, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    _manifest_cache.clear()
+    return manifest
+
+
+def load_manifest(static_folder):
+    """Load the build manifest (empty when assets have not been built)"""
+    if static_folder not in _manifest_cache:
+        try:
+            with open(os.path.join(static_folder, DIST_DIR, MANIFEST_FILE)) as f:
+                _manifest_cache[static_folder] = json.load(f)
+        except (OSError, ValueError):
+            _manifest_cache[static_folder] = {}
+    return _manifest_cache[static_folder]
+
+
+def init_assets(app):
+    """Register the asset route and the asset_url/asset_urls template helpers"""
+    from flask import request, send_from_directory, url_for
+    from werkzeug.security import safe_join
+
+    dist_folder = os.path.join(app.static_folder, DIST_DIR)
+
+    def asset_urls(bundle):
+        """URLs to load for a bundle: the hashed build, or the raw sources in development"""
+        manifest = load_manifest(app.static_folder)
+        if bundle in manifest:
+            return [url_for('serve_asset', filename=manifest[bundle])]
+        return [url_for('static', filename=source) for source in BUNDLES[bundle]]
+
+    def asset_url(bundle):
+        """URL of a single-file bundle"""
+        return asset_urls(bundle)[0]
+
+    @app.route('/assets/<path:filename>')
+    def serve_asset(filename):
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        encoding = None
+        served_name = filename
+
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            compressed_path = safe_join(dist_folder, filename + suffix)
+            if candidate in accept_encoding and compressed_path and os.path.exists(compressed_path):
+                encoding = candidate
+                served_name = filename + suffix
+                break
+
+        mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+        response = send_from_directory(dist_folder, served_name, mimetype=mimetype, max_age=31536000)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    app.jinja_env.globals.update(asset_url=asset_url, asset_urls=asset_urls)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build_assets(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static'))
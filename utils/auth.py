@@ -2,6 +2,7 @@ from functools import wraps
 from flask import session, redirect, url_for, request
 from models import AuditLog
 from app import db
+from utils.tenant import get_tenant
 import logging
 
 def require_role(required_role):
@@ -38,7 +39,7 @@ def require_any_role(*roles):
         return decorated_function
     return decorator
 
-def log_audit(user_id, action, entity_type=None, entity_id=None, old_values=None, new_values=None, ip_address=None, user_agent=None, shop_id=None):
+def log_audit(user_id, action, entity_type=None, entity_id=None, ip_address=None, user_agent=None, old_values=None, new_values=None, shop_id=None):
     """Log audit trail for important actions"""
     try:
         audit_log = AuditLog(
@@ -59,16 +60,11 @@ def log_audit(user_id, action, entity_type=None, entity_id=None, old_values=None
         # Don't let audit logging failure break the main operation
         pass
 
-def is_shop_active(shop_id):
-    """Check if shop license is active"""
-    from models import Shop
-    from datetime import datetime
+def is_shop_active(shop_id, refresh=False):
+    """Check if shop license is active (cached flag maintained by the license sweep)"""
+    from utils.licenses import is_license_current
     
-    shop = Shop.query.get(shop_id)
-    if not shop:
-        return False
-    
-    return shop.is_active and shop.license_expires > datetime.utcnow()
+    return is_license_current(shop_id, refresh)
 
 def require_shop_access(f):
     """Decorator to ensure user has access to their shop"""
@@ -81,12 +77,12 @@ def require_shop_access(f):
         if session.get('role') == 'super_admin':
             return f(*args, **kwargs)
         
-        shop_id = session.get('shop_id')
-        if not shop_id:
+        tenant = get_tenant()
+        if not tenant.shop_id:
             return redirect(url_for('auth.login'))
         
-        # Check if shop license is active
-        if not is_shop_active(shop_id):
+        # Check if shop license is active (once per request, shared with check_auth)
+        if not tenant.license_active:
             return redirect(url_for('auth.login'))
         
         return f(*args, **kwargs)
@@ -94,9 +90,4 @@ def require_shop_access(f):
 
 def get_current_user():
     """Get current logged in user"""
-    from models import User
-    
-    user_id = session.get('user_id')
-    if user_id:
-        return User.query.get(user_id)
-    return None
\ No newline at end of file
+    return get_tenant().user
\ No newline at end of file
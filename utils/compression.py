@@ -0,0 +1,97 @@
+"""
+Response Compression
+Content-negotiated brotli/gzip compression of dynamic HTML, JSON and CSV
+responses. Buffered responses below a size threshold are left alone;
+streamed responses (CSV exports) are compressed chunk by chunk as they are sent.
+"""
+
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Text types worth compressing; images, PDFs, archives, ESC/POS bytes and
+# event streams (which must reach the till unbuffered) are sent as they are
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'text/javascript',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+}
+
+
+def get_compression_settings():
+    """Get response compression configuration from the environment"""
+    return {
+        'enabled': os.environ.get('COMPRESS_ENABLED', 'true').lower() == 'true',
+        'min_size': int(os.environ.get('COMPRESS_MIN_SIZE', '500')),
+        'gzip_level': int(os.environ.get('COMPRESS_GZIP_LEVEL', '6')),
+        'brotli_quality': int(os.environ.get('COMPRESS_BROTLI_QUALITY', '4')),
+    }
+
+
+def choose_encoding(accept_encodings):
+    """Best encoding the client accepts: brotli (when installed) or gzip, else None"""
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    return accept_encodings.best_match(offered)
+
+
+def compressor(encoding, settings):
+    """Incremental compressor as (compress(chunk), finish()) functions"""
+    if encoding == 'br':
+        engine = brotli.Compressor(quality=settings['brotli_quality'])
+        return engine.process, engine.finish
+    engine = zlib.compressobj(settings['gzip_level'], zlib.DEFLATED, 31)  # gzip container
+    return engine.compress, engine.flush
+
+
+def compress_stream(chunks, encoding, settings):
+    compress, finish = compressor(encoding, settings)
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """after_request hook: compress the body for clients that accept it"""
+    from flask import request
+
+    settings = get_compression_settings()
+    if (not settings['enabled'] or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, settings)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < settings['min_size']:
+            return response
+        compress, finish = compressor(encoding, settings)
+        response.set_data(compress(data) + finish())
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the ones a strong ETag describes
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,110 @@
+"""
+Cooperative Workers
+Support for running under gevent workers, where each worker process serves
+many connections at once from greenlets instead of one request per process
+"""
+
+import importlib.util
+import logging
+import os
+import sys
+
+
+def get_worker_settings():
+    """Get gunicorn worker configuration from the environment"""
+    worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+    return {
+        'worker_class': worker_class,
+        'workers': int(os.environ.get('WEB_CONCURRENCY', '4')),
+        'worker_connections': int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000')),
+        'timeout': int(os.environ.get('GUNICORN_TIMEOUT', '120')),
+        'max_requests': int(os.environ.get('GUNICORN_MAX_REQUESTS', '0')),
+        'cooperative': worker_class == 'gevent',
+    }
+
+
+def get_pool_settings():
+    """SQLAlchemy pool options set in the environment (DB_POOL_SIZE etc.)"""
+    options = {}
+    for option, variable in (('pool_size', 'DB_POOL_SIZE'),
+                             ('max_overflow', 'DB_MAX_OVERFLOW'),
+                             ('pool_timeout', 'DB_POOL_TIMEOUT')):
+        if os.environ.get(variable):
+            options[option] = int(os.environ[variable])
+    return options
+
+
+def is_cooperative():
+    """True when the stdlib has been monkey-patched by gevent, so blocking I/O yields"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def patch_psycopg():
+    """Make the PostgreSQL driver wait for the server through gevent instead of blocking the worker.
+
+    Both drivers talk to PostgreSQL through libpq in C, which monkey-patching cannot
+    reach: psycopg2 gets a wait callback that hands every wait back to the gevent
+    hub, and psycopg 3 is switched from its C wait loop to one on the (patched)
+    select module.
+    """
+    patched = [name for name, patch in (('psycopg2', _patch_psycopg2), ('psycopg', _patch_psycopg3)) if patch()]
+    if patched:
+        logging.info(f"{' and '.join(patched)} patched for gevent")
+    return bool(patched)
+
+
+def _patch_psycopg2():
+    try:
+        import psycopg2
+        from psycopg2 import extensions
+        from gevent.socket import wait_read, wait_write
+    except ImportError:
+        return False
+
+    def wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+    extensions.set_wait_callback(wait_callback)
+    return True
+
+
+def _patch_psycopg3():
+    if importlib.util.find_spec('psycopg') is None or importlib.util.find_spec('gevent') is None:
+        return False
+
+    # psycopg 3 picks its wait function when psycopg.waiting is first imported,
+    # and only avoids the C one if gevent has already patched select by then.
+    # Importing it here, before the worker patches the stdlib, would pull in ssl
+    # too early, so set the choice through the environment unless it is loaded
+    waiting = sys.modules.get('psycopg.waiting')
+    if waiting is None:
+        os.environ['PSYCOPG_WAIT_FUNC'] = 'wait_select'
+    else:
+        waiting.wait = waiting.wait_select
+    return True
+
+
+def database_url(url):
+    """The SQLAlchemy URL for a PostgreSQL connection string, naming psycopg 3 when psycopg2 is not installed.
+
+    A plain postgresql:// URL means psycopg2 to SQLAlchemy; deployments that only
+    install psycopg 3 (render.yaml) would otherwise fail to connect.
+    """
+    if not url or not url.startswith(('postgres://', 'postgresql://')):
+        return url
+    if importlib.util.find_spec('psycopg2') is None and importlib.util.find_spec('psycopg') is not None:
+        return 'postgresql+psycopg://' + url.split('://', 1)[1]
+    return url
@@ -0,0 +1,429 @@
+"""
+Customers and Loyalty
+A per-shop customer directory keyed by normalised MSISDN, upserted in batches
+from M-Pesa payers and the sales their payments settle. Purchases link sales
+to the customer; points are earned on them and kept in a ledger whose entries
+carry the customer's running balance, so a till reads a returning customer
+and their balance from one indexed row.
+"""
+
+import csv
+import io
+import logging
+import os
+import re
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import bindparam, case, func, insert, select, text, update
+from utils.database import copy_from_file, is_postgres, upsert_insert
+from utils.pricing import local_time
+from utils.sales import to_money
+
+# Sales per UPDATE ... CASE when linking them to customers, ids per IN (...) lookup
+LINK_CHUNK = 1000
+BACKFILL_CHUNK = 5000
+# Batches at least this large are linked through a staging table on PostgreSQL
+STAGING_MIN_ROWS = 500
+
+STAGING_COLUMNS = ['sale_id', 'shop_id', 'msisdn', 'name', 'total', 'created_at', 'points']
+
+MSISDN_SEPARATORS = re.compile(r'[\s\-()+]')
+
+
+def get_loyalty_settings():
+    """Get loyalty configuration from the environment"""
+    return {
+        # KES spent per point earned; 0 turns earning off
+        'spend_per_point': Decimal(os.environ.get('LOYALTY_SPEND_PER_POINT', '100')),
+    }
+
+
+def normalize_msisdn(value):
+    """A Kenyan mobile number as 2547XXXXXXXX / 2541XXXXXXXX, or None (including masked MSISDNs)"""
+    digits = MSISDN_SEPARATORS.sub('', str(value or ''))
+    if not digits.isdigit():
+        return None
+    if len(digits) == 10 and digits[0] == '0':
+        digits = '254' + digits[1:]
+    elif len(digits) == 9:
+        digits = '254' + digits
+    if len(digits) == 12 and digits.startswith('254') and digits[3] in '17':
+        return digits
+    return None
+
+
+def points_for(amount, spend_per_point=None):
+    if spend_per_point is None:
+        spend_per_point = get_loyalty_settings()['spend_per_point']
+    if spend_per_point <= 0:
+        return 0
+    return int(to_money(amount) // spend_per_point)
+
+
+def utc_from_local(moment):
+    """M-Pesa times are the shop's local time; customer times are UTC like sales"""
+    return moment - (local_time(moment) - moment)
+
+
+def upsert_customers(rows):
+    """Insert or refresh customers from (shop_id, msisdn, name, seen_at) rows in one batched upsert.
+
+    msisdn must already be normalised. Returns {(shop_id, msisdn): customer id}.
+    """
+    from app import db
+    from models import Customer
+
+    merged = {}
+    for shop_id, msisdn, name, seen_at in rows:
+        name = ' '.join(str(name or '').split())[:100]
+        current = merged.get((shop_id, msisdn))
+        if current is None:
+            merged[(shop_id, msisdn)] = {'shop_id': shop_id, 'msisdn': msisdn, 'name': name or None,
+                                         'first_seen_at': seen_at, 'last_seen_at': seen_at}
+            continue
+        current['first_seen_at'] = min(current['first_seen_at'], seen_at)
+        if seen_at >= current['last_seen_at']:
+            current['last_seen_at'] = seen_at
+            current['name'] = name or current['name']
+    if not merged:
+        return {}
+
+    table = Customer.__table__
+    statement = upsert_insert(table)
+    excluded = statement.excluded
+    # The most recently seen name wins; seen times only widen
+    statement = statement.on_conflict_do_update(
+        index_elements=['shop_id', 'msisdn'],
+        set_={
+            'name': case((excluded.last_seen_at >= table.c.last_seen_at, func.coalesce(excluded.name, table.c.name)),
+                         else_=func.coalesce(table.c.name, excluded.name)),
+            'first_seen_at': case((excluded.first_seen_at < table.c.first_seen_at, excluded.first_seen_at),
+                                  else_=table.c.first_seen_at),
+            'last_seen_at': case((excluded.last_seen_at > table.c.last_seen_at, excluded.last_seen_at),
+                                 else_=table.c.last_seen_at),
+        }
+    ).returning(table.c.id, table.c.shop_id, table.c.msisdn)
+    return {(shop_id, msisdn): row_id
+            for row_id, shop_id, msisdn in db.session.execute(statement, list(merged.values()))}
+
+
+def record_payers(payments):
+    """Add M-Pesa payers to the directory from (shop_id, msisdn, name, local time) payments"""
+    return upsert_customers(
+        (shop_id, msisdn, name, utc_from_local(at))
+        for shop_id, msisdn, name, at in
+        ((shop_id, normalize_msisdn(phone), name, at) for shop_id, phone, name, at in payments)
+        if msisdn is not None
+    )
+
+
+def record_customer_sales(sales, award_points=True):
+    """Link paid sales to their payers' customer records and earn points on them.
+
+    sales are (sale_id, shop_id, phone, name, total, created_at) rows. Only
+    sales not yet linked are counted, so repeating a batch is harmless. All
+    writes are batched and made in the caller's transaction: large batches on
+    PostgreSQL go through COPY into a staging table and set-based statements,
+    others through a few multi-row statements. Returns how many sales were
+    linked.
+    """
+    spend_per_point = get_loyalty_settings()['spend_per_point']
+    by_sale = {}
+    for sale_id, shop_id, phone, name, total, created_at in sales:
+        msisdn = normalize_msisdn(phone)
+        if msisdn is not None:
+            total = to_money(total)
+            by_sale[sale_id] = (sale_id, shop_id, msisdn, name, total, created_at,
+                                points_for(total, spend_per_point) if award_points else 0)
+    rows = list(by_sale.values())
+    if not rows:
+        return 0
+    if len(rows) >= STAGING_MIN_ROWS and is_postgres():
+        return link_sales_postgres(rows)
+    return link_sales(rows)
+
+
+def link_sales(rows):
+    """Link (sale_id, shop_id, msisdn, name, total, created_at, points) rows with multi-row statements"""
+    from app import db
+    from models import Customer, LoyaltyEntry, Sale
+
+    customer_ids = upsert_customers((shop_id, msisdn, name, at) for _, shop_id, msisdn, name, _, at, _ in rows)
+    customer_of = {row[0]: customer_ids[(row[1], row[2])] for row in rows}
+
+    # Link the sales still without a customer; the update returns exactly the ones this call linked
+    sales_table = Sale.__table__
+    sale_ids = list(customer_of)
+    linked = set()
+    for start in range(0, len(sale_ids), LINK_CHUNK):
+        chunk = {sale_id: customer_of[sale_id] for sale_id in sale_ids[start:start + LINK_CHUNK]}
+        linked.update(db.session.execute(
+            update(sales_table)
+            .where(sales_table.c.id.in_(chunk), sales_table.c.customer_id.is_(None))
+            .values(customer_id=case(chunk, value=sales_table.c.id))
+            .returning(sales_table.c.id)
+        ).scalars())
+    if not linked:
+        return 0
+
+    totals = {}
+    earned = []
+    for sale_id, shop_id, _, _, total, created_at, points in sorted(rows, key=lambda row: (row[5], row[0])):
+        if sale_id not in linked:
+            continue
+        customer_id = customer_of[sale_id]
+        customer = totals.setdefault(customer_id, {'count': 0, 'spent': Decimal(0), 'points': 0,
+                                                   'last': created_at})
+        customer['count'] += 1
+        customer['spent'] += total
+        customer['points'] += points
+        customer['last'] = max(customer['last'], created_at)
+        if points:
+            earned.append((customer_id, shop_id, sale_id, points))
+
+    table = Customer.__table__
+    db.session.execute(
+        update(table).where(table.c.id == bindparam('row_id'))
+        .values(purchases_count=table.c.purchases_count + bindparam('new_count'),
+                total_spent=table.c.total_spent + bindparam('new_spent'),
+                points_balance=table.c.points_balance + bindparam('new_points'),
+                last_purchase_at=case((table.c.last_purchase_at.is_(None)
+                                       | (table.c.last_purchase_at < bindparam('new_last')), bindparam('new_last')),
+                                      else_=table.c.last_purchase_at)),
+        [{'row_id': customer_id, 'new_count': values['count'], 'new_spent': values['spent'],
+          'new_points': values['points'], 'new_last': values['last']} for customer_id, values in totals.items()]
+    )
+
+    if earned:
+        # The rows just updated stay locked until commit, so these balances include this batch last;
+        # each entry's balance_after counts back from them
+        earners = list({customer_id for customer_id, _, _, _ in earned})
+        balances = {}
+        for start in range(0, len(earners), BACKFILL_CHUNK):
+            balances.update(db.session.execute(
+                select(table.c.id, table.c.points_balance).where(table.c.id.in_(earners[start:start + BACKFILL_CHUNK]))
+            ).all())
+        entries = []
+        now = datetime.utcnow()
+        for customer_id, shop_id, sale_id, points in reversed(earned):
+            entries.append({'customer_id': customer_id, 'shop_id': shop_id, 'entry_type': 'earn', 'points': points,
+                            'balance_after': balances[customer_id], 'sale_id': sale_id, 'created_at': now})
+            balances[customer_id] -= points
+        entries.reverse()
+        db.session.execute(insert(LoyaltyEntry.__table__), entries)
+
+    return len(linked)
+
+
+def link_sales_postgres(rows):
+    """Link rows via COPY into a staging table and set-based statements (PostgreSQL)"""
+    from app import db
+
+    conn = db.session.connection()
+    conn.execute(text(
+        "CREATE TEMP TABLE IF NOT EXISTS customer_sales_staging ("
+        "sale_id INTEGER PRIMARY KEY, shop_id INTEGER, msisdn VARCHAR(15), name VARCHAR(100), "
+        "total NUMERIC(12, 2), created_at TIMESTAMP, points INTEGER, customer_id INTEGER, "
+        "linked BOOLEAN DEFAULT false"
+        ") ON COMMIT DROP"
+    ))
+    conn.execute(text("TRUNCATE customer_sales_staging"))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for sale_id, shop_id, msisdn, name, total, created_at, points in rows:
+        writer.writerow([sale_id, shop_id, msisdn, ' '.join(str(name or '').split())[:100], total, created_at, points])
+    copy_from_file(conn.connection, f"COPY customer_sales_staging ({', '.join(STAGING_COLUMNS)}) "
+                                    "FROM STDIN WITH (FORMAT csv)", io.BytesIO(buffer.getvalue().encode('utf-8')))
+
+    params = {'now': datetime.utcnow()}
+    # One row per payer: the latest name, the batch's first and last sale; same merge as upsert_customers
+    conn.execute(text(
+        "INSERT INTO customers (shop_id, msisdn, name, first_seen_at, last_seen_at, purchases_count, "
+        "  total_spent, points_balance, created_at) "
+        "SELECT DISTINCT ON (shop_id, msisdn) shop_id, msisdn, "
+        "  first_value(name) OVER (PARTITION BY shop_id, msisdn ORDER BY (name IS NULL), created_at DESC), "
+        "  min(created_at) OVER (PARTITION BY shop_id, msisdn), max(created_at) OVER (PARTITION BY shop_id, msisdn), "
+        "  0, 0, 0, :now "
+        "FROM customer_sales_staging ORDER BY shop_id, msisdn "
+        "ON CONFLICT (shop_id, msisdn) DO UPDATE SET "
+        "  name = CASE WHEN excluded.last_seen_at >= customers.last_seen_at "
+        "    THEN COALESCE(excluded.name, customers.name) ELSE COALESCE(customers.name, excluded.name) END, "
+        "  first_seen_at = LEAST(customers.first_seen_at, excluded.first_seen_at), "
+        "  last_seen_at = GREATEST(customers.last_seen_at, excluded.last_seen_at)"
+    ), params)
+    conn.execute(text(
+        "UPDATE customer_sales_staging st SET customer_id = c.id FROM customers c "
+        "WHERE c.shop_id = st.shop_id AND c.msisdn = st.msisdn"
+    ))
+
+    # Link the sales still without a customer and mark the ones this call linked
+    conn.execute(text(
+        "WITH linked AS ("
+        "  UPDATE sales s SET customer_id = st.customer_id FROM customer_sales_staging st "
+        "  WHERE s.id = st.sale_id AND s.customer_id IS NULL RETURNING s.id"
+        ") UPDATE customer_sales_staging st SET linked = true FROM linked WHERE st.sale_id = linked.id"
+    ))
+    conn.execute(text(
+        "UPDATE customers c SET purchases_count = c.purchases_count + t.sales, "
+        "  total_spent = c.total_spent + t.spent, points_balance = c.points_balance + t.points, "
+        "  last_purchase_at = GREATEST(c.last_purchase_at, t.last) "
+        "FROM (SELECT customer_id, count(*) AS sales, sum(total) AS spent, sum(points) AS points, "
+        "      max(created_at) AS last FROM customer_sales_staging WHERE linked GROUP BY customer_id) t "
+        "WHERE c.id = t.customer_id"
+    ))
+    # The customers just updated stay locked until commit; balance_after counts back from their balances
+    conn.execute(text(
+        "INSERT INTO loyalty_ledger (customer_id, shop_id, entry_type, points, balance_after, sale_id, created_at) "
+        "SELECT st.customer_id, st.shop_id, 'earn', st.points, "
+        "  c.points_balance - COALESCE(sum(st.points) OVER (PARTITION BY st.customer_id "
+        "    ORDER BY st.created_at, st.sale_id ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING), 0), "
+        "  st.sale_id, :now "
+        "FROM customer_sales_staging st JOIN customers c ON c.id = st.customer_id "
+        "WHERE st.linked AND st.points > 0 ORDER BY st.customer_id, st.created_at, st.sale_id"
+    ), params)
+
+    return conn.execute(text("SELECT count(*) FROM customer_sales_staging WHERE linked")).scalar()
+
+
+def post_points(customer_id, shop_id, points, entry_type, sale_id=None, user_id=None, note=None,
+                allow_negative=False):
+    """Add (or with negative points, take) points in one conditional update plus a ledger entry.
+
+    Returns the new balance; raises ValueError if the balance would go below
+    zero and allow_negative is False.
+    """
+    from app import db
+    from models import Customer, LoyaltyEntry
+
+    table = Customer.__table__
+    statement = update(table).where(table.c.id == customer_id)
+    if not allow_negative:
+        statement = statement.where(table.c.points_balance + points >= 0)
+    balance = db.session.execute(
+        statement.values(points_balance=table.c.points_balance + points).returning(table.c.points_balance)
+    ).scalar()
+    if balance is None:
+        raise ValueError('Not enough points')
+
+    db.session.execute(insert(LoyaltyEntry).values(
+        customer_id=customer_id, shop_id=shop_id, entry_type=entry_type, points=points, balance_after=balance,
+        sale_id=sale_id, note=note, created_by=user_id, created_at=datetime.utcnow()))
+    return balance
+
+
+def record_refund_points(sale, amount, user_id):
+    """Take a refund off the sale's customer: spend, and the points earned on the refunded share"""
+    from app import db
+    from models import Customer, LoyaltyEntry, Refund
+
+    if not sale.customer_id:
+        return
+    table = Customer.__table__
+    db.session.execute(update(table).where(table.c.id == sale.customer_id)
+                       .values(total_spent=table.c.total_spent - to_money(amount)))
+
+    earned, reversed_points = db.session.execute(
+        select(func.coalesce(func.sum(case((LoyaltyEntry.entry_type == 'earn', LoyaltyEntry.points), else_=0)), 0),
+               func.coalesce(func.sum(case((LoyaltyEntry.entry_type == 'reverse', -LoyaltyEntry.points), else_=0)), 0))
+        .where(LoyaltyEntry.sale_id == sale.id)
+    ).one()
+    if not earned:
+        return
+
+    refunded = db.session.execute(
+        select(func.coalesce(func.sum(Refund.amount), 0)).where(Refund.sale_id == sale.id)
+    ).scalar()
+    target = earned if to_money(refunded) >= to_money(sale.total_amount) else min(earned, points_for(refunded))
+    if target > reversed_points:
+        # Points already redeemed can take the balance below zero
+        post_points(sale.customer_id, sale.shop_id, reversed_points - target, 'reverse', sale_id=sale.id,
+                    user_id=user_id, note='Refund', allow_negative=True)
+
+
+def backfill_customers(award_points=False):
+    """Build the directory from recorded M-Pesa payers and link past sales that carry a payer's phone.
+
+    Works in chunks, committing after each. Returns (payments read, sales linked).
+    """
+    from app import db
+    from models import MpesaTransaction, Sale
+
+    payments = linked = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(MpesaTransaction.id, MpesaTransaction.shop_id, MpesaTransaction.msisdn,
+                   MpesaTransaction.first_name, MpesaTransaction.middle_name, MpesaTransaction.last_name,
+                   MpesaTransaction.transaction_time)
+            .where(MpesaTransaction.id > last_id, MpesaTransaction.transaction_type == 'sale',
+                   MpesaTransaction.shop_id.isnot(None))
+            .order_by(MpesaTransaction.id).limit(BACKFILL_CHUNK)
+        ).all()
+        if not rows:
+            break
+        record_payers((row.shop_id, row.msisdn,
+                       ' '.join(part for part in (row.first_name, row.middle_name, row.last_name) if part),
+                       row.transaction_time) for row in rows)
+        db.session.commit()
+        payments += len(rows)
+        last_id = rows[-1].id
+
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Sale.id, Sale.shop_id, Sale.customer_phone, Sale.customer_name, Sale.total_amount, Sale.created_at)
+            .where(Sale.id > last_id, Sale.customer_phone.isnot(None), Sale.customer_id.is_(None),
+                   Sale.status.in_(['completed', 'partially_refunded', 'refunded']))
+            .order_by(Sale.id).limit(BACKFILL_CHUNK)
+        ).all()
+        if not rows:
+            break
+        linked += record_customer_sales([tuple(row) for row in rows], award_points=award_points)
+        db.session.commit()
+        last_id = rows[-1].id
+
+    logging.info(f"Customer backfill: {payments} payments read, {linked} sales linked")
+    return payments, linked
+
+
+def rebuild_customer_totals(shop_id=None):
+    """Recompute purchase totals from linked sales and refunds, and points balances from the ledger"""
+    from app import db
+    from models import Customer, LoyaltyEntry, Refund, Sale
+
+    customers = select(Customer.id)
+    if shop_id is not None:
+        customers = customers.where(Customer.shop_id == shop_id)
+    totals = {row_id: {'count': 0, 'spent': Decimal(0), 'last': None, 'points': 0}
+              for row_id in db.session.execute(customers).scalars()}
+    if not totals:
+        return 0
+
+    sales_query = select(Sale.customer_id, func.count(Sale.id), func.sum(Sale.total_amount), func.max(Sale.created_at)
+                         ).where(Sale.customer_id.in_(totals)).group_by(Sale.customer_id)
+    refunds_query = select(Sale.customer_id, func.sum(Refund.amount)
+                           ).join(Sale, Sale.id == Refund.sale_id
+                           ).where(Sale.customer_id.in_(totals)).group_by(Sale.customer_id)
+    points_query = select(LoyaltyEntry.customer_id, func.sum(LoyaltyEntry.points)
+                          ).where(LoyaltyEntry.customer_id.in_(totals)).group_by(LoyaltyEntry.customer_id)
+
+    for row_id, count, spent, last in db.session.execute(sales_query):
+        totals[row_id].update(count=count, spent=to_money(spent), last=last)
+    for row_id, refunded in db.session.execute(refunds_query):
+        totals[row_id]['spent'] -= to_money(refunded)
+    for row_id, points in db.session.execute(points_query):
+        totals[row_id]['points'] = int(points or 0)
+
+    table = Customer.__table__
+    db.session.execute(
+        update(table).where(table.c.id == bindparam('row_id'))
+        .values(purchases_count=bindparam('new_count'), total_spent=bindparam('new_spent'),
+                last_purchase_at=bindparam('new_last'), points_balance=bindparam('new_points')),
+        [{'row_id': row_id, 'new_count': values['count'], 'new_spent': values['spent'],
+          'new_last': values['last'], 'new_points': values['points']} for row_id, values in totals.items()]
+    )
+    db.session.commit()
+
+    logging.info(f"Rebuilt totals for {len(totals)} customers")
+    return len(totals)
@@ -0,0 +1,224 @@
+"""
+Database Utilities
+Dialect helpers, read-replica routing, additive schema upgrades and PostgreSQL COPY support
+"""
+
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Date, Integer, cast, event, func, inspect, literal, text
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+
+# Cached replica health: (checked_at, usable)
+_replica_state = {'checked_at': 0.0, 'usable': False}
+_replica_lock = threading.Lock()
+
+
+def is_postgres(engine=None):
+    """Check if the engine (primary by default) is PostgreSQL"""
+    if engine is None:
+        from app import db
+        engine = db.engine
+    return engine.dialect.name == 'postgresql'
+
+
+def upsert_insert(table, engine=None):
+    """Dialect-specific INSERT supporting ON CONFLICT clauses (PostgreSQL or SQLite)"""
+    if is_postgres(engine):
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(table)
+
+
+def upgrade_schema():
+    """Add model columns and indexes that are missing from existing tables.
+
+    db.create_all() only creates missing tables, so columns added to models
+    after a database was first created are added here as nullable columns,
+    along with any model indexes not already covered by an existing index.
+    """
+    from app import db
+
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logging.info(f"Added missing column {table.name}.{column.name}")
+
+            existing_indexes = {tuple(i['column_names']) for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if tuple(c.name for c in index.columns) not in existing_indexes:
+                    index.create(conn)
+                    logging.info(f"Created missing index {index.name}")
+
+
+def copy_to_file(conn, sql, fileobj):
+    """Stream a COPY ... TO STDOUT statement into a binary file object"""
+    cursor = conn.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2
+            cursor.copy_expert(sql, fileobj)
+        else:
+            # psycopg 3
+            with cursor.copy(sql) as copy:
+                for data in copy:
+                    fileobj.write(bytes(data))
+    finally:
+        cursor.close()
+
+
+def copy_from_file(conn, sql, fileobj):
+    """Stream a binary file object into a COPY ... FROM STDIN statement"""
+    cursor = conn.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2
+            cursor.copy_expert(sql, fileobj)
+        else:
+            # psycopg 3
+            with cursor.copy(sql) as copy:
+                while True:
+                    data = fileobj.read(64 * 1024)
+                    if not data:
+                        break
+                    copy.write(data)
+    finally:
+        cursor.close()
+
+
+def day_offset(column, start):
+    """Whole days from the date `start` to a date or timestamp column, as an SQL integer"""
+    if hasattr(start, 'date'):
+        start = start.date()
+    if is_postgres():
+        return cast(column, Date) - literal(start, Date)
+    return cast(func.julianday(func.date(column)) - func.julianday(start.isoformat()), Integer)
+
+
+def fetch_driver_rows(statement):
+    """Run a SELECT on the DBAPI cursor and return its plain tuples.
+
+    For bulk reads of millions of narrow rows, where building SQLAlchemy Row
+    objects costs more than the query. Bind values are passed to the driver
+    unprocessed, so use this on PostgreSQL only.
+    """
+    from app import db
+
+    connection = db.session.connection(bind_arguments={'clause': statement})
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(compiled.string, compiled.params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class RoutingSession(Session):
+    """Session that sends read-only queries of replica-enabled views to the replica.
+
+    Flushes, DML statements and anything after the first write in a request
+    always use the primary, so a view never reads stale copies of its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing
+                and not isinstance(clause, UpdateBase)
+                and _replica_requested()):
+            engine = get_replica_engine()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _pin_request_to_primary(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _replica_requested():
+    return has_request_context() and g.get('use_replica', False) and not g.get('db_wrote', False)
+
+
+def get_replica_settings():
+    """Get read-replica configuration from the environment"""
+    return {
+        'url': os.environ.get('REPLICA_DATABASE_URL', ''),
+        'max_lag_seconds': float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '30')),
+        'check_interval': float(os.environ.get('REPLICA_CHECK_INTERVAL', '10')),
+    }
+
+
+def replica_lag_seconds(engine):
+    """Measure replication lag on the replica (0 when it is fully caught up)"""
+    if not is_postgres(engine):
+        return 0.0
+
+    with engine.connect() as conn:
+        lag = conn.execute(text(
+            "SELECT CASE "
+            "WHEN NOT pg_is_in_recovery() THEN 0 "
+            "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )).scalar()
+    return float(lag or 0)
+
+
+def get_replica_engine():
+    """Return the replica engine if configured and within the lag budget, else None"""
+    from app import db
+
+    engine = db.engines.get(REPLICA_BIND)
+    if engine is None:
+        return None
+
+    settings = get_replica_settings()
+    now = time.monotonic()
+    if now - _replica_state['checked_at'] < settings['check_interval']:
+        return engine if _replica_state['usable'] else None
+
+    with _replica_lock:
+        if now - _replica_state['checked_at'] >= settings['check_interval']:
+            try:
+                lag = replica_lag_seconds(engine)
+                usable = lag <= settings['max_lag_seconds']
+                if not usable:
+                    logging.warning(f"Replica lag {lag:.1f}s exceeds limit, using primary")
+            except Exception as e:
+                logging.error(f"Replica health check failed, using primary: {e}")
+                usable = False
+
+            _replica_state['usable'] = usable
+            _replica_state['checked_at'] = time.monotonic()
+
+    return engine if _replica_state['usable'] else None
+
+
+def read_replica(f):
+    """Decorator to run a view's read-only queries on the read replica"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.use_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
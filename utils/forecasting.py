@@ -0,0 +1,181 @@
+"""
+Demand Forecasting
+Per-product demand, days of cover and reorder suggestions computed with NumPy
+across every product of a shop at once
+"""
+
+import os
+from datetime import datetime, timedelta
+from itertools import chain
+import numpy as np
+from sqlalchemy import func, select, update
+from utils.database import day_offset, fetch_driver_rows, is_postgres
+
+FORECAST_METHODS = ('ema', 'sma')
+COUNTED_STATUSES = ('completed', 'partially_refunded', 'refunded')
+
+
+def get_forecast_settings():
+    """Get forecasting configuration from the environment"""
+    return {
+        'method': os.environ.get('FORECAST_METHOD', 'ema'),
+        'history_days': int(os.environ.get('FORECAST_HISTORY_DAYS', '180')),
+        'window_days': int(os.environ.get('FORECAST_WINDOW_DAYS', '28')),
+        'smoothing': float(os.environ.get('FORECAST_SMOOTHING', '0.1')),
+        'lead_time_days': int(os.environ.get('FORECAST_LEAD_TIME_DAYS', '7')),
+        'review_days': int(os.environ.get('FORECAST_REVIEW_DAYS', '14')),
+        'service_level_z': float(os.environ.get('FORECAST_SERVICE_LEVEL_Z', '1.65')),
+    }
+
+
+def load_daily_demand(shop_id, start, end):
+    """Net units sold per product per day in [start, end) with one aggregate query.
+
+    Returns NumPy arrays (product_ids, day offsets from start, quantities).
+    Offsets are computed by the database so rows convert straight to integers.
+    """
+    from app import db
+    from models import Sale, SaleItem
+
+    offset = day_offset(Sale.created_at, start)
+    query = (
+        select(SaleItem.product_id, offset,
+               func.sum(SaleItem.quantity - func.coalesce(SaleItem.refunded_quantity, 0)))
+        .join(Sale, Sale.id == SaleItem.sale_id)
+        .where(Sale.shop_id == shop_id,
+               Sale.status.in_(COUNTED_STATUSES),
+               Sale.created_at >= start,
+               Sale.created_at < end,
+               SaleItem.created_at >= start)
+        .group_by(SaleItem.product_id, offset)
+    )
+    if is_postgres():
+        rows = fetch_driver_rows(query)
+    else:
+        rows = db.session.execute(query).all()
+
+    demand = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=3 * len(rows)).reshape(-1, 3)
+    return demand[:, 0], demand[:, 1], demand[:, 2].astype(np.float64)
+
+
+def forecast_inventory(shop_id, method=None, history_days=None, lead_time_days=None,
+                       review_days=None, today=None):
+    """Forecast daily demand and reorder needs for every active product of a shop.
+
+    Demand is a simple moving average over the last window_days ('sma') or an
+    exponentially weighted average over the whole history ('ema'). Days before
+    a product was created are not counted as zero-sales days. The reorder point
+    covers demand over the lead time plus safety stock for demand variability;
+    suggested orders top stock up to cover the lead time and review period.
+    """
+    from app import db
+    from models import Product
+
+    settings = get_forecast_settings()
+    method = method or settings['method']
+    if method not in FORECAST_METHODS:
+        raise ValueError(f"Unknown forecast method: {method}")
+    history_days = history_days or settings['history_days']
+    lead_time_days = settings['lead_time_days'] if lead_time_days is None else lead_time_days
+    review_days = settings['review_days'] if review_days is None else review_days
+    if history_days < 1 or lead_time_days < 0 or review_days < 0:
+        raise ValueError("History must be at least one day and lead/review times not negative")
+
+    today = today or datetime.utcnow().date()
+    # Only whole days: today's partial sales would understate demand
+    end = datetime(today.year, today.month, today.day)
+    start = end - timedelta(days=history_days)
+
+    products = db.session.execute(
+        select(Product.id, Product.name, Product.sku, Product.stock_quantity,
+               Product.cost_price, Product.created_at)
+        .where(Product.shop_id == shop_id, Product.is_active == True)
+        .order_by(Product.id)
+    ).all()
+
+    result = {
+        'method': method,
+        'history_days': history_days,
+        'lead_time_days': lead_time_days,
+        'review_days': review_days,
+        'start_date': start.date().isoformat(),
+        'end_date': (end - timedelta(days=1)).date().isoformat(),
+        'products': [],
+    }
+    if not products:
+        return result
+
+    count = len(products)
+    ids, names, skus, stock, cost, created = zip(*products)
+    ids = np.array(ids, dtype=np.int64)
+    stock = np.array(stock, dtype=np.float64)
+    created = np.array([(c or start).date() for c in created], dtype='datetime64[D]')
+    first_day = np.clip((created - np.datetime64(start.date(), 'D')).astype(np.int64), 0, history_days - 1)
+    observed_days = history_days - first_day
+
+    # Map each (product, day) row onto its product's position
+    sold_ids, offsets, quantities = load_daily_demand(shop_id, start, end)
+    positions = np.minimum(np.searchsorted(ids, sold_ids), count - 1)
+    known = ids[positions] == sold_ids
+    positions, offsets, quantities = positions[known], offsets[known], quantities[known]
+
+    total = np.bincount(positions, weights=quantities, minlength=count)
+    squares = np.bincount(positions, weights=quantities ** 2, minlength=count)
+    mean = total / observed_days
+    std = np.sqrt(np.maximum(squares / observed_days - mean ** 2, 0))
+
+    if method == 'sma':
+        window = min(settings['window_days'], history_days)
+        recent = offsets >= history_days - window
+        demand = (np.bincount(positions[recent], weights=quantities[recent], minlength=count)
+                  / np.minimum(window, observed_days))
+    else:
+        # Weight of each day offset, 1 for the most recent day; suffix sums
+        # renormalise for products created part-way through the history
+        decay = (1 - settings['smoothing']) ** np.arange(history_days - 1, -1, -1, dtype=np.float64)
+        weight_from = np.cumsum(decay[::-1])[::-1]
+        demand = (np.bincount(positions, weights=quantities * decay[offsets], minlength=count)
+                  / weight_from[first_day])
+
+    safety_stock = settings['service_level_z'] * std * np.sqrt(lead_time_days)
+    reorder_point = demand * lead_time_days + safety_stock
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cover = np.where(demand > 0, stock / demand, np.inf)
+    suggested = np.maximum(np.ceil(demand * (lead_time_days + review_days) + safety_stock - stock), 0)
+    suggested[demand <= 0] = 0
+    needs_reorder = (demand > 0) & (stock <= reorder_point)
+
+    order = np.lexsort((ids, cover))
+    result['products'] = [{
+        'product_id': int(ids[i]),
+        'name': names[i],
+        'sku': skus[i],
+        'stock_quantity': int(stock[i]),
+        'daily_demand': round(float(demand[i]), 2),
+        'demand_std': round(float(std[i]), 2),
+        'days_of_cover': round(float(cover[i]), 1) if np.isfinite(cover[i]) else None,
+        'reorder_point': int(np.ceil(reorder_point[i])),
+        'suggested_order': int(suggested[i]),
+        'suggested_order_cost': round(float(suggested[i]) * float(cost[i] or 0), 2),
+        'needs_reorder': bool(needs_reorder[i]),
+    } for i in order]
+    return result
+
+
+def apply_reorder_points(shop_id, forecast, minimum=1):
+    """Store forecast reorder points as low-stock thresholds in one batched update.
+
+    Products without demand keep their current threshold. Returns the number updated.
+    """
+    from app import db
+    from models import Product
+    from utils.inventory import refresh_inventory_counters
+
+    values = [{'id': p['product_id'], 'low_stock_threshold': max(p['reorder_point'], minimum)}
+              for p in forecast['products'] if p['daily_demand'] > 0]
+    if values:
+        # Bulk UPDATE by primary key (executemany)
+        db.session.execute(update(Product).where(Product.shop_id == shop_id), values,
+                           execution_options={'synchronize_session': None})
+        refresh_inventory_counters(shop_id)
+    return len(values)
@@ -0,0 +1,212 @@
+"""
+Idempotency Keys
+Tills send an Idempotency-Key header with sale and payment POSTs so a retry
+replays the first response instead of repeating the sale. The key is claimed
+when the view commits, in the same transaction as its writes: a view that
+rolls back leaves no key and a retry runs again; a duplicate that races the
+first request fails its claim and is rolled back. Keys expire after
+IDEMPOTENCY_TTL_SECONDS.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, jsonify, request, session
+from sqlalchemy import delete, event, select, update
+from utils.database import RoutingSession, upsert_insert
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 64
+
+_claims = {'count': 0}
+_claims_lock = threading.Lock()
+
+
+class KeyInUse(Exception):
+    """Raised at commit when another request holds the same key"""
+
+
+def get_idempotency_settings():
+    """Get idempotency key configuration from the environment"""
+    return {
+        'ttl_seconds': int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400')),
+        'purge_every': int(os.environ.get('IDEMPOTENCY_PURGE_EVERY', '500')),
+    }
+
+
+def request_fingerprint():
+    """Digest of the method, path and body, so a key can't be reused for another request"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{request.method} {request.path}\n'.encode('utf-8'))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def claim_key(session_, shop_id, key, fingerprint, ttl_seconds):
+    """Insert the key in the session's transaction; False if an unexpired one exists.
+
+    On PostgreSQL a concurrent claim of the same key waits for the other
+    transaction to finish, then finds the key taken (or free, after a rollback).
+    """
+    from models import IdempotencyKey
+
+    now = datetime.utcnow()
+    table = IdempotencyKey.__table__
+    values = dict(fingerprint=fingerprint, status_code=None, content_type=None, response_body=None,
+                  created_at=now, expires_at=now + timedelta(seconds=ttl_seconds))
+    statement = upsert_insert(table).values(shop_id=shop_id, key=key, **values)
+    # An expired key is taken over as if it were new
+    statement = statement.on_conflict_do_update(
+        index_elements=['shop_id', 'key'], set_=values, where=table.c.expires_at <= now
+    ).returning(table.c.key)
+    return session_.execute(statement).first() is not None
+
+
+def _claim_on_commit(session_):
+    """before_commit listener: claim the request's key with the view's first commit"""
+    pending = session_.info.pop('idempotency_key', None)
+    if pending is None:
+        return
+    if not claim_key(session_, *pending):
+        session_.info['idempotency_conflict'] = True
+        raise KeyInUse(pending[1])
+    session_.info['idempotency_claimed'] = True
+
+
+def store_response(shop_id, key, fingerprint, response):
+    """Save the response for a key the view's commit claimed"""
+    from app import db
+    from models import IdempotencyKey
+
+    table = IdempotencyKey.__table__
+    try:
+        db.session.execute(
+            update(table)
+            .where(table.c.shop_id == shop_id, table.c.key == key,
+                   table.c.fingerprint == fingerprint, table.c.status_code.is_(None))
+            .values(status_code=response.status_code, content_type=response.content_type,
+                    response_body=response.get_data(as_text=True))
+        )
+        db.session.commit()
+    except Exception as e:
+        # The key stays in flight until it expires; retries get 409 rather than a second sale
+        db.session.rollback()
+        logging.error(f"Failed to store idempotent response for key {key}: {e}")
+
+
+def in_progress_response():
+    response = jsonify({'error': 'Request in progress, retry shortly'})
+    response.status_code = 409
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def replay_response(shop_id, key, fingerprint):
+    """Stored response for a key, or None if it isn't taken (or has expired)"""
+    from app import db
+    from models import IdempotencyKey
+
+    row = db.session.execute(
+        select(IdempotencyKey.fingerprint, IdempotencyKey.status_code,
+               IdempotencyKey.content_type, IdempotencyKey.response_body)
+        .where(IdempotencyKey.shop_id == shop_id, IdempotencyKey.key == key,
+               IdempotencyKey.expires_at > datetime.utcnow())
+    ).first()
+
+    if row is None:
+        return None
+    if row.fingerprint != fingerprint:
+        return jsonify({'error': f'{HEADER} was already used for a different request'}), 422
+    if row.status_code is None:
+        # The first request committed and is still finishing
+        return in_progress_response()
+
+    response = current_app.response_class(row.response_body, status=row.status_code,
+                                          content_type=row.content_type)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def purge_expired_keys(now=None):
+    """Delete expired keys (one indexed delete); returns how many were removed"""
+    from app import db
+    from models import IdempotencyKey
+
+    result = db.session.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.expires_at <= (now or datetime.utcnow()))
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def _maybe_purge(settings):
+    """Purge expired keys once every `purge_every` claims made by this process"""
+    if settings['purge_every'] <= 0:
+        return
+    with _claims_lock:
+        _claims['count'] += 1
+        due = _claims['count'] % settings['purge_every'] == 0
+    if due:
+        try:
+            removed = purge_expired_keys()
+            if removed:
+                logging.info(f"Purged {removed} expired idempotency keys")
+        except Exception as e:
+            from app import db
+            db.session.rollback()
+            logging.error(f"Idempotency key purge failed: {e}")
+
+
+def idempotent(f):
+    """Replay the stored response when a POST repeats its Idempotency-Key.
+
+    Requests without the header run as before. Use after require_shop_access,
+    as keys are scoped to the session's shop.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get(HEADER, '').strip()
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+        settings = get_idempotency_settings()
+        _maybe_purge(settings)
+
+        shop_id = session['shop_id']
+        fingerprint = request_fingerprint()
+        replay = replay_response(shop_id, key, fingerprint)
+        if replay is not None:
+            return replay
+
+        from app import db
+        info = db.session.info
+        info['idempotency_key'] = (shop_id, key, fingerprint, settings['ttl_seconds'])
+        try:
+            response = current_app.make_response(f(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            info.pop('idempotency_key', None)
+            conflict = info.pop('idempotency_conflict', False)
+            claimed = info.pop('idempotency_claimed', False)
+
+        if conflict:
+            # Lost the race to a concurrent request with the same key
+            db.session.rollback()
+            return replay_response(shop_id, key, fingerprint) or in_progress_response()
+        if claimed:
+            store_response(shop_id, key, fingerprint, response)
+        return response
+    return decorated_function
+
+
+def init_idempotency():
+    """Claim Idempotency-Keys as part of the commit of the views that use them"""
+    if not event.contains(RoutingSession, 'before_commit', _claim_on_commit):
+        event.listen(RoutingSession, 'before_commit', _claim_on_commit)
@@ -0,0 +1,211 @@
+"""
+Inventory Counters
+Per-shop product counts and stock valuation, kept current by applying the
+change each product write makes in the same transaction, so inventory
+headers read one row however large the catalogue is
+"""
+
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import and_, case, event, func, inspect, select, update
+from utils.database import RoutingSession, upsert_insert
+from utils.page_cache import mark_shop_changed
+from utils.sales import to_money
+
+COUNTERS = ('total_products', 'active_products', 'low_stock', 'out_of_stock', 'cost_value', 'retail_value')
+WATCHED = ('shop_id', 'is_active', 'stock_quantity', 'low_stock_threshold', 'cost_price', 'price')
+
+
+def contribution(is_active, stock, threshold, cost, price):
+    """What one product adds to its shop's counters (same rules as count_inventory)"""
+    if is_active is not True:
+        return (1, 0, 0, 0, Decimal(0), Decimal(0))
+    if stock is None:
+        return (1, 1, 0, 0, Decimal(0), Decimal(0))
+    return (1, 1,
+            1 if threshold is not None and stock <= threshold else 0,
+            1 if stock <= 0 else 0,
+            Decimal(str(cost)) * stock if cost is not None else Decimal(0),
+            Decimal(str(price)) * stock if price is not None else Decimal(0))
+
+
+def add_delta(deltas, shop_id, values, sign=1):
+    total = deltas.get(shop_id, (0, 0, 0, 0, Decimal(0), Decimal(0)))
+    deltas[shop_id] = tuple(a + sign * b for a, b in zip(total, values))
+
+
+def count_inventory(shop_id):
+    """Count a shop's inventory from its products (one aggregate query)"""
+    from app import db
+    from models import Product
+
+    active = Product.is_active == True
+    row = db.session.execute(
+        select(func.count(Product.id),
+               func.sum(case((active, 1), else_=0)),
+               func.sum(case((and_(active, Product.stock_quantity <= Product.low_stock_threshold), 1), else_=0)),
+               func.sum(case((and_(active, Product.stock_quantity <= 0), 1), else_=0)),
+               func.sum(case((active, Product.cost_price * Product.stock_quantity), else_=0)),
+               func.sum(case((active, Product.price * Product.stock_quantity), else_=0)))
+        .where(Product.shop_id == shop_id)
+    ).one()
+    counts = {name: int(value or 0) for name, value in zip(COUNTERS[:4], row[:4])}
+    counts.update(cost_value=to_money(row[4]), retail_value=to_money(row[5]))
+    return counts
+
+
+def get_inventory_counters(shop_id):
+    """A shop's inventory counters: one row read, or a count if none is stored yet"""
+    from app import db
+    from models import ShopInventory
+
+    row = db.session.get(ShopInventory, shop_id)
+    if row is None:
+        return count_inventory(shop_id)
+    return {name: getattr(row, name) for name in COUNTERS}
+
+
+def refresh_inventory_counters(shop_id):
+    """Recount a shop's counters in the current transaction; returns (old or None, new)"""
+    from app import db
+    from models import ShopInventory
+
+    table = ShopInventory.__table__
+    # Lock the counter row first: writers that already applied a change have
+    # committed before the count runs, later ones add theirs after it
+    locked = select(*(table.c[name] for name in COUNTERS)).where(table.c.shop_id == shop_id).with_for_update()
+    old = db.session.execute(locked).first()
+    if old is None:
+        db.session.execute(upsert_insert(table).values(shop_id=shop_id).on_conflict_do_nothing())
+        db.session.execute(locked)
+    old = dict(zip(COUNTERS, old)) if old is not None else None
+    counts = count_inventory(shop_id)
+    mark_shop_changed(db.session, shop_id)
+    db.session.execute(update(table).where(table.c.shop_id == shop_id)
+                       .values(reconciled_at=datetime.utcnow(), **counts))
+    return old, counts
+
+
+def apply_inventory_deltas(session, deltas):
+    """Add per-shop counter changes in the current transaction (atomic increments)"""
+    from models import ShopInventory
+
+    table = ShopInventory.__table__
+    for shop_id, delta in deltas.items():
+        if shop_id is None or not any(delta):
+            continue
+        mark_shop_changed(session, shop_id)
+        result = session.execute(
+            update(table).where(table.c.shop_id == shop_id)
+            .values({name: table.c[name] + value for name, value in zip(COUNTERS, delta)})
+        )
+        if result.rowcount == 0:
+            # First change since the counters existed: count the shop as it is now
+            refresh_inventory_counters(shop_id)
+
+
+@contextmanager
+def track_inventory(*criteria):
+    """Apply the counter changes of bulk product statements run inside the block.
+
+    criteria select the products the statements touch; they are locked and
+    read before and after, so the block costs two reads of those rows only.
+    """
+    from app import db
+
+    before = {}
+    for row in _load_products(criteria, lock=True):
+        add_delta(before, row[0], contribution(*row[1:]))
+    yield
+    deltas = {shop_id: tuple(-value for value in delta) for shop_id, delta in before.items()}
+    for row in _load_products(criteria):
+        add_delta(deltas, row[0], contribution(*row[1:]))
+    apply_inventory_deltas(db.session, deltas)
+
+
+def _load_products(criteria, lock=False):
+    from app import db
+    from models import Product
+
+    query = select(*(getattr(Product, name) for name in WATCHED)).where(*criteria)
+    if lock:
+        query = query.with_for_update()
+    return db.session.execute(query).all()
+
+
+def _values(state, old=False):
+    values = []
+    for name in WATCHED:
+        if old:
+            history = state.attrs[name].history
+            value = (history.deleted or history.unchanged or [None])[0]
+        else:
+            value = state.attrs[name].value
+        values.append(value)
+    return values[0], contribution(*values[1:])
+
+
+def _collect_product_changes(session, flush_context):
+    from models import Product
+
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Product):
+            shop_id, values = _values(inspect(obj))
+            add_delta(deltas, shop_id, values)
+    for obj in session.deleted:
+        if isinstance(obj, Product):
+            shop_id, values = _values(inspect(obj), old=True)
+            add_delta(deltas, shop_id, values, -1)
+    for obj in session.dirty:
+        if isinstance(obj, Product):
+            state = inspect(obj)
+            if not any(state.attrs[name].history.has_changes() for name in WATCHED):
+                continue
+            old_shop, old_values = _values(state, old=True)
+            shop_id, values = _values(state)
+            add_delta(deltas, old_shop, old_values, -1)
+            add_delta(deltas, shop_id, values)
+
+    if deltas:
+        apply_inventory_deltas(session, deltas)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+def init_inventory_counters():
+    """Maintain the counters on every flush of Product objects"""
+    from models import Product
+
+    if event.contains(RoutingSession, 'after_flush', _collect_product_changes):
+        return
+    event.listen(RoutingSession, 'after_flush', _collect_product_changes)
+    # Load the previous value when an attribute of an expired product is set,
+    # so the change can be worked out at flush time
+    for name in WATCHED:
+        event.listen(getattr(Product, name), 'set', _keep_old_value, active_history=True)
+
+
+def reconcile_inventory_counters(shop_id=None):
+    """Recount every shop's counters (one transaction per shop); returns shops that drifted"""
+    from app import db
+    from models import Shop
+
+    shop_ids = [shop_id] if shop_id else db.session.execute(select(Shop.id).order_by(Shop.id)).scalars().all()
+    drifted = []
+    for current_id in shop_ids:
+        try:
+            old, new = refresh_inventory_counters(current_id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Inventory counter reconcile failed for shop {current_id}: {e}")
+            continue
+        if old is not None and old != new:
+            logging.warning(f"Inventory counters drifted for shop {current_id}: {old} -> {new}")
+            drifted.append((current_id, old, new))
+    return drifted
@@ -0,0 +1,251 @@
+"""
+Key-Value Stores
+In-process LRU store for single-node deployments, a Redis-backed store
+shared between workers, and a database table store that every worker shares
+without Redis. RedisStore accepts any client exposing the redis-py
+get/set/delete/incr API, so a local stand-in (e.g. fakeredis) can replace it.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import Integer, String, case, cast, delete, select
+from utils.database import upsert_insert
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class MemoryStore:
+    """Thread-safe LRU store with per-key expiry"""
+
+    # Visible to this process only: other workers never see its writes or deletes
+    shared = False
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _put(self, key, value, ttl):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._get_entry(key, time.monotonic())
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._put(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist; returns True if it was set"""
+        with self._lock:
+            if self._get_entry(key, time.monotonic()) is not None:
+                return False
+            self._put(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            entry = self._get_entry(key, time.monotonic())
+            value = int(entry[0]) + amount if entry else amount
+            if entry:
+                self._data[key] = (value, entry[1])
+            else:
+                self._put(key, value, ttl)
+            return value
+
+
+class RedisStore:
+    """Store backed by a shared Redis server (or anything with the same client API)"""
+
+    shared = True
+
+    def __init__(self, client, prefix=''):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), value, ex=int(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self._key(key), value, ex=int(ttl) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def incr(self, key, amount=1, ttl=None):
+        value = self.client.incr(self._key(key), amount)
+        if ttl and value == amount:
+            self.client.expire(self._key(key), int(ttl))
+        return value
+
+
+class DatabaseStore:
+    """Store kept in the kv_entries table, shared by every worker of every node.
+
+    Each call runs in its own short transaction on the primary, so values are
+    visible to other workers at once and never tied to the request's session.
+    Expired entries are ignored on read and purged every purge_every writes.
+    """
+
+    shared = True
+
+    def __init__(self, namespace, purge_every=1000):
+        self.namespace = namespace
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        from models import KeyValueEntry
+        return KeyValueEntry.__table__
+
+    @staticmethod
+    def _expires_at(ttl):
+        return datetime.utcnow() + timedelta(seconds=ttl) if ttl else None
+
+    def _live(self, now):
+        table = self.table
+        return (table.c.namespace == self.namespace) & (table.c.expires_at.is_(None) | (table.c.expires_at > now))
+
+    def _wrote(self):
+        with self._lock:
+            self._writes += 1
+            due = self.purge_every and self._writes % self.purge_every == 0
+        if due:
+            self.purge()
+
+    def get(self, key):
+        from app import db
+
+        with db.engine.connect() as conn:
+            return conn.execute(
+                select(self.table.c.value).where(self._live(datetime.utcnow()), self.table.c.key == key)
+            ).scalar()
+
+    def set(self, key, value, ttl=None):
+        from app import db
+
+        values = {'value': str(value), 'expires_at': self._expires_at(ttl)}
+        with db.engine.begin() as conn:
+            conn.execute(upsert_insert(self.table).values(namespace=self.namespace, key=key, **values)
+                         .on_conflict_do_update(index_elements=['namespace', 'key'], set_=values))
+        self._wrote()
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist (or has expired); returns True if it was set"""
+        from app import db
+
+        table = self.table
+        values = {'value': str(value), 'expires_at': self._expires_at(ttl)}
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            added = conn.execute(
+                upsert_insert(table).values(namespace=self.namespace, key=key, **values)
+                .on_conflict_do_update(index_elements=['namespace', 'key'], set_=values,
+                                       where=table.c.expires_at.is_not(None) & (table.c.expires_at <= now))
+                .returning(table.c.key)
+            ).first() is not None
+        self._wrote()
+        return added
+
+    def delete(self, key):
+        from app import db
+
+        with db.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.namespace == self.namespace,
+                                                  self.table.c.key == key))
+
+    def incr(self, key, amount=1, ttl=None):
+        from app import db
+
+        table = self.table
+        now = datetime.utcnow()
+        expired = table.c.expires_at.is_not(None) & (table.c.expires_at <= now)
+        with db.engine.begin() as conn:
+            value = conn.execute(
+                upsert_insert(table).values(namespace=self.namespace, key=key, value=str(amount),
+                                            expires_at=self._expires_at(ttl))
+                .on_conflict_do_update(index_elements=['namespace', 'key'], set_={
+                    'value': case((expired, str(amount)),
+                                  else_=cast(cast(table.c.value, Integer) + amount, String)),
+                    'expires_at': case((expired, self._expires_at(ttl)), else_=table.c.expires_at),
+                })
+                .returning(table.c.value)
+            ).scalar()
+        return int(value)
+
+    def purge(self):
+        """Delete this namespace's expired entries"""
+        from app import db
+
+        with db.engine.begin() as conn:
+            return conn.execute(delete(self.table).where(
+                self.table.c.namespace == self.namespace, self.table.c.expires_at <= datetime.utcnow()
+            )).rowcount
+
+
+def get_redis_client():
+    """Create a Redis client from REDIS_URL, or None if unavailable"""
+    url = os.environ.get('REDIS_URL')
+    if not url:
+        return None
+
+    try:
+        import redis
+    except ImportError:
+        logging.warning("REDIS_URL is set but the redis package is not installed; using in-process stores")
+        return None
+
+    return redis.Redis.from_url(url)
+
+
+def get_store(namespace, max_entries=10000):
+    """Get the shared store for a namespace (Redis when configured, else in-process LRU)"""
+    with _stores_lock:
+        if namespace not in _stores:
+            client = get_redis_client()
+            if client is not None:
+                _stores[namespace] = RedisStore(client, prefix=f"comolor:{namespace}:")
+            else:
+                _stores[namespace] = MemoryStore(max_entries=max_entries)
+        return _stores[namespace]
+
+
+def set_store(namespace, store):
+    """Replace the store for a namespace (e.g. with a local stand-in)"""
+    with _stores_lock:
+        _stores[namespace] = store
@@ -6,6 +6,7 @@ Handles license payments to super admin's configured payment method (till or pho
 from models import SystemSettings, Shop, LicensePayment, MpesaTransaction
 from app import db
 from datetime import datetime, timedelta
+from utils.licenses import invalidate_license
 
 def get_license_payment_config():
     """Get super admin's license payment configuration"""
@@ -99,6 +100,8 @@ def process_license_payment(mpesa_data):
         transaction.shop_id = None
     
     db.session.commit()
+    if shop:
+        invalidate_license(shop.id)
     return True
 
 def approve_license_payment(transaction, shop):
@@ -124,6 +127,7 @@ def approve_license_payment(transaction, shop):
     
     # Update shop
     shop.license_expires = license_end
+    shop.license_status = 'active'
     shop.is_active = True
     
     # Mark transaction as processed
@@ -231,5 +235,6 @@ def manual_license_approval(transaction_id, shop_id):
     
     payment = approve_license_payment(transaction, shop)
     db.session.commit()
+    invalidate_license(shop.id)
     
     return payment
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""
+License Expiry
+Scheduled sweep that flips lapsed shop licenses to expired, and the cached
+per-shop flag that request-time license checks read instead of the database
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import or_, select, update
+from utils.kvstore import get_store
+
+_sweeper = {'pid': None}
+_sweeper_lock = threading.Lock()
+
+
+def get_license_settings():
+    """Get license sweep configuration from the environment"""
+    return {
+        'sweep_interval': int(os.environ.get('LICENSE_SWEEP_INTERVAL', '60')),
+        'cache_seconds': int(os.environ.get('LICENSE_CACHE_SECONDS', '300')),
+        'warning_days': int(os.environ.get('LICENSE_EXPIRY_WARNING_DAYS', '30')),
+    }
+
+
+def license_store():
+    return get_store('licenses')
+
+
+def cache_license_flag(shop_id, active, license_expires=None, now=None):
+    """Cache a shop's license flag; an active flag never outlives the license itself"""
+    if not license_store().shared:
+        return
+    now = now or datetime.utcnow()
+    ttl = get_license_settings()['cache_seconds']
+    if active and license_expires:
+        ttl = max(1, min(ttl, int((license_expires - now).total_seconds())))
+    license_store().set(f'shop:{shop_id}', '1' if active else '0', ttl=ttl)
+
+
+def invalidate_license(shop_id):
+    """Drop a shop's cached flag after its license or activation changes"""
+    license_store().delete(f'shop:{shop_id}')
+    license_store().delete('expiring')
+
+
+def get_cached_license(shop_id):
+    """The cached license flag for a shop, or None if it is not cached.
+
+    Always None without a shared store: invalidate_license only reaches the
+    calling worker's memory, so a shop suspended there would keep trading in
+    every other worker until its flag expired. Callers then read the shop.
+    """
+    store = license_store()
+    if not store.shared:
+        return None
+    cached = store.get(f'shop:{shop_id}')
+    return None if cached is None else cached == '1'
+
+
+def license_state(shop, now=None):
+    """True if a shop (model or row) is active with an unexpired license"""
+    now = now or datetime.utcnow()
+    return bool(shop and shop.is_active and shop.license_status != 'expired'
+                and shop.license_expires and shop.license_expires > now)
+
+
+def is_license_current(shop_id, refresh=False):
+    """True if the shop is active with an unexpired license, from the cached flag"""
+    from app import db
+    from models import Shop
+
+    if not shop_id:
+        return False
+    if not refresh:
+        cached = get_cached_license(shop_id)
+        if cached is not None:
+            return cached
+
+    now = datetime.utcnow()
+    row = db.session.execute(
+        select(Shop.is_active, Shop.license_status, Shop.license_expires).where(Shop.id == shop_id)
+    ).first()
+    active = license_state(row, now)
+    cache_license_flag(shop_id, active, row.license_expires if row else None, now)
+    return active
+
+
+def sweep_licenses(now=None):
+    """Flip lapsed licenses to expired and refresh the expiring-soon set.
+
+    The expiry is a single UPDATE ... RETURNING on the (license_status,
+    license_expires) index. Returns the ids of shops that expired in this sweep.
+    """
+    from app import db
+    from models import Shop
+
+    now = now or datetime.utcnow()
+    # Shops created before license_status existed
+    db.session.execute(update(Shop).where(Shop.license_status.is_(None))
+                       .values(license_status='active'),
+                       execution_options={'synchronize_session': False})
+
+    expired = db.session.execute(
+        update(Shop).where(Shop.license_status == 'active', Shop.license_expires <= now)
+        .values(license_status='expired').returning(Shop.id),
+        execution_options={'synchronize_session': False}
+    ).scalars().all()
+    db.session.commit()
+
+    store = license_store()
+    for shop_id in expired:
+        store.set(f'shop:{shop_id}', '0', ttl=get_license_settings()['cache_seconds'])
+        logging.info(f"License expired for shop {shop_id}")
+
+    refresh_expiring_licenses(now)
+    return expired
+
+
+def refresh_expiring_licenses(now=None):
+    """Precompute the shops whose licenses expire within the warning window"""
+    from app import db
+    from models import Shop
+
+    now = now or datetime.utcnow()
+    settings = get_license_settings()
+    rows = db.session.execute(
+        select(Shop.id, Shop.name, Shop.license_expires)
+        .where(or_(Shop.license_status == 'active', Shop.license_status.is_(None)),
+               Shop.license_expires > now,
+               Shop.license_expires <= now + timedelta(days=settings['warning_days']))
+        .order_by(Shop.license_expires)
+    ).all()
+    expiring = [{'id': row.id, 'name': row.name, 'license_expires': row.license_expires.isoformat()}
+                for row in rows]
+    ttl = max(settings['sweep_interval'] * 2, 60)
+    license_store().set('expiring', json.dumps(expiring), ttl=ttl)
+    return expiring
+
+
+def get_expiring_licenses():
+    """Shops with licenses expiring within the warning window, soonest first"""
+    cached = license_store().get('expiring')
+    expiring = json.loads(cached) if cached is not None else refresh_expiring_licenses()
+
+    now = datetime.utcnow()
+    result = []
+    for shop in expiring:
+        expires = datetime.fromisoformat(shop['license_expires'])
+        if expires > now:
+            result.append(dict(shop, license_expires=expires, days_left=(expires - now).days))
+    return result
+
+
+def run_sweeper(app, interval):
+    from app import db
+
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                sweep_licenses()
+            except Exception as e:
+                logging.error(f"License sweep failed: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+def ensure_license_sweeper(app):
+    """Start this process's background sweeper (once per process, so it survives forking)"""
+    interval = get_license_settings()['sweep_interval']
+    if interval <= 0 or _sweeper['pid'] == os.getpid():
+        return
+    with _sweeper_lock:
+        if _sweeper['pid'] == os.getpid():
+            return
+        _sweeper['pid'] = os.getpid()
+        threading.Thread(target=run_sweeper, args=(app, interval), daemon=True,
+                         name='license-sweeper').start()
@@ -5,6 +5,9 @@ import os
 import logging
 import hashlib
 import hmac
+import threading
+import time
+from requests.adapters import HTTPAdapter
 
 class MpesaAPI:
     def __init__(self):
@@ -21,9 +24,30 @@ class MpesaAPI:
             self.base_url = 'https://api.safaricom.co.ke'
         else:
             self.base_url = 'https://sandbox.safaricom.co.ke'
+        
+        # One keep-alive connection pool shared by all requests (and greenlets)
+        # of this worker, with timeouts so a slow Daraja call cannot hang a request
+        self.timeout = (float(os.getenv('MPESA_CONNECT_TIMEOUT', '5')),
+                        float(os.getenv('MPESA_READ_TIMEOUT', '30')))
+        pool_size = int(os.getenv('MPESA_POOL_SIZE', '10'))
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
     
     def get_access_token(self):
-        """Get access token for MPesa API"""
+        """Get access token for MPesa API, reused until shortly before it expires"""
+        if self._token and time.monotonic() < self._token_expires:
+            return self._token
+        
+        with self._token_lock:
+            if self._token and time.monotonic() < self._token_expires:
+                return self._token
+            return self._fetch_access_token()
+    
+    def _fetch_access_token(self):
         try:
             auth_url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
             
@@ -37,10 +61,13 @@ class MpesaAPI:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(auth_url, headers=headers)
+            response = self.http.get(auth_url, headers=headers, timeout=self.timeout)
             response.raise_for_status()
             
-            return response.json().get('access_token')
+            result = response.json()
+            self._token = result.get('access_token')
+            self._token_expires = time.monotonic() + int(result.get('expires_in', 3599)) - 60
+            return self._token
             
         except Exception as e:
             logging.error(f"Failed to get MPesa access token: {e}")
@@ -67,7 +94,7 @@ class MpesaAPI:
                 "ValidationURL": validation_url
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = self.http.post(url, json=payload, headers=headers, timeout=self.timeout)
             response.raise_for_status()
             
             result = response.json()
@@ -101,7 +128,7 @@ class MpesaAPI:
                 "BillRefNumber": bill_ref_number
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = self.http.post(url, json=payload, headers=headers, timeout=self.timeout)
             response.raise_for_status()
             
             result = response.json()
@@ -150,7 +177,7 @@ class MpesaAPI:
                 "TransactionDesc": transaction_desc
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = self.http.post(url, json=payload, headers=headers, timeout=self.timeout)
             response.raise_for_status()
             
             result = response.json()
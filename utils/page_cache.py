@@ -0,0 +1,167 @@
+"""
+Page and Fragment Cache
+Rendered public pages and dashboard fragments kept in the 'pages' store,
+keyed by shop, role and the shop's data version, which moves on every
+commit that changes its sales, products or staff. Versions live in the
+database when the pages store is per process, so a commit on one worker
+invalidates fragments on all of them. Responses carry an ETag
+(and Last-Modified for public pages) so unchanged pages revalidate with a 304.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from datetime import date, datetime, timezone
+from functools import wraps
+from flask import make_response, request, session
+from markupsafe import Markup
+from sqlalchemy import event
+from utils.database import RoutingSession
+from utils.kvstore import DatabaseStore, get_store
+
+# Data versions when the pages store is not shared between workers
+_database_versions = DatabaseStore('page_versions')
+
+
+def get_page_cache_settings():
+    """Get page cache configuration from the environment"""
+    return {
+        'enabled': os.environ.get('PAGE_CACHE_ENABLED', 'true').lower() == 'true',
+        'page_seconds': int(os.environ.get('PAGE_CACHE_SECONDS', '3600')),
+        'fragment_seconds': int(os.environ.get('FRAGMENT_CACHE_SECONDS', '300')),
+        'browser_seconds': int(os.environ.get('PAGE_CACHE_BROWSER_SECONDS', '300')),
+        'bytecode_dir': os.environ.get('JINJA_BYTECODE_CACHE_DIR',
+                                       os.path.join(tempfile.gettempdir(), 'comolor-jinja')),
+    }
+
+
+def page_store():
+    return get_store('pages')
+
+
+def version_store():
+    """The page store if every worker shares it, else the database.
+
+    A version bumped in one worker's memory would leave the others serving
+    fragments rendered before the change.
+    """
+    store = page_store()
+    return store if store.shared else _database_versions
+
+
+def data_version(shop_id):
+    """When a shop's cached data last changed (0 if not since the store was emptied)"""
+    return version_store().get(f'version:{shop_id}') or '0'
+
+
+def bump_data_version(shop_id):
+    version_store().set(f'version:{shop_id}', repr(time.time()))
+
+
+def mark_shop_changed(session_, shop_id):
+    """Bump a shop's data version once the current transaction commits"""
+    if shop_id is not None:
+        session_.info.setdefault('changed_shops', set()).add(shop_id)
+
+
+def _mark_flushed_shops(session_, flush_context):
+    from models import Category, Product, Refund, Sale, Shop, User
+
+    # Models whose changes show up on cached dashboards
+    versioned = (Sale, Refund, Product, Category, User, Shop)
+    for obj in (*session_.new, *session_.dirty, *session_.deleted):
+        if isinstance(obj, versioned):
+            mark_shop_changed(session_, obj.id if isinstance(obj, Shop) else obj.shop_id)
+
+
+def _bump_committed_shops(session_):
+    for shop_id in session_.info.pop('changed_shops', ()):
+        try:
+            bump_data_version(shop_id)
+        except Exception as e:
+            logging.error(f"Failed to bump data version for shop {shop_id}: {e}")
+
+
+def _discard_changed_shops(session_):
+    session_.info.pop('changed_shops', None)
+
+
+def etag_for(body):
+    return hashlib.sha1(body.encode('utf-8') if isinstance(body, str) else body).hexdigest()
+
+
+def conditional_response(body, etag=None, last_modified=None, cache_control=None):
+    """Response that answers If-None-Match / If-Modified-Since with a 304"""
+    response = make_response(body)
+    response.set_etag(etag or etag_for(response.get_data()))
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if cache_control:
+        response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+
+def cached_page(timeout=None):
+    """Cache a public GET view's rendered body (the same for every visitor)"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            settings = get_page_cache_settings()
+            if not settings['enabled'] or request.method != 'GET':
+                return f(*args, **kwargs)
+
+            key = f'page:{request.full_path}'
+            store = page_store()
+            cached = store.get(key)
+            if cached is None:
+                body = f(*args, **kwargs)
+                if not isinstance(body, str):
+                    return body
+                cached = f'{etag_for(body)}:{int(time.time())}:{body}'
+                store.set(key, cached, ttl=timeout or settings['page_seconds'])
+
+            etag, modified, body = cached.split(':', 2)
+            return conditional_response(
+                body, etag, datetime.fromtimestamp(int(modified), timezone.utc),
+                f"public, max-age={settings['browser_seconds']}")
+        return decorated_function
+    return decorator
+
+
+def cached_fragment(name, render, shop_id=None, timeout=None):
+    """Rendered HTML for a widget, rebuilt only when the shop's data version moves.
+
+    Keyed by role, shop, day and data version; render() is called on a miss.
+    """
+    settings = get_page_cache_settings()
+    if not settings['enabled']:
+        return Markup(render())
+
+    shop_id = shop_id or session.get('shop_id')
+    key = f"fragment:{name}:{session.get('role')}:{shop_id}:{date.today().isoformat()}:{data_version(shop_id)}"
+    store = page_store()
+    html = store.get(key)
+    if html is None:
+        html = render()
+        store.set(key, html, ttl=timeout or settings['fragment_seconds'])
+    return Markup(html)
+
+
+def init_page_cache(app):
+    """Install the Jinja bytecode cache and the data-version listeners"""
+    from jinja2 import FileSystemBytecodeCache
+
+    directory = get_page_cache_settings()['bytecode_dir']
+    if directory:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        except OSError as e:
+            logging.warning(f"Jinja bytecode cache disabled: {e}")
+
+    if not event.contains(RoutingSession, 'after_flush', _mark_flushed_shops):
+        event.listen(RoutingSession, 'after_flush', _mark_flushed_shops)
+        event.listen(RoutingSession, 'after_commit', _bump_committed_shops)
+        event.listen(RoutingSession, 'after_rollback', _discard_changed_shops)
@@ -0,0 +1,404 @@
+"""
+Time Partitioning Utilities
+Monthly PostgreSQL range partitions for the append-only tables, archived to gzip'd CSV
+"""
+
+import gzip
+import logging
+import os
+import re
+from datetime import datetime
+from sqlalchemy import text
+from utils.database import is_postgres, copy_to_file
+
+# Partitioned table -> indexes created on the partitioned parent
+PARTITIONED_TABLES = {
+    'sales': [
+        ('shop_id', 'created_at'),
+        ('cashier_id', 'created_at'),
+        ('receipt_number',),
+        ('client_uuid',),
+        ('shift_id',),
+        ('customer_id', 'created_at'),
+    ],
+    'sale_items': [
+        ('sale_id',),
+        ('product_id', 'created_at'),
+    ],
+    'stock_movements': [
+        ('product_id', 'created_at'),
+    ],
+    'audit_logs': [
+        ('shop_id', 'created_at'),
+        ('created_at',),
+    ],
+}
+
+# Unique columns PostgreSQL cannot enforce on a partitioned table (the key would
+# have to include created_at); a trigger keeps them in partition_unique_keys
+PARTITIONED_UNIQUE_COLUMNS = {
+    'sales': ['receipt_number', 'client_uuid'],
+}
+
+PARTITION_KEY = 'created_at'
+PARTITION_NAME_RE = re.compile(r'^(?P<table>[a-z_]+)_p(?P<year>\d{4})(?P<month>\d{2})$')
+
+
+def get_partition_settings():
+    """Get partitioning configuration from the environment"""
+    return {
+        'months_ahead': int(os.environ.get('PARTITION_MONTHS_AHEAD', '3')),
+        'retention_months': int(os.environ.get('PARTITION_RETENTION_MONTHS', '24')),
+        'archive_dir': os.environ.get('PARTITION_ARCHIVE_DIR', 'archive'),
+    }
+
+
+def month_start(value):
+    """Return the first instant of the month containing value"""
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    """Return the first day of the month that is `months` after value's month"""
+    month_index = value.year * 12 + (value.month - 1) + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def month_range(start, end):
+    """Yield the first day of every month from start to end (inclusive)"""
+    current = month_start(start)
+    while current <= end:
+        yield current
+        current = add_months(current, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month.strftime('%Y%m')}"
+
+
+def is_partitioned(conn, table):
+    """Check if a table is already a partitioned parent"""
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"
+    ), {'table': table}).scalar() is not None
+
+
+def list_partitions(conn, table):
+    """List (name, month) for the monthly partitions of a table"""
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table)"
+    ), {'table': table}).scalars().all()
+
+    partitions = []
+    for name in rows:
+        match = PARTITION_NAME_RE.match(name)
+        if match and match.group('table') == table:
+            month = datetime(int(match.group('year')), int(match.group('month')), 1)
+            partitions.append((name, month))
+
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def create_partition(conn, table, month):
+    """Create the monthly partition of table for month if it does not exist"""
+    name = partition_name(table, month)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"
+    ))
+    return name
+
+
+def ensure_unique_keys(conn, table):
+    """Enforce PARTITIONED_UNIQUE_COLUMNS of a partitioned table through partition_unique_keys.
+
+    Every insert, update and delete keeps one key row per unique value, so a
+    duplicate raises the same unique violation (IntegrityError) as the
+    constraint on the unpartitioned table. Keys of existing rows are added
+    when the trigger is first installed.
+    """
+    columns = PARTITIONED_UNIQUE_COLUMNS.get(table)
+    if not columns:
+        return False
+
+    # Workers starting together would otherwise race to install the trigger
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('partition_unique_keys'))"))
+    trigger = f"{table}_unique_keys"
+    if conn.execute(text(
+        "SELECT 1 FROM pg_trigger WHERE tgname = :trigger AND tgrelid = to_regclass(:table)"
+    ), {'trigger': trigger, 'table': table}).scalar() is not None:
+        return False
+
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS partition_unique_keys ("
+        "table_name VARCHAR(63) NOT NULL, column_name VARCHAR(63) NOT NULL, value VARCHAR(100) NOT NULL, "
+        "PRIMARY KEY (table_name, column_name, value))"
+    ))
+    conn.exec_driver_sql("""
+        CREATE OR REPLACE FUNCTION maintain_partition_unique_keys() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            col TEXT;
+            old_value TEXT;
+            new_value TEXT;
+        BEGIN
+            FOREACH col IN ARRAY TG_ARGV[1:TG_NARGS - 1] LOOP
+                old_value := CASE WHEN TG_OP <> 'INSERT' THEN to_jsonb(OLD) ->> col END;
+                new_value := CASE WHEN TG_OP <> 'DELETE' THEN to_jsonb(NEW) ->> col END;
+                CONTINUE WHEN old_value IS NOT DISTINCT FROM new_value;
+                IF old_value IS NOT NULL THEN
+                    DELETE FROM partition_unique_keys
+                    WHERE table_name = TG_ARGV[0] AND column_name = col AND value = old_value;
+                END IF;
+                IF new_value IS NOT NULL THEN
+                    INSERT INTO partition_unique_keys (table_name, column_name, value)
+                    VALUES (TG_ARGV[0], col, new_value);
+                END IF;
+            END LOOP;
+            RETURN NULL;
+        END $$
+    """)
+
+    # Keys of the rows already in the table; a value that is already duplicated cannot be enforced
+    for column in columns:
+        duplicates = conn.execute(text(
+            f"SELECT count(*) FROM (SELECT {column} FROM {table} WHERE {column} IS NOT NULL "
+            f"GROUP BY {column} HAVING count(*) > 1) d"
+        )).scalar()
+        if duplicates:
+            logging.warning(f"{table}.{column} has {duplicates} duplicated values; "
+                            f"only the first row of each is kept in partition_unique_keys")
+        conn.execute(text(
+            f"INSERT INTO partition_unique_keys (table_name, column_name, value) "
+            f"SELECT DISTINCT '{table}', '{column}', {column}::text FROM {table} WHERE {column} IS NOT NULL "
+            f"ON CONFLICT DO NOTHING"
+        ))
+
+    conn.execute(text(
+        f"CREATE TRIGGER {trigger} AFTER INSERT OR DELETE OR UPDATE OF {', '.join(columns)} ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION maintain_partition_unique_keys('{table}', "
+        f"{', '.join(repr(column) for column in columns)})"
+    ))
+    logging.info(f"Enforcing unique {', '.join(columns)} on partitioned {table}")
+    return True
+
+
+def move_default_rows(conn, table, month):
+    """Move a month's rows out of the default partition so its partition can be created.
+
+    PostgreSQL refuses to create a partition while the default partition holds
+    rows in its range. The rows are deleted and reinserted through the parent,
+    so the unique key trigger sees them leave and come back.
+    """
+    default = f"{table}_default"
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    if conn.execute(text(
+        f"SELECT 1 FROM {default} WHERE {PARTITION_KEY} >= :start AND {PARTITION_KEY} < :end LIMIT 1"
+    ), bounds).scalar() is None:
+        return 0
+
+    staging = f"{default}_moving"
+    conn.execute(text(
+        f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT * FROM {default} "
+        f"WHERE {PARTITION_KEY} >= :start AND {PARTITION_KEY} < :end"
+    ), bounds)
+    conn.execute(text(f"DELETE FROM {default} WHERE {PARTITION_KEY} >= :start AND {PARTITION_KEY} < :end"), bounds)
+    create_partition(conn, table, month)
+    moved = conn.execute(text(f"INSERT INTO {table} SELECT * FROM {staging}")).rowcount
+    conn.execute(text(f"DROP TABLE {staging}"))
+    logging.info(f"Moved {moved} rows of {table} from the default partition to {partition_name(table, month)}")
+    return moved
+
+
+def convert_to_partitioned(table):
+    """Rebuild an existing table as a monthly range-partitioned table.
+
+    This is a one-off migration that copies every row, so run it in a
+    maintenance window. Foreign keys pointing at a partitioned table are
+    dropped (the ORM relationships keep working). Unique constraints become
+    plain indexes because PostgreSQL requires every unique key to include
+    the partition column; the columns in PARTITIONED_UNIQUE_COLUMNS stay
+    unique through partition_unique_keys.
+    """
+    from app import db
+
+    if not is_postgres():
+        logging.warning("Partitioning is only supported on PostgreSQL")
+        return False
+
+    settings = get_partition_settings()
+    legacy = f"{table}_legacy"
+
+    with db.engine.begin() as conn:
+        if is_partitioned(conn, table):
+            logging.info(f"{table} is already partitioned")
+            return False
+
+        # sale_items has no date of its own; copy it from the parent sale
+        if table == 'sale_items':
+            conn.execute(text("ALTER TABLE sale_items ADD COLUMN IF NOT EXISTS created_at TIMESTAMP"))
+            conn.execute(text(
+                "UPDATE sale_items si SET created_at = s.created_at "
+                "FROM sales s WHERE si.sale_id = s.id AND si.created_at IS NULL"
+            ))
+
+        conn.execute(text(f"UPDATE {table} SET created_at = now() WHERE created_at IS NULL"))
+
+        # Drop foreign keys that reference this table
+        incoming = conn.execute(text(
+            "SELECT conname, conrelid::regclass::text FROM pg_constraint "
+            "WHERE confrelid = to_regclass(:table) AND contype = 'f'"
+        ), {'table': table}).all()
+        for constraint, source in incoming:
+            conn.execute(text(f'ALTER TABLE {source} DROP CONSTRAINT "{constraint}"'))
+            logging.info(f"Dropped foreign key {source}.{constraint} -> {table}")
+
+        # Remember outgoing foreign keys so they can be recreated on the parent
+        outgoing = conn.execute(text(
+            "SELECT conname, pg_get_constraintdef(oid), confrelid::regclass::text FROM pg_constraint "
+            "WHERE conrelid = to_regclass(:table) AND contype = 'f'"
+        ), {'table': table}).all()
+
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table}).scalar()
+        bounds = conn.execute(text(f"SELECT min(created_at), max(created_at) FROM {table}")).one()
+
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        conn.execute(text(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({PARTITION_KEY})"
+        ))
+        conn.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {table}_part_pkey PRIMARY KEY (id, {PARTITION_KEY})"))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+
+        for constraint, definition, target in outgoing:
+            if target in PARTITIONED_TABLES:
+                continue
+            conn.execute(text(f'ALTER TABLE {table} ADD CONSTRAINT "{constraint}" {definition}'))
+
+        for columns in PARTITIONED_TABLES[table]:
+            index_name = f"{table}_part_{'_'.join(columns)}_idx"
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({', '.join(columns)})"))
+
+        # Monthly partitions covering existing data and the months ahead
+        now = datetime.utcnow()
+        first = bounds[0] or now
+        last = add_months(now, settings['months_ahead'])
+        if bounds[1] and bounds[1] > last:
+            last = bounds[1]
+        for month in month_range(first, last):
+            create_partition(conn, table, month)
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+        # Installed before the copy so the trigger records the keys of every copied row
+        ensure_unique_keys(conn, table)
+        conn.execute(text(f"INSERT INTO {table} SELECT * FROM {legacy}"))
+        conn.execute(text(f"DROP TABLE {legacy}"))
+
+    logging.info(f"Converted {table} to monthly partitions")
+    return True
+
+
+def ensure_future_partitions(months_ahead=None):
+    """Create partitions for the current month and the next months_ahead months.
+
+    Months with rows in the default partition (backdated offline sales, or
+    inserts past the last partition) get their partition too, and the rows
+    are moved into it.
+    """
+    from app import db
+
+    if not is_postgres():
+        return []
+
+    if months_ahead is None:
+        months_ahead = get_partition_settings()['months_ahead']
+
+    created = []
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(conn, table):
+                continue
+
+            ensure_unique_keys(conn, table)
+
+            existing = {name for name, _ in list_partitions(conn, table)}
+            months = set(month_range(now, add_months(now, months_ahead)))
+            if conn.execute(text("SELECT to_regclass(:default)"), {'default': f"{table}_default"}).scalar():
+                months.update(conn.execute(text(
+                    f"SELECT DISTINCT date_trunc('month', {PARTITION_KEY}) FROM {table}_default "
+                    f"WHERE {PARTITION_KEY} IS NOT NULL"
+                )).scalars())
+                for month in sorted(months):
+                    if partition_name(table, month) not in existing and move_default_rows(conn, table, month):
+                        existing.add(partition_name(table, month))
+                        created.append(partition_name(table, month))
+
+            for month in sorted(months):
+                name = partition_name(table, month)
+                if name not in existing:
+                    create_partition(conn, table, month)
+                    created.append(name)
+
+    if created:
+        logging.info(f"Created partitions: {', '.join(created)}")
+    return created
+
+
+def archive_old_partitions(retention_months=None, archive_dir=None):
+    """Archive partitions older than the retention window to gzip'd CSV and drop them"""
+    from app import db
+
+    if not is_postgres():
+        return []
+
+    settings = get_partition_settings()
+    if retention_months is None:
+        retention_months = settings['retention_months']
+    if archive_dir is None:
+        archive_dir = settings['archive_dir']
+
+    cutoff = add_months(datetime.utcnow(), -retention_months)
+    archived = []
+
+    with db.engine.connect() as conn:
+        tables = [t for t in PARTITIONED_TABLES if is_partitioned(conn, t)]
+        old_partitions = [
+            (table, name)
+            for table in tables
+            for name, month in list_partitions(conn, table)
+            if add_months(month, 1) <= cutoff
+        ]
+
+    for table, name in old_partitions:
+        table_dir = os.path.join(archive_dir, table)
+        os.makedirs(table_dir, exist_ok=True)
+        path = os.path.join(table_dir, f"{name}.csv.gz")
+
+        # Write the archive before the partition is detached and dropped
+        raw_conn = db.engine.raw_connection()
+        try:
+            with gzip.open(path, 'wb') as archive:
+                copy_to_file(raw_conn, f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER true)", archive)
+            raw_conn.commit()
+        finally:
+            raw_conn.close()
+
+        with db.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+
+        logging.info(f"Archived partition {name} to {path}")
+        archived.append(path)
+
+    return archived
+
+
+def maintain_partitions():
+    """Create upcoming partitions and archive expired ones"""
+    created = ensure_future_partitions()
+    archived = archive_old_partitions()
+    return created, archived
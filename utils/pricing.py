@@ -0,0 +1,286 @@
+"""
+Pricing Engine
+Server-side basket pricing in integer cents with per-shop promotion rules
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from decimal import ROUND_HALF_UP, Decimal
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+PROMOTION_TYPES = {
+    'multi_buy': 'Multi-buy (e.g. 3 for 250)',
+    'category_percent': 'Category % off',
+    'bundle': 'Bundle price',
+    'time_of_day': 'Happy hour % off',
+}
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def get_pricing_settings():
+    """Get pricing configuration from the environment"""
+    return {
+        'time_zone': os.environ.get('SHOP_TIME_ZONE', 'Africa/Nairobi'),
+    }
+
+
+def to_cents(value):
+    """Convert a money amount (Decimal, str, int or float) to integer cents"""
+    return int((Decimal(str(value or 0)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    """Convert integer cents to a two-place Decimal for Numeric columns"""
+    return Decimal(cents).scaleb(-2)
+
+
+def percent_of(cents, basis_points):
+    """A percentage (in basis points) of an amount, rounded half up to the cent"""
+    return (cents * basis_points + 5000) // 10000
+
+
+def parse_minutes(value):
+    """Parse 'HH:MM' into minutes after midnight"""
+    hours, minutes = str(value).split(':')
+    result = int(hours) * 60 + int(minutes)
+    if not 0 <= result <= 24 * 60:
+        raise ValueError(f'Invalid time: {value}')
+    return result
+
+
+class CompiledRule:
+    """A promotion reduced to the integers needed to price a line"""
+
+    __slots__ = ('id', 'name', 'kind', 'starts_at', 'ends_at', 'quantity', 'price_cents',
+                 'pay_quantity', 'basis_points', 'product_ids', 'window', 'days')
+
+    def __init__(self, promotion):
+        rules = promotion.rules or {}
+        self.id = promotion.id
+        self.name = promotion.name
+        self.kind = promotion.promo_type
+        self.starts_at = promotion.starts_at
+        self.ends_at = promotion.ends_at
+        self.quantity = int(rules.get('quantity') or 0)
+        self.price_cents = int(rules['price_cents']) if rules.get('price_cents') is not None else None
+        self.pay_quantity = int(rules.get('pay_quantity') or 0)
+        self.basis_points = to_cents(rules.get('percent') or 0)
+        self.product_ids = tuple(dict.fromkeys(int(pid) for pid in rules.get('product_ids') or ()))
+        self.window = None
+        self.days = None
+        if self.kind == 'time_of_day':
+            self.window = (parse_minutes(rules.get('start', '00:00')), parse_minutes(rules.get('end', '24:00')))
+            self.days = frozenset(int(day) for day in rules['days']) if rules.get('days') else None
+
+    def is_live(self, now, local_now):
+        if self.starts_at and now < self.starts_at:
+            return False
+        if self.ends_at and now >= self.ends_at:
+            return False
+        if self.window:
+            if self.days is not None and local_now.weekday() not in self.days:
+                return False
+            start, end = self.window
+            minute = local_now.hour * 60 + local_now.minute
+            # Windows such as 22:00-02:00 wrap past midnight
+            return start <= minute < end if start <= end else (minute >= start or minute < end)
+        return True
+
+    def line_discount(self, unit_cents, quantity):
+        """Discount in cents for `quantity` units of one product"""
+        if self.kind == 'multi_buy':
+            if self.quantity < 1:
+                return 0
+            if self.price_cents is not None:
+                saving = self.quantity * unit_cents - self.price_cents
+            else:
+                saving = (self.quantity - self.pay_quantity) * unit_cents
+            return (quantity // self.quantity) * max(saving, 0)
+        return percent_of(unit_cents * quantity, self.basis_points)
+
+
+class PromotionIndex:
+    """A shop's promotions keyed by product and category for one-pass basket pricing"""
+
+    def __init__(self, promotions):
+        self.by_product = {}
+        self.by_category = {}
+        self.shop_wide = []
+        self.bundles_by_product = {}
+
+        for promotion in promotions:
+            try:
+                rule = CompiledRule(promotion)
+            except (KeyError, TypeError, ValueError) as e:
+                logging.warning(f"Skipping invalid promotion {promotion.id}: {e}")
+                continue
+
+            if rule.kind == 'bundle':
+                if len(rule.product_ids) > 1 and rule.price_cents is not None:
+                    for product_id in rule.product_ids:
+                        self.bundles_by_product.setdefault(product_id, []).append(rule)
+            elif promotion.product_id:
+                self.by_product.setdefault(promotion.product_id, []).append(rule)
+            elif promotion.category_id:
+                self.by_category.setdefault(promotion.category_id, []).append(rule)
+            elif rule.kind == 'time_of_day':
+                self.shop_wide.append(rule)
+
+    def __bool__(self):
+        return bool(self.by_product or self.by_category or self.shop_wide or self.bundles_by_product)
+
+    def line_rules(self, product_id, category_id):
+        return (self.by_product.get(product_id, []) + self.by_category.get(category_id, [])
+                + self.shop_wide)
+
+
+def get_promotion_index(shop_id):
+    """Get the compiled promotions of a shop, recompiled when any promotion changes"""
+    from app import db
+    from models import Promotion
+    from sqlalchemy import func, select
+
+    fingerprint = tuple(db.session.execute(
+        select(func.count(Promotion.id), func.max(Promotion.updated_at)).where(Promotion.shop_id == shop_id)
+    ).one())
+
+    cached = _index_cache.get(shop_id)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    promotions = Promotion.query.filter_by(shop_id=shop_id, is_active=True).all()
+    index = PromotionIndex(promotions)
+    with _index_lock:
+        _index_cache[shop_id] = (fingerprint, index)
+    return index
+
+
+def local_time(now):
+    name = get_pricing_settings()['time_zone']
+    try:
+        zone = ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logging.warning(f"Unknown time zone {name}, using UTC for promotions")
+        return now
+    return now.replace(tzinfo=timezone.utc).astimezone(zone).replace(tzinfo=None)
+
+
+def price_basket(shop, lines, products, now=None, index=None):
+    """Price a basket in integer cents.
+
+    lines is a list of (product_id, quantity); products maps product id to an
+    object with price and category_id. Quantities of repeated products are
+    combined so multi-buys span lines. Bundles are applied first, then each
+    line gets the single best of its product, category and shop-wide rules
+    for the units left over. Tax is charged on the discounted subtotal.
+    """
+    now = now or datetime.utcnow()
+    settings = shop.settings or {}
+
+    quantities = {}
+    for product_id, quantity in lines:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    priced = {}
+    for product_id, quantity in quantities.items():
+        unit_cents = to_cents(products[product_id].price)
+        priced[product_id] = {
+            'product_id': product_id,
+            'quantity': quantity,
+            'unit_cents': unit_cents,
+            'gross_cents': unit_cents * quantity,
+            'discount_cents': 0,
+            'promotions': [],
+        }
+
+    if settings.get('enable_discounts', True):
+        if index is None:
+            index = get_promotion_index(shop.id)
+        if index:
+            apply_promotions(index, priced, products, now, local_time(now))
+
+    subtotal = sum(line['gross_cents'] for line in priced.values())
+    discount = sum(line['discount_cents'] for line in priced.values())
+    for line in priced.values():
+        line['net_cents'] = line['gross_cents'] - line['discount_cents']
+
+    tax = percent_of(subtotal - discount, to_cents(settings.get('tax_rate', 16)))
+    return {
+        'lines': list(priced.values()),
+        'subtotal_cents': subtotal,
+        'discount_cents': discount,
+        'tax_cents': tax,
+        'total_cents': subtotal - discount + tax,
+    }
+
+
+def apply_promotions(index, priced, products, now, local_now):
+    remaining = {product_id: line['quantity'] for product_id, line in priced.items()}
+
+    bundles = {}
+    for product_id in priced:
+        for rule in index.bundles_by_product.get(product_id, ()):
+            bundles[rule.id] = rule
+    offers = []
+    for rule in bundles.values():
+        if all(pid in priced for pid in rule.product_ids) and rule.is_live(now, local_now):
+            saving = sum(priced[pid]['unit_cents'] for pid in rule.product_ids) - rule.price_cents
+            if saving > 0:
+                offers.append((saving, rule))
+
+    # Best saving per set first; each unit counts towards at most one promotion
+    for saving, rule in sorted(offers, key=lambda offer: -offer[0]):
+        sets = min(remaining[pid] for pid in rule.product_ids)
+        if not sets:
+            continue
+        full_price = sum(priced[pid]['unit_cents'] for pid in rule.product_ids)
+        allocated = 0
+        for position, pid in enumerate(rule.product_ids):
+            remaining[pid] -= sets
+            if position == len(rule.product_ids) - 1:
+                share = saving * sets - allocated
+            else:
+                share = saving * sets * priced[pid]['unit_cents'] // full_price
+                allocated += share
+            priced[pid]['discount_cents'] += share
+            priced[pid]['promotions'].append(rule.name)
+
+    for product_id, line in priced.items():
+        quantity = remaining[product_id]
+        if not quantity:
+            continue
+        best, best_rule = 0, None
+        for rule in index.line_rules(product_id, products[product_id].category_id):
+            discount = rule.line_discount(line['unit_cents'], quantity)
+            if discount > best and rule.is_live(now, local_now):
+                best, best_rule = discount, rule
+        if best_rule:
+            line['discount_cents'] += min(best, line['unit_cents'] * quantity)
+            line['promotions'].append(best_rule.name)
+
+
+def priced_basket_json(basket):
+    """Serialise a priced basket with amounts in both cents and currency units"""
+    def money(cents):
+        return float(from_cents(cents))
+
+    return {
+        'lines': [{
+            'product_id': line['product_id'],
+            'quantity': line['quantity'],
+            'unit_price': money(line['unit_cents']),
+            'line_total': money(line['gross_cents']),
+            'discount': money(line['discount_cents']),
+            'net_total': money(line['net_cents']),
+            'promotions': line['promotions'],
+        } for line in basket['lines']],
+        'subtotal': money(basket['subtotal_cents']),
+        'discount': money(basket['discount_cents']),
+        'tax': money(basket['tax_cents']),
+        'total': money(basket['total_cents']),
+        'total_cents': basket['total_cents'],
+    }
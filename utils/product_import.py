@@ -0,0 +1,430 @@
+"""
+Bulk Product Import
+Streams CSV/XLSX product lists in validated chunks and upserts them by barcode/SKU,
+using COPY into a staging table on PostgreSQL and executemany elsewhere
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import insert, select, text, update
+from utils.database import copy_from_file, is_postgres
+from utils.inventory import refresh_inventory_counters
+from utils.kvstore import get_store
+
+CHUNK_SIZE = 2000
+MAX_REPORTED_ERRORS = 100
+PROGRESS_TTL = 24 * 3600
+
+COLUMNS = ['name', 'description', 'price', 'cost_price', 'barcode', 'sku',
+           'stock_quantity', 'low_stock_threshold', 'category']
+
+# Alternative header spellings accepted in uploaded files
+HEADER_ALIASES = {
+    'product': 'name',
+    'product_name': 'name',
+    'selling_price': 'price',
+    'cost': 'cost_price',
+    'stock': 'stock_quantity',
+    'quantity': 'stock_quantity',
+    'qty': 'stock_quantity',
+    'reorder_level': 'low_stock_threshold',
+    'category_name': 'category',
+}
+
+STAGING_COLUMNS = ['line', 'name', 'description', 'price', 'cost_price', 'barcode', 'sku',
+                   'stock_quantity', 'low_stock_threshold', 'category_id']
+
+
+def normalize_header(value):
+    key = str(value or '').strip().lower().replace(' ', '_').replace('-', '_')
+    return HEADER_ALIASES.get(key, key)
+
+
+def iter_csv_rows(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = [normalize_header(h) for h in next(reader, [])]
+        for row in reader:
+            yield dict(zip(header, row))
+
+
+def iter_xlsx_rows(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("XLSX import requires the openpyxl package; upload a CSV file instead")
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [normalize_header(h) for h in next(rows, ())]
+        for row in rows:
+            yield {key: '' if value is None else value for key, value in zip(header, row)}
+    finally:
+        workbook.close()
+
+
+def iter_rows(path, filename):
+    """Yield (line number, row dict) from an uploaded CSV or XLSX file"""
+    if filename.lower().endswith('.xlsx'):
+        rows = iter_xlsx_rows(path)
+    elif filename.lower().endswith('.csv'):
+        rows = iter_csv_rows(path)
+    else:
+        raise ValueError("Unsupported file type; upload a .csv or .xlsx file")
+
+    # Line 1 is the header row
+    for line, row in enumerate(rows, start=2):
+        if any(str(value).strip() for value in row.values()):
+            yield line, row
+
+
+def parse_decimal(value, field, default=None):
+    value = str(value).strip().replace(',', '')
+    if not value:
+        if default is None:
+            raise ValueError(f"{field} is required")
+        return default
+    try:
+        number = Decimal(value).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f"{field} must be a number")
+    if number < 0:
+        raise ValueError(f"{field} cannot be negative")
+    return number
+
+
+def parse_int(value, field, default):
+    value = str(value).strip().replace(',', '')
+    if not value:
+        return default
+    try:
+        number = int(float(value))
+    except ValueError:
+        raise ValueError(f"{field} must be a whole number")
+    if number < 0:
+        raise ValueError(f"{field} cannot be negative")
+    return number
+
+
+def clean_text(value, max_length=None):
+    value = str(value).strip()
+    return value[:max_length] if max_length else value
+
+
+def clean_code(value):
+    """Clean a barcode/SKU (spreadsheets turn numeric codes into floats)"""
+    value = clean_text(value, 100)
+    if value.endswith('.0') and value[:-2].isdigit():
+        value = value[:-2]
+    return value or None
+
+
+def validate_row(row):
+    """Validate and convert one row; raises ValueError with a readable message"""
+    name = clean_text(row.get('name', ''), 200)
+    if not name:
+        raise ValueError("name is required")
+
+    return {
+        'name': name,
+        'description': clean_text(row.get('description', '')),
+        'price': parse_decimal(row.get('price', ''), 'price'),
+        'cost_price': parse_decimal(row.get('cost_price', ''), 'cost_price', Decimal('0.00')),
+        'barcode': clean_code(row.get('barcode', '')),
+        'sku': clean_code(row.get('sku', '')),
+        'stock_quantity': parse_int(row.get('stock_quantity', ''), 'stock_quantity', 0),
+        'low_stock_threshold': parse_int(row.get('low_stock_threshold', ''), 'low_stock_threshold', 10),
+        'category': clean_text(row.get('category', ''), 100),
+    }
+
+
+class ProductImport:
+    """One import job for a shop, with progress kept in the 'product_imports' store"""
+
+    def __init__(self, shop_id, user_id, job_id=None):
+        self.shop_id = shop_id
+        self.user_id = user_id
+        self.job_id = job_id or uuid.uuid4().hex
+        self.progress = {
+            'shop_id': shop_id,
+            'status': 'pending',
+            'processed': 0,
+            'inserted': 0,
+            'updated': 0,
+            'failed': 0,
+            'errors': [],
+        }
+        self.categories = None
+        self.seen_keys = set()
+
+    def save_progress(self, **changes):
+        self.progress.update(changes)
+        get_store('product_imports').set(self.job_id, json.dumps(self.progress), ttl=PROGRESS_TTL)
+
+    def add_error(self, line, message):
+        self.progress['failed'] += 1
+        if len(self.progress['errors']) < MAX_REPORTED_ERRORS:
+            self.progress['errors'].append({'line': line, 'message': message})
+
+    def run(self, path, filename):
+        """Import every row of the file, committing one chunk at a time"""
+        from app import db
+
+        self.save_progress(status='running', started_at=datetime.utcnow().isoformat())
+        try:
+            chunk = []
+            for line, row in iter_rows(path, filename):
+                chunk.append((line, row))
+                if len(chunk) >= CHUNK_SIZE:
+                    self.import_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.import_chunk(chunk)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Product import {self.job_id} failed: {e}")
+            self.save_progress(status='failed', message=str(e))
+            raise
+
+        self.save_progress(status='completed', finished_at=datetime.utcnow().isoformat())
+        return self.progress
+
+    def import_chunk(self, chunk):
+        from app import db
+
+        rows = []
+        for line, raw in chunk:
+            try:
+                row = validate_row(raw)
+            except ValueError as e:
+                self.add_error(line, str(e))
+                continue
+
+            key = ('barcode', row['barcode']) if row['barcode'] else ('sku', row['sku']) if row['sku'] else None
+            if key is not None:
+                if key in self.seen_keys:
+                    self.add_error(line, f"duplicate {key[0]} {key[1]} in file")
+                    continue
+                self.seen_keys.add(key)
+
+            row['line'] = line
+            rows.append(row)
+
+        if rows:
+            self.resolve_categories(rows)
+            if is_postgres():
+                inserted, updated, conflicts = self.merge_postgres(rows)
+            else:
+                inserted, updated, conflicts = self.merge_executemany(rows)
+            # Bulk statements bypass the per-product counter updates; recount the shop
+            refresh_inventory_counters(self.shop_id)
+            db.session.commit()
+
+            for line, barcode in conflicts:
+                self.add_error(line, f"barcode {barcode} is already used by another shop")
+            self.progress['inserted'] += inserted
+            self.progress['updated'] += updated
+
+        self.save_progress(processed=self.progress['processed'] + len(chunk))
+
+    def resolve_categories(self, rows):
+        """Map category names to ids with one lookup map, creating missing categories in bulk"""
+        from app import db
+        from models import Category
+
+        if self.categories is None:
+            self.categories = {
+                name.strip().lower(): category_id
+                for category_id, name in db.session.execute(
+                    select(Category.id, Category.name).where(Category.shop_id == self.shop_id)
+                )
+            }
+
+        missing = {}
+        for row in rows:
+            key = row['category'].lower()
+            if key and key not in self.categories:
+                missing.setdefault(key, row['category'])
+
+        if missing:
+            now = datetime.utcnow()
+            created = db.session.execute(
+                insert(Category).returning(Category.id, Category.name),
+                [{'name': name, 'shop_id': self.shop_id, 'created_at': now} for name in missing.values()]
+            )
+            for category_id, name in created:
+                self.categories[name.lower()] = category_id
+
+        for row in rows:
+            row['category_id'] = self.categories.get(row['category'].lower())
+
+    def merge_executemany(self, rows):
+        """Upsert a chunk with executemany statements (SQLite and other databases)"""
+        from app import db
+        from models import Product, StockMovement
+
+        barcodes = [row['barcode'] for row in rows if row['barcode']]
+        skus = [row['sku'] for row in rows if row['sku'] and not row['barcode']]
+
+        by_barcode, by_sku, taken_barcodes = {}, {}, set()
+        if barcodes:
+            for product_id, barcode, stock, shop_id in db.session.execute(
+                select(Product.id, Product.barcode, Product.stock_quantity, Product.shop_id)
+                .where(Product.barcode.in_(barcodes))
+            ):
+                if shop_id == self.shop_id:
+                    by_barcode[barcode] = (product_id, stock)
+                else:
+                    taken_barcodes.add(barcode)
+        if skus:
+            for product_id, sku, stock in db.session.execute(
+                select(Product.id, Product.sku, Product.stock_quantity)
+                .where(Product.shop_id == self.shop_id, Product.sku.in_(skus))
+            ):
+                by_sku.setdefault(sku, (product_id, stock))
+
+        now = datetime.utcnow()
+        inserts, updates, movements, conflicts = [], [], [], []
+        for row in rows:
+            values = {column: row[column] for column in STAGING_COLUMNS if column != 'line'}
+            existing = by_barcode.get(row['barcode']) if row['barcode'] else by_sku.get(row['sku'])
+
+            if existing:
+                product_id, old_stock = existing
+                updates.append(dict(values, id=product_id, updated_at=now))
+                if row['stock_quantity'] != (old_stock or 0):
+                    movements.append(self.movement(product_id, 'adjustment',
+                                                   row['stock_quantity'] - (old_stock or 0), now))
+            elif row['barcode'] in taken_barcodes:
+                conflicts.append((row['line'], row['barcode']))
+            else:
+                inserts.append(dict(values, shop_id=self.shop_id, is_active=True,
+                                    created_at=now, updated_at=now))
+
+        if updates:
+            db.session.execute(update(Product), updates)
+        if inserts:
+            for product_id, stock in db.session.execute(
+                insert(Product).returning(Product.id, Product.stock_quantity), inserts
+            ):
+                if stock > 0:
+                    movements.append(self.movement(product_id, 'in', stock, now))
+        if movements:
+            db.session.execute(insert(StockMovement), movements)
+
+        return len(inserts), len(updates), conflicts
+
+    def movement(self, product_id, movement_type, quantity, now):
+        return {
+            'product_id': product_id,
+            'movement_type': movement_type,
+            'quantity': quantity,
+            'reference': 'initial_stock' if movement_type == 'in' else 'product_import',
+            'notes': f'Product import {self.job_id}',
+            'created_by': self.user_id,
+            'created_at': now,
+        }
+
+    def merge_postgres(self, rows):
+        """Upsert a chunk via COPY into a staging table and set-based merge statements"""
+        from app import db
+
+        conn = db.session.connection()
+        conn.execute(text(
+            "CREATE TEMP TABLE IF NOT EXISTS product_import_staging ("
+            "line INTEGER, name VARCHAR(200), description TEXT, price NUMERIC(10, 2), "
+            "cost_price NUMERIC(10, 2), barcode VARCHAR(100), sku VARCHAR(100), "
+            "stock_quantity INTEGER, low_stock_threshold INTEGER, category_id INTEGER, "
+            "product_id INTEGER, old_stock INTEGER, conflict BOOLEAN DEFAULT false"
+            ") ON COMMIT DROP"
+        ))
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['' if row[column] is None else row[column] for column in STAGING_COLUMNS])
+        data = io.BytesIO(buffer.getvalue().encode('utf-8'))
+        copy_from_file(conn.connection, f"COPY product_import_staging ({', '.join(STAGING_COLUMNS)}) "
+                                        "FROM STDIN WITH (FORMAT csv)", data)
+
+        params = {'shop_id': self.shop_id, 'user_id': self.user_id, 'now': datetime.utcnow(),
+                  'notes': f'Product import {self.job_id}'}
+
+        # Match existing products by barcode, then by SKU for rows without a barcode
+        conn.execute(text(
+            "UPDATE product_import_staging s SET product_id = p.id, old_stock = p.stock_quantity "
+            "FROM products p WHERE p.shop_id = :shop_id AND p.barcode = s.barcode"
+        ), params)
+        conn.execute(text(
+            "UPDATE product_import_staging s SET product_id = m.id, old_stock = m.stock_quantity "
+            "FROM (SELECT DISTINCT ON (sku) id, sku, stock_quantity FROM products "
+            "      WHERE shop_id = :shop_id AND sku IS NOT NULL ORDER BY sku, id) m "
+            "WHERE s.barcode IS NULL AND s.sku = m.sku"
+        ), params)
+        conn.execute(text(
+            "UPDATE product_import_staging s SET conflict = true FROM products p "
+            "WHERE s.product_id IS NULL AND p.barcode = s.barcode AND p.shop_id <> :shop_id"
+        ), params)
+
+        updated = conn.execute(text(
+            "UPDATE products p SET name = s.name, description = s.description, price = s.price, "
+            "cost_price = s.cost_price, sku = s.sku, stock_quantity = s.stock_quantity, "
+            "low_stock_threshold = s.low_stock_threshold, category_id = s.category_id, updated_at = :now "
+            "FROM product_import_staging s WHERE p.id = s.product_id"
+        ), params).rowcount
+        conn.execute(text(
+            "INSERT INTO stock_movements (product_id, movement_type, quantity, reference, notes, created_by, created_at) "
+            "SELECT product_id, 'adjustment', stock_quantity - COALESCE(old_stock, 0), 'product_import', "
+            ":notes, :user_id, :now FROM product_import_staging "
+            "WHERE product_id IS NOT NULL AND stock_quantity <> COALESCE(old_stock, 0)"
+        ), params)
+
+        inserted = conn.execute(text(
+            "WITH new_products AS ("
+            "  INSERT INTO products (name, description, price, cost_price, barcode, sku, stock_quantity, "
+            "    low_stock_threshold, category_id, shop_id, is_active, created_at, updated_at) "
+            "  SELECT name, description, price, cost_price, barcode, sku, stock_quantity, "
+            "    low_stock_threshold, category_id, :shop_id, true, :now, :now "
+            "  FROM product_import_staging WHERE product_id IS NULL AND NOT conflict ORDER BY line "
+            "  RETURNING id, stock_quantity"
+            "), movements AS ("
+            "  INSERT INTO stock_movements (product_id, movement_type, quantity, reference, notes, created_by, created_at) "
+            "  SELECT id, 'in', stock_quantity, 'initial_stock', :notes, :user_id, :now "
+            "  FROM new_products WHERE stock_quantity > 0"
+            ") SELECT count(*) FROM new_products"
+        ), params).scalar()
+
+        conflicts = conn.execute(text(
+            "SELECT line, barcode FROM product_import_staging WHERE conflict ORDER BY line"
+        )).all()
+
+        return inserted, updated, [tuple(row) for row in conflicts]
+
+
+def get_import_progress(job_id):
+    """Get the stored progress of an import job (None if unknown or expired)"""
+    data = get_store('product_imports').get(job_id)
+    return json.loads(data) if data else None
+
+
+def run_import_file(app, job, path, filename, ip_address=None, user_agent=None):
+    """Run an import job in the background and remove the uploaded file afterwards"""
+    from utils.auth import log_audit
+
+    with app.app_context():
+        try:
+            progress = job.run(path, filename)
+            log_audit(job.user_id, 'import_products', 'product', None, ip_address, user_agent,
+                      new_values={key: progress[key] for key in ('inserted', 'updated', 'failed')},
+                      shop_id=job.shop_id)
+        except Exception:
+            pass
+        finally:
+            os.remove(path)
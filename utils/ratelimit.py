@@ -0,0 +1,213 @@
+"""
+Rate Limiting
+Token-bucket limits per endpoint class, shop and user, checked before any
+database work. Buckets live in process memory, or in Redis when
+RATELIMIT_STORAGE_URL is set; set_rate_limit_backend() swaps in a stand-in.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, render_template, request, session
+
+DEFAULT_LIMITS = {
+    'callback': '300/10',   # M-Pesa callbacks, per source address
+    'polling': '40/60',     # payment and import status checks
+    'lookup': '180/60',     # product search and barcode lookups
+    'auth': '20/60',        # login and registration attempts, per address
+}
+
+# Static files, hashed asset bundles and the service worker: a page load fetches
+# several at once, and they must not spend the page's own budget
+EXEMPT_ENDPOINTS = {'static', 'serve_asset', 'service_worker'}
+
+_backend = {'backend': None}
+_backend_lock = threading.Lock()
+_limits = {}
+
+REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+def get_rate_limit_settings():
+    """Get rate limiting configuration from the environment"""
+    return {
+        'enabled': os.environ.get('RATELIMIT_ENABLED', 'true').lower() == 'true',
+        'default': os.environ.get('RATELIMIT_DEFAULT', '600/60'),
+        'storage_url': os.environ.get('RATELIMIT_STORAGE_URL', ''),
+    }
+
+
+def parse_limit(value):
+    """Parse 'count/seconds' into (tokens per second, burst), or None for no limit"""
+    if not value or value.lower() in ('0', 'off', 'none'):
+        return None
+    count, _, seconds = value.partition('/')
+    count, seconds = float(count), float(seconds or 1)
+    if count <= 0 or seconds <= 0:
+        raise ValueError(f"Invalid rate limit: {value}")
+    return count / seconds, count
+
+
+def get_limit(limit_class):
+    """Limit for an endpoint class or blueprint: RATELIMIT_<CLASS>, else the default"""
+    if limit_class not in _limits:
+        value = os.environ.get(f'RATELIMIT_{limit_class.upper()}',
+                               DEFAULT_LIMITS.get(limit_class, get_rate_limit_settings()['default']))
+        try:
+            _limits[limit_class] = parse_limit(value)
+        except ValueError as e:
+            logging.error(f"{e}; {limit_class} is not rate limited")
+            _limits[limit_class] = None
+    return _limits[limit_class]
+
+
+class MemoryBuckets:
+    """Token buckets in process memory, least recently used dropped beyond max_keys"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """Take one token; returns (allowed, tokens left)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = burst
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                self._buckets.move_to_end(key)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            return allowed, tokens
+
+
+class RedisBuckets:
+    """Token buckets shared between workers, updated atomically by a Lua script"""
+
+    def __init__(self, client, prefix='comolor:ratelimit:'):
+        self.prefix = prefix
+        self.script = client.register_script(REDIS_TOKEN_BUCKET)
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        allowed, tokens = self.script(keys=[f'{self.prefix}{key}'], args=[rate, burst, now])
+        return bool(allowed), float(tokens)
+
+
+def get_rate_limit_backend():
+    """Get the bucket backend (Redis when RATELIMIT_STORAGE_URL is set, else in-process)"""
+    backend = _backend['backend']
+    if backend is not None:
+        return backend
+
+    with _backend_lock:
+        if _backend['backend'] is None:
+            url = get_rate_limit_settings()['storage_url']
+            backend = None
+            if url:
+                try:
+                    import redis
+                    backend = RedisBuckets(redis.Redis.from_url(url))
+                except ImportError:
+                    logging.warning("RATELIMIT_STORAGE_URL is set but the redis package is not installed; "
+                                    "using in-process rate limits")
+            _backend['backend'] = backend or MemoryBuckets()
+        return _backend['backend']
+
+
+def set_rate_limit_backend(backend):
+    """Replace the bucket backend (anything with take(key, rate, burst))"""
+    with _backend_lock:
+        _backend['backend'] = backend
+
+
+def rate_limit(limit_class):
+    """Put a view in an endpoint class with its own limit (instead of its blueprint's)"""
+    def decorator(f):
+        f.rate_limit_class = limit_class
+        return f
+    return decorator
+
+
+def check_rate_limit(app):
+    """before_request hook: 429 with Retry-After once the caller's bucket is empty"""
+    view = app.view_functions.get(request.endpoint)
+    if view is None or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+
+    limit_class = getattr(view, 'rate_limit_class', None) or request.blueprint or 'default'
+    limit = get_limit(limit_class)
+    if limit is None:
+        return None
+    rate, burst = limit
+
+    caller = session.get('user_id') or request.remote_addr
+    key = f"{limit_class}:{session.get('shop_id') or '-'}:{caller}"
+    try:
+        allowed, tokens = get_rate_limit_backend().take(key, rate, burst)
+    except Exception as e:
+        # Fail open: an unavailable limiter must not take the POS down
+        logging.error(f"Rate limit check failed: {e}")
+        return None
+
+    g.rate_limit = (int(burst), int(tokens))
+    if allowed:
+        return None
+
+    retry_after = max(1, math.ceil((1 - tokens) / rate))
+    if wants_html():
+        response = app.make_response(render_template('rate_limited.html', retry_after=retry_after))
+    else:
+        response = jsonify({'error': 'Too many requests', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def wants_html():
+    """True for page loads and form posts; API calls (JSON bodies, fetch() without Accept) get JSON"""
+    if request.is_json:
+        return False
+    return request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html'
+
+
+def add_rate_limit_headers(response):
+    limit = g.get('rate_limit')
+    if limit:
+        response.headers['X-RateLimit-Limit'] = str(limit[0])
+        response.headers['X-RateLimit-Remaining'] = str(limit[1])
+    return response
+
+
+def init_rate_limits(app):
+    """Check rate limits before every other request hook"""
+    if not get_rate_limit_settings()['enabled']:
+        return
+    app.before_request_funcs.setdefault(None, []).insert(0, lambda: check_rate_limit(app))
+    app.after_request(add_rate_limit_headers)
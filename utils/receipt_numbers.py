@@ -0,0 +1,130 @@
+"""
+Receipt Number Allocation
+Per-shop monotonic receipt sequences handed out in leased blocks, so each
+worker process (and each offline till) numbers sales without a round trip
+"""
+
+import os
+import re
+import socket
+import threading
+from datetime import datetime
+from sqlalchemy import insert, select, update
+from utils.database import upsert_insert
+
+RECEIPT_PREFIX = 'RCP'
+MAX_TILL_BLOCK_SIZE = 10000
+# Shop IDs and values are zero padded to at least 5 and 9 digits and grow past them
+RECEIPT_NUMBER_RE = re.compile(rf'^{RECEIPT_PREFIX}(?P<shop_id>\d{{5,}})-(?P<value>\d{{9,}})$')
+
+
+def get_receipt_settings():
+    """Get receipt allocation configuration from the environment"""
+    return {
+        'block_size': int(os.environ.get('RECEIPT_BLOCK_SIZE', '50')),
+        'till_block_size': int(os.environ.get('RECEIPT_TILL_BLOCK_SIZE', '500')),
+    }
+
+
+def format_receipt_number(shop_id, value):
+    """Format a sequence value as a receipt number, e.g. RCP00012-000004521.
+
+    Zero padding keeps numbers of a shop sorted and adjacent in the index.
+    """
+    return f"{RECEIPT_PREFIX}{shop_id:05d}-{value:09d}"
+
+
+def parse_receipt_number(receipt_number):
+    """(shop_id, value) of a formatted receipt number, or None if it isn't one"""
+    match = RECEIPT_NUMBER_RE.match(receipt_number or '')
+    if match is None:
+        return None
+    return int(match['shop_id']), int(match['value'])
+
+
+def till_leased_values(shop_id, values):
+    """The subset of values that fall inside blocks leased to the shop's tills (one query)"""
+    from app import db
+    from models import ReceiptBlock
+
+    values = set(values)
+    if not values:
+        return set()
+    blocks = db.session.execute(
+        select(ReceiptBlock.start_value, ReceiptBlock.end_value)
+        .where(ReceiptBlock.shop_id == shop_id, ReceiptBlock.holder.like('till:%'),
+               ReceiptBlock.end_value >= min(values), ReceiptBlock.start_value <= max(values))
+    ).all()
+    return {value for value in values if any(start <= value <= end for start, end in blocks)}
+
+
+def lease_block(shop_id, size, holder, user_id=None):
+    """Reserve `size` consecutive numbers for a holder; returns (start, end) inclusive.
+
+    Runs in its own short transaction so the lease is durable even if the
+    caller's transaction rolls back (the numbers are then simply skipped).
+    """
+    from app import db
+    from models import ReceiptBlock, ReceiptSequence
+
+    if size < 1:
+        raise ValueError("Block size must be at least 1")
+
+    sequences = ReceiptSequence.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            upsert_insert(sequences).values(shop_id=shop_id, next_value=1, updated_at=datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=['shop_id'])
+        )
+        end = conn.execute(
+            update(sequences)
+            .where(sequences.c.shop_id == shop_id)
+            .values(next_value=sequences.c.next_value + size, updated_at=datetime.utcnow())
+            .returning(sequences.c.next_value)
+        ).scalar_one() - 1
+        start = end - size + 1
+
+        conn.execute(insert(ReceiptBlock.__table__).values(
+            shop_id=shop_id, holder=holder, start_value=start, end_value=end,
+            leased_by=user_id, created_at=datetime.utcnow()
+        ))
+
+    return start, end
+
+
+class ReceiptAllocator:
+    """Hands out receipt numbers from per-shop blocks leased by this process"""
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size or get_receipt_settings()['block_size']
+        self.holder = f"worker:{socket.gethostname()}:{os.getpid()}"
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def next_value(self, shop_id):
+        with self._lock:
+            current, end = self._blocks.get(shop_id, (1, 0))
+            if current > end:
+                current, end = lease_block(shop_id, self.block_size, self.holder)
+            self._blocks[shop_id] = (current + 1, end)
+            return current
+
+    def next_receipt_number(self, shop_id):
+        return format_receipt_number(shop_id, self.next_value(shop_id))
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def next_receipt_number(shop_id):
+    """Allocate the next receipt number for a shop"""
+    global _allocator
+
+    # Forked workers must not reuse the parent's leased blocks
+    if _allocator is None or _allocator.holder.rsplit(':', 1)[1] != str(os.getpid()):
+        with _allocator_lock:
+            if _allocator is None or _allocator.holder.rsplit(':', 1)[1] != str(os.getpid()):
+                _allocator = ReceiptAllocator()
+
+    return _allocator.next_receipt_number(shop_id)
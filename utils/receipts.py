@@ -0,0 +1,304 @@
+"""
+Receipt Rendering Engine
+Renders receipts as ESC/POS byte streams for thermal printers and as compact
+print HTML, from a layout compiled once per shop and a single-query sale snapshot;
+shift Z-reports are printed with the same layout
+"""
+
+import logging
+import os
+import socket
+import threading
+from markupsafe import escape
+
+# ESC/POS control sequences
+ESC_INIT = b'\x1b@'
+ESC_ALIGN_LEFT = b'\x1ba\x00'
+ESC_ALIGN_CENTER = b'\x1ba\x01'
+ESC_BOLD_ON = b'\x1bE\x01'
+ESC_BOLD_OFF = b'\x1bE\x00'
+ESC_DOUBLE_SIZE = b'\x1d!\x11'
+ESC_NORMAL_SIZE = b'\x1d!\x00'
+ESC_FEED_AND_CUT = b'\x1dVB\x03'
+
+PRINTER_ENCODING = 'cp437'
+
+# Characters per line for the supported paper widths (Font A)
+LINE_WIDTHS = {'58mm': 32, '80mm': 48}
+
+HTML_STYLE = (
+    "@media print{body{margin:0}}"
+    "body{font-family:'Courier New',monospace;font-size:12px;max-width:300px;margin:0 auto;padding:10px}"
+    ".c{text-align:center}.r{text-align:right}.b{font-weight:bold}"
+    "hr{border:0;border-top:1px dashed #000}"
+    "table{width:100%;border-collapse:collapse}td{padding:1px 2px;vertical-align:top}"
+)
+
+_layout_cache = {}
+_layout_lock = threading.Lock()
+
+
+def money(value):
+    return f"{value or 0:,.2f}"
+
+
+class ReceiptLayout:
+    """Receipt layout for one shop, with static header/footer parts prebuilt"""
+
+    def __init__(self, shop_name, contact_lines, receipt_header, receipt_footer, width='80mm'):
+        self.line_width = LINE_WIDTHS.get(width, LINE_WIDTHS['80mm'])
+        self.name_width = self.line_width - 18
+        self.item_format = f"{{:<{self.name_width}.{self.name_width}}}{{:>4}}{{:>14}}"
+        self.rule = '-' * self.line_width
+
+        header_lines = [line for line in (receipt_header or '').splitlines() if line.strip()]
+        footer_lines = [line for line in (receipt_footer or '').splitlines() if line.strip()]
+
+        self.escpos_header = b''.join([
+            ESC_INIT, ESC_ALIGN_CENTER,
+            ESC_BOLD_ON, ESC_DOUBLE_SIZE, self.encode(shop_name) + b'\n', ESC_NORMAL_SIZE, ESC_BOLD_OFF,
+            *(self.encode(line) + b'\n' for line in contact_lines + header_lines),
+            ESC_ALIGN_LEFT, self.encode(self.rule) + b'\n',
+        ])
+        self.escpos_footer = b''.join([
+            ESC_ALIGN_CENTER,
+            *(self.encode(line) + b'\n' for line in footer_lines),
+            b'Powered by Comolor POS\n',
+            ESC_ALIGN_LEFT, ESC_FEED_AND_CUT,
+        ])
+
+        self.html_header = (
+            f"<!DOCTYPE html><html><head><meta charset=\"UTF-8\"><style>{HTML_STYLE}</style></head><body>"
+            f"<div class=\"c\"><div class=\"b\" style=\"font-size:16px\">{escape(shop_name)}</div>"
+            + ''.join(f"<div>{escape(line)}</div>" for line in contact_lines + header_lines)
+            + "</div><hr>"
+        )
+        self.html_footer = (
+            "<hr><div class=\"c\" style=\"font-size:10px\">"
+            + ''.join(f"<div>{escape(line)}</div>" for line in footer_lines)
+            + "<div>Powered by Comolor POS</div></div>"
+            "<script>window.onload=function(){window.print();window.onafterprint=function(){window.close();};};</script>"
+            "</body></html>"
+        )
+
+    @staticmethod
+    def encode(text):
+        return str(text).encode(PRINTER_ENCODING, errors='replace')
+
+    def pair(self, label, value):
+        """Label on the left, value right-aligned on the same line"""
+        value = str(value)
+        return f"{label:<{self.line_width - len(value)}}{value}"
+
+    def info_lines(self, snapshot):
+        lines = [
+            f"Receipt #: {snapshot['receipt_number']}",
+            f"Date: {snapshot['created_at']:%Y-%m-%d %H:%M}",
+            f"Cashier: {snapshot['cashier']}",
+        ]
+        if snapshot['customer_name']:
+            lines.append(f"Customer: {snapshot['customer_name']}")
+        if snapshot['mpesa_receipt']:
+            lines.append(f"MPesa: {snapshot['mpesa_receipt']}")
+        return lines
+
+    def total_lines(self, snapshot):
+        lines = [('Subtotal:', f"KES {money(snapshot['subtotal'])}")]
+        if snapshot['discount_amount']:
+            lines.append(('Discount:', f"-KES {money(snapshot['discount_amount'])}"))
+        lines.append(('Tax:', f"KES {money(snapshot['tax_amount'])}"))
+        return lines
+
+    def render_escpos(self, snapshot):
+        """Render a sale snapshot as an ESC/POS byte stream"""
+        lines = self.info_lines(snapshot)
+        lines.append(self.rule)
+        lines.append(self.item_format.format('Item', 'Qty', 'Total'))
+        item_format = self.item_format
+        for name, quantity, unit_price, line_total in snapshot['items']:
+            lines.append(item_format.format(name, quantity, money(line_total)))
+            if quantity != 1:
+                lines.append(f"  @ {money(unit_price)}")
+        lines.append(self.rule)
+        lines.extend(self.pair(label, value) for label, value in self.total_lines(snapshot))
+
+        body = self.encode('\n'.join(lines) + '\n')
+        total = self.encode(self.pair('TOTAL:', f"KES {money(snapshot['total_amount'])}") + '\n')
+        payment = self.encode(self.pair('Payment:', snapshot['payment_method'].upper()) + '\n')
+
+        return b''.join([
+            self.escpos_header, body,
+            ESC_BOLD_ON, total, ESC_BOLD_OFF, payment,
+            self.encode(self.rule) + b'\n',
+            self.escpos_footer,
+        ])
+
+    def render_html(self, snapshot):
+        """Render a sale snapshot as a compact, self-printing HTML page"""
+        parts = [self.html_header]
+        parts.extend(f"<div>{escape(line)}</div>" for line in self.info_lines(snapshot))
+        parts.append("<hr><table><tr class=\"b\"><td>Item</td><td class=\"r\">Qty</td>"
+                     "<td class=\"r\">Price</td><td class=\"r\">Total</td></tr>")
+        for name, quantity, unit_price, line_total in snapshot['items']:
+            parts.append(
+                f"<tr><td>{escape(name)}</td><td class=\"r\">{quantity}</td>"
+                f"<td class=\"r\">{unit_price:,.0f}</td><td class=\"r\">{line_total:,.0f}</td></tr>"
+            )
+        parts.append("</table><hr><table>")
+        for label, value in self.total_lines(snapshot):
+            parts.append(f"<tr><td>{label}</td><td class=\"r\">{value}</td></tr>")
+        parts.append(
+            f"<tr class=\"b\"><td>TOTAL:</td><td class=\"r\">KES {money(snapshot['total_amount'])}</td></tr>"
+            f"<tr><td>Payment:</td><td class=\"r\">{escape(snapshot['payment_method'].upper())}</td></tr></table>"
+        )
+        parts.append(self.html_footer)
+        return ''.join(parts)
+
+    def z_report_sections(self, report):
+        """Title, shift details and (label, value) sections of a Z-report"""
+        title = 'Z-REPORT' if report['closed_at'] else 'X-REPORT (SHIFT OPEN)'
+        info = [
+            f"Shift #: {report['shift_id']}",
+            f"Cashier: {report['cashier']}",
+            f"Opened: {report['opened_at']:%Y-%m-%d %H:%M}",
+        ]
+        if report['closed_at']:
+            info.append(f"Closed: {report['closed_at']:%Y-%m-%d %H:%M}")
+
+        sections = [
+            [('Sales:', report['sales_count']),
+             ('Items sold:', report['items_sold']),
+             ('Gross sales:', f"KES {money(report['gross_sales'])}"),
+             ('Discounts:', f"KES {money(report['discount_amount'])}"),
+             ('Tax:', f"KES {money(report['tax_amount'])}"),
+             (f"Refunds ({report['refunds_count']}):", f"-KES {money(report['refund_amount'])}"),
+             ('Net sales:', f"KES {money(report['net_sales'])}")],
+            [('Cash sales:', f"KES {money(report['cash_sales'])}"),
+             (f"MPesa sales ({report['mpesa_count']}):", f"KES {money(report['mpesa_sales'])}"),
+             ('Cash refunds:', f"-KES {money(report['cash_refunds'])}"),
+             ('MPesa refunds:', f"-KES {money(report['mpesa_refunds'])}")],
+            [('Opening float:', f"KES {money(report['opening_float'])}"),
+             ('Expected cash:', f"KES {money(report['expected_cash'])}")],
+        ]
+        if report['counted_cash'] is not None:
+            sections[-1].append(('Counted cash:', f"KES {money(report['counted_cash'])}"))
+            sections[-1].append(('Variance:', f"KES {report['cash_variance']:+,.2f}"))
+        return title, info, sections
+
+    def render_z_report_escpos(self, report):
+        """Render a shift's Z-report as an ESC/POS byte stream"""
+        title, info, sections = self.z_report_sections(report)
+        lines = list(info)
+        for section in sections:
+            lines.append(self.rule)
+            lines.extend(self.pair(label, value) for label, value in section)
+        if report['notes']:
+            lines.append(self.rule)
+            lines.append(f"Notes: {report['notes']}")
+        lines.append(self.rule)
+
+        return b''.join([
+            self.escpos_header,
+            ESC_ALIGN_CENTER, ESC_BOLD_ON, self.encode(title) + b'\n', ESC_BOLD_OFF, ESC_ALIGN_LEFT,
+            self.encode('\n'.join(lines) + '\n'),
+            self.escpos_footer,
+        ])
+
+    def render_z_report_html(self, report):
+        """Render a shift's Z-report as a compact, self-printing HTML page"""
+        title, info, sections = self.z_report_sections(report)
+        parts = [self.html_header, f"<div class=\"c b\">{title}</div>"]
+        parts.extend(f"<div>{escape(line)}</div>" for line in info)
+        for section in sections:
+            parts.append("<hr><table>")
+            parts.extend(f"<tr><td>{escape(label)}</td><td class=\"r\">{escape(value)}</td></tr>"
+                         for label, value in section)
+            parts.append("</table>")
+        if report['notes']:
+            parts.append(f"<hr><div>Notes: {escape(report['notes'])}</div>")
+        parts.append(self.html_footer)
+        return ''.join(parts)
+
+
+def get_receipt_layout(shop, width='80mm'):
+    """Get the compiled layout for a shop, rebuilt when its receipt details change"""
+    settings = shop.settings or {}
+    contact_lines = [line for line in (
+        shop.address,
+        f"Phone: {shop.phone}" if shop.phone else None,
+        f"Email: {shop.email}" if shop.email else None,
+    ) if line]
+    key = (shop.id, width)
+    fingerprint = (shop.name, tuple(contact_lines),
+                   settings.get('receipt_header', ''), settings.get('receipt_footer', ''))
+
+    cached = _layout_cache.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    layout = ReceiptLayout(shop.name, contact_lines, fingerprint[2], fingerprint[3], width)
+    with _layout_lock:
+        _layout_cache[key] = (fingerprint, layout)
+    return layout
+
+
+def get_sale_snapshot(sale_id, shop_id):
+    """Load everything a receipt needs in one joined query (None if not found)"""
+    from app import db
+    from models import Product, Sale, SaleItem, User
+
+    rows = db.session.query(
+        Sale.receipt_number, Sale.created_at, Sale.subtotal, Sale.tax_amount,
+        Sale.discount_amount, Sale.total_amount, Sale.payment_method,
+        Sale.mpesa_receipt, Sale.customer_name, User.username,
+        Product.name, SaleItem.quantity, SaleItem.unit_price, SaleItem.line_total
+    ).join(User, User.id == Sale.cashier_id
+    ).outerjoin(SaleItem, SaleItem.sale_id == Sale.id
+    ).outerjoin(Product, Product.id == SaleItem.product_id
+    ).filter(Sale.id == sale_id, Sale.shop_id == shop_id
+    ).order_by(SaleItem.id).all()
+
+    if not rows:
+        return None
+
+    first = rows[0]
+    return {
+        'receipt_number': first[0],
+        'created_at': first[1],
+        'subtotal': first[2],
+        'tax_amount': first[3],
+        'discount_amount': first[4],
+        'total_amount': first[5],
+        'payment_method': first[6],
+        'mpesa_receipt': first[7],
+        'customer_name': first[8],
+        'cashier': first[9],
+        'items': [(row[10] or 'Item', row[11], row[12], row[13]) for row in rows if row[11] is not None],
+    }
+
+
+def get_printer_settings():
+    """Get network receipt printer configuration from the environment"""
+    return {
+        'host': os.environ.get('RECEIPT_PRINTER_HOST', ''),
+        'port': int(os.environ.get('RECEIPT_PRINTER_PORT', '9100')),
+        'timeout': float(os.environ.get('RECEIPT_PRINTER_TIMEOUT', '5')),
+    }
+
+
+def send_to_printer(data):
+    """Send raw ESC/POS bytes to the configured network (port 9100) thermal printer.
+
+    The address only ever comes from RECEIPT_PRINTER_*, never from a request,
+    so tills cannot make the server connect to arbitrary hosts.
+    """
+    settings = get_printer_settings()
+    host, port = settings['host'], settings['port']
+
+    if not host:
+        raise ValueError("No receipt printer configured")
+
+    with socket.create_connection((host, port), timeout=settings['timeout']) as conn:
+        conn.sendall(data)
+
+    logging.info(f"Sent {len(data)} byte receipt to printer {host}:{port}")
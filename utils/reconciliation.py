@@ -0,0 +1,472 @@
+"""
+M-Pesa Statement Reconciliation
+Matches Safaricom statement exports against recorded M-Pesa transactions and
+unpaid M-Pesa sales with in-memory hash joins: first on the M-Pesa receipt,
+then on (till, amount) within a time window. Certain matches are settled with
+bulk updates; everything else goes to an exceptions report.
+"""
+
+import csv
+import io
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, select, text, update
+from utils.customers import normalize_msisdn, record_customer_sales, record_payers
+from utils.database import copy_from_file, is_postgres, upsert_insert
+from utils.pricing import from_cents, local_time, to_cents
+from utils.sales import REVENUE_STATUSES
+
+# Rows per IN (...) list when looking up by transaction or sale id
+LOOKUP_CHUNK = 5000
+
+# Statement column names (after normalize_header) -> our field names
+HEADER_ALIASES = {
+    'receipt_no': 'transaction_id',
+    'receipt_no.': 'transaction_id',
+    'receipt': 'transaction_id',
+    'transaction_id': 'transaction_id',
+    'trans_id': 'transaction_id',
+    'completion_time': 'time',
+    'transaction_time': 'time',
+    'trans_time': 'time',
+    'paid_in': 'paid_in',
+    'amount': 'paid_in',
+    'transaction_status': 'status',
+    'status': 'status',
+    'other_party_info': 'party',
+    'other_party': 'party',
+    'till_number': 'till_number',
+    'till': 'till_number',
+    'till_no': 'till_number',
+    'store_number': 'till_number',
+    'short_code': 'till_number',
+    'business_short_code': 'till_number',
+}
+
+# Statement times: 2024-05-01 13:45:07, 01-05-2024 13:45:07, 01/05/2024 13:45 or 20240501134507;
+# parsed with one regex, as strptime dominates loading a month of statements
+TIME_PATTERN = re.compile(r'(\d{1,4})[-/](\d{1,2})[-/](\d{1,4})[ T](\d{1,2}):(\d{2})(?::(\d{2}))?'
+                          r'|(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})(\d{2})$')
+
+STAGING_COLUMNS = ['transaction_id', 'is_new', 'bill_ref_number', 'amount', 'msisdn', 'first_name', 'middle_name',
+                   'last_name', 'transaction_time', 'shop_id', 'sale_id', 'customer_name']
+
+EXCEPTION_FIELDS = ['kind', 'transaction_id', 'till_number', 'shop_id', 'sale_id', 'amount', 'time', 'detail']
+
+# Exception kinds in the report
+UNKNOWN_TILL = 'unknown_till'  # statement credit for a till no shop uses
+AMOUNT_MISMATCH = 'amount_mismatch'  # recorded amount differs from the statement
+NOT_ON_STATEMENT = 'not_on_statement'  # recorded payment the statement doesn't show
+AMBIGUOUS = 'ambiguous'  # several sales (or payments) fit; settle by hand
+PAYMENT_UNMATCHED = 'payment_unmatched'  # paid in, no unpaid sale fits
+SALE_UNPAID = 'sale_unpaid'  # M-Pesa sale with no payment on the statement
+INVALID_LINE = 'invalid_line'
+
+
+def get_reconciliation_settings():
+    """Get reconciliation configuration from the environment"""
+    return {
+        'window_minutes': int(os.environ.get('MPESA_RECONCILE_WINDOW_MINUTES', '10')),
+    }
+
+
+def normalize_header(value):
+    key = str(value or '').strip().lower().replace(' ', '_').replace('-', '_')
+    return HEADER_ALIASES.get(key, key)
+
+
+def parse_time(value):
+    match = TIME_PATTERN.match(str(value).strip())
+    if match is None:
+        raise ValueError(f"unrecognised time {value!r}")
+    if match.group(7):
+        return datetime(*map(int, match.groups()[6:]))
+    first, month, last, hour, minute, second = match.groups()[:6]
+    year, day = (first, last) if len(first) == 4 else (last, first)
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0))
+    except ValueError:
+        raise ValueError(f"unrecognised time {value!r}")
+
+
+def parse_party(value):
+    """Split 'Other Party Info' ('2547XXXXX123 - JANE DOE') into phone and name"""
+    phone, _, name = str(value or '').partition(' - ')
+    return phone.strip()[:15], name.strip()[:100]
+
+
+def iter_statement_lines(path):
+    """Yield (line number, row dict) from a statement CSV, skipping the export's preamble"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = None
+        for line, row in enumerate(reader, start=1):
+            if header is None:
+                names = [normalize_header(value) for value in row]
+                if 'transaction_id' in names and 'paid_in' in names:
+                    header = names
+                continue
+            if any(value.strip() for value in row):
+                yield line, dict(zip(header, row))
+        if header is None:
+            raise ValueError(f"{os.path.basename(path)}: no statement header row (Receipt No., Paid In)")
+
+
+def parse_statement_line(row, till_number=None):
+    """A completed credit as (transaction_id, till_number, cents, time, phone, name); None for other rows"""
+    status = str(row.get('status', 'completed')).strip().lower()
+    paid_in = str(row.get('paid_in', '')).strip().replace(',', '')
+    if status not in ('', 'completed') or not paid_in:
+        return None
+    try:
+        cents = to_cents(paid_in)
+    except ArithmeticError:
+        raise ValueError(f"invalid Paid In {paid_in!r}")
+    if cents <= 0:
+        return None
+
+    transaction_id = str(row.get('transaction_id', '')).strip().upper()
+    if not transaction_id:
+        raise ValueError("missing receipt number")
+    phone, name = parse_party(row.get('party'))
+    return (transaction_id, str(row.get('till_number') or till_number or '').strip(), cents,
+            parse_time(row.get('time', '')), phone, name)
+
+
+class Reconciliation:
+    """One reconciliation run over one or more statement files.
+
+    Times on statements and in mpesa_transactions are the shop's local time;
+    sale times are UTC and are converted with SHOP_TIME_ZONE.
+    """
+
+    def __init__(self, window_minutes=None, dry_run=False):
+        self.window = timedelta(minutes=window_minutes or get_reconciliation_settings()['window_minutes'])
+        self.dry_run = dry_run
+        self.credits = {}  # transaction_id -> statement credit
+        self.exceptions = []
+        self.counts = {'statement_lines': 0, 'credits': 0, 'matched': 0, 'recorded': 0, 'settled': 0}
+
+    def add_exception(self, kind, transaction_id=None, till_number=None, shop_id=None, sale_id=None,
+                      cents=None, time=None, detail=''):
+        if till_number is None and transaction_id in self.credits:
+            till_number = self.credits[transaction_id][1]
+        self.exceptions.append({
+            'kind': kind, 'transaction_id': transaction_id, 'till_number': till_number, 'shop_id': shop_id,
+            'sale_id': sale_id, 'amount': f"{from_cents(cents)}" if cents is not None else None,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S') if time else None, 'detail': detail,
+        })
+
+    def load(self, path, till_number=None):
+        """Read a statement file; till_number applies to files without a till column"""
+        for line, row in iter_statement_lines(path):
+            self.counts['statement_lines'] += 1
+            try:
+                credit = parse_statement_line(row, till_number)
+            except ValueError as e:
+                self.add_exception(INVALID_LINE, detail=f"{os.path.basename(path)} line {line}: {e}")
+                continue
+            if credit is not None:
+                # Overlapping exports repeat lines; the receipt number identifies them
+                self.credits.setdefault(credit[0], credit)
+        self.counts['credits'] = len(self.credits)
+
+    def run(self):
+        """Match the loaded statements, settle certain matches and collect exceptions"""
+        from app import db
+
+        if not self.credits:
+            return self.summary()
+
+        times = [credit[3] for credit in self.credits.values()]
+        self.period = (min(times), max(times))
+        self.tills = self.load_tills()
+
+        payments = self.match_receipts()
+        sales = self.load_unpaid_sales()
+        settlements = self.match_sales(payments, sales)
+        if self.dry_run:
+            self.counts['recorded'] = len(self.new_rows)
+            self.counts['settled'] = len(settlements)
+            db.session.rollback()
+        else:
+            if is_postgres():
+                taken = self.write_postgres(settlements)
+            else:
+                taken = self.write_executemany(settlements)
+            for payment, sale in settlements:
+                if payment[0] in taken:
+                    self.add_exception(PAYMENT_UNMATCHED, payment[0], None, payment[1], sale[0], payment[2],
+                                       payment[3], 'sale was settled by another payment during reconciliation')
+            self.record_customers([(payment, sale) for payment, sale in settlements if payment[0] not in taken])
+            db.session.commit()
+
+        logging.info(f"M-Pesa reconciliation: {self.summary()}")
+        return self.summary()
+
+    def summary(self):
+        kinds = {}
+        for exception in self.exceptions:
+            kinds[exception['kind']] = kinds.get(exception['kind'], 0) + 1
+        return dict(self.counts, exceptions=kinds)
+
+    def load_tills(self):
+        from app import db
+        from models import Shop
+
+        return {till: shop_id for shop_id, till in db.session.execute(
+            select(Shop.id, Shop.till_number).where(Shop.till_number.isnot(None)))}
+
+    def load_recorded(self):
+        """Recorded sale payments in the statement period (plus the window), and any the statement names"""
+        from app import db
+        from models import MpesaTransaction
+
+        columns = (MpesaTransaction.transaction_id, MpesaTransaction.amount, MpesaTransaction.shop_id,
+                   MpesaTransaction.sale_id, MpesaTransaction.is_processed, MpesaTransaction.msisdn,
+                   MpesaTransaction.transaction_time)
+        recorded = {row.transaction_id: row for row in db.session.execute(
+            select(*columns).where(MpesaTransaction.transaction_type == 'sale',
+                                   MpesaTransaction.transaction_time >= self.period[0] - self.window,
+                                   MpesaTransaction.transaction_time <= self.period[1] + self.window))}
+
+        # Recorded with a time outside the period (clock skew, late callbacks)
+        missing = [transaction_id for transaction_id in self.credits if transaction_id not in recorded]
+        for start in range(0, len(missing), LOOKUP_CHUNK):
+            for row in db.session.execute(select(*columns).where(
+                    MpesaTransaction.transaction_id.in_(missing[start:start + LOOKUP_CHUNK]))):
+                recorded[row.transaction_id] = row
+        return recorded
+
+    def match_receipts(self):
+        """Pass 1: join statement credits to recorded transactions on the receipt number.
+
+        Collects credits whose callback never arrived in self.new_rows, and
+        returns the payments still waiting for a sale as (transaction_id,
+        shop_id, cents, time, phone, name).
+        """
+        recorded = self.load_recorded()
+        payments = []
+        self.new_rows = []
+        self.statement_shops = set()
+        now = datetime.utcnow()
+
+        for transaction_id, till, cents, time, phone, name in self.credits.values():
+            row = recorded.get(transaction_id)
+            if row is None:
+                shop_id = self.tills.get(till)
+                if shop_id is None:
+                    self.add_exception(UNKNOWN_TILL, transaction_id, till, cents=cents, time=time,
+                                       detail='not recorded and the till is not assigned to a shop')
+                    continue
+                self.statement_shops.add(shop_id)
+                first, _, rest = name.partition(' ')
+                middle, _, last = rest.rpartition(' ')
+                self.new_rows.append({'transaction_type': 'sale', 'transaction_id': transaction_id,
+                                      'bill_ref_number': till, 'amount': from_cents(cents),
+                                      'msisdn': normalize_msisdn(phone) or phone,
+                                      'first_name': first or None, 'middle_name': middle or None, 'last_name': last or None,
+                                      'transaction_time': time, 'shop_id': shop_id, 'is_processed': False,
+                                      'created_at': now})
+                payments.append((transaction_id, shop_id, cents, time, phone, name))
+                continue
+
+            if row.shop_id is not None:
+                self.statement_shops.add(row.shop_id)
+            if to_cents(row.amount) != cents:
+                self.add_exception(AMOUNT_MISMATCH, transaction_id, till, row.shop_id, row.sale_id, cents, time,
+                                   f"recorded {row.amount}")
+                continue
+            self.counts['matched'] += 1
+            if not row.is_processed and row.sale_id is None and row.shop_id is not None:
+                payments.append((transaction_id, row.shop_id, cents, time, row.msisdn, name))
+
+        # Callbacks we recorded that the statement doesn't show, for the shops and span it covers
+        for transaction_id, row in recorded.items():
+            if (transaction_id not in self.credits and row.shop_id in self.statement_shops
+                    and self.period[0] <= row.transaction_time <= self.period[1]):
+                self.add_exception(NOT_ON_STATEMENT, transaction_id, None, row.shop_id, row.sale_id,
+                                   to_cents(row.amount), row.transaction_time)
+        return payments
+
+    def load_unpaid_sales(self):
+        """M-Pesa sales without a receipt in the statement period, as (id, shop_id, cents, local time)"""
+        from app import db
+        from models import Sale
+
+        # Sale times are UTC; the shop's zone has a fixed offset (no DST in East Africa)
+        self.offset = offset = local_time(self.period[0]) - self.period[0]
+        start = self.period[0] - offset - self.window
+        end = self.period[1] - offset + self.window
+        shop_ids = list(self.statement_shops)
+        # A partially refunded sale was still paid its full total, which is what the statement shows
+        sales = []
+        for first in range(0, len(shop_ids), LOOKUP_CHUNK):
+            sales.extend(
+                (sale_id, shop_id, to_cents(total), created_at + offset)
+                for sale_id, shop_id, total, created_at in db.session.execute(
+                    select(Sale.id, Sale.shop_id, Sale.total_amount, Sale.created_at)
+                    .where(Sale.shop_id.in_(shop_ids[first:first + LOOKUP_CHUNK]),
+                           Sale.created_at >= start, Sale.created_at <= end,
+                           Sale.payment_method == 'mpesa', Sale.mpesa_receipt.is_(None),
+                           Sale.status.in_(REVENUE_STATUSES))))
+        return sales
+
+    def match_sales(self, payments, sales):
+        """Pass 2: join waiting payments to unpaid sales on (shop, amount) within the time window.
+
+        A match is settled only when the payment fits exactly one sale and
+        that sale fits no other payment.
+        """
+        buckets = {}
+        for sale in sales:
+            buckets.setdefault((sale[1], sale[2]), []).append(sale)
+
+        sale_payments = {}
+        candidates = []
+        for payment in payments:
+            fits = [sale for sale in buckets.get((payment[1], payment[2]), ())
+                    if abs(payment[3] - sale[3]) <= self.window]
+            candidates.append((payment, fits))
+            for sale in fits:
+                sale_payments.setdefault(sale[0], []).append(payment[0])
+
+        settlements = []
+        matched_sales = set()
+        for payment, fits in candidates:
+            transaction_id, shop_id, cents, time = payment[:4]
+            if not fits:
+                self.add_exception(PAYMENT_UNMATCHED, transaction_id, None, shop_id, None, cents, time)
+            elif len(fits) > 1 or len(sale_payments[fits[0][0]]) > 1:
+                sale_ids = sorted({sale[0] for sale in fits})
+                others = sorted(set().union(*(sale_payments[sale_id] for sale_id in sale_ids)) - {transaction_id})
+                self.add_exception(AMBIGUOUS, transaction_id, None, shop_id, None, cents, time,
+                                   f"sales {', '.join(map(str, sale_ids))}"
+                                   + (f"; also fits {', '.join(others)}" if others else ''))
+                matched_sales.update(sale_ids)
+            else:
+                settlements.append((payment, fits[0]))
+                matched_sales.add(fits[0][0])
+
+        # Unpaid sales old enough that their payment should be on the statement
+        cutoff = self.period[1] - self.window
+        for sale_id, shop_id, cents, time in sales:
+            if sale_id not in matched_sales and self.period[0] <= time <= cutoff:
+                self.add_exception(SALE_UNPAID, None, None, shop_id, sale_id, cents, time)
+        return settlements
+
+    def write_executemany(self, settlements):
+        """Record missing callbacks and settle matches with one executemany per statement.
+
+        Returns the payments whose sale was settled by someone else meanwhile.
+        """
+        from app import db
+        from models import MpesaTransaction, Sale
+
+        transactions = MpesaTransaction.__table__
+        if self.new_rows:
+            # A callback arriving during the run already recorded its payment
+            self.counts['recorded'] = len(db.session.execute(
+                upsert_insert(transactions).on_conflict_do_nothing(index_elements=['transaction_id'])
+                .returning(transactions.c.id), self.new_rows).all())
+        if not settlements:
+            return set()
+
+        sales = Sale.__table__
+        db.session.execute(
+            update(sales).where(sales.c.id == bindparam('sale_id'), sales.c.mpesa_receipt.is_(None))
+            .values(mpesa_receipt=bindparam('receipt'), customer_phone=bindparam('phone'),
+                    customer_name=bindparam('name')),
+            [{'sale_id': sale[0], 'receipt': payment[0], 'phone': payment[4], 'name': payment[5] or None}
+             for payment, sale in settlements]
+        )
+
+        # A sale confirmed at the till meanwhile keeps its own receipt; only mark payments that took
+        receipts = {}
+        sale_ids = [sale[0] for _, sale in settlements]
+        for start in range(0, len(sale_ids), LOOKUP_CHUNK):
+            receipts.update(db.session.execute(
+                select(Sale.id, Sale.mpesa_receipt).where(Sale.id.in_(sale_ids[start:start + LOOKUP_CHUNK]))).all())
+        settled = [(payment, sale) for payment, sale in settlements if receipts.get(sale[0]) == payment[0]]
+
+        if settled:
+            db.session.execute(
+                update(transactions).where(transactions.c.transaction_id == bindparam('receipt'))
+                .values(sale_id=bindparam('sale_id'), is_processed=True),
+                [{'receipt': payment[0], 'sale_id': sale[0]} for payment, sale in settled]
+            )
+        self.counts['settled'] = len(settled)
+        return {payment[0] for payment, sale in settlements if receipts.get(sale[0]) != payment[0]}
+
+    def write_postgres(self, settlements):
+        """Record missing callbacks and settle matches via COPY into a staging table and set-based statements.
+
+        Returns the payments whose sale was settled by someone else meanwhile.
+        """
+        from app import db
+
+        conn = db.session.connection()
+        conn.execute(text(
+            "CREATE TEMP TABLE IF NOT EXISTS mpesa_reconcile_staging ("
+            "transaction_id VARCHAR(100) PRIMARY KEY, is_new BOOLEAN, bill_ref_number VARCHAR(100), "
+            "amount NUMERIC(10, 2), msisdn VARCHAR(15), first_name VARCHAR(100), middle_name VARCHAR(100), "
+            "last_name VARCHAR(100), transaction_time TIMESTAMP, shop_id INTEGER, sale_id INTEGER, "
+            "customer_name VARCHAR(100), settled BOOLEAN DEFAULT false"
+            ") ON COMMIT DROP"
+        ))
+
+        sale_ids = {payment[0]: (sale[0], payment[5]) for payment, sale in settlements}
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in self.new_rows:
+            sale_id, name = sale_ids.pop(row['transaction_id'], ('', ''))
+            writer.writerow([row['transaction_id'], 't', row['bill_ref_number'], row['amount'], row['msisdn'],
+                             row['first_name'], row['middle_name'], row['last_name'], row['transaction_time'],
+                             row['shop_id'], sale_id, name])
+        for transaction_id, (sale_id, name) in sale_ids.items():
+            writer.writerow([transaction_id, 'f', '', '', '', '', '', '', '', '', sale_id, name])
+        copy_from_file(conn.connection, f"COPY mpesa_reconcile_staging ({', '.join(STAGING_COLUMNS)}) "
+                                        "FROM STDIN WITH (FORMAT csv)", io.BytesIO(buffer.getvalue().encode('utf-8')))
+
+        # A callback arriving during the run already recorded its payment
+        self.counts['recorded'] = conn.execute(text(
+            "WITH recorded AS ("
+            "  INSERT INTO mpesa_transactions (transaction_type, transaction_id, bill_ref_number, amount, msisdn, "
+            "    first_name, middle_name, last_name, transaction_time, shop_id, is_processed, created_at) "
+            "  SELECT 'sale', transaction_id, bill_ref_number, amount, msisdn, first_name, middle_name, last_name, "
+            "    transaction_time, shop_id, false, :now FROM mpesa_reconcile_staging WHERE is_new "
+            "  ON CONFLICT (transaction_id) DO NOTHING RETURNING 1"
+            ") SELECT count(*) FROM recorded"
+        ), {'now': datetime.utcnow()}).scalar()
+
+        # A sale confirmed at the till meanwhile keeps its own receipt; only mark payments that took
+        conn.execute(text(
+            "WITH settled AS ("
+            "  UPDATE sales s SET mpesa_receipt = st.transaction_id, customer_phone = m.msisdn, "
+            "    customer_name = NULLIF(st.customer_name, '') "
+            "  FROM mpesa_reconcile_staging st JOIN mpesa_transactions m ON m.transaction_id = st.transaction_id "
+            "  WHERE s.id = st.sale_id AND s.mpesa_receipt IS NULL RETURNING s.id"
+            ") UPDATE mpesa_reconcile_staging st SET settled = true FROM settled WHERE st.sale_id = settled.id"
+        ))
+        self.counts['settled'] = conn.execute(text(
+            "UPDATE mpesa_transactions m SET sale_id = st.sale_id, is_processed = true "
+            "FROM mpesa_reconcile_staging st WHERE m.transaction_id = st.transaction_id AND st.settled"
+        )).rowcount
+        return set(conn.execute(text(
+            "SELECT transaction_id FROM mpesa_reconcile_staging WHERE sale_id IS NOT NULL AND NOT settled"
+        )).scalars())
+
+    def record_customers(self, settled):
+        """Link the settled sales to their payers' customer records and add the other new payers to the directory"""
+        settled_ids = {payment[0] for payment, _ in settled}
+        record_payers((row['shop_id'], row['msisdn'], self.credits[row['transaction_id']][5], row['transaction_time'])
+                      for row in self.new_rows if row['transaction_id'] not in settled_ids)
+        record_customer_sales([(sale[0], sale[1], payment[4], payment[5], from_cents(sale[2]), sale[3] - self.offset)
+                               for payment, sale in settled])
+
+    def write_exceptions(self, f):
+        writer = csv.DictWriter(f, fieldnames=EXCEPTION_FIELDS)
+        writer.writeheader()
+        writer.writerows(self.exceptions)
@@ -140,33 +140,50 @@ def generate_product_report_pdf(products_data, shop_name):
     buffer.seek(0)
     return buffer
 
-def generate_sales_csv(sales_data):
-    """Generate CSV sales report"""
+SALES_CSV_HEADER = ['Receipt Number', 'Date', 'Cashier', 'Customer Phone', 'Customer Name',
+                    'Subtotal', 'Tax', 'Total', 'Payment Method', 'MPesa Receipt', 'Status']
+
+def iter_sales_csv(rows, batch_size=500):
+    """Yield a CSV sales report in chunks of batch_size rows, for streamed responses.
+
+    rows are (receipt_number, created_at, cashier, customer_phone, customer_name,
+    subtotal, tax_amount, total_amount, payment_method, mpesa_receipt, status)
+    """
     output = io.StringIO()
     writer = csv.writer(output)
+    writer.writerow(SALES_CSV_HEADER)
     
-    # Header
-    writer.writerow(['Receipt Number', 'Date', 'Cashier', 'Customer Phone', 'Customer Name', 
-                     'Subtotal', 'Tax', 'Total', 'Payment Method', 'MPesa Receipt', 'Status'])
-    
-    # Data
-    for sale in sales_data:
+    for count, row in enumerate(rows, 1):
+        (receipt_number, created_at, cashier, phone, name, subtotal, tax, total,
+         payment_method, mpesa_receipt, status) = row
         writer.writerow([
-            sale.receipt_number,
-            sale.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            sale.cashier_user.username,
-            sale.customer_phone or '',
-            sale.customer_name or '',
-            float(sale.subtotal),
-            float(sale.tax_amount),
-            float(sale.total_amount),
-            sale.payment_method,
-            sale.mpesa_receipt or '',
-            sale.status
+            receipt_number,
+            created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            cashier,
+            phone or '',
+            name or '',
+            float(subtotal),
+            float(tax),
+            float(total),
+            payment_method,
+            mpesa_receipt or '',
+            status
         ])
+        if count % batch_size == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
     
-    output.seek(0)
-    return output.getvalue()
+    yield output.getvalue()
+
+def generate_sales_csv(sales_data):
+    """Generate CSV sales report"""
+    return ''.join(iter_sales_csv(
+        (sale.receipt_number, sale.created_at, sale.cashier_user.username, sale.customer_phone,
+         sale.customer_name, sale.subtotal, sale.tax_amount, sale.total_amount, sale.payment_method,
+         sale.mpesa_receipt, sale.status)
+        for sale in sales_data
+    ))
 
 def generate_products_csv(products_data):
     """Generate CSV products report"""
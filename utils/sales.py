@@ -0,0 +1,288 @@
+"""
+Sales Utilities
+Daily sales rollups and the set-based refund engine
+"""
+
+import logging
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from sqlalchemy import case, delete, func, insert, select, update
+from utils.database import upsert_insert
+
+CENTS = Decimal('0.01')
+
+# Sales that count towards revenue, net of their refunds (a refunded sale nets to zero)
+REVENUE_STATUSES = ('completed', 'partially_refunded')
+
+
+def to_money(value):
+    return Decimal(str(value or 0)).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def net_sale_amount():
+    """SQL expression for a sale's total less the refunds recorded against it"""
+    from models import Refund, Sale
+
+    refunded = select(func.coalesce(func.sum(Refund.amount), 0)).where(Refund.sale_id == Sale.id).scalar_subquery()
+    # Only partially refunded sales have refunds to subtract
+    return case((Sale.status == 'partially_refunded', Sale.total_amount - refunded), else_=Sale.total_amount)
+
+
+def net_item_quantity():
+    """SQL expression for a sale line's quantity less the refunded quantity"""
+    from models import SaleItem
+
+    return SaleItem.quantity - func.coalesce(SaleItem.refunded_quantity, 0)
+
+
+def net_item_revenue():
+    """SQL expression for a sale line's discounted total, pro rata to the quantity not refunded"""
+    from models import SaleItem
+
+    line_total = SaleItem.line_total - func.coalesce(SaleItem.discount_amount, 0)
+    return case((func.coalesce(SaleItem.refunded_quantity, 0) == 0, line_total),
+                else_=line_total * net_item_quantity() / func.nullif(SaleItem.quantity, 0))
+
+
+def record_daily_sales(shop_id, day, sales_count=0, items_sold=0, gross_sales=0,
+                       tax_amount=0, refunds_count=0, refund_amount=0, cash_sales=0,
+                       mpesa_sales=0, mpesa_count=0, active_tills=0):
+    """Add to a shop's daily rollup in the current transaction (atomic increment)"""
+    from app import db
+    from models import ShopDailySales
+
+    table = ShopDailySales.__table__
+    increments = {
+        'sales_count': sales_count,
+        'items_sold': items_sold,
+        'gross_sales': to_money(gross_sales),
+        'tax_amount': to_money(tax_amount),
+        'refunds_count': refunds_count,
+        'refund_amount': to_money(refund_amount),
+        'cash_sales': to_money(cash_sales),
+        'mpesa_sales': to_money(mpesa_sales),
+        'mpesa_count': mpesa_count,
+        'active_tills': active_tills,
+    }
+
+    stmt = upsert_insert(table).values(shop_id=shop_id, date=day, **increments)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['shop_id', 'date'],
+        # Columns added after a rollup row was written are NULL until a rebuild
+        set_={column: func.coalesce(table.c[column], 0) + stmt.excluded[column] for column in increments}
+    )
+    db.session.execute(stmt)
+
+
+def record_sale(sale, items_sold):
+    """Add a newly created sale to its shop's daily rollup"""
+    from app import db
+    from models import ShopDailyTill
+
+    day = sale.created_at.date()
+    new_till = db.session.execute(
+        upsert_insert(ShopDailyTill.__table__)
+        .values(shop_id=sale.shop_id, date=day, cashier_id=sale.cashier_id)
+        .on_conflict_do_nothing()
+    ).rowcount
+
+    is_mpesa = sale.payment_method == 'mpesa'
+    record_daily_sales(sale.shop_id, day, sales_count=1, items_sold=items_sold,
+                       gross_sales=sale.total_amount, tax_amount=sale.tax_amount,
+                       cash_sales=sale.total_amount if sale.payment_method == 'cash' else 0,
+                       mpesa_sales=sale.total_amount if is_mpesa else 0,
+                       mpesa_count=1 if is_mpesa else 0, active_tills=1 if new_till else 0)
+
+
+def refund_sale_items(sale, reason, user_id, quantities=None):
+    """Refund a sale, fully or by line.
+
+    quantities maps sale item id -> quantity to refund; None refunds everything
+    not yet refunded. Stock, refunded quantities, stock movements, the refund
+    record and the daily rollup are each written with a single statement
+    however many lines are refunded, all in the caller's transaction.
+    Raises ValueError for invalid quantities.
+    """
+    from app import db
+    from models import Product, Refund, RefundItem, Sale, SaleItem, StockMovement
+    from utils.customers import record_refund_points
+    from utils.inventory import track_inventory
+    from utils.shifts import record_shift_refund
+
+    if sale.status not in ('completed', 'partially_refunded'):
+        raise ValueError('Can only refund completed sales')
+
+    # Lock the sale so concurrent refunds cannot both refund the same lines
+    db.session.execute(select(Sale.id).where(Sale.id == sale.id).with_for_update())
+
+    lines = db.session.execute(
+        select(SaleItem.id, SaleItem.product_id, SaleItem.quantity,
+               func.coalesce(SaleItem.refunded_quantity, 0),
+               SaleItem.line_total - func.coalesce(SaleItem.discount_amount, 0))
+        .where(SaleItem.sale_id == sale.id)
+    ).all()
+
+    refund_lines = []
+    fully_refunded = True
+    for item_id, product_id, quantity, refunded, line_total in lines:
+        remaining = quantity - refunded
+        requested = remaining if quantities is None else quantities.get(item_id, 0)
+        if requested < 0 or requested > remaining:
+            raise ValueError(f'Invalid refund quantity for item {item_id}: {remaining} remaining')
+        if requested:
+            amount = to_money(Decimal(line_total) * requested / quantity)
+            refund_lines.append((item_id, product_id, requested, amount))
+        if requested != remaining:
+            fully_refunded = False
+
+    if quantities and set(quantities) - {line[0] for line in lines}:
+        raise ValueError('Refund includes items that are not part of this sale')
+    if not refund_lines:
+        raise ValueError('Nothing to refund')
+
+    # Line amounts are net of promotions; refund their tax share along with them
+    subtotal = Decimal(sale.subtotal or 0) - Decimal(sale.discount_amount or 0)
+    ratio = Decimal(sale.total_amount) / subtotal if subtotal else Decimal(1)
+    if fully_refunded:
+        already_refunded = db.session.execute(
+            select(func.coalesce(func.sum(Refund.amount), 0)).where(Refund.sale_id == sale.id)
+        ).scalar()
+        amount = to_money(Decimal(sale.total_amount) - Decimal(already_refunded))
+    else:
+        amount = to_money(sum(line[3] for line in refund_lines) * ratio)
+
+    now = datetime.utcnow()
+    refunded_by_item = {item_id: quantity for item_id, _, quantity, _ in refund_lines}
+    restock = {}
+    for _, product_id, quantity, _ in refund_lines:
+        restock[product_id] = restock.get(product_id, 0) + quantity
+
+    db.session.execute(
+        update(SaleItem.__table__)
+        .where(SaleItem.id.in_(refunded_by_item))
+        .values(refunded_quantity=func.coalesce(SaleItem.refunded_quantity, 0)
+                + case(refunded_by_item, value=SaleItem.id))
+    )
+    with track_inventory(Product.id.in_(restock)):
+        db.session.execute(
+            update(Product.__table__)
+            .where(Product.id.in_(restock))
+            .values(stock_quantity=Product.stock_quantity + case(restock, value=Product.id), updated_at=now)
+        )
+    db.session.execute(insert(StockMovement), [{
+        'product_id': product_id,
+        'movement_type': 'in',
+        'quantity': quantity,
+        'reference': f'refund_{sale.receipt_number}',
+        'notes': f'Refund: {reason}',
+        'created_by': user_id,
+        'created_at': now,
+    } for product_id, quantity in restock.items()])
+
+    refund = Refund(shop_id=sale.shop_id, sale_id=sale.id, amount=amount, reason=reason,
+                    created_by=user_id, shift_id=record_shift_refund(sale, amount, user_id),
+                    created_at=now)
+    db.session.add(refund)
+    db.session.flush()
+    db.session.execute(insert(RefundItem), [{
+        'refund_id': refund.id,
+        'sale_item_id': item_id,
+        'product_id': product_id,
+        'quantity': quantity,
+        'amount': line_amount,
+    } for item_id, product_id, quantity, line_amount in refund_lines])
+
+    record_daily_sales(sale.shop_id, now.date(), refunds_count=1, refund_amount=amount)
+    record_refund_points(sale, amount, user_id)
+
+    sale.status = 'refunded' if fully_refunded else 'partially_refunded'
+    sale.refund_reason = reason
+    return refund
+
+
+def rebuild_daily_sales(shop_id=None):
+    """Recompute the daily rollups from sales and refunds (all shops by default)"""
+    from app import db
+    from models import Refund, Sale, SaleItem, ShopDailySales, ShopDailyTill
+
+    totals = {}
+
+    def bucket_date(day):
+        return datetime.strptime(day, '%Y-%m-%d').date() if isinstance(day, str) else day
+
+    def bucket(row_shop_id, day):
+        key = (row_shop_id, bucket_date(day))
+        if key not in totals:
+            totals[key] = {'sales_count': 0, 'items_sold': 0, 'gross_sales': Decimal(0),
+                           'tax_amount': Decimal(0), 'refunds_count': 0, 'refund_amount': Decimal(0),
+                           'cash_sales': Decimal(0), 'mpesa_sales': Decimal(0), 'mpesa_count': 0,
+                           'active_tills': 0}
+        return totals[key]
+
+    sale_day = func.date(Sale.created_at)
+    counted = Sale.status.in_(['completed', 'partially_refunded', 'refunded'])
+    is_cash = Sale.payment_method == 'cash'
+    is_mpesa = Sale.payment_method == 'mpesa'
+    sales_query = select(Sale.shop_id, sale_day, func.count(Sale.id),
+                         func.sum(Sale.total_amount), func.sum(Sale.tax_amount),
+                         func.sum(case((is_cash, Sale.total_amount), else_=0)),
+                         func.sum(case((is_mpesa, Sale.total_amount), else_=0)),
+                         func.sum(case((is_mpesa, 1), else_=0)),
+                         func.count(func.distinct(Sale.cashier_id))
+                         ).where(counted).group_by(Sale.shop_id, sale_day)
+    tills_query = select(Sale.shop_id, sale_day, Sale.cashier_id).where(counted).distinct()
+    items_query = select(Sale.shop_id, sale_day, func.sum(SaleItem.quantity)
+                         ).join(SaleItem, SaleItem.sale_id == Sale.id
+                         ).where(counted).group_by(Sale.shop_id, sale_day)
+    refund_day = func.date(Refund.created_at)
+    refunds_query = select(Refund.shop_id, refund_day, func.count(Refund.id), func.sum(Refund.amount)
+                           ).group_by(Refund.shop_id, refund_day)
+    # Sales refunded before refunds were recorded individually
+    legacy_refunds_query = select(Sale.shop_id, sale_day, func.count(Sale.id), func.sum(Sale.total_amount)
+                                  ).where(Sale.status == 'refunded',
+                                          ~select(Refund.id).where(Refund.sale_id == Sale.id).exists()
+                                  ).group_by(Sale.shop_id, sale_day)
+
+    if shop_id is not None:
+        sales_query = sales_query.where(Sale.shop_id == shop_id)
+        items_query = items_query.where(Sale.shop_id == shop_id)
+        refunds_query = refunds_query.where(Refund.shop_id == shop_id)
+        legacy_refunds_query = legacy_refunds_query.where(Sale.shop_id == shop_id)
+        tills_query = tills_query.where(Sale.shop_id == shop_id)
+
+    for row_shop_id, day, count, gross, tax, cash, mpesa, mpesa_count, tills in db.session.execute(sales_query):
+        row = bucket(row_shop_id, day)
+        row['sales_count'] += count
+        row['gross_sales'] += Decimal(gross or 0)
+        row['tax_amount'] += Decimal(tax or 0)
+        row['cash_sales'] += Decimal(cash or 0)
+        row['mpesa_sales'] += Decimal(mpesa or 0)
+        row['mpesa_count'] += int(mpesa_count or 0)
+        row['active_tills'] += tills
+    for row_shop_id, day, quantity in db.session.execute(items_query):
+        bucket(row_shop_id, day)['items_sold'] += int(quantity or 0)
+    for query in (refunds_query, legacy_refunds_query):
+        for row_shop_id, day, count, amount in db.session.execute(query):
+            row = bucket(row_shop_id, day)
+            row['refunds_count'] += count
+            row['refund_amount'] += Decimal(amount or 0)
+
+    clear = delete(ShopDailySales)
+    clear_tills = delete(ShopDailyTill)
+    if shop_id is not None:
+        clear = clear.where(ShopDailySales.shop_id == shop_id)
+        clear_tills = clear_tills.where(ShopDailyTill.shop_id == shop_id)
+    db.session.execute(clear)
+    db.session.execute(clear_tills)
+    if totals:
+        db.session.execute(insert(ShopDailySales), [
+            dict(values, shop_id=row_shop_id, date=day) for (row_shop_id, day), values in totals.items()
+        ])
+    tills = [{'shop_id': row_shop_id, 'date': bucket_date(day), 'cashier_id': cashier_id}
+             for row_shop_id, day, cashier_id in db.session.execute(tills_query)]
+    if tills:
+        db.session.execute(insert(ShopDailyTill), tills)
+    db.session.commit()
+
+    logging.info(f"Rebuilt {len(totals)} daily sales rollups")
+    return len(totals)
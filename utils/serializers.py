@@ -0,0 +1,106 @@
+"""
+JSON Serializers
+Typed response shapes compiled once into row -> dict functions and fed by
+narrow column selects, so API responses are built without ORM objects, and
+an orjson-backed JSON provider for Flask (used when orjson is installed)
+"""
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import select
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def as_float(value):
+    return float(value) if value is not None else None
+
+
+def as_timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value is not None else None
+
+
+def default_to(fallback):
+    """Converter that replaces empty values with fallback"""
+    def convert(value):
+        return value or fallback
+    return convert
+
+
+class Schema:
+    """A response shape: (key, column[, converter]) fields compiled into serializer functions.
+
+    dump_row() reads a row of schema.select() positionally; dump_object()
+    reads the same fields from an already loaded ORM object.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.keys = tuple(field[0] for field in fields)
+        self.columns = tuple(field[1] for field in fields)
+        self.converters = tuple(field[2] if len(field) > 2 else None for field in fields)
+        self.dump_row = self._compile('row', [f'row[{i}]' for i in range(len(fields))])
+        self.dump_object = self._compile(
+            'obj', [f'obj.{column.key}' if hasattr(column, 'class_') else None for column in self.columns])
+
+    def _compile(self, argument, accessors):
+        if None in accessors:
+            def unsupported(value):
+                raise TypeError(f'{self.name} has computed fields; serialize rows from select()')
+            return unsupported
+
+        namespace = {}
+        items = []
+        for i, (key, accessor, converter) in enumerate(zip(self.keys, accessors, self.converters)):
+            if converter is not None:
+                namespace[f'convert_{i}'] = converter
+                accessor = f'convert_{i}({accessor})'
+            items.append(f'{key!r}: {accessor}')
+        source = f"def dump_{argument}({argument}):\n    return {{{', '.join(items)}}}\n"
+        exec(compile(source, f'<schema {self.name}>', 'exec'), namespace)
+        return namespace[f'dump_{argument}']
+
+    def select(self):
+        """SELECT of exactly this schema's columns, in field order"""
+        return select(*self.columns)
+
+    def dump_all(self, rows):
+        dump_row = self.dump_row
+        return [dump_row(row) for row in rows]
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; output matches the default provider's types.
+
+    Dates keep Flask's HTTP-date format and Decimals become strings, both via
+    DefaultJSONProvider.default.
+    """
+
+    def _options(self):
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        data = orjson.dumps(obj, default=self.default, option=self._options())
+        return self._app.response_class(data, mimetype=self.mimetype)
+
+
+def init_json_provider(app):
+    """Serialize JSON with orjson when it is installed"""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
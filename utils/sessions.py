@@ -0,0 +1,129 @@
+"""
+Server-Side Sessions
+Keeps session data in a key-value store so the cookie only carries an opaque ID
+"""
+
+import logging
+import os
+import secrets
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from utils.kvstore import DatabaseStore, MemoryStore, get_redis_client, get_store, set_store
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict that tracks modification and its store ID"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Issue a new session ID (call on login to prevent session fixation)"""
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = ServerSideSessionInterface.generate_sid()
+        self.new = True
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface storing session data server-side"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def generate_sid():
+        return secrets.token_urlsafe(32)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                try:
+                    return ServerSideSession(self.serializer.loads(data), sid=sid)
+                except ValueError:
+                    logging.warning("Discarding unreadable session data")
+
+        return ServerSideSession(sid=self.generate_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            # Session was emptied (e.g. logout): drop it server-side and client-side
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       httponly=self.get_cookie_httponly(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.modified:
+            ttl = int(app.permanent_session_lifetime.total_seconds())
+            self.store.set(session.sid, self.serializer.dumps(dict(session)), ttl=ttl)
+
+        # The ID never changes for an existing session, so the cookie is only sent once
+        if session.new:
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def init_sessions(app):
+    """Install the configured session backend.
+
+    SESSION_BACKEND is 'redis' (shared between workers), 'database' (the
+    kv_entries table, shared between workers), 'memory' (in-process LRU,
+    single worker only) or 'cookie' (Flask's signed cookie, which carries the
+    session data itself). Defaults to 'redis' when REDIS_URL is set, otherwise
+    'database', so the cookie only ever holds an opaque ID unless 'cookie' is
+    chosen explicitly.
+    """
+    backend = os.environ.get('SESSION_BACKEND') or ('redis' if os.environ.get('REDIS_URL') else 'database')
+
+    if backend == 'cookie':
+        return
+    if backend == 'memory':
+        max_entries = int(os.environ.get('SESSION_MAX_ENTRIES', '10000'))
+        set_store('session', MemoryStore(max_entries=max_entries))
+    elif backend == 'redis' and get_redis_client() is None:
+        logging.warning("Redis session backend unavailable; storing sessions in the database")
+        backend = 'database'
+    elif backend not in ('redis', 'database'):
+        logging.warning(f"Unknown SESSION_BACKEND {backend!r}; storing sessions in the database")
+        backend = 'database'
+
+    if backend == 'database':
+        set_store('session', DatabaseStore('session'))
+
+    app.session_interface = ServerSideSessionInterface(get_store('session'))
+    logging.info(f"Using {backend} server-side sessions")
@@ -0,0 +1,208 @@
+"""
+Till Shifts
+Cashier shifts with running totals: every sale and refund adds to its shift
+with one UPDATE in the same transaction, so closing a shift and printing its
+Z-report read a single row however many sales were made
+"""
+
+import logging
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import bindparam, case, func, select, update
+from utils.sales import to_money
+
+# Running totals kept on each shift, rebuilt by rebuild_shift_totals
+TOTAL_COLUMNS = ('sales_count', 'items_sold', 'gross_sales', 'discount_amount', 'tax_amount',
+                 'cash_sales', 'mpesa_sales', 'mpesa_count', 'refunds_count', 'cash_refunds',
+                 'mpesa_refunds')
+
+
+def get_open_shift(shop_id, cashier_id):
+    from models import Shift
+
+    return Shift.query.filter_by(shop_id=shop_id, cashier_id=cashier_id, closed_at=None).first()
+
+
+def open_shift(shop_id, cashier_id, opening_float):
+    """Open a shift for a cashier; raises ValueError if one is already open"""
+    from app import db
+    from models import Shift
+
+    if get_open_shift(shop_id, cashier_id) is not None:
+        raise ValueError('You already have an open shift')
+    if opening_float < 0:
+        raise ValueError('Opening float cannot be negative')
+
+    # A concurrent open fails on the uq_shifts_open_cashier index at flush
+    shift = Shift(shop_id=shop_id, cashier_id=cashier_id, opening_float=to_money(opening_float),
+                  opened_at=datetime.utcnow())
+    db.session.add(shift)
+    db.session.flush()
+    return shift
+
+
+def record_shift_sale(sale, items_sold, at=None):
+    """Add a sale to its cashier's shift if one was open at `at` (default now).
+
+    Returns the shift id, or None. Run before the sale is flushed so its
+    shift_id is written with it.
+    """
+    from app import db
+    from models import Shift
+
+    table = Shift.__table__
+    total = to_money(sale.total_amount)
+    is_cash = sale.payment_method == 'cash'
+    is_mpesa = sale.payment_method == 'mpesa'
+    return db.session.execute(
+        update(table)
+        .where(table.c.shop_id == sale.shop_id, table.c.cashier_id == sale.cashier_id,
+               table.c.closed_at.is_(None), table.c.opened_at <= (at or datetime.utcnow()))
+        .values(sales_count=table.c.sales_count + 1,
+                items_sold=table.c.items_sold + items_sold,
+                gross_sales=table.c.gross_sales + total,
+                discount_amount=table.c.discount_amount + to_money(sale.discount_amount),
+                tax_amount=table.c.tax_amount + to_money(sale.tax_amount),
+                cash_sales=table.c.cash_sales + (total if is_cash else 0),
+                mpesa_sales=table.c.mpesa_sales + (total if is_mpesa else 0),
+                mpesa_count=table.c.mpesa_count + (1 if is_mpesa else 0))
+        .returning(table.c.id)
+    ).scalar()
+
+
+def record_shift_refund(sale, amount, user_id):
+    """Take a refund from the sale's shift if it is still open, else the refunding user's open shift.
+
+    Returns the shift id, or None when neither is open.
+    """
+    from app import db
+    from models import Shift
+
+    table = Shift.__table__
+    amount = to_money(amount)
+    values = dict(refunds_count=table.c.refunds_count + 1,
+                  cash_refunds=table.c.cash_refunds + (amount if sale.payment_method == 'cash' else 0),
+                  mpesa_refunds=table.c.mpesa_refunds + (amount if sale.payment_method == 'mpesa' else 0))
+
+    candidates = [table.c.id == sale.shift_id] if sale.shift_id else []
+    candidates.append((table.c.shop_id == sale.shop_id) & (table.c.cashier_id == user_id))
+    for condition in candidates:
+        shift_id = db.session.execute(
+            update(table).where(condition, table.c.closed_at.is_(None)).values(**values).returning(table.c.id)
+        ).scalar()
+        if shift_id is not None:
+            return shift_id
+    return None
+
+
+def close_shift(shift, counted_cash, user_id, notes=None):
+    """Close an open shift with the cash counted in the drawer; raises ValueError if already closed"""
+    from app import db
+    from models import Shift
+
+    if counted_cash < 0:
+        raise ValueError('Counted cash cannot be negative')
+
+    # Lock the row: sales committing meanwhile wait, then find the shift closed
+    db.session.execute(select(Shift.id).where(Shift.id == shift.id).with_for_update())
+    db.session.refresh(shift)
+    if shift.closed_at is not None:
+        raise ValueError('Shift is already closed')
+
+    shift.closed_at = datetime.utcnow()
+    shift.closed_by = user_id
+    shift.counted_cash = to_money(counted_cash)
+    shift.notes = notes or None
+    return shift
+
+
+def z_report(shift):
+    """Z-report figures for a shift, read from its running totals"""
+    refunds = (shift.cash_refunds or 0) + (shift.mpesa_refunds or 0)
+    return {
+        'shift_id': shift.id,
+        'cashier': shift.cashier.username if shift.cashier else '',
+        'opened_at': shift.opened_at,
+        'closed_at': shift.closed_at,
+        'sales_count': shift.sales_count,
+        'items_sold': shift.items_sold,
+        'gross_sales': shift.gross_sales,
+        'discount_amount': shift.discount_amount,
+        'tax_amount': shift.tax_amount,
+        'refunds_count': shift.refunds_count,
+        'refund_amount': refunds,
+        'net_sales': shift.gross_sales - refunds,
+        'cash_sales': shift.cash_sales,
+        'mpesa_sales': shift.mpesa_sales,
+        'mpesa_count': shift.mpesa_count,
+        'cash_refunds': shift.cash_refunds,
+        'mpesa_refunds': shift.mpesa_refunds,
+        'opening_float': shift.opening_float,
+        'expected_cash': shift.expected_cash,
+        'counted_cash': shift.counted_cash,
+        'cash_variance': shift.cash_variance,
+        'notes': shift.notes,
+    }
+
+
+def z_report_json(report):
+    """A Z-report with amounts as numbers and times in ISO format"""
+    def convert(value):
+        if isinstance(value, Decimal):
+            return float(value)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
+
+    return {key: convert(value) for key, value in report.items()}
+
+
+def rebuild_shift_totals(shift_id=None):
+    """Recompute shift totals from their sales and refunds (all shifts by default)"""
+    from app import db
+    from models import Refund, Sale, SaleItem, Shift
+
+    shift_ids = select(Shift.id)
+    if shift_id is not None:
+        shift_ids = shift_ids.where(Shift.id == shift_id)
+    totals = {row_id: dict.fromkeys(TOTAL_COLUMNS, 0) for row_id in db.session.execute(shift_ids).scalars()}
+    if not totals:
+        return 0
+
+    is_cash = Sale.payment_method == 'cash'
+    is_mpesa = Sale.payment_method == 'mpesa'
+    sales_query = select(Sale.shift_id, func.count(Sale.id), func.sum(Sale.total_amount),
+                         func.sum(func.coalesce(Sale.discount_amount, 0)), func.sum(func.coalesce(Sale.tax_amount, 0)),
+                         func.sum(case((is_cash, Sale.total_amount), else_=0)),
+                         func.sum(case((is_mpesa, Sale.total_amount), else_=0)),
+                         func.sum(case((is_mpesa, 1), else_=0))
+                         ).where(Sale.shift_id.in_(totals)).group_by(Sale.shift_id)
+    items_query = select(Sale.shift_id, func.sum(SaleItem.quantity)
+                         ).join(SaleItem, SaleItem.sale_id == Sale.id
+                         ).where(Sale.shift_id.in_(totals)).group_by(Sale.shift_id)
+    refunds_query = select(Refund.shift_id, func.count(Refund.id),
+                           func.sum(case((is_cash, Refund.amount), else_=0)),
+                           func.sum(case((is_mpesa, Refund.amount), else_=0))
+                           ).join(Sale, Sale.id == Refund.sale_id
+                           ).where(Refund.shift_id.in_(totals)).group_by(Refund.shift_id)
+
+    for row_id, count, gross, discount, tax, cash, mpesa, mpesa_count in db.session.execute(sales_query):
+        totals[row_id].update(sales_count=count, gross_sales=to_money(gross), discount_amount=to_money(discount),
+                              tax_amount=to_money(tax), cash_sales=to_money(cash), mpesa_sales=to_money(mpesa),
+                              mpesa_count=int(mpesa_count or 0))
+    for row_id, quantity in db.session.execute(items_query):
+        totals[row_id]['items_sold'] = int(quantity or 0)
+    for row_id, count, cash, mpesa in db.session.execute(refunds_query):
+        totals[row_id].update(refunds_count=count, cash_refunds=to_money(cash), mpesa_refunds=to_money(mpesa))
+
+    table = Shift.__table__
+    db.session.execute(
+        update(table).where(table.c.id == bindparam('row_id'))
+        .values({column: bindparam(f'new_{column}') for column in TOTAL_COLUMNS}),
+        [dict({f'new_{column}': value for column, value in values.items()}, row_id=row_id)
+         for row_id, values in totals.items()]
+    )
+    db.session.commit()
+
+    logging.info(f"Rebuilt totals for {len(totals)} shifts")
+    return len(totals)
@@ -0,0 +1,351 @@
+"""
+Stock History
+Point-in-time stock levels, valuation and shrinkage from daily stock snapshots
+plus the stock movement ledger, and a batched ledger drift checker
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import and_, case, delete, func, insert, or_, select
+
+
+def get_snapshot_settings():
+    """Get stock snapshot configuration from the environment"""
+    return {
+        'daily_retention_days': int(os.environ.get('STOCK_SNAPSHOT_DAILY_RETENTION_DAYS', '90')),
+    }
+
+
+def signed_quantity():
+    """Ledger quantity with outgoing movements negated"""
+    from models import StockMovement
+
+    return case((StockMovement.movement_type == 'out', -StockMovement.quantity),
+                else_=StockMovement.quantity)
+
+
+def snapshot_cutoff(day):
+    """Instant a snapshot for day was taken at (the start of the next day)"""
+    return datetime(day.year, day.month, day.day) + timedelta(days=1)
+
+
+def start_of_day(day):
+    """Accept a date (meaning the start of that day) or a datetime"""
+    if isinstance(day, datetime):
+        return day
+    return datetime(day.year, day.month, day.day)
+
+
+def end_of_day(day):
+    """Accept a date (meaning the end of that day) or a datetime"""
+    if isinstance(day, datetime):
+        return day
+    return snapshot_cutoff(day)
+
+
+def movement_totals(shop_id, start=None, end=None, product_ids=None):
+    """Sum signed movements per product for a shop in [start, end)"""
+    from app import db
+    from models import Product, StockMovement
+
+    query = select(StockMovement.product_id, func.sum(signed_quantity())).join(
+        Product, Product.id == StockMovement.product_id
+    ).where(Product.shop_id == shop_id).group_by(StockMovement.product_id)
+
+    if start is not None:
+        query = query.where(StockMovement.created_at >= start)
+    if end is not None:
+        query = query.where(StockMovement.created_at < end)
+    if product_ids is not None:
+        query = query.where(StockMovement.product_id.in_(product_ids))
+
+    return {product_id: int(total or 0) for product_id, total in db.session.execute(query)}
+
+
+def nearest_snapshot_dates(shop_id, at):
+    """Latest snapshot taken at or before `at` and earliest taken after it"""
+    from app import db
+    from models import StockSnapshot
+
+    last_before = (at - timedelta(days=1)).date()
+    before = db.session.execute(
+        select(func.max(StockSnapshot.date)).where(StockSnapshot.shop_id == shop_id,
+                                                   StockSnapshot.date <= last_before)
+    ).scalar()
+    after = db.session.execute(
+        select(func.min(StockSnapshot.date)).where(StockSnapshot.shop_id == shop_id,
+                                                   StockSnapshot.date > last_before)
+    ).scalar()
+    return before, after
+
+
+def load_snapshot(shop_id, day, product_ids=None):
+    """Load {product_id: (quantity, cost_price)} for a shop's snapshot day"""
+    from app import db
+    from models import StockSnapshot
+
+    query = select(StockSnapshot.product_id, StockSnapshot.quantity, StockSnapshot.cost_price).where(
+        StockSnapshot.shop_id == shop_id, StockSnapshot.date == day
+    )
+    if product_ids is not None:
+        query = query.where(StockSnapshot.product_id.in_(product_ids))
+    return {product_id: (quantity, cost) for product_id, quantity, cost in db.session.execute(query)}
+
+
+def stock_levels_at(shop_id, at, product_ids=None):
+    """Stock of every product in a shop at an instant: {product_id: (quantity, cost_price)}.
+
+    Starts from whichever checkpoint is nearest in time (the last snapshot
+    before, the first snapshot after, or the live stock_quantity) and replays
+    only the movements between that checkpoint and `at`.
+    """
+    from app import db
+    from models import Product
+
+    at = end_of_day(at)
+    now = datetime.utcnow()
+    before, after = nearest_snapshot_dates(shop_id, at)
+
+    products_query = select(Product.id, Product.stock_quantity, Product.cost_price, Product.created_at).where(
+        Product.shop_id == shop_id
+    )
+    if product_ids is not None:
+        products_query = products_query.where(Product.id.in_(product_ids))
+    products = db.session.execute(products_query).all()
+
+    forward_distance = at - snapshot_cutoff(before) if before else None
+    backward_checkpoint = min(snapshot_cutoff(after), now) if after else now
+    backward_distance = abs(backward_checkpoint - at)
+
+    levels = {}
+    pending = {product_id for product_id, _, _, _ in products}
+
+    if forward_distance is not None and forward_distance <= backward_distance:
+        snapshot = load_snapshot(shop_id, before, product_ids)
+        tail = movement_totals(shop_id, snapshot_cutoff(before), at, product_ids)
+        for product_id in list(pending):
+            if product_id in snapshot:
+                quantity, cost = snapshot[product_id]
+                levels[product_id] = (quantity + tail.get(product_id, 0), cost)
+                pending.discard(product_id)
+    elif after and snapshot_cutoff(after) < now:
+        snapshot = load_snapshot(shop_id, after, product_ids)
+        tail = movement_totals(shop_id, at, snapshot_cutoff(after), product_ids)
+        for product_id in list(pending):
+            if product_id in snapshot:
+                quantity, cost = snapshot[product_id]
+                levels[product_id] = (quantity - tail.get(product_id, 0), cost)
+                pending.discard(product_id)
+
+    if pending:
+        # Replay backwards from the live stock level
+        tail = movement_totals(shop_id, at, None, pending if product_ids is not None else None)
+        for product_id, stock, cost, created_at in products:
+            if product_id not in pending:
+                continue
+            if created_at and created_at >= at:
+                levels[product_id] = (0, cost)
+            else:
+                levels[product_id] = ((stock or 0) - tail.get(product_id, 0), cost)
+
+    return levels
+
+
+def stock_valuation(shop_id, at):
+    """Total stock and cost valuation of a shop at an instant, with a per-category breakdown"""
+    from app import db
+    from models import Category, Product
+
+    levels = stock_levels_at(shop_id, at)
+    categories = dict(db.session.execute(
+        select(Product.id, func.coalesce(Category.name, 'Uncategorized'))
+        .outerjoin(Category, Category.id == Product.category_id)
+        .where(Product.shop_id == shop_id)
+    ).all())
+
+    total_quantity = 0
+    total_value = Decimal(0)
+    by_category = {}
+    for product_id, (quantity, cost) in levels.items():
+        value = Decimal(cost or 0) * max(quantity, 0)
+        total_quantity += quantity
+        total_value += value
+        category = by_category.setdefault(categories.get(product_id, 'Uncategorized'),
+                                          {'quantity': 0, 'value': Decimal(0)})
+        category['quantity'] += quantity
+        category['value'] += value
+
+    return {
+        'as_of': end_of_day(at),
+        'products': len(levels),
+        'total_quantity': total_quantity,
+        'total_value': total_value,
+        'by_category': by_category,
+    }
+
+
+def shrinkage(shop_id, start, end):
+    """Stock lost to manual write-downs and negative adjustments between two dates (inclusive)"""
+    from app import db
+    from models import Product, StockMovement
+
+    losses = or_(
+        and_(StockMovement.movement_type == 'out', StockMovement.reference == 'manual_adjustment'),
+        and_(StockMovement.movement_type == 'adjustment', StockMovement.quantity < 0),
+    )
+    rows = db.session.execute(
+        select(Product.id, Product.name, Product.cost_price,
+               func.sum(func.abs(StockMovement.quantity)))
+        .join(StockMovement, StockMovement.product_id == Product.id)
+        .where(Product.shop_id == shop_id, losses,
+               StockMovement.created_at >= start_of_day(start),
+               StockMovement.created_at < end_of_day(end))
+        .group_by(Product.id, Product.name, Product.cost_price)
+        .order_by(func.sum(func.abs(StockMovement.quantity) * Product.cost_price).desc())
+    ).all()
+
+    products = [{
+        'product_id': product_id,
+        'name': name,
+        'quantity': int(quantity),
+        'value': Decimal(cost or 0) * int(quantity),
+    } for product_id, name, cost, quantity in rows]
+
+    return {
+        'total_quantity': sum(p['quantity'] for p in products),
+        'total_value': sum((p['value'] for p in products), Decimal(0)),
+        'products': products,
+    }
+
+
+def take_daily_snapshots(day=None, shop_id=None):
+    """Record end-of-day stock for every product (yesterday by default); returns rows written"""
+    from app import db
+    from models import Shop, StockSnapshot
+
+    day = day or (datetime.utcnow() - timedelta(days=1)).date()
+    shop_ids = [shop_id] if shop_id else db.session.execute(select(Shop.id)).scalars().all()
+
+    written = 0
+    for current_shop_id in shop_ids:
+        levels = stock_levels_at(current_shop_id, day)
+        db.session.execute(delete(StockSnapshot).where(StockSnapshot.shop_id == current_shop_id,
+                                                       StockSnapshot.date == day))
+        if levels:
+            now = datetime.utcnow()
+            db.session.execute(insert(StockSnapshot), [{
+                'shop_id': current_shop_id,
+                'product_id': product_id,
+                'date': day,
+                'quantity': quantity,
+                'cost_price': cost,
+                'created_at': now,
+            } for product_id, (quantity, cost) in levels.items()])
+        db.session.commit()
+        written += len(levels)
+
+    prune_snapshots()
+    logging.info(f"Took {written} stock snapshots for {day}")
+    return written
+
+
+def prune_snapshots(today=None):
+    """Drop daily snapshots past retention, keeping month-end snapshots"""
+    from app import db
+    from models import StockSnapshot
+
+    today = today or datetime.utcnow().date()
+    cutoff = today - timedelta(days=get_snapshot_settings()['daily_retention_days'])
+
+    old_days = db.session.execute(
+        select(StockSnapshot.date).where(StockSnapshot.date < cutoff).distinct()
+    ).scalars().all()
+    expired = [day for day in old_days if (day + timedelta(days=1)).month == day.month]
+    if expired:
+        db.session.execute(delete(StockSnapshot).where(StockSnapshot.date.in_(expired)))
+        db.session.commit()
+    return len(expired)
+
+
+def check_stock_drift(shop_id=None, batch_size=5000, fix=False, user_id=None):
+    """Compare the ledger with Product.stock_quantity in batches of products.
+
+    The ledger level is the latest snapshot plus the movements since it, or
+    the sum of all movements when a product has no snapshot. With fix=True an
+    'adjustment' movement is written so the ledger matches the product again.
+    Returns a list of drifted products.
+    """
+    from app import db
+    from models import Product, StockMovement, StockSnapshot
+
+    drifted = []
+    last_id = 0
+    while True:
+        query = select(Product.id, Product.shop_id, Product.name, Product.stock_quantity).where(
+            Product.id > last_id
+        ).order_by(Product.id).limit(batch_size)
+        if shop_id:
+            query = query.where(Product.shop_id == shop_id)
+        batch = db.session.execute(query).all()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        ids = [row[0] for row in batch]
+
+        latest = select(StockSnapshot.product_id, func.max(StockSnapshot.date).label('date')).where(
+            StockSnapshot.product_id.in_(ids)
+        ).group_by(StockSnapshot.product_id).subquery()
+        snapshots = {
+            product_id: (day, quantity)
+            for product_id, day, quantity in db.session.execute(
+                select(StockSnapshot.product_id, StockSnapshot.date, StockSnapshot.quantity)
+                .join(latest, and_(latest.c.product_id == StockSnapshot.product_id,
+                                   latest.c.date == StockSnapshot.date))
+            )
+        }
+
+        # Movements after each product's snapshot (or all of them without one),
+        # one grouped query per distinct snapshot day
+        by_day = {}
+        for product_id in ids:
+            day = snapshots[product_id][0] if product_id in snapshots else None
+            by_day.setdefault(day, []).append(product_id)
+
+        ledger = {product_id: snapshots[product_id][1] if product_id in snapshots else 0 for product_id in ids}
+        for day, product_ids in by_day.items():
+            query = select(StockMovement.product_id, func.sum(signed_quantity())).where(
+                StockMovement.product_id.in_(product_ids)
+            ).group_by(StockMovement.product_id)
+            if day is not None:
+                query = query.where(StockMovement.created_at >= snapshot_cutoff(day))
+            for product_id, total in db.session.execute(query):
+                ledger[product_id] += int(total or 0)
+
+        corrections = []
+        for product_id, product_shop_id, name, stock in batch:
+            difference = (stock or 0) - ledger[product_id]
+            if difference:
+                drifted.append({'product_id': product_id, 'shop_id': product_shop_id, 'name': name,
+                                'stock_quantity': stock or 0, 'ledger_quantity': ledger[product_id],
+                                'difference': difference})
+                corrections.append({'product_id': product_id, 'movement_type': 'adjustment',
+                                    'quantity': difference, 'reference': 'drift_correction',
+                                    'notes': f'Ledger drift correction ({ledger[product_id]} -> {stock or 0})',
+                                    'created_by': user_id, 'created_at': datetime.utcnow()})
+
+        if fix and corrections:
+            db.session.execute(insert(StockMovement), corrections)
+            db.session.commit()
+
+    logging.info(f"Stock drift check found {len(drifted)} products out of line with the ledger")
+    return drifted
+
+
+def parse_date(value, default=None):
+    """Parse a YYYY-MM-DD request argument"""
+    if not value:
+        return default
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
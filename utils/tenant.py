@@ -0,0 +1,80 @@
+"""
+Tenant Context
+The signed-in user, their shop, the shop's settings and license state,
+loaded at most once per request and shared by decorators and views via flask.g
+"""
+
+from flask import g, session
+
+_UNSET = object()
+
+
+class TenantContext:
+    """Identity of the current request; user and shop load lazily, once each"""
+
+    def __init__(self, user_id, shop_id, role, impersonating=False):
+        self.user_id = user_id
+        self.shop_id = shop_id
+        self.role = role
+        self.impersonating = impersonating
+        self._user = _UNSET
+        self._shop = _UNSET
+        self._cashier_settings = None
+        self._license_active = None
+
+    @property
+    def user(self):
+        if self._user is _UNSET:
+            from app import db
+            from models import User
+            self._user = db.session.get(User, self.user_id) if self.user_id else None
+        return self._user
+
+    @property
+    def shop(self):
+        if self._shop is _UNSET:
+            from app import db
+            from models import Shop
+            self._shop = db.session.get(Shop, self.shop_id) if self.shop_id else None
+        return self._shop
+
+    @property
+    def settings(self):
+        """The shop's settings (empty without a shop)"""
+        shop = self.shop
+        return shop.settings or {} if shop else {}
+
+    @property
+    def cashier_settings(self):
+        """The user's cashier preferences, defaults filled in"""
+        if self._cashier_settings is None:
+            from utils.user_settings import get_cashier_settings
+            self._cashier_settings = get_cashier_settings(self.user_id)
+        return self._cashier_settings
+
+    @property
+    def license_active(self):
+        """Whether the shop may trade, from the cached license flag.
+
+        On a cache miss the flag is worked out from the shop this request loads
+        anyway, so a cold cache costs no extra query.
+        """
+        if self._license_active is None:
+            from utils.licenses import cache_license_flag, get_cached_license, license_state
+            active = get_cached_license(self.shop_id) if self.shop_id else False
+            if active is None:
+                shop = self.shop
+                active = license_state(shop)
+                cache_license_flag(self.shop_id, active, shop.license_expires if shop else None)
+            self._license_active = active
+        return self._license_active
+
+
+def get_tenant():
+    """The current request's TenantContext, built from the session on first use"""
+    tenant = g.get('tenant')
+    if tenant is None or tenant.user_id != session.get('user_id'):
+        tenant = TenantContext(session.get('user_id'), session.get('shop_id'),
+                               session.get('role'), bool(session.get('impersonating')))
+        g.tenant = tenant
+    return tenant
@@ -0,0 +1,73 @@
+"""
+User Settings
+Per-user cashier preferences persisted on the user record, cached when
+the store is shared between workers
+"""
+
+import json
+from utils.kvstore import get_store
+
+SETTINGS_CACHE_TTL = 300
+
+DEFAULT_CASHIER_SETTINGS = {
+    'theme': 'light',
+    'language': 'en',
+    'default_printer': '',
+    'receipt_width': '80mm',
+    'screen_mode': 'windowed',
+    'auto_logout_time': '300',
+    'network_mode': 'online',
+    'time_zone': 'Africa/Nairobi',
+    'startup_behavior': 'new_sale',
+    'default_payment_mode': 'mpesa',
+    'sound_volume': '75',
+    'auto_receipt': False,
+    'touchscreen_mode': False,
+    'auto_lock_pos': False,
+    'enable_beep_on_scan': False,
+    'payment_sounds': False,
+    'error_sounds': False,
+    'keyboard_shortcuts': False,
+    'auto_focus': False,
+    'quick_add': False,
+    'auto_update': False,
+    'show_welcome_screen': False,
+    'scanner_prefix': '',
+    'scanner_suffix': ''
+}
+
+
+def get_cashier_settings(user_id):
+    """Get a user's cashier settings (defaults filled in).
+
+    Cached only in a shared store: a save clears the cache of the worker that
+    handled it, so a per-process copy would go stale in every other worker.
+    Without one, the user is read through the session's identity map, which
+    costs nothing when the request has already loaded them.
+    """
+    from app import db
+    from models import User
+
+    cache = get_store('user_settings')
+    if cache.shared:
+        cached = cache.get(str(user_id))
+        if cached is not None:
+            return json.loads(cached)
+
+    user = db.session.get(User, user_id)
+    settings = dict(DEFAULT_CASHIER_SETTINGS)
+    if user and user.settings:
+        settings.update(user.settings)
+
+    if cache.shared:
+        cache.set(str(user_id), json.dumps(settings), ttl=SETTINGS_CACHE_TTL)
+    return settings
+
+
+def save_cashier_settings(user, settings):
+    """Persist a user's cashier settings and invalidate the cache"""
+    from app import db
+
+    user.settings = dict(settings)
+    db.session.commit()
+    get_store('user_settings').delete(str(user.id))